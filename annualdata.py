@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+"""
+Ten-year fundamentals stored in TickerAnnualData
+
+AnnualDataStore answers /tenyeardata from the database and only runs the
+fetch script when a ticker has no row or its newest row is more than
+max_age seconds old.  A row is (ticker, year, data, updated): the
+ten-year text as fetched during fiscal year `year`, and when it was
+fetched.  Freshness goes by `updated` alone, so the turn of the year
+does not send every ticker back to the fetch script at once; the first
+refresh in a new year adds that year's row.
+
+Reads go through the store: fresh rows are served directly, stale rows
+are served while a background refresh fetches a new copy, and missing
+rows are fetched on the spot.  Fetched data is written behind: queued in
+memory, visible to reads straight away, and flushed to the table in
+batches with one upsert per batch.  close() flushes what is still
+queued; the server calls it on shutdown.  A fetch that comes back empty
+or with an error message instead of data raises FetchError and is not
+stored; a flush that fails is logged and tried again a flush_interval
+later, the rows staying queued.
+
+    python annualdata.py warm tickers.txt [--batch_size=50]
+
+loads a ticker universe into the table ahead of time.
+"""
+
+import asyncio
+import logging
+import time
+
+from fetchers import FetchError
+
+
+UPSERT = {
+    "mysql": "INSERT INTO TickerAnnualData (ticker, year, data, updated) "
+             "VALUES (%s, %s, %s, %s) ON DUPLICATE KEY UPDATE "
+             "data = VALUES(data), updated = VALUES(updated)",
+    "sqlite": "INSERT INTO TickerAnnualData (ticker, year, data, updated) "
+              "VALUES (%s, %s, %s, %s) ON CONFLICT (ticker, year) DO UPDATE "
+              "SET data = excluded.data, updated = excluded.updated",
+}
+
+# what the fetch script prints when it fails instead of data
+ERROR_PREFIXES = ("Traceback", "Error", "error")
+
+
+def _usable(data):
+    """Whether fetched text is ten-year data rather than a failure"""
+    return isinstance(data, str) and data.strip() != "" and \
+        not data.lstrip().startswith(ERROR_PREFIXES)
+
+
+class AnnualDataStore:
+    """
+    Read-through, write-behind access to TickerAnnualData.
+
+    db is a dbpool.ConnectionPool, or anything else with its coroutine
+    query and executemany taking %s placeholders.  fetch is a coroutine
+    function returning the ten-year text for a ticker.
+    """
+
+    def __init__(self, db, fetch, max_age=7 * 86400, flush_interval=5.0,
+                 batch_size=200, dialect="mysql", clock=time.time):
+        self.db = db
+        self.fetch = fetch
+        self.max_age = max_age
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.upsert = UPSERT[dialect]
+        self.clock = clock
+        self.pending = {}       # ticker -> (data, updated, year)
+        self.refreshing = {}    # ticker -> Task
+        self.flusher = None     # flush started by a full batch
+        self.timer = None       # flush waiting out flush_interval
+        self.flush_lock = None
+
+    def year(self):
+        return time.strftime("%Y", time.gmtime(self.clock()))
+
+    def _stale(self, updated):
+        return self.clock() - updated > self.max_age
+
+    async def _select(self, tickers):
+        """ticker -> (data, updated) of the newest row of each ticker"""
+        rows = await self.db.query(
+            "SELECT ticker, data, updated FROM TickerAnnualData "
+            "WHERE ticker IN (%s)" % ", ".join(["%s"] * len(tickers)),
+            *tickers)
+        newest = {}
+        for row in rows:
+            found = newest.get(row["ticker"])
+            if found is None or row["updated"] > found[1]:
+                newest[row["ticker"]] = (row["data"], row["updated"])
+        return newest
+
+    async def get(self, ticker):
+        """The ten-year text for ticker"""
+        ticker = ticker.upper()
+        row = self.pending.get(ticker)
+        if row is None:
+            row = (await self._select([ticker])).get(ticker)
+        if row is None:
+            return await self.refresh(ticker)
+        data, updated = row[:2]
+        if self._stale(updated):
+            self._refresh_later(ticker)
+        return data
+
+    async def refresh(self, ticker):
+        """Fetches ticker now, sharing the fetch with concurrent callers"""
+        ticker = ticker.upper()
+        task = self.refreshing.get(ticker)
+        if task is None:
+            task = self.refreshing[ticker] = asyncio.ensure_future(
+                self._refresh(ticker))
+        return await asyncio.shield(task)
+
+    async def _refresh(self, ticker):
+        try:
+            data = await self.fetch(ticker)
+        finally:
+            del self.refreshing[ticker]
+        if not _usable(data):
+            raise FetchError("No ten-year data for %s: %r"
+                             % (ticker, (data or "")[:80]))
+        self.pending[ticker] = (data, int(self.clock()), self.year())
+        self._schedule_flush()
+        return data
+
+    def _refresh_later(self, ticker):
+        if ticker in self.refreshing:
+            return
+        task = asyncio.ensure_future(self.refresh(ticker))
+        task.add_done_callback(self._log_failure)
+
+    @staticmethod
+    def _log_failure(task):
+        if not task.cancelled() and task.exception() is not None:
+            logging.warning("Ten-year data refresh failed: %s",
+                            task.exception())
+
+    def _schedule_flush(self):
+        if len(self.pending) >= self.batch_size:
+            # a running flush keeps going until the queue is empty
+            if self.flusher is None or self.flusher.done():
+                self.flusher = asyncio.ensure_future(self.flush())
+                self.flusher.add_done_callback(self._flush_failed)
+        else:
+            self._flush_soon()
+
+    def _flush_soon(self):
+        if self.timer is None or self.timer.done():
+            self.timer = asyncio.ensure_future(self._flush_later())
+            self.timer.add_done_callback(self._flush_failed)
+
+    def _flush_failed(self, task):
+        """Logs a background flush failure and tries again later"""
+        if task.cancelled() or task.exception() is None:
+            return
+        logging.warning("Ten-year data flush failed, %d rows queued: %s",
+                        len(self.pending), task.exception())
+        if self.pending:
+            # wait out flush_interval even if a full batch is queued
+            self._flush_soon()
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        await self.flush()
+
+    async def flush(self):
+        """Writes the queued rows, batch_size at a time"""
+        if self.flush_lock is None:
+            self.flush_lock = asyncio.Lock()
+        async with self.flush_lock:
+            await self._flush()
+
+    async def _flush(self):
+        while self.pending:
+            batch = []
+            for ticker in list(self.pending)[:self.batch_size]:
+                data, updated, year = self.pending[ticker]
+                batch.append((ticker, year, data, updated))
+            await self.db.executemany(self.upsert, batch)
+            for ticker, year, data, updated in batch:
+                # drop only what was written; a newer fetch stays queued
+                if self.pending.get(ticker) == (data, updated, year):
+                    del self.pending[ticker]
+
+    async def warm(self, tickers, batch_size=50):
+        """
+        Makes sure every ticker has a fresh row, one batch at a time: one
+        query finds the batch's fresh rows, the rest are fetched side by
+        side and written in one upsert.  Returns (fresh, fetched, failed).
+        """
+        tickers = [t.upper() for t in tickers]
+        fresh = fetched = failed = 0
+        for i in range(0, len(tickers), batch_size):
+            batch = tickers[i:i + batch_size]
+            rows = await self._select(batch)
+            todo = [t for t in batch
+                    if t not in rows or self._stale(rows[t][1])]
+            fresh += len(batch) - len(todo)
+            results = await asyncio.gather(
+                *[self.refresh(t) for t in todo],
+                return_exceptions=True)
+            for ticker, result in zip(todo, results):
+                if isinstance(result, Exception):
+                    failed += 1
+                    logging.warning("Could not fetch %s: %s", ticker, result)
+                else:
+                    fetched += 1
+            await self.flush()
+        return fresh, fetched, failed
+
+    async def close(self):
+        if self.timer is not None:
+            self.timer.cancel()
+        await self.flush()
+
+
+def main():
+    import os
+    from tornado.options import define, options, parse_command_line
+    import dbpool
+    import fetchers
+
+    define("mysql_host", default="127.0.0.1:3306", help="database host")
+    define("mysql_database", default="aspiringinvestments",
+           help="database name")
+    define("mysql_user", default="ai", help="database user")
+    define("mysql_password", default="ai", help="database password")
+    define("fetch_workers", default=8, help="threads for market data fetches",
+           type=int)
+    define("batch_size", default=50, help="tickers per warm-up batch",
+           type=int)
+    args = parse_command_line()
+    if len(args) != 2 or args[0] != "warm":
+        raise SystemExit("usage: annualdata.py warm TICKERFILE [options]")
+    with open(args[1]) as f:
+        tickers = [line.strip() for line in f
+                   if line.strip() and not line.startswith("#")]
+
+    db = dbpool.mysql_pool(options.mysql_host, options.mysql_database,
+                           options.mysql_user, options.mysql_password, size=1)
+    fetcher = fetchers.TickerFetcher(
+        fetchers.ScriptSource(os.path.join(os.path.dirname(__file__), "util")),
+        max_workers=options.fetch_workers)
+    store = AnnualDataStore(db, fetcher.ten_year_data)
+
+    async def warm():
+        start = time.time()
+        fresh, fetched, failed = await store.warm(tickers, options.batch_size)
+        await store.close()
+        logging.info("%d tickers: %d already fresh, %d fetched, %d failed "
+                     "in %.1fs", len(tickers), fresh, fetched, failed,
+                     time.time() - start)
+
+    asyncio.run(warm())
+    db.close()
+    fetcher.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+"""
+Fan-out benchmark for one collaboration session: the /updates long poll
+versus the /socket WebSocket.
+
+A local Tornado server holds one pubsub.MessageMixin channel with
+--clients listeners, all on the long poll or all on the WebSocket.  The
+listeners are spread over --client-procs processes, so decoding on the
+client side does not hold up the server.  A publisher posts to
+/broadcast back to back for --seconds.  Each message carries the time
+it was sent, which gives the fan-out latency from broadcast to each
+listener.  Messages/s counts deliveries: one message reaching one
+listener.  Wakeups/s counts responses and frames: how often a listener
+was woken, however many messages each carried.  --burst sends that many
+broadcasts at once each round, as a paste or fill-down does, and
+--window-ms sets the channel's batch window.
+
+    python benchmarks/bench_collab.py [--clients 500] [--seconds 5]
+                                      [--payload 0] [--burst 1]
+                                      [--window-ms 0]
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import sys
+import time
+import urllib.parse
+import uuid
+
+import tornado.escape
+import tornado.httpclient
+import tornado.httpserver
+import tornado.netutil
+import tornado.web
+import tornado.websocket
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import pubsub
+
+
+class BroadcastHandler(tornado.web.RequestHandler):
+    def post(self):
+        message = dict(id=str(uuid.uuid4()), type="execute",
+                       data=self.get_argument("data"), html="<div></div>")
+        self.application.channel.new_messages([message])
+        self.finish(message)
+
+
+class UpdatesHandler(tornado.web.RequestHandler):
+    """MessageUpdateHandler on a future instead of @asynchronous"""
+
+    async def post(self):
+        waiter = asyncio.get_running_loop().create_future()
+        await self.application.channel.wait_for_messages(
+            waiter.set_result, cursor=self.get_argument("cursor", None))
+        batch = await waiter
+        self.set_header("Content-Type", "application/json; charset=UTF-8")
+        self.finish(batch.encoded)
+
+
+class SocketHandler(tornado.websocket.WebSocketHandler):
+    """MessageSocketHandler, receiving side"""
+
+    async def open(self):
+        await self.application.channel.subscribe(self.on_new_messages)
+
+    def on_new_messages(self, batch):
+        try:
+            self.write_message(batch.encoded)
+        except tornado.websocket.WebSocketClosedError:
+            pass
+
+    def on_close(self):
+        self.application.channel.unsubscribe(self.on_new_messages)
+
+
+def serve(port_queue, window):
+    async def run():
+        app = tornado.web.Application([
+            (r"/broadcast", BroadcastHandler),
+            (r"/updates", UpdatesHandler),
+            (r"/socket", SocketHandler)])
+        app.channel = pubsub.MessageMixin("BENCH", "", "",
+                                          batch_window=window / 1000.0)
+        sockets = tornado.netutil.bind_sockets(0, "127.0.0.1", backlog=2048)
+        tornado.httpserver.HTTPServer(app).add_sockets(sockets)
+        port_queue.put(sockets[0].getsockname()[1])
+        await asyncio.Event().wait()
+
+    asyncio.run(run())
+
+
+def record(messages, latencies, wakeups):
+    now = time.time()
+    wakeups.append(1)
+    latencies.extend(now - float(m["data"].split()[0]) for m in messages)
+
+
+DRAIN = 3   # seconds listeners wait after the last broadcast
+
+
+async def listen(transport, base, cursor, clients, seconds, ready, start):
+    latencies = []
+    wakeups = []
+    deadline = None
+
+    async def poller(client, cursor):
+        while time.time() < deadline:
+            body = urllib.parse.urlencode({"cursor": cursor} if cursor else {})
+            try:
+                response = await client.fetch(
+                    base + "/updates", method="POST", body=body,
+                    request_timeout=max(deadline - time.time(), 0.1))
+            except tornado.httpclient.HTTPClientError:
+                return
+            messages = tornado.escape.json_decode(response.body)["messages"]
+            record(messages, latencies, wakeups)
+            cursor = messages[-1]["id"]
+
+    async def subscriber(conn):
+        while True:
+            text = await conn.read_message()
+            if text is None:
+                return
+            record(tornado.escape.json_decode(text)["messages"], latencies,
+                   wakeups)
+
+    if transport == "longpoll":
+        client = tornado.httpclient.AsyncHTTPClient(max_clients=clients)
+        ready.release()
+        await asyncio.get_running_loop().run_in_executor(None, start.wait)
+        deadline = time.time() + seconds + DRAIN
+        # the last polls time out at the deadline
+        await asyncio.gather(*[poller(client, cursor)
+                               for _ in range(clients)])
+    else:
+        conns = [await tornado.websocket.websocket_connect(
+                    base.replace("http", "ws") + "/socket")
+                 for _ in range(clients)]
+        ready.release()
+        await asyncio.get_running_loop().run_in_executor(None, start.wait)
+        tasks = [asyncio.ensure_future(subscriber(conn)) for conn in conns]
+        await asyncio.sleep(seconds + DRAIN)
+        for conn in conns:
+            conn.close()
+        await asyncio.gather(*tasks)
+    return latencies, len(wakeups)
+
+
+def listener(transport, base, cursor, clients, seconds, ready, start,
+             results):
+    results.put(asyncio.run(listen(transport, base, cursor, clients,
+                                   seconds, ready, start)))
+
+
+async def broadcast(client, base, payload=0):
+    data = "%r %s" % (time.time(), "x" * payload)
+    response = await client.fetch(base + "/broadcast", method="POST",
+                                  body=urllib.parse.urlencode({"data": data}))
+    return tornado.escape.json_decode(response.body)["id"]
+
+
+async def publish(base, seconds, payload, burst):
+    client = tornado.httpclient.AsyncHTTPClient()
+    deadline = time.time() + seconds
+    sent = 0
+    while time.time() < deadline:
+        await asyncio.gather(*[broadcast(client, base, payload)
+                               for _ in range(burst)])
+        sent += burst
+    return sent
+
+
+def measure(transport, base, args):
+    ready = multiprocessing.Semaphore(0)
+    start = multiprocessing.Event()
+    results = multiprocessing.Queue()
+    # long polls start from here, so none misses the first broadcasts
+    cursor = asyncio.run(
+        broadcast(tornado.httpclient.AsyncHTTPClient(), base))
+    share = [args.clients // args.client_procs +
+             (n < args.clients % args.client_procs)
+             for n in range(args.client_procs)]
+    procs = [multiprocessing.Process(
+                target=listener, args=(transport, base, cursor, n,
+                                       args.seconds, ready, start, results))
+             for n in share if n]
+    for proc in procs:
+        proc.start()
+    for _ in procs:
+        ready.acquire()
+    start.set()
+    sent = asyncio.run(publish(base, args.seconds, args.payload, args.burst))
+    latencies, wakeups = [], 0
+    for _ in procs:
+        got, woken = results.get()
+        latencies.extend(got)
+        wakeups += woken
+    latencies.sort()
+    for proc in procs:
+        proc.join()
+    return (sent / args.seconds, len(latencies) / args.seconds,
+            wakeups / args.seconds,
+            1000 * latencies[len(latencies) // 2],
+            1000 * latencies[int(len(latencies) * 0.99)],
+            len(latencies) / (sent * args.clients))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, default=500)
+    parser.add_argument("--client-procs", type=int, default=4)
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--payload", type=int, default=0,
+                        help="bytes of padding per message, e.g. a paste")
+    parser.add_argument("--burst", type=int, default=1)
+    parser.add_argument("--window-ms", type=float, default=0)
+    args = parser.parse_args()
+
+    port_queue = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve,
+                                     args=(port_queue, args.window_ms),
+                                     daemon=True)
+    server.start()
+    base = "http://127.0.0.1:%d" % port_queue.get()
+
+    print("%d listeners on one session, %gs per transport, %d byte messages,"
+          " bursts of %d, %gms window" % (args.clients, args.seconds,
+                                          args.payload, args.burst,
+                                          args.window_ms))
+    print("              broadcasts/s  messages/s   wakeups/s   fan-out p50"
+          "     p99  delivered")
+    for transport in ("longpoll", "websocket"):
+        sent, delivered, woken, p50, p99, ratio = measure(transport, base,
+                                                          args)
+        print("  %-10s %13.1f %11.0f %11.0f %11.1fms %6.1fms %9.1f%%"
+              % (transport, sent, delivered, woken, p50, p99, 100 * ratio))
+    server.terminate()
+
+
+if __name__ == "__main__":
+    main()
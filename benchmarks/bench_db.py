@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""
+Load test for /save and /updates: one blocking database connection on the
+IOLoop versus dbpool.ConnectionPool.
+
+Both handlers are served from a local Tornado server backed by a sqlite
+UserSheets table.  Every statement also sleeps --latency seconds, standing
+in for a MySQL round trip or a large LONGBLOB read.  --savers clients post
+sheets to /save while --pollers clients hit /updates with a cursor that is
+already behind, so each poll answers at once from the channel cache.  With
+the blocking connection every poll waits behind whichever save holds the
+loop; with the pool they don't.
+
+    python benchmarks/bench_db.py [--seconds 3] [--savers 16] [--pollers 16]
+"""
+
+import argparse
+import asyncio
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+import urllib.parse
+
+import tornado.httpclient
+import tornado.httpserver
+import tornado.netutil
+import tornado.web
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import dbpool
+
+
+class SlowSqlite:
+    """tornado.database calls on sqlite, each taking at least latency"""
+
+    def __init__(self, path, latency):
+        self.conn = sqlite3.connect(path, check_same_thread=False,
+                                    isolation_level=None, timeout=30)
+        self.conn.row_factory = sqlite3.Row
+        self.latency = latency
+
+    def query(self, sql, *args):
+        time.sleep(self.latency)
+        return self.conn.execute(sql.replace("%s", "?"), args).fetchall()
+
+    def execute(self, sql, *args):
+        time.sleep(self.latency)
+        return self.conn.execute(sql.replace("%s", "?"), args).lastrowid
+
+    def close(self):
+        self.conn.close()
+
+
+SHEET = "cell:A1:v:1\n" * 2000
+
+
+class BlockingSaveHandler(tornado.web.RequestHandler):
+    """SaveHandler.post as it was: blocking calls on the shared connection"""
+
+    def post(self):
+        db = self.application.blocking_db
+        user, fname = "demo", self.get_argument("fname")
+        sheetstr = self.get_argument("data")
+        if db.query("SELECT * FROM UserSheets WHERE user = %s AND fname = %s",
+                    user, fname):
+            db.execute("UPDATE UserSheets SET data = %s "
+                       "WHERE user = %s AND fname = %s", sheetstr, user, fname)
+        else:
+            db.execute("INSERT INTO UserSheets (user,fname,data) "
+                       "VALUES (%s,%s,%s)", user, fname, sheetstr)
+        self.finish(dict(data="Done"))
+
+
+class PooledSaveHandler(tornado.web.RequestHandler):
+    async def post(self):
+        db = self.application.pool
+        user, fname = "demo", self.get_argument("fname")
+        sheetstr = self.get_argument("data")
+        if await db.query("SELECT * FROM UserSheets "
+                          "WHERE user = %s AND fname = %s", user, fname):
+            await db.execute("UPDATE UserSheets SET data = %s "
+                             "WHERE user = %s AND fname = %s",
+                             sheetstr, user, fname)
+        else:
+            await db.execute("INSERT INTO UserSheets (user,fname,data) "
+                             "VALUES (%s,%s,%s)", user, fname, sheetstr)
+        self.finish(dict(data="Done"))
+
+
+class UpdatesHandler(tornado.web.RequestHandler):
+    """/updates for a client whose cursor is behind: served from the cache"""
+
+    def post(self):
+        cursor = self.get_argument("cursor")
+        cache = self.application.messages
+        index = next(i for i, m in enumerate(cache) if m["id"] == cursor)
+        self.finish(dict(messages=cache[index + 1:]))
+
+
+async def load(base, save_path, seconds, savers, pollers):
+    client = tornado.httpclient.AsyncHTTPClient(
+        max_clients=savers + pollers)
+    deadline = time.perf_counter() + seconds
+    saves = []
+    polls = []
+
+    async def saver(n):
+        body = urllib.parse.urlencode({"fname": "sheet%d" % n,
+                                       "data": SHEET})
+        while time.perf_counter() < deadline:
+            await client.fetch(base + save_path, method="POST", body=body,
+                               request_timeout=300)
+            saves.append(1)
+
+    async def poller():
+        body = urllib.parse.urlencode({"cursor": "m0"})
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            await client.fetch(base + "/updates", method="POST", body=body,
+                               request_timeout=300)
+            polls.append(time.perf_counter() - start)
+            await asyncio.sleep(0.005)
+
+    await asyncio.gather(*[saver(n) for n in range(savers)],
+                         *[poller() for _ in range(pollers)])
+    polls.sort()
+    return (len(saves) / seconds,
+            1000 * polls[len(polls) // 2],
+            1000 * polls[int(len(polls) * 0.99)])
+
+
+async def run(args, path):
+    setup = sqlite3.connect(path)
+    setup.execute("PRAGMA journal_mode=WAL")
+    setup.execute("CREATE TABLE UserSheets (id INTEGER PRIMARY KEY, "
+                  "user TEXT, fname TEXT, data BLOB, UNIQUE (user, fname))")
+    setup.commit()
+    setup.close()
+
+    app = tornado.web.Application([
+        (r"/save-blocking", BlockingSaveHandler),
+        (r"/save", PooledSaveHandler),
+        (r"/updates", UpdatesHandler)])
+    app.blocking_db = SlowSqlite(path, args.latency)
+    app.pool = dbpool.ConnectionPool(lambda: SlowSqlite(path, args.latency),
+                                     size=args.pool_size)
+    app.messages = [dict(id="m%d" % i, data="ecell:A1") for i in range(3)]
+    sockets = tornado.netutil.bind_sockets(0, "127.0.0.1")
+    server = tornado.httpserver.HTTPServer(app)
+    server.add_sockets(sockets)
+    base = "http://127.0.0.1:%d" % sockets[0].getsockname()[1]
+
+    print("latency %.3fs per statement, %d savers, %d pollers, pool of %d"
+          % (args.latency, args.savers, args.pollers, args.pool_size))
+    print("                         saves/s   /updates p50    p99")
+    for label, save_path in (("one blocking connection", "/save-blocking"),
+                             ("ConnectionPool", "/save")):
+        rate, p50, p99 = await load(base, save_path, args.seconds,
+                                    args.savers, args.pollers)
+        print("  %-22s %8.1f %10.1fms %7.1fms" % (label, rate, p50, p99))
+    server.stop()
+    app.pool.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seconds", type=float, default=3)
+    parser.add_argument("--savers", type=int, default=16)
+    parser.add_argument("--pollers", type=int, default=16)
+    parser.add_argument("--pool-size", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.02)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        asyncio.run(run(args, os.path.join(tmp, "bench.db")))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+"""
+Time and memory of sheetexport writing a large sheet to each format.
+
+The save is parsed once; each format is then written to a temporary
+file, once for time and once under tracemalloc.  "peak" is the most
+memory allocated while writing, beyond the parsed sheet, which stays
+flat however large the output.
+
+    python benchmarks/bench_export.py [cells]
+"""
+
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import sheetexport
+from bench_parse import generate_sheet_save
+
+
+def main():
+    ncells = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    text = generate_sheet_save(ncells)
+    start = time.perf_counter()
+    sheets = sheetexport.load(text)
+    print("%d cells, parsed in %.2fs" % (ncells, time.perf_counter() - start))
+    print("  format      seconds   output MB   peak MB")
+    for type in sheetexport.WRITERS:
+        with tempfile.TemporaryFile() as out:
+            start = time.perf_counter()
+            sheetexport.WRITERS[type](sheets, out)
+            elapsed = time.perf_counter() - start
+            size = out.tell()
+        # a second run for memory, as tracemalloc slows the first down
+        with tempfile.TemporaryFile() as out:
+            tracemalloc.start()
+            sheetexport.WRITERS[type](sheets, out)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        print("  %-10s %8.2f %11.1f %9.1f"
+              % (type, elapsed, size / 1e6, peak / 1e6))
+
+
+if __name__ == "__main__":
+    main()
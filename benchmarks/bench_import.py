@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""
+Time and memory of sheetimport reading a large workbook in each format.
+
+The files are written by sheetexport from a generated sheet, then read
+back into a workbook save, once for time and once under tracemalloc.
+The save is measured as it comes out rather than kept, so "peak", the
+most memory allocated while reading, is what the reader itself needs.
+
+    python benchmarks/bench_import.py [cells]
+"""
+
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import sheetexport
+import sheetimport
+from bench_parse import generate_sheet_save
+
+
+def read(f, fname):
+    """Reads f, counting the save's length without keeping it"""
+    f.seek(0)
+    return sum(len(piece) for piece in
+               sheetimport.convert(sheetimport.reader(fname)(f)))
+
+
+def main():
+    ncells = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    sheets = sheetexport.load(generate_sheet_save(ncells))
+    print("%d cells" % ncells)
+    print("  format      file MB   seconds   save MB   peak MB")
+    for type, extension in (("Excel2007", "xlsx"), ("ODS", "ods"),
+                            ("CSV", "csv")):
+        with tempfile.TemporaryFile() as f:
+            sheetexport.WRITERS[type](sheets, f)
+            size = f.tell()
+            start = time.perf_counter()
+            length = read(f, "upload." + extension)
+            elapsed = time.perf_counter() - start
+            tracemalloc.start()
+            read(f, "upload." + extension)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        print("  %-10s %8.1f %9.2f %9.1f %9.1f"
+              % (type, size / 1e6, elapsed, length / 1e6, peak / 1e6))
+
+
+if __name__ == "__main__":
+    main()
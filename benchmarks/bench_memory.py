@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""
+Compares the memory held by a parsed socialcalc.Sheet with the naive
+dict-per-cell model (one dict of every cell field, as the old
+interoppartial.py sketched it).
+
+    python benchmarks/bench_memory.py [cells]
+"""
+
+import gc
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import socialcalc
+from bench_parse import generate_sheet_save
+
+
+def parse_dict_per_cell(text):
+    cells = {}
+    for coord, cell in socialcalc.parse_sheet_save(text).cells.items():
+        entry = {"coord": coord}
+        for name in ("datavalue", "datatype", "formula", "valuetype"):
+            entry[name] = getattr(cell, name)
+        for name in socialcalc.STYLE_FIELDS:
+            entry[name] = getattr(cell, name)
+        cells[coord] = entry
+    return cells
+
+
+def measure(parse, text):
+    gc.collect()
+    tracemalloc.start()
+    model = parse(text)
+    gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return model, size
+
+
+def main():
+    ncells = int(sys.argv[1]) if len(sys.argv) > 1 else 300000
+    text = generate_sheet_save(ncells)
+    _, naive = measure(parse_dict_per_cell, text)
+    sheet, compact = measure(socialcalc.parse_sheet_save, text)
+    print("%d cells, %d distinct cell styles" %
+          (ncells, len(set(cell.style for cell in sheet.cells.values()))))
+    for label, size in (("dict per cell", naive), ("socialcalc.Sheet", compact)):
+        print("  %-18s %7.1f MB  %5d bytes/cell"
+              % (label, size / 1e6, size / ncells))
+    print("  saving %.1fx" % (naive / compact))
+
+
+if __name__ == "__main__":
+    main()
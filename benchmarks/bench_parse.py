@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""
+Times socialcalc.parse_spreadsheet_save on a generated multipart save.
+
+    python benchmarks/bench_parse.py [cells]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import socialcalc
+
+
+def generate_sheet_save(ncells, ncols=10):
+    """Text in the first column, numbers in the middle, a SUM at the end"""
+    lines = ["version:1.5"]
+    lastcol = socialcalc.number_to_colname(ncols)
+    nrows = (ncells + ncols - 1) // ncols
+    for row in range(1, nrows + 1):
+        for col in range(1, ncols + 1):
+            coord = socialcalc.cr_to_coord(col, row)
+            if col == 1:
+                lines.append("cell:%s:t:Line item %d:f:1" % (coord, row))
+            elif col == ncols:
+                lines.append("cell:%s:vtf:n:%d:SUM(B%d\\c%s%d):b:1:1:1:1"
+                             % (coord, row, row, lastcol, row))
+            else:
+                lines.append("cell:%s:v:%d.25:ntvf:1" % (coord, row * col))
+    lines.append("sheet:c:%d:r:%d" % (ncols, nrows))
+    lines.append("border:1:1px solid rgb(0,0,0)")
+    lines.append("font:1:normal bold * *")
+    lines.append("valueformat:1:#,##0.00")
+    return "\n".join(lines) + "\n"
+
+
+def main():
+    ncells = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    sheet = socialcalc.parse_sheet_save(generate_sheet_save(ncells))
+    save = socialcalc.create_spreadsheet_save(sheet, {"edit": "version:1.0\n"})
+    best = None
+    for _ in range(3):
+        start = time.perf_counter()
+        sheet, _ = socialcalc.parse_spreadsheet_save(save)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print("parsed %d cells (%.1f MB) in %.3fs"
+          % (len(sheet), len(save) / 1e6, best))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Times single-cell edits against formula.Recalc as the sheet grows.
+
+Each sheet is a simple valuation model: an input column, two formula
+columns per row and totals over the whole of each formula column.  An
+edit changes one input and recalculates what depends on it.
+
+    python benchmarks/bench_recalc.py [formulas ...]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import formula
+import socialcalc
+
+
+def generate_model(nformulas):
+    """A, B=A*1.05, C=B-A per row, then SUM/AVERAGE totals under B and C"""
+    nrows = nformulas // 2
+    lines = ["version:1.5"]
+    for row in range(1, nrows + 1):
+        lines.append("cell:A%d:v:%d" % (row, row))
+        lines.append("cell:B%d:vtf:n:0:A%d*1.05" % (row, row))
+        lines.append("cell:C%d:vtf:n:0:B%d-A%d" % (row, row, row))
+    total = nrows + 2
+    lines.append("cell:B%d:vtf:n:0:SUM(B1\\cB%d)" % (total, nrows))
+    lines.append("cell:C%d:vtf:n:0:AVERAGE(C1\\cC%d)" % (total, nrows))
+    return socialcalc.parse_sheet_save("\n".join(lines) + "\n")
+
+
+def main():
+    sizes = [int(a) for a in sys.argv[1:]] or [1000, 10000, 50000, 100000]
+    print("%10s %10s %10s %12s %10s %10s"
+          % ("formulas", "build (s)", "full (s)", "graph (ms)", "edit (ms)",
+             "evaluated"))
+    for size in sizes:
+        sheet = generate_model(size)
+        start = time.perf_counter()
+        recalc = formula.Recalc(sheet)
+        built = time.perf_counter() - start
+
+        start = time.perf_counter()
+        recalc.recalc()
+        full = time.perf_counter() - start
+
+        # graph: finding and ordering the dirty cells; edit: the whole
+        # set_value + recalc, including re-summing the column totals
+        graph = edit = None
+        rows = size // 2
+        for i in range(20):
+            coord = "A%d" % (1 + (i * 7919) % rows)
+            start = time.perf_counter()
+            recalc.graph.order(recalc.graph.dirty([coord]))
+            elapsed = time.perf_counter() - start
+            graph = elapsed if graph is None else min(graph, elapsed)
+
+            start = time.perf_counter()
+            recalc.set_value(coord, i)
+            evaluated = recalc.recalc([coord])
+            elapsed = time.perf_counter() - start
+            edit = elapsed if edit is None else min(edit, elapsed)
+        print("%10d %10.3f %10.3f %12.3f %10.3f %10d"
+              % (len(recalc.parsed), built, full, graph * 1000, edit * 1000,
+                 len(evaluated)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+Requests/sec on /ticker: forking msnparse.py per request versus the
+in-process fetchers.TickerFetcher.
+
+A stub util directory stands in for the real data source: msnparse.py and
+ystockquote.py sleep for --latency seconds, as a network lookup would,
+and return a small canned result.  Both handlers are served from a local
+Tornado server and hit by --concurrency clients.
+
+    python benchmarks/bench_ticker.py [--requests 200] [--concurrency 20]
+"""
+
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+
+import tornado.httpclient
+import tornado.httpserver
+import tornado.netutil
+import tornado.web
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import fetchers
+
+STUB_MSNPARSE = '''
+import os
+import sys
+import time
+
+LATENCY = float(os.environ.get("STUB_LATENCY", "0.02"))
+
+
+def main(argv):
+    time.sleep(LATENCY)
+    ticker = argv[-1]
+    for row, label in enumerate(("Revenue", "Net Income", "EPS"), 1):
+        print("cell:A%d:t:%s %s" % (row, ticker, label))
+        print("cell:B%d:v:%d" % (row, 1000 * row))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
+'''
+
+STUB_YSTOCKQUOTE = '''
+import os
+import time
+
+LATENCY = float(os.environ.get("STUB_LATENCY", "0.02"))
+
+
+def get_all(symbol):
+    time.sleep(LATENCY)
+    return {"price": "101.25", "change": "+0.75", "volume": "1200000"}
+'''
+
+
+def write_stub_util(path):
+    for name, text in (("msnparse", STUB_MSNPARSE),
+                       ("ystockquote", STUB_YSTOCKQUOTE)):
+        with open(os.path.join(path, name + ".py"), "w") as f:
+            f.write(text)
+
+
+class ForkingTickerHandler(tornado.web.RequestHandler):
+    """The old /ticker: a new interpreter per request, on the IOLoop"""
+
+    def post(self):
+        ticker = self.get_argument("ticker")
+        cmdname = os.path.join(self.application.settings["util_path"],
+                               "msnparse.py")
+        sheetstr = subprocess.getoutput("%s %s %s %s" % (
+            sys.executable, cmdname, "none", ticker))
+        tickdata = self.application.source.quote(ticker)
+        self.finish(dict(data=sheetstr, tick=tickdata, result="ok"))
+
+
+class TickerHandler(tornado.web.RequestHandler):
+    async def post(self):
+        ticker = self.get_argument("ticker")
+        sheetstr, tickdata = await self.application.fetcher.ticker(ticker)
+        self.finish(dict(data=sheetstr, tick=tickdata, result="ok"))
+
+
+async def drive(url, nrequests, concurrency):
+    client = tornado.httpclient.AsyncHTTPClient(max_clients=concurrency)
+    body = urllib.parse.urlencode({"ticker": "AAPL"})
+    remaining = iter(range(nrequests))
+
+    async def worker():
+        for _ in remaining:
+            response = await client.fetch(url, method="POST", body=body,
+                                          request_timeout=300)
+            assert b'"result": "ok"' in response.body
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return nrequests / (time.perf_counter() - start)
+
+
+async def run(args, util_path):
+    source = fetchers.ScriptSource(util_path)
+    fetcher = fetchers.TickerFetcher(source, max_workers=args.workers)
+    app = tornado.web.Application(
+        [(r"/ticker-fork", ForkingTickerHandler), (r"/ticker", TickerHandler)],
+        util_path=util_path)
+    app.source = source
+    app.fetcher = fetcher
+    sockets = tornado.netutil.bind_sockets(0, "127.0.0.1")
+    port = sockets[0].getsockname()[1]
+    server = tornado.httpserver.HTTPServer(app)
+    server.add_sockets(sockets)
+
+    base = "http://127.0.0.1:%d" % port
+    before = await drive(base + "/ticker-fork", args.requests,
+                         args.concurrency)
+    after = await drive(base + "/ticker", args.requests, args.concurrency)
+    server.stop()
+    fetcher.close()
+    print("latency %.3fs, %d requests, %d clients, %d workers"
+          % (args.latency, args.requests, args.concurrency, args.workers))
+    print("  commands.getoutput per request: %8.1f req/s" % before)
+    print("  in-process TickerFetcher:       %8.1f req/s (%.1fx)"
+          % (after, after / before))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.02)
+    args = parser.parse_args()
+    os.environ["STUB_LATENCY"] = str(args.latency)
+    with tempfile.TemporaryDirectory() as util_path:
+        write_stub_util(util_path)
+        asyncio.run(run(args, util_path))
+
+
+if __name__ == "__main__":
+    main()
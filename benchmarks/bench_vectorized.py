@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+Compares a full recalc through formula.Recalc and formula_vector.VectorRecalc,
+from a freshly parsed save (the way a compaction or recalc_save runs) and
+again on an object already built.
+
+The sheet is a ten-year template copied down many rows: yearly figures in
+B:K, then SUM, AVERAGE, NPV, a growth rate and a spread per row.
+
+    python benchmarks/bench_vectorized.py [rows ...]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import formula
+import formula_vector
+import socialcalc
+
+
+def generate_template(nrows):
+    lines = ["version:1.5"]
+    for row in range(1, nrows + 1):
+        for i, col in enumerate("BCDEFGHIJK"):
+            lines.append("cell:%s%d:v:%d.5" % (col, row, 100 + row + i * 7))
+        lines.append("cell:L%d:vtf:n:0:SUM(B%d\\cK%d)" % (row, row, row))
+        lines.append("cell:M%d:vtf:n:0:AVERAGE(B%d\\cK%d)" % (row, row, row))
+        lines.append("cell:N%d:vtf:n:0:NPV(0.08,B%d\\cK%d)" % (row, row, row))
+        lines.append("cell:O%d:vtf:n:0:(K%d/B%d)^(1/9)-1" % (row, row, row))
+        lines.append("cell:P%d:vtf:n:0:MAX(B%d\\cK%d)-MIN(B%d\\cK%d)"
+                     % (row, row, row, row, row))
+    return "\n".join(lines) + "\n"
+
+
+def best_of(fn, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def cold(cls, text):
+    """Parse the save, build the recalc object and run one full recalc"""
+    def run():
+        formula.parse.cache_clear()
+        cls(socialcalc.parse_sheet_save(text)).recalc()
+    return run
+
+
+def main():
+    sizes = [int(a) for a in sys.argv[1:]] or [1000, 10000, 20000]
+    print("Cold: parse, construct and recalc once.  The first vector run")
+    print("builds the plan; later ones find it cached by the sheet layout.")
+    print("%8s %10s %11s %11s %11s %11s %11s %8s"
+          % ("rows", "formulas", "scalar", "vec first", "vec cached",
+             "scalar rc", "vector rc", "speedup"))
+    for nrows in sizes:
+        text = generate_template(nrows)
+        formula_vector._plans.clear()
+        scalar_cold = best_of(cold(formula.Recalc, text), 1)
+        first = best_of(cold(formula_vector.VectorRecalc, text), 1)
+        cached = best_of(cold(formula_vector.VectorRecalc, text), 1)
+        scalar = formula.Recalc(socialcalc.parse_sheet_save(text))
+        vector = formula_vector.VectorRecalc(socialcalc.parse_sheet_save(text))
+        vector.recalc()
+        scalar_time = best_of(scalar.recalc)
+        vector_time = best_of(vector.recalc)
+        print("%8d %10d %10.3fs %10.3fs %10.3fs %10.3fs %10.4fs %7.0fx"
+              % (nrows, len(scalar.parsed), scalar_cold, first, cached,
+                 scalar_time, vector_time, scalar_time / vector_time))
+
+if __name__ == "__main__":
+    main()
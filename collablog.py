@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+"""
+On-disk log of a collaboration session
+
+A channel's messages and idinsession counter used to exist only in
+memory, so a deploy ended every /collaborate session.  SessionLog keeps
+them in a directory per session as append-only segments:
+
+    <log_dir>/<session>/00000000000000000001.log
+
+Each segment is named for the sequence number of its first message and
+holds one JSON record per line:
+
+    {"t":"o","ticker":...,"fname":...,"n":nextid,"seq":seq}  segment header
+    {"t":"n","n":id}                                    an idinsession handed out
+    {"t":"m","m":message}                                a broadcast message
+
+Given an executor, a single-thread concurrent.futures one, the log does
+its file work there rather than on the caller's thread: append() and
+record_nextid() queue the write and return, and the fsyncs, the
+catch-up reads of read_since() and the closing go through the same
+queue, so each sees every write queued before it.  Without one the
+work is done in the call.  Records are fsynced together every
+fsync_interval seconds, or after every write if that is 0, or never
+(left to the OS) if it is None.  A segment past
+segment_bytes is closed and a new one started.  Old segments are
+deleted once the later ones hold `keep` messages.  Every segment starts
+with a header, so dropping old ones loses nothing needed to rebuild the
+channel.
+
+replay() rebuilds a channel from the segments after a restart: its
+ticker and fname, its next idinsession, and its last `keep` messages.
+since(cursor) serves catch-up reads older than the in-memory cache.  It
+memory-maps the segments and searches them for the cursor's id, so it
+reads only the pages it touches, and unmaps each when done.  A torn record at the end of the last
+segment, left by a crash mid-write, is cut off when the log is opened.
+"""
+
+import asyncio
+import collections
+import contextlib
+import json
+import logging
+import mmap
+import os
+import re
+import shutil
+
+
+SESSION_NAME = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+
+def _encode(record):
+    return json.dumps(record, separators=(",", ":")).encode("utf-8") + b"\n"
+
+
+def _records(data, offset=0):
+    """(offset, end, record) for each whole record in a segment's bytes"""
+    while offset < len(data):
+        end = data.find(b"\n", offset)
+        if end < 0:
+            return
+        try:
+            record = json.loads(data[offset:end])
+        except ValueError:
+            return
+        yield offset, end + 1, record
+        offset = end + 1
+
+
+def _log_failure(future):
+    if not future.cancelled() and future.exception() is not None:
+        logging.error("Session log write failed: %s", future.exception())
+
+
+class Replayed:
+    """What replay() recovers of a channel"""
+
+    def __init__(self, ticker, fname, nextid, seq, messages):
+        self.ticker = ticker
+        self.fname = fname
+        self.nextid = nextid
+        self.seq = seq              # sequence number of the last message
+        self.messages = messages    # the last `keep`, oldest first
+
+
+class SessionLog:
+    """
+    The log of one session, in directory.  Use create() for a new
+    session and open() to pick up an existing one.
+    """
+
+    def __init__(self, directory, segment_bytes=4 * 1024 * 1024, keep=1000,
+                 fsync_interval=0.05, executor=None):
+        self.directory = directory
+        self.executor = executor
+        self.segment_bytes = segment_bytes
+        self.keep = keep
+        self.fsync_interval = fsync_interval
+        self.segments = []      # [first sequence number, path, messages]
+        self.fd = None
+        self.size = 0
+        self.dirty = False
+        self.sync_timer = None
+        self.ticker = self.fname = ""
+        self.nextid = 2
+        self.seq = 0
+
+    @classmethod
+    def create(cls, directory, ticker, fname, **kwargs):
+        """A new log, replacing any left in directory"""
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory)
+        log = cls(directory, **kwargs)
+        log.ticker, log.fname = ticker, fname
+        log._start_segment()
+        return log
+
+    @classmethod
+    def open(cls, directory, **kwargs):
+        """(log, Replayed) for the log in directory, or None if there is none"""
+        if not os.path.isdir(directory):
+            return None
+        log = cls(directory, **kwargs)
+        replayed = log._replay()
+        if replayed is None:
+            return None
+        log._reopen()
+        return log, replayed
+
+    def _path(self, first):
+        return os.path.join(self.directory, "%020d.log" % first)
+
+    def _replay(self):
+        names = sorted(name for name in os.listdir(self.directory)
+                       if name.endswith(".log"))
+        if not names:
+            return None
+        messages = collections.deque(maxlen=self.keep)
+        for name in names:
+            path = os.path.join(self.directory, name)
+            with self._map(path) as data:
+                count, end, size = 0, 0, len(data)
+                for _, end, record in _records(data):
+                    if record["t"] == "o":
+                        self.ticker = record["ticker"]
+                        self.fname = record["fname"]
+                        self.nextid, self.seq = record["n"], record["seq"]
+                    elif record["t"] == "n":
+                        self.nextid = record["n"] + 1
+                    elif record["t"] == "m":
+                        self.seq += 1
+                        count += 1
+                        messages.append(record["m"])
+            if end < size:
+                # cut off a record the last run did not finish writing
+                with open(path, "r+b") as f:
+                    f.truncate(end)
+            self.segments.append([int(name[:-4]), path, count])
+        return Replayed(self.ticker, self.fname, self.nextid, self.seq,
+                        list(messages))
+
+    @staticmethod
+    @contextlib.contextmanager
+    def _map(path):
+        """The bytes of the file at path, mapped until the block ends"""
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                yield b""
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                yield data
+
+    def _submit(self, fn, *args):
+        """fn(*args) on the executor, after the work queued before it"""
+        if self.executor is None:
+            fn(*args)
+        else:
+            self.executor.submit(fn, *args).add_done_callback(_log_failure)
+
+    def _reopen(self):
+        path = self.segments[-1][1]
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND)
+        self.size = os.fstat(self.fd).st_size
+
+    def _start_segment(self):
+        if self.fd is not None:
+            self._sync()
+            os.close(self.fd)
+        first = self.seq + 1
+        path = self._path(first)
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self.size = 0
+        self.segments.append([first, path, 0])
+        self._write(_encode(dict(t="o", ticker=self.ticker, fname=self.fname,
+                                 n=self.nextid, seq=self.seq)))
+        # the older segments are no longer needed once these hold `keep`
+        while len(self.segments) > 1 and \
+                sum(count for _, _, count in self.segments[1:]) >= self.keep:
+            os.remove(self.segments.pop(0)[1])
+
+    def _write(self, data):
+        os.write(self.fd, data)
+        self.size += len(data)
+        self.dirty = True
+        if self.fsync_interval == 0:
+            self._sync()
+
+    def _sync_later(self):
+        if self.fsync_interval is None or self.fsync_interval == 0 or \
+                self.sync_timer is not None:
+            return
+        try:
+            self.sync_timer = asyncio.get_running_loop().call_later(
+                self.fsync_interval, self.sync)
+        except RuntimeError:
+            pass    # no loop; synced on close
+
+    def append(self, messages):
+        self._submit(self._append, list(messages))
+        self._sync_later()
+
+    def _append(self, messages):
+        # a segment holds at least one message, so no two share a name
+        if self.size >= self.segment_bytes and self.segments[-1][2]:
+            self._start_segment()
+        self._write(b"".join(_encode(dict(t="m", m=message))
+                             for message in messages))
+        self.seq += len(messages)
+        self.segments[-1][2] += len(messages)
+
+    def record_nextid(self, id):
+        self._submit(self._record_nextid, id)
+        self._sync_later()
+
+    def _record_nextid(self, id):
+        self.nextid = id + 1
+        self._write(_encode(dict(t="n", n=id)))
+
+    async def read_since(self, cursor):
+        """since(cursor), read on the executor"""
+        if self.executor is None:
+            return self.since(cursor)
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, self.since, cursor)
+
+    def since(self, cursor):
+        """The logged messages after the one with id cursor, or None"""
+        for i, (_, path, _) in enumerate(self.segments):
+            with self._map(path) as data:
+                end = self._find(data, cursor)
+                if end is None:
+                    continue
+                messages = [record["m"] for _, _, record in
+                            _records(data, end) if record["t"] == "m"]
+            for _, later, _ in self.segments[i + 1:]:
+                with self._map(later) as data:
+                    messages.extend(record["m"] for _, _, record in
+                                    _records(data) if record["t"] == "m")
+            return messages
+        return None
+
+    @staticmethod
+    def _find(data, cursor):
+        """The offset after the message with id cursor in data, or None"""
+        needle = _encode(dict(id=cursor))[1:-2]     # "id":"..."
+        found = data.find(needle)
+        while found >= 0:
+            start = data.rfind(b"\n", 0, found) + 1
+            end = data.find(b"\n", found)
+            if end < 0:
+                return None
+            record = json.loads(data[start:end])
+            if record["t"] == "m" and record["m"].get("id") == cursor:
+                return end + 1
+            found = data.find(needle, end)
+        return None
+
+    def _cancel_sync(self):
+        if self.sync_timer is not None:
+            self.sync_timer.cancel()
+            self.sync_timer = None
+
+    def sync(self):
+        self._cancel_sync()
+        self._submit(self._sync)
+
+    def _sync(self):
+        if self.dirty and self.fd is not None:
+            os.fsync(self.fd)
+            self.dirty = False
+
+    def close(self):
+        self._cancel_sync()
+        self._submit(self._close)
+
+    def _close(self):
+        self._sync()
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def delete(self):
+        self._cancel_sync()
+        self._submit(self._delete)
+
+    def _delete(self):
+        self._close()
+        shutil.rmtree(self.directory, ignore_errors=True)
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+"""
+Pooled, non-blocking database access
+
+The handlers used to share one tornado.database.Connection and call it
+from the IOLoop thread, so a slow read (a large UserSheets LONGBLOB, say)
+held up every other request, long polls included.  ConnectionPool keeps
+up to `size` connections and runs each call on a worker thread with a
+connection of its own, handing back a coroutine:
+
+    rows = await pool.query("SELECT * FROM UserSheets WHERE user = %s", user)
+
+Calls beyond `size` queue without blocking the event loop.  A connection
+that has sat idle longer than ping_interval is checked before use and
+replaced if the check fails; one that raises a disconnect error mid-call
+is dropped, so the next call gets a fresh connection.
+
+tornado.database went with Tornado 3.0.  MySQLConnection keeps its
+interface, rows whose columns read as keys or attributes included, on a
+PyMySQL connection, and mysql_pool() builds the pool main.py uses.
+"""
+
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import pymysql
+except ImportError:
+    pymysql = None
+
+
+class ConnectionPool:
+    """
+    connect is called to open a connection with the tornado.database
+    interface (query, get, execute, executemany, close), such as a
+    MySQLConnection.
+    disconnect_errors are the exceptions that mean a connection is no
+    longer usable; any other error leaves the connection in the pool.
+    """
+
+    def __init__(self, connect, size=8, ping_interval=60.0,
+                 ping_sql="SELECT 1", disconnect_errors=(),
+                 clock=time.monotonic):
+        self.connect = connect
+        self.size = size
+        self.ping_interval = ping_interval
+        self.ping_sql = ping_sql
+        self.disconnect_errors = tuple(disconnect_errors)
+        self.clock = clock
+        self.executor = ThreadPoolExecutor(size, thread_name_prefix="db")
+        self.lock = threading.Lock()
+        self.idle = []          # (connection, last used), most recent last
+        self.open = 0
+        self.active = 0
+        self.queued = 0
+        self.counters = dict(calls=0, connects=0, pings=0, failed_pings=0,
+                             disconnects=0, errors=0)
+
+    def _count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def _connect(self):
+        conn = self.connect()
+        with self.lock:
+            self.open += 1
+            self.counters["connects"] += 1
+        return conn
+
+    def _discard(self, conn):
+        with self.lock:
+            self.open -= 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _checkout(self):
+        with self.lock:
+            conn, last_used = self.idle.pop() if self.idle else (None, None)
+        if conn is None:
+            return self._connect()
+        if self.clock() - last_used > self.ping_interval:
+            self._count("pings")
+            try:
+                conn.query(self.ping_sql)
+            except Exception:
+                self._count("failed_pings")
+                self._discard(conn)
+                return self._connect()
+        return conn
+
+    def _checkin(self, conn):
+        with self.lock:
+            self.idle.append((conn, self.clock()))
+
+    def _call(self, fn):
+        with self.lock:
+            self.queued -= 1
+            self.active += 1
+        try:
+            conn = self._checkout()
+            try:
+                result = fn(conn)
+            except self.disconnect_errors:
+                self._count("disconnects")
+                self._discard(conn)
+                raise
+            except Exception:
+                self._count("errors")
+                self._checkin(conn)
+                raise
+            self._checkin(conn)
+            return result
+        finally:
+            with self.lock:
+                self.active -= 1
+
+    async def run(self, fn):
+        """fn(connection), on a worker thread; for several statements in a row"""
+        with self.lock:
+            self.queued += 1
+            self.counters["calls"] += 1
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self._call, fn)
+
+    async def query(self, sql, *args):
+        return await self.run(lambda conn: conn.query(sql, *args))
+
+    async def get(self, sql, *args):
+        return await self.run(lambda conn: conn.get(sql, *args))
+
+    async def execute(self, sql, *args):
+        return await self.run(lambda conn: conn.execute(sql, *args))
+
+    async def executemany(self, sql, args):
+        return await self.run(lambda conn: conn.executemany(sql, args))
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats.update(size=self.size, open=self.open,
+                         idle=len(self.idle), active=self.active,
+                         queued=self.queued)
+        return stats
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn, _ in idle:
+            self._discard(conn)
+
+
+class Row(dict):
+    """A result row; row["fname"] and row.fname both work"""
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+class MySQLConnection:
+    """
+    The tornado.database.Connection interface on PyMySQL, in autocommit
+    mode as that was.  host is "host", "host:port" or a unix socket path.
+    """
+
+    def __init__(self, host, database, user=None, password=None,
+                 connect_timeout=10):
+        if pymysql is None:
+            raise ImportError("MySQL access needs the PyMySQL package")
+        args = dict(database=database, user=user, password=password,
+                    charset="utf8mb4", autocommit=True,
+                    connect_timeout=connect_timeout)
+        if "/" in host:
+            args["unix_socket"] = host
+        else:
+            host, _, port = host.partition(":")
+            args.update(host=host, port=int(port or 3306))
+        self.conn = pymysql.connect(**args)
+
+    def _run(self, sql, args, many=False):
+        cursor = self.conn.cursor()
+        if many:
+            cursor.executemany(sql, args)
+        else:
+            # no arguments: a % in the SQL is left alone
+            cursor.execute(sql, args or None)
+        return cursor
+
+    def query(self, sql, *args):
+        cursor = self._run(sql, args)
+        try:
+            names = [column[0] for column in cursor.description or ()]
+            return [Row(zip(names, row)) for row in cursor]
+        finally:
+            cursor.close()
+
+    def get(self, sql, *args):
+        rows = self.query(sql, *args)
+        if len(rows) > 1:
+            raise ValueError("get() query returned %d rows" % len(rows))
+        return rows[0] if rows else None
+
+    def execute(self, sql, *args):
+        """The id of the row inserted, if any"""
+        cursor = self._run(sql, args)
+        cursor.close()
+        return cursor.lastrowid
+
+    def execute_rowcount(self, sql, *args):
+        """The number of rows changed"""
+        cursor = self._run(sql, args)
+        cursor.close()
+        return cursor.rowcount
+
+    def executemany(self, sql, args):
+        cursor = self._run(sql, args, many=True)
+        cursor.close()
+        return cursor.lastrowid
+
+    def close(self):
+        self.conn.close()
+
+
+def mysql_errors():
+    """(disconnect errors, duplicate-key errors) of the MySQL driver"""
+    if pymysql is None:
+        return (), ()
+    return ((pymysql.OperationalError, pymysql.InterfaceError),
+            (pymysql.IntegrityError,))
+
+
+def mysql_pool(host, database, user, password, **kwargs):
+    """A ConnectionPool of MySQLConnections; kwargs as for ConnectionPool"""
+    disconnect_errors, _ = mysql_errors()
+    return ConnectionPool(
+        lambda: MySQLConnection(host, database, user, password),
+        disconnect_errors=disconnect_errors, **kwargs)
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+"""
+Exported workbooks kept on disk by content
+
+Everyone downloading a shared model as Excel gets the same bytes, yet
+each download ran a fresh export job.  ExportCache keeps finished
+exports as files named by key(content, type), a hash of the save and
+the format, and serves a repeat download by opening the file:
+
+    f = await cache.get(key, produce)
+
+On a miss the coroutine function produce(path) writes the export to
+path.  Concurrent misses on one key share a single produce().  Once the
+files add up to more than max_bytes the least recently used go first;
+the newest is kept even if it alone is larger, and a file is not
+evicted while callers waiting on its export have yet to open it.  The
+file comes back open, so an eviction while it is being sent does not
+cut it short.
+
+The key doubles as an ETag for GET requests naming it: it changes
+exactly when the bytes would.
+Processes may share a directory; each keeps its own recency order and
+picks up files another process wrote the first time it is asked for
+them.
+"""
+
+import asyncio
+import collections
+import hashlib
+import os
+import re
+import tempfile
+import time
+import uuid
+
+KEY = re.compile(r"[0-9a-f]{64}\.\w+\Z")
+STALE_PART = 3600       # seconds before an unfinished file is removed
+PRODUCE_TRIES = 3       # exports of one key per get() before giving up
+
+
+def key(content, type):
+    """The cache key, and ETag, of content exported as type"""
+    if isinstance(content, str):
+        content = content.encode("utf-8")
+    return "%s.%s" % (hashlib.sha256(content).hexdigest(), type)
+
+
+class ExportCache:
+    """
+    Export files under directory (a new temporary directory by default),
+    at most max_bytes of them with the least recently used going first
+    """
+
+    def __init__(self, directory=None, max_bytes=256 * 1024 * 1024):
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        else:
+            directory = tempfile.mkdtemp(prefix="exports-")
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()    # key -> bytes
+        self.bytes = 0
+        self.inflight = {}                          # key -> Task
+        self.pinned = collections.Counter()         # key -> waiters
+        self.counters = dict(hits=0, misses=0, coalesced=0, evictions=0,
+                             errors=0)
+        self._scan()
+
+    def _scan(self):
+        """Takes over the files a previous run left, oldest first"""
+        found = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if KEY.match(name):
+                st = os.stat(path)
+                found.append((st.st_mtime, name, st.st_size))
+            elif ".part-" in name and \
+                    os.stat(path).st_mtime < time.time() - STALE_PART:
+                # left by an export that never finished
+                os.remove(path)
+        for _, name, size in sorted(found):
+            self._add(name, size)
+        self._evict()
+
+    def _path(self, key):
+        if not KEY.match(key):
+            raise ValueError("not an export key: %r" % key)
+        return os.path.join(self.directory, key)
+
+    def _add(self, key, size):
+        self.bytes += size - self.entries.get(key, 0)
+        self.entries[key] = size
+        self.entries.move_to_end(key)
+
+    def _drop(self, key):
+        self.bytes -= self.entries.pop(key, 0)
+
+    def _evict(self):
+        for key in list(self.entries):
+            if self.bytes <= self.max_bytes or len(self.entries) <= 1:
+                break
+            if self.pinned[key]:
+                continue
+            self.bytes -= self.entries.pop(key)
+            self.counters["evictions"] += 1
+            try:
+                os.remove(os.path.join(self.directory, key))
+            except FileNotFoundError:
+                pass
+
+    def open(self, key):
+        """The cached export for key as an open file, or None"""
+        path = self._path(key)
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            # evicted by another process sharing the directory
+            self._drop(key)
+            return None
+        if key not in self.entries:
+            # written by another process sharing the directory
+            self._add(key, os.fstat(f.fileno()).st_size)
+            self._evict()
+        self.entries.move_to_end(key)
+        os.utime(path)
+        return f
+
+    async def get(self, key, produce):
+        """
+        The export for key as an open file, calling the coroutine function
+        produce(path) to write it on a miss
+        """
+        f = self.open(key)
+        if f is not None:
+            self.counters["hits"] += 1
+            return f
+        for _ in range(PRODUCE_TRIES):
+            task = self.inflight.get(key)
+            if task is not None:
+                self.counters["coalesced"] += 1
+            else:
+                self.counters["misses"] += 1
+                task = self.inflight[key] = asyncio.ensure_future(
+                    self._produce(key, produce))
+            # pinned until opened, so exports finishing in between cannot
+            # evict it
+            self.pinned[key] += 1
+            try:
+                # a cancelled caller must not cancel the export others
+                # wait on
+                await asyncio.shield(task)
+                f = self.open(key)
+            finally:
+                self.pinned[key] -= 1
+                if not self.pinned[key]:
+                    del self.pinned[key]
+                    self._evict()
+            if f is not None:
+                return f
+            # removed by another process sharing the directory
+        raise FileNotFoundError("export %s removed before it could be "
+                                "opened" % key)
+
+    async def _produce(self, key, produce):
+        path = self._path(key)
+        part = "%s.part-%s" % (path, uuid.uuid4().hex)
+        try:
+            await produce(part)
+            os.replace(part, path)
+        except BaseException:
+            self.counters["errors"] += 1
+            try:
+                os.remove(part)
+            except FileNotFoundError:
+                pass
+            raise
+        finally:
+            del self.inflight[key]
+        self._add(key, os.stat(path).st_size)
+        self._evict()
+
+    def stats(self):
+        stats = dict(self.counters)
+        lookups = stats["hits"] + stats["misses"] + stats["coalesced"]
+        stats.update(
+            files=len(self.entries), bytes=self.bytes,
+            max_bytes=self.max_bytes, inflight=len(self.inflight),
+            pinned=len(self.pinned),
+            hit_ratio=(stats["hits"] + stats["coalesced"]) / lookups
+            if lookups else 0.0)
+        return stats
@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+"""
+In-process market data fetchers
+
+The handlers used to run util/msnparse.py and util/tenyeardata.py with
+commands.getoutput, forking a fresh interpreter per request and blocking
+the IOLoop until it exited.  ScriptSource loads those scripts once as
+modules and calls their command-line entry point, main(argv), in the
+current process, collecting what they print; a script without main()
+is run as __main__ with runpy instead.  TickerFetcher runs the
+source's calls on a bounded thread pool and hands back coroutines, so a
+slow lookup only ties up a worker thread.  TickerCache keeps recent
+results so repeated lookups of the same ticker skip the source entirely.
+"""
+
+import ast
+import asyncio
+import collections
+import contextlib
+import importlib.util
+import io
+import os
+import runpy
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class FetchError(Exception):
+    pass
+
+
+class _ThreadStdout:
+    """sys.stdout stand-in that can send one thread's output to a buffer"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def write(self, text):
+        buffer = getattr(self.local, "buffer", None)
+        return (buffer if buffer is not None else self.stream).write(text)
+
+    def flush(self):
+        if getattr(self.local, "buffer", None) is None:
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+_stdout_lock = threading.Lock()
+_stdout_users = 0
+_argv_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def _captured_stdout():
+    """
+    Sends what this thread prints to the StringIO it yields.  sys.stdout
+    is wrapped only while some thread is capturing, then put back.
+    """
+    global _stdout_users
+    with _stdout_lock:
+        if not isinstance(sys.stdout, _ThreadStdout):
+            sys.stdout = _ThreadStdout(sys.stdout)
+        _stdout_users += 1
+        stdout = sys.stdout
+    buffer = stdout.local.buffer = io.StringIO()
+    try:
+        yield buffer
+    finally:
+        stdout.local.buffer = None
+        with _stdout_lock:
+            _stdout_users -= 1
+            if not _stdout_users and sys.stdout is stdout:
+                sys.stdout = stdout.stream
+
+
+def _defines_main(path):
+    with open(path) as f:
+        tree = ast.parse(f.read(), path)
+    return any(isinstance(node, ast.FunctionDef) and node.name == "main"
+               for node in tree.body)
+
+
+class ScriptSource:
+    """
+    Runs the util/ fetch scripts in-process.  A script exposing main(argv),
+    the body of its command line entry point, is imported once from
+    util_path; its return value, or failing that what it prints, is the
+    result.  A script without one is run afresh as __main__ each time
+    with sys.argv set.  sys.argv is shared by every thread, so those runs
+    take turns.
+    """
+
+    def __init__(self, util_path):
+        self.util_path = util_path
+        self.modules = {}
+        self.has_main = {}      # name -> whether the script defines main
+        self.lock = threading.Lock()
+
+    def _path(self, name):
+        path = os.path.join(self.util_path, name + ".py")
+        if not os.path.exists(path):
+            raise FetchError("No fetch script " + path)
+        return path
+
+    def module(self, name):
+        module = self.modules.get(name)
+        if module is None:
+            with self.lock:
+                module = self.modules.get(name)
+                if module is None:
+                    module = self.modules[name] = self._load(name)
+        return module
+
+    def _load(self, name):
+        path = self._path(name)
+        spec = importlib.util.spec_from_file_location(
+            "fetchers.util." + name, path)
+        if spec is None:
+            raise FetchError("No fetch script " + path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+
+    def _run_path(self, name, args):
+        path = self._path(name)
+        with _argv_lock:
+            argv, sys.argv = sys.argv, [path] + list(args)
+            try:
+                runpy.run_path(path, run_name="__main__")
+            finally:
+                sys.argv = argv
+
+    def run(self, name, *args):
+        if name not in self.has_main:
+            self.has_main[name] = _defines_main(self._path(name))
+        with _captured_stdout() as buffer:
+            try:
+                if self.has_main[name]:
+                    result = self.module(name).main(list(args))
+                else:
+                    result = self._run_path(name, args)
+            except SystemExit:
+                result = None
+        if isinstance(result, str):
+            return result
+        return buffer.getvalue().rstrip("\n")
+
+    def stock_sheet(self, ticker):
+        return self.run("msnparse", ticker)
+
+    def ticker_sheet(self, ticker):
+        return self.run("msnparse", "none", ticker)
+
+    def compare_json(self, *tickers):
+        return self.run("msnparse", "json", *tickers)
+
+    def ten_year_data(self, ticker):
+        return self.run("tenyeardata", ticker)
+
+    def quote(self, ticker):
+        return self.module("ystockquote").get_all(ticker)
+
+
+class TickerCache:
+    """
+    Results by key, each kept for the ttl it was stored with, at most
+    maxsize of them with the least recently used going first.  get()
+    coalesces concurrent misses on one key into a single fetch whose
+    result, or error, every caller receives; errors are not cached.
+    """
+
+    def __init__(self, maxsize=2000, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.clock = clock
+        self.entries = collections.OrderedDict()   # key -> (expires, value)
+        self.inflight = {}                          # key -> Task
+        self.counters = dict(hits=0, misses=0, coalesced=0, expired=0,
+                             evictions=0, errors=0)
+        self.fetch_count = 0
+        self.fetch_seconds = 0.0
+        self.fetch_max_seconds = 0.0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def lookup(self, key):
+        """The cached value, or None if key is missing or expired"""
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= self.clock():
+            del self.entries[key]
+            self.counters["expired"] += 1
+            return None
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    def put(self, key, value, ttl):
+        self.entries[key] = (self.clock() + ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.counters["evictions"] += 1
+
+    def invalidate(self, key):
+        self.entries.pop(key, None)
+
+    async def get(self, key, ttl, fetch):
+        """The value for key, calling the coroutine function fetch on a miss"""
+        value = self.lookup(key)
+        if value is not None:
+            self.counters["hits"] += 1
+            return value
+        task = self.inflight.get(key)
+        if task is not None:
+            self.counters["coalesced"] += 1
+        else:
+            self.counters["misses"] += 1
+            task = self.inflight[key] = asyncio.ensure_future(
+                self._fetch(key, ttl, fetch))
+        # a cancelled caller must not cancel the fetch the others wait on
+        return await asyncio.shield(task)
+
+    async def _fetch(self, key, ttl, fetch):
+        start = time.perf_counter()
+        try:
+            value = await fetch()
+        except Exception:
+            self.counters["errors"] += 1
+            raise
+        finally:
+            del self.inflight[key]
+            elapsed = time.perf_counter() - start
+            self.fetch_count += 1
+            self.fetch_seconds += elapsed
+            self.fetch_max_seconds = max(self.fetch_max_seconds, elapsed)
+        if value is not None:
+            self.put(key, value, ttl)
+        return value
+
+    def stats(self):
+        stats = dict(self.counters)
+        lookups = stats["hits"] + stats["misses"] + stats["coalesced"]
+        stats.update(
+            size=len(self.entries), maxsize=self.maxsize,
+            inflight=len(self.inflight),
+            hit_ratio=(stats["hits"] + stats["coalesced"]) / lookups
+            if lookups else 0.0,
+            fetches=self.fetch_count,
+            fetch_mean_ms=1000 * self.fetch_seconds / self.fetch_count
+            if self.fetch_count else 0.0,
+            fetch_max_ms=1000 * self.fetch_max_seconds)
+        return stats
+
+
+class TickerFetcher:
+    """
+    Coroutine front end to a source.  At most max_workers source calls run
+    at once; callers beyond that wait on the pool's queue without blocking
+    the event loop.  With a cache, quotes are kept for quote_ttl seconds
+    and sheets and annual data for fundamentals_ttl seconds.
+    """
+
+    def __init__(self, source, max_workers=8, cache=None, quote_ttl=15,
+                 fundamentals_ttl=6 * 3600):
+        self.source = source
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers,
+                                           thread_name_prefix="fetch")
+        self.cache = cache
+        self.quote_ttl = quote_ttl
+        self.fundamentals_ttl = fundamentals_ttl
+
+    async def _run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, fn, *args)
+
+    async def _cached(self, key, ttl, fn, *args):
+        if self.cache is None:
+            return await self._run(fn, *args)
+        return await self.cache.get(key, ttl, lambda: self._run(fn, *args))
+
+    async def stock_sheet(self, ticker):
+        return await self._cached(("sheet", ticker.upper()),
+                                  self.fundamentals_ttl,
+                                  self.source.stock_sheet, ticker)
+
+    async def compare_json(self, *tickers):
+        key = ("json",) + tuple(t.upper() for t in tickers)
+        return await self._cached(key, self.fundamentals_ttl,
+                                  self.source.compare_json, *tickers)
+
+    async def ten_year_data(self, ticker):
+        return await self._cached(("tenyear", ticker.upper()),
+                                  self.fundamentals_ttl,
+                                  self.source.ten_year_data, ticker)
+
+    async def quote(self, ticker):
+        return await self._cached(("quote", ticker.upper()), self.quote_ttl,
+                                  self.source.quote, ticker)
+
+    async def ticker(self, ticker):
+        """(sheet text, quote) for /ticker, fetched side by side"""
+        sheet, quote = await asyncio.gather(
+            self._cached(("tickersheet", ticker.upper()),
+                         self.fundamentals_ttl,
+                         self.source.ticker_sheet, ticker),
+            self.quote(ticker))
+        return sheet, quote
+
+    def close(self):
+        self.executor.shutdown(wait=False)
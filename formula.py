@@ -0,0 +1,1483 @@
+#!/usr/bin/env python3
+"""
+Server-side SocialCalc formula evaluation
+
+A Python counterpart of src/js/core/formula-parser.js: formulas are
+tokenized, parsed with the same operator precedence (unary minus binds
+tighter than ^, % is postfix, ^ is left associative), and evaluated
+against a socialcalc.Sheet.  Recalc keeps the parsed form of every formula
+cell and a dependency graph between cells, so after an edit only the cells
+downstream of it are evaluated again.
+
+Values inside the evaluator are plain Python objects: int/float for
+numbers, bool for logical results, str for text, None for a blank cell,
+Range for a range reference and FormulaError for an error value.
+"""
+
+import datetime
+import functools
+import math
+import re
+
+import socialcalc
+
+_colname = functools.lru_cache(maxsize=None)(socialcalc.number_to_colname)
+
+
+_coord_to_cr = functools.lru_cache(maxsize=65536)(socialcalc.coord_to_cr)
+
+
+def cr_to_coord(col, row):
+    return _colname(col) + str(row)
+
+
+class FormulaError(Exception):
+    """An error value such as #DIV/0!; raised inside the evaluator"""
+
+    def __init__(self, code, message=""):
+        Exception.__init__(self, code)
+        self.code = code
+        self.message = message or code
+
+    def __repr__(self):
+        return "<FormulaError %s>" % self.code
+
+
+class Range:
+    __slots__ = ("col1", "row1", "col2", "row2")
+
+    def __init__(self, col1, row1, col2, row2):
+        self.col1, self.col2 = min(col1, col2), max(col1, col2)
+        self.row1, self.row2 = min(row1, row2), max(row1, row2)
+
+    @property
+    def ncols(self):
+        return self.col2 - self.col1 + 1
+
+    @property
+    def nrows(self):
+        return self.row2 - self.row1 + 1
+
+    def coords(self):
+        """Coordinates in row-major order"""
+        for row in range(self.row1, self.row2 + 1):
+            for col in range(self.col1, self.col2 + 1):
+                yield cr_to_coord(col, row)
+
+    def __repr__(self):
+        return "%s:%s" % (cr_to_coord(self.col1, self.row1),
+                          cr_to_coord(self.col2, self.row2))
+
+
+#
+# Tokenizer
+#
+
+_token_re = re.compile(r"""
+    (?P<space>\s+)
+  | (?P<num>(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)
+  | (?P<str>"(?:[^"]|"")*")
+  | (?P<err>\#(?:NULL!|NUM!|DIV/0!|VALUE!|REF!|NAME\?|N/A))
+  | (?P<sheetref>(?:[A-Za-z_][\w.]*|'[^']+')!\$?[A-Za-z]{1,2}\$?[1-9]\d*)
+  | (?P<coord>\$?[A-Za-z]{1,2}\$?[1-9]\d*)(?![\w.(])
+  | (?P<name>[A-Za-z_][\w.]*)
+  | (?P<op><=|>=|<>|[-+*/^&%<>=():,])
+""", re.X)
+
+
+def tokenize(text):
+    """Returns a list of (kind, text) tokens; raises FormulaError on junk"""
+    tokens = []
+    pos = 0
+    while pos < len(text):
+        m = _token_re.match(text, pos)
+        if not m:
+            raise FormulaError("#VALUE!", "Unexpected character in formula: "
+                               + text[pos])
+        kind = m.lastgroup
+        if kind != "space":
+            tokens.append((kind, m.group(kind)))
+        pos = m.end()
+    return tokens
+
+
+#
+# Parser: builds a tree of tuples
+#
+#   ("num", v) ("str", s) ("err", code) ("ref", col, row, rowabs)
+#   ("range", col1, row1, col2, row2, row1abs, row2abs)
+#   ("name", NAME) ("xref", text)
+#
+# rowabs flags record a $ before the row number; copied-down formulas
+# differ only in their relative rows.
+#   ("neg", a) ("pct", a) ("bin", op, a, b) ("call", NAME, [args])
+#
+
+_COMPARISONS = ("=", "<>", "<", ">", "<=", ">=")
+
+
+class _Parser:
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.pos = 0
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return (None, None)
+
+    def take(self):
+        token = self.peek()
+        self.pos += 1
+        return token
+
+    def expect(self, text):
+        kind, value = self.take()
+        if value != text:
+            raise FormulaError("#VALUE!", "Expected %s in formula" % text)
+
+    def binary(self, operators, operand):
+        node = operand()
+        while self.peek()[0] == "op" and self.peek()[1] in operators:
+            op = self.take()[1]
+            node = ("bin", op, node, operand())
+        return node
+
+    def expression(self):
+        return self.binary(_COMPARISONS, self.concat)
+
+    def concat(self):
+        return self.binary(("&",), self.additive)
+
+    def additive(self):
+        return self.binary(("+", "-"), self.term)
+
+    def term(self):
+        return self.binary(("*", "/"), self.power)
+
+    def power(self):
+        return self.binary(("^",), self.unary)
+
+    def unary(self):
+        kind, value = self.peek()
+        if kind == "op" and value in ("-", "+"):
+            self.take()
+            operand = self.unary()
+            return ("neg", operand) if value == "-" else operand
+        return self.postfix()
+
+    def postfix(self):
+        node = self.primary()
+        while self.peek() == ("op", "%"):
+            self.take()
+            node = ("pct", node)
+        return node
+
+    def primary(self):
+        kind, value = self.take()
+        if kind == "num":
+            return ("num", socialcalc.to_number(value))
+        if kind == "str":
+            return ("str", value[1:-1].replace('""', '"'))
+        if kind == "err":
+            return ("err", value)
+        if kind == "sheetref":
+            return ("xref", value)
+        if kind == "coord":
+            col, row = socialcalc.coord_to_cr(value)
+            rowabs = value.rfind("$") > 0
+            if self.peek() == ("op", ":"):
+                self.take()
+                kind, value = self.take()
+                if kind != "coord":
+                    raise FormulaError("#VALUE!", "Bad range in formula")
+                col2, row2 = socialcalc.coord_to_cr(value)
+                row2abs = value.rfind("$") > 0
+                if row2 < row:
+                    row, row2, rowabs, row2abs = row2, row, row2abs, rowabs
+                return ("range", min(col, col2), row, max(col, col2), row2,
+                        rowabs, row2abs)
+            return ("ref", col, row, rowabs)
+        if kind == "name":
+            name = value.upper()
+            if self.peek() == ("op", "("):
+                self.take()
+                args = []
+                if self.peek() != ("op", ")"):
+                    args.append(self.expression())
+                    while self.peek() == ("op", ","):
+                        self.take()
+                        args.append(self.expression())
+                self.expect(")")
+                return ("call", name, args)
+            return ("name", name)
+        if (kind, value) == ("op", "("):
+            node = self.expression()
+            self.expect(")")
+            return node
+        if kind is None:
+            raise FormulaError("#VALUE!", "Missing operand in formula")
+        raise FormulaError("#VALUE!", "Unexpected %s in formula" % value)
+
+
+class ParsedFormula:
+    """A parsed formula and the cells and ranges it reads"""
+
+    __slots__ = ("text", "tree", "error", "refs", "ranges", "names")
+
+    def __init__(self, text):
+        self.text = text
+        self.tree = None
+        self.error = None
+        self.refs = set()
+        self.ranges = []
+        self.names = set()
+        try:
+            parser = _Parser(tokenize(text))
+            self.tree = parser.expression()
+            if parser.pos != len(parser.tokens):
+                raise FormulaError("#VALUE!", "Error in formula")
+        except FormulaError as e:
+            self.error = e
+            return
+        self._collect(self.tree)
+
+    def _collect(self, node):
+        kind = node[0]
+        if kind == "ref":
+            self.refs.add(cr_to_coord(node[1], node[2]))
+        elif kind == "range":
+            self.ranges.append(Range(*node[1:5]))
+        elif kind == "name":
+            self.names.add(node[1])
+        elif kind in ("neg", "pct"):
+            self._collect(node[1])
+        elif kind == "bin":
+            self._collect(node[2])
+            self._collect(node[3])
+        elif kind == "call":
+            for arg in node[2]:
+                self._collect(arg)
+
+
+@functools.lru_cache(maxsize=20000)
+def parse(text):
+    """Parses formula text (without the leading '='); results are shared"""
+    return ParsedFormula(text)
+
+
+#
+# Value conversion
+#
+
+def _is_error(value):
+    return isinstance(value, FormulaError)
+
+
+def to_number(value):
+    if value is None:
+        return 0
+    if isinstance(value, (int, float)):
+        return value
+    if isinstance(value, FormulaError):
+        raise value
+    if isinstance(value, Range):
+        raise FormulaError("#VALUE!", "Range used where a value was expected")
+    number = _parse_number(value)
+    if number is None:
+        raise FormulaError("#VALUE!")
+    return number
+
+
+_number_re = re.compile(r"[-+]?(?:\d[\d,]*\.?\d*|\.\d+)(?:[eE][-+]?\d+)?$")
+
+
+def _parse_number(text):
+    """Returns text as a number, or None if it is not one"""
+    text = text.strip()
+    if not _number_re.match(text):
+        return None
+    return socialcalc.to_number(text.replace(",", ""))
+
+
+def to_text(value):
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "TRUE" if value else "FALSE"
+    if isinstance(value, (int, float)):
+        return socialcalc.format_number(value)
+    if isinstance(value, FormulaError):
+        raise value
+    if isinstance(value, Range):
+        raise FormulaError("#VALUE!", "Range used where a value was expected")
+    return value
+
+
+def to_bool(value):
+    if isinstance(value, str):
+        upper = value.upper()
+        if upper in ("TRUE", "FALSE"):
+            return upper == "TRUE"
+        raise FormulaError("#VALUE!")
+    return bool(to_number(value))
+
+
+def _compare(op, a, b):
+    if _is_error(a):
+        raise a
+    if _is_error(b):
+        raise b
+    if isinstance(a, (int, float)) and isinstance(b, (int, float)):
+        x, y = a, b
+    else:
+        x, y = to_text(a).lower(), to_text(b).lower()
+    if op == "=":
+        return x == y
+    if op == "<>":
+        return x != y
+    if op == "<":
+        return x < y
+    if op == ">":
+        return x > y
+    if op == "<=":
+        return x <= y
+    return x >= y
+
+
+#
+# Evaluator
+#
+
+class Context:
+    """Reads cell values for the evaluator"""
+
+    def __init__(self, sheet):
+        self.sheet = sheet
+        self.cells = sheet.cells
+
+    def value(self, coord):
+        cell = self.cells.get(coord)
+        if cell is None or cell.datatype is None:
+            return None
+        vtype = cell.valuetype
+        if vtype == "n":
+            value = cell.datavalue
+            if value.__class__ is int or value.__class__ is float:
+                return value
+        if vtype[:1] == "e":
+            return FormulaError(vtype[1:] or "#VALUE!", cell.errors)
+        if vtype == "nl":
+            return bool(cell.datavalue)
+        if vtype[:1] == "n":
+            value = cell.datavalue
+            return value if isinstance(value, (int, float)) else \
+                socialcalc.to_number(str(value))
+        if vtype == "b" or cell.datavalue == "":
+            return None
+        return cell.datavalue
+
+    def range_values(self, r):
+        """Values of a range in row-major order"""
+        value = self.value
+        names = [_colname(col) for col in range(r.col1, r.col2 + 1)]
+        return [value(name + str(row))
+                for row in range(r.row1, r.row2 + 1) for name in names]
+
+    def range_value(self, r, rowoffset, coloffset):
+        return self.value(cr_to_coord(r.col1 + coloffset, r.row1 + rowoffset))
+
+
+def evaluate(node, ctx):
+    kind = node[0]
+    if kind == "num" or kind == "str":
+        return node[1]
+    if kind == "ref":
+        return ctx.value(cr_to_coord(node[1], node[2]))
+    if kind == "bin":
+        op = node[1]
+        a = evaluate(node[2], ctx)
+        b = evaluate(node[3], ctx)
+        if op == "+":
+            return to_number(a) + to_number(b)
+        if op == "-":
+            return to_number(a) - to_number(b)
+        if op == "*":
+            return to_number(a) * to_number(b)
+        if op == "/":
+            divisor = to_number(b)
+            dividend = to_number(a)
+            if divisor == 0:
+                raise FormulaError("#DIV/0!")
+            return dividend / divisor
+        if op == "^":
+            try:
+                result = math.pow(to_number(a), to_number(b))
+            except (ValueError, OverflowError):
+                raise FormulaError("#NUM!")
+            return int(result) if result.is_integer() and \
+                abs(result) < 2 ** 53 else result
+        if op == "&":
+            return to_text(a) + to_text(b)
+        return _compare(op, a, b)
+    if kind == "range":
+        return Range(*node[1:5])
+    if kind == "call":
+        return call_function(node[1], node[2], ctx)
+    if kind == "neg":
+        return -to_number(evaluate(node[1], ctx))
+    if kind == "pct":
+        return to_number(evaluate(node[1], ctx)) * 0.01
+    if kind == "name":
+        return lookup_name(node[1], ctx)
+    if kind == "err":
+        raise FormulaError(node[1])
+    if kind == "xref":
+        raise FormulaError("#REF!", "References to other sheets are not "
+                           "available on the server: " + node[1])
+    raise FormulaError("#VALUE!", "Unknown formula element")
+
+
+def lookup_name(name, ctx):
+    if name in ("TRUE", "FALSE"):
+        return name == "TRUE"
+    entry = ctx.sheet.names.get(name)
+    if entry is None:
+        raise FormulaError("#NAME?", "Unknown name " + name)
+    definition = entry["definition"]
+    if definition.startswith("="):
+        definition = definition[1:]
+    parsed = parse(definition)
+    if parsed.error:
+        raise parsed.error
+    return evaluate(parsed.tree, ctx)
+
+
+FUNCTIONS = {}
+
+# Functions that take their error arguments as values instead of failing
+_ERROR_TOLERANT = set()
+
+
+def function(*names, **options):
+    def register(fn):
+        for name in names:
+            FUNCTIONS[name] = fn
+            if options.get("errors"):
+                _ERROR_TOLERANT.add(name)
+        return fn
+    return register
+
+
+def call_function(name, argnodes, ctx):
+    fn = FUNCTIONS.get(name)
+    if fn is None:
+        raise FormulaError("#NAME?", "Unknown function " + name)
+    if name in _ERROR_TOLERANT:
+        args = []
+        for node in argnodes:
+            try:
+                args.append(evaluate(node, ctx))
+            except FormulaError as e:
+                args.append(e)
+    else:
+        args = [evaluate(node, ctx) for node in argnodes]
+    try:
+        return fn(ctx, *args)
+    except TypeError:
+        raise FormulaError("#VALUE!", "Incorrect arguments to function "
+                           + name)
+
+
+def _flatten(ctx, args):
+    """Series values: numbers, text, blanks and errors from args and ranges"""
+    for arg in args:
+        if isinstance(arg, Range):
+            yield from ctx.range_values(arg)
+        else:
+            yield arg
+
+
+def _numbers(ctx, args):
+    numbers = []
+    for value in _flatten(ctx, args):
+        if isinstance(value, (int, float)):
+            numbers.append(value)
+        elif _is_error(value):
+            raise value
+    return numbers
+
+
+#
+# Statistical series functions
+#
+
+@function("SUM")
+def _sum(ctx, *args):
+    return math.fsum(_numbers(ctx, args)) if args else 0
+
+
+@function("PRODUCT")
+def _product(ctx, *args):
+    return math.prod(_numbers(ctx, args))
+
+
+@function("MIN")
+def _min(ctx, *args):
+    return min(_numbers(ctx, args), default=0)
+
+
+@function("MAX")
+def _max(ctx, *args):
+    return max(_numbers(ctx, args), default=0)
+
+
+@function("COUNT")
+def _count(ctx, *args):
+    return sum(1 for v in _flatten(ctx, args)
+               if isinstance(v, (int, float)))
+
+
+@function("COUNTA", errors=True)
+def _counta(ctx, *args):
+    return sum(1 for v in _flatten(ctx, args) if v is not None)
+
+
+@function("COUNTBLANK")
+def _countblank(ctx, *args):
+    return sum(1 for v in _flatten(ctx, args) if v is None)
+
+
+@function("AVERAGE")
+def _average(ctx, *args):
+    numbers = _numbers(ctx, args)
+    if not numbers:
+        raise FormulaError("#DIV/0!")
+    return math.fsum(numbers) / len(numbers)
+
+
+def _variance(ctx, args, population):
+    numbers = _numbers(ctx, args)
+    if len(numbers) < 2:
+        raise FormulaError("#DIV/0!")
+    mean = math.fsum(numbers) / len(numbers)
+    ss = math.fsum((x - mean) ** 2 for x in numbers)
+    return ss / (len(numbers) if population else len(numbers) - 1)
+
+
+@function("VAR")
+def _var(ctx, *args):
+    return _variance(ctx, args, False)
+
+
+@function("VARP")
+def _varp(ctx, *args):
+    return _variance(ctx, args, True)
+
+
+@function("STDEV")
+def _stdev(ctx, *args):
+    return math.sqrt(_variance(ctx, args, False))
+
+
+@function("STDEVP")
+def _stdevp(ctx, *args):
+    return math.sqrt(_variance(ctx, args, True))
+
+
+#
+# Logical and information functions
+#
+
+@function("IF", errors=True)
+def _if(ctx, cond, iftrue=True, iffalse=False):
+    if _is_error(cond):
+        raise cond
+    result = iftrue if to_bool(cond) else iffalse
+    if _is_error(result):
+        raise result
+    return result
+
+
+@function("AND")
+def _and(ctx, *args):
+    return all(to_bool(v) for v in _flatten(ctx, args) if v is not None)
+
+
+@function("OR")
+def _or(ctx, *args):
+    return any(to_bool(v) for v in _flatten(ctx, args) if v is not None)
+
+
+@function("NOT")
+def _not(ctx, value):
+    return not to_bool(value)
+
+
+@function("TRUE")
+def _true(ctx):
+    return True
+
+
+@function("FALSE")
+def _false(ctx):
+    return False
+
+
+@function("NA")
+def _na(ctx):
+    raise FormulaError("#N/A")
+
+
+def _single(ctx, value):
+    if isinstance(value, Range):
+        return ctx.range_value(value, 0, 0)
+    return value
+
+
+@function("ISERROR", errors=True)
+def _iserror(ctx, value):
+    return _is_error(_single(ctx, value))
+
+
+@function("ISERR", errors=True)
+def _iserr(ctx, value):
+    value = _single(ctx, value)
+    return _is_error(value) and value.code != "#N/A"
+
+
+@function("ISNA", errors=True)
+def _isna(ctx, value):
+    value = _single(ctx, value)
+    return _is_error(value) and value.code == "#N/A"
+
+
+@function("ISBLANK", errors=True)
+def _isblank(ctx, value):
+    return _single(ctx, value) is None
+
+
+@function("ISNUMBER", errors=True)
+def _isnumber(ctx, value):
+    value = _single(ctx, value)
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+@function("ISTEXT", errors=True)
+def _istext(ctx, value):
+    return isinstance(_single(ctx, value), str)
+
+
+@function("ISLOGICAL", errors=True)
+def _islogical(ctx, value):
+    return isinstance(_single(ctx, value), bool)
+
+
+@function("CHOOSE", errors=True)
+def _choose(ctx, index, *choices):
+    if _is_error(index):
+        raise index
+    i = int(to_number(index))
+    if i < 1 or i > len(choices):
+        raise FormulaError("#VALUE!")
+    result = choices[i - 1]
+    if _is_error(result):
+        raise result
+    return result
+
+
+#
+# Math functions
+#
+
+def _num(value):
+    return to_number(value)
+
+
+@function("ABS")
+def _abs(ctx, x):
+    return abs(_num(x))
+
+
+@function("INT")
+def _int(ctx, x):
+    return math.floor(_num(x))
+
+
+@function("TRUNC")
+def _trunc(ctx, x, digits=0):
+    factor = 10 ** int(_num(digits))
+    return math.trunc(_num(x) * factor) / factor
+
+
+@function("ROUND")
+def _round(ctx, x, digits=0):
+    x, digits = _num(x), int(_num(digits))
+    # round half away from zero, like the browser engine
+    factor = 10 ** digits
+    result = math.floor(abs(x) * factor + 0.5) / factor
+    result = math.copysign(result, x)
+    return int(result) if digits <= 0 else result
+
+
+@function("MOD")
+def _mod(ctx, x, y):
+    x, y = _num(x), _num(y)
+    if y == 0:
+        raise FormulaError("#DIV/0!")
+    return x - y * math.floor(x / y)
+
+
+@function("SQRT")
+def _sqrt(ctx, x):
+    x = _num(x)
+    if x < 0:
+        raise FormulaError("#NUM!")
+    return math.sqrt(x)
+
+
+@function("POWER")
+def _power(ctx, x, y):
+    try:
+        return math.pow(_num(x), _num(y))
+    except (ValueError, OverflowError):
+        raise FormulaError("#NUM!")
+
+
+@function("EXP")
+def _exp(ctx, x):
+    try:
+        return math.exp(_num(x))
+    except OverflowError:
+        raise FormulaError("#NUM!")
+
+
+def _log(x, base):
+    if x <= 0 or base <= 0 or base == 1:
+        raise FormulaError("#NUM!")
+    return math.log(x, base)
+
+
+@function("LN")
+def _ln(ctx, x):
+    return _log(_num(x), math.e)
+
+
+@function("LOG")
+def _logfn(ctx, x, base=10):
+    return _log(_num(x), _num(base))
+
+
+@function("LOG10")
+def _log10(ctx, x):
+    return _log(_num(x), 10)
+
+
+@function("PI")
+def _pi(ctx):
+    return math.pi
+
+
+#
+# Text functions
+#
+
+@function("LEN")
+def _len(ctx, s):
+    return len(to_text(s))
+
+
+@function("LEFT")
+def _left(ctx, s, n=1):
+    return to_text(s)[:max(0, int(_num(n)))]
+
+
+@function("RIGHT")
+def _right(ctx, s, n=1):
+    n = max(0, int(_num(n)))
+    return to_text(s)[-n:] if n else ""
+
+
+@function("MID")
+def _mid(ctx, s, start, n):
+    start = int(_num(start))
+    if start < 1:
+        raise FormulaError("#VALUE!")
+    return to_text(s)[start - 1:start - 1 + max(0, int(_num(n)))]
+
+
+@function("UPPER")
+def _upper(ctx, s):
+    return to_text(s).upper()
+
+
+@function("LOWER")
+def _lower(ctx, s):
+    return to_text(s).lower()
+
+
+@function("PROPER")
+def _proper(ctx, s):
+    return to_text(s).title()
+
+
+@function("TRIM")
+def _trim(ctx, s):
+    return " ".join(to_text(s).split())
+
+
+@function("EXACT")
+def _exact(ctx, a, b):
+    return to_text(a) == to_text(b)
+
+
+@function("VALUE")
+def _value(ctx, s):
+    if isinstance(s, (int, float)):
+        return s
+    number = _parse_number(to_text(s))
+    if number is None:
+        raise FormulaError("#VALUE!")
+    return number
+
+
+#
+# Lookup functions
+#
+
+def _criteria_match(value, criteria):
+    """SocialCalc.Formula.TestCriteria"""
+    if _is_error(criteria) or _is_error(value):
+        return False
+    if isinstance(criteria, (int, float)):
+        comparator, base = "none", criteria
+    else:
+        criteria = to_text(criteria)
+        for comparator in ("<=", "<>", ">=", "=", "<", ">"):
+            if criteria.startswith(comparator):
+                criteria = criteria[len(comparator):]
+                break
+        else:
+            comparator = "none"
+        if not criteria:
+            if comparator == "none":
+                return False
+            if value is None:
+                return comparator == "="
+            return comparator == "<>"
+        base = _parse_number(criteria)
+        if base is None:
+            base = criteria
+    if isinstance(base, (int, float)):
+        if isinstance(value, str):
+            number = _parse_number(value)
+            value = value if number is None else number
+        if not isinstance(value, (int, float)):
+            return comparator == "<>"
+    else:
+        if isinstance(value, (int, float)) or value is None:
+            value = to_text(value)
+        base, value = base.lower(), value.lower()
+        if comparator == "none":
+            return value.startswith(base)
+    if comparator in ("none", "="):
+        return value == base
+    if comparator == "<>":
+        return value != base
+    if comparator == "<":
+        return value < base
+    if comparator == ">":
+        return value > base
+    if comparator == "<=":
+        return value <= base
+    return value >= base
+
+
+def _need_range(value):
+    if not isinstance(value, Range):
+        raise FormulaError("#VALUE!", "Range expected")
+    return value
+
+
+@function("SUMIF")
+def _sumif(ctx, r, criteria, sumrange=None):
+    r = _need_range(r)
+    sumrange = _need_range(sumrange) if sumrange is not None else r
+    total = 0
+    for i, value in enumerate(ctx.range_values(r)):
+        if _criteria_match(value, criteria):
+            target = ctx.range_value(sumrange, i // r.ncols, i % r.ncols)
+            if isinstance(target, (int, float)):
+                total += target
+            elif _is_error(target):
+                raise target
+    return total
+
+
+@function("COUNTIF")
+def _countif(ctx, r, criteria):
+    return sum(1 for value in ctx.range_values(_need_range(r))
+               if _criteria_match(value, criteria))
+
+
+def _lookup_equal(a, b):
+    if isinstance(a, str) and isinstance(b, str):
+        return a.lower() == b.lower()
+    return a == b
+
+
+def _lookup_less(a, b):
+    """a <= b for the approximate lookups; mixed types never compare"""
+    if isinstance(a, (int, float)) and isinstance(b, (int, float)):
+        return a <= b
+    if isinstance(a, str) and isinstance(b, str):
+        return a.lower() <= b.lower()
+    return None
+
+
+def _search(values, target, approximate):
+    """Index of target in values, or of the last value <= target"""
+    found = None
+    for i, value in enumerate(values):
+        if approximate:
+            less = _lookup_less(value, target)
+            if less is None:
+                continue
+            if not less:
+                break
+            found = i
+        elif _lookup_equal(value, target):
+            return i
+    if found is None:
+        raise FormulaError("#N/A")
+    return found
+
+
+def _table_lookup(ctx, target, r, offset, approximate, vertical):
+    r = _need_range(r)
+    target = _single(ctx, target)
+    offset = int(_num(offset))
+    if offset < 1:
+        raise FormulaError("#VALUE!")
+    if offset > (r.ncols if vertical else r.nrows):
+        raise FormulaError("#REF!")
+    if vertical:
+        keys = [ctx.range_value(r, i, 0) for i in range(r.nrows)]
+    else:
+        keys = [ctx.range_value(r, 0, i) for i in range(r.ncols)]
+    i = _search(keys, target, to_bool(approximate))
+    if vertical:
+        return ctx.range_value(r, i, offset - 1)
+    return ctx.range_value(r, offset - 1, i)
+
+
+@function("VLOOKUP")
+def _vlookup(ctx, target, r, offset, approximate=True):
+    return _table_lookup(ctx, target, r, offset, approximate, True)
+
+
+@function("HLOOKUP")
+def _hlookup(ctx, target, r, offset, approximate=True):
+    return _table_lookup(ctx, target, r, offset, approximate, False)
+
+
+@function("MATCH")
+def _match(ctx, target, r, matchtype=1):
+    r = _need_range(r)
+    values = ctx.range_values(r)
+    matchtype = int(_num(matchtype))
+    target = _single(ctx, target)
+    if matchtype == 0:
+        return _search(values, target, False) + 1
+    if matchtype > 0:
+        return _search(values, target, True) + 1
+    found = None
+    for i, value in enumerate(values):
+        less = _lookup_less(target, value)
+        if less is None:
+            continue
+        if not less:
+            break
+        found = i
+    if found is None:
+        raise FormulaError("#N/A")
+    return found + 1
+
+
+@function("INDEX")
+def _index(ctx, r, row=0, col=0):
+    r = _need_range(r)
+    row, col = int(_num(row)), int(_num(col))
+    if r.nrows == 1 and col == 0:
+        row, col = 1, row
+    row, col = max(row, 1), max(col, 1)
+    if row > r.nrows or col > r.ncols:
+        raise FormulaError("#REF!")
+    return ctx.range_value(r, row - 1, col - 1)
+
+
+@function("LOOKUP")
+def _lookupfn(ctx, target, r, resultrange=None):
+    r = _need_range(r)
+    i = _search(ctx.range_values(r), _single(ctx, target), True)
+    if resultrange is None:
+        return ctx.range_values(r)[i]
+    return ctx.range_values(_need_range(resultrange))[i]
+
+
+@function("ROWS")
+def _rows(ctx, r):
+    return _need_range(r).nrows
+
+
+@function("COLUMNS")
+def _columns(ctx, r):
+    return _need_range(r).ncols
+
+
+#
+# Date functions, as serial days from 1899-12-30
+#
+
+_EPOCH = datetime.date(1899, 12, 30)
+
+
+def _to_date(serial):
+    return _EPOCH + datetime.timedelta(days=int(math.floor(_num(serial))))
+
+
+@function("DATE")
+def _date(ctx, year, month, day):
+    year, month, day = int(_num(year)), int(_num(month)), int(_num(day))
+    year += (month - 1) // 12
+    month = (month - 1) % 12 + 1
+    try:
+        start = datetime.date(year, month, 1)
+    except ValueError:
+        raise FormulaError("#NUM!")
+    return (start - _EPOCH).days + day - 1
+
+
+@function("YEAR")
+def _year(ctx, serial):
+    return _to_date(serial).year
+
+
+@function("MONTH")
+def _month(ctx, serial):
+    return _to_date(serial).month
+
+
+@function("DAY")
+def _day(ctx, serial):
+    return _to_date(serial).day
+
+
+@function("TODAY")
+def _today(ctx):
+    return (datetime.date.today() - _EPOCH).days
+
+
+@function("NOW")
+def _now(ctx):
+    now = datetime.datetime.now()
+    midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    return (now.date() - _EPOCH).days + \
+        (now - midnight).total_seconds() / 86400.0
+
+
+#
+# Financial functions
+#
+
+@function("NPV")
+def _npv(ctx, rate, *values):
+    rate = _num(rate)
+    total = 0
+    for i, value in enumerate(_numbers(ctx, values), 1):
+        if rate == -1:
+            raise FormulaError("#DIV/0!")
+        total += value / (1 + rate) ** i
+    return total
+
+
+@function("IRR")
+def _irr(ctx, values, guess=0.1):
+    flows = _numbers(ctx, [values])
+    rate = _num(guess)
+    for _ in range(50):
+        # no rate at or below -100%, and Newton's method may run off
+        if rate <= -1:
+            break
+        npv = dnpv = 0.0
+        try:
+            for i, flow in enumerate(flows):
+                npv += flow / (1 + rate) ** i
+                dnpv -= i * flow / (1 + rate) ** (i + 1)
+        except ArithmeticError:
+            break
+        if dnpv == 0:
+            break
+        step = npv / dnpv
+        rate -= step
+        if abs(step) < 1e-10:
+            return rate
+    raise FormulaError("#NUM!")
+
+
+def _annuity(rate, nper, pmt, pv, fv, paytype):
+    """Zero when the time-value-of-money terms balance"""
+    if rate == 0:
+        return pv + pmt * nper + fv
+    growth = (1 + rate) ** nper
+    return pv * growth + pmt * (1 + rate * paytype) * (growth - 1) / rate + fv
+
+
+@function("PMT")
+def _pmt(ctx, rate, nper, pv, fv=0, paytype=0):
+    rate, nper, pv, fv, paytype = map(_num, (rate, nper, pv, fv, paytype))
+    if nper == 0:
+        raise FormulaError("#NUM!")
+    if rate == 0:
+        return -(pv + fv) / nper
+    growth = (1 + rate) ** nper
+    return -(pv * growth + fv) * rate / ((1 + rate * paytype) * (growth - 1))
+
+
+@function("PV")
+def _pv(ctx, rate, nper, pmt, fv=0, paytype=0):
+    rate, nper, pmt, fv, paytype = map(_num, (rate, nper, pmt, fv, paytype))
+    if rate == 0:
+        return -(pmt * nper + fv)
+    growth = (1 + rate) ** nper
+    return -(pmt * (1 + rate * paytype) * (growth - 1) / rate + fv) / growth
+
+
+@function("FV")
+def _fv(ctx, rate, nper, pmt, pv=0, paytype=0):
+    rate, nper, pmt, pv, paytype = map(_num, (rate, nper, pmt, pv, paytype))
+    if rate == 0:
+        return -(pv + pmt * nper)
+    growth = (1 + rate) ** nper
+    return -(pv * growth + pmt * (1 + rate * paytype) * (growth - 1) / rate)
+
+
+@function("NPER")
+def _nper(ctx, rate, pmt, pv, fv=0, paytype=0):
+    rate, pmt, pv, fv, paytype = map(_num, (rate, pmt, pv, fv, paytype))
+    if rate == 0:
+        if pmt == 0:
+            raise FormulaError("#NUM!")
+        return -(pv + fv) / pmt
+    adjusted = pmt * (1 + rate * paytype) / rate
+    try:
+        return math.log((adjusted - fv) / (adjusted + pv)) / math.log(1 + rate)
+    except (ValueError, ZeroDivisionError):
+        raise FormulaError("#NUM!")
+
+
+@function("RATE")
+def _rate(ctx, nper, pmt, pv, fv=0, paytype=0, guess=0.1):
+    nper, pmt, pv, fv, paytype, rate = map(_num, (nper, pmt, pv, fv,
+                                                   paytype, guess))
+    for _ in range(100):
+        value = _annuity(rate, nper, pmt, pv, fv, paytype)
+        delta = 1e-7
+        slope = (_annuity(rate + delta, nper, pmt, pv, fv, paytype)
+                 - value) / delta
+        if slope == 0:
+            break
+        step = value / slope
+        rate -= step
+        if abs(step) < 1e-10:
+            return rate
+    raise FormulaError("#NUM!")
+
+
+@function("SLN")
+def _sln(ctx, cost, salvage, life):
+    life = _num(life)
+    if life == 0:
+        raise FormulaError("#DIV/0!")
+    return (_num(cost) - _num(salvage)) / life
+
+
+@function("SYD")
+def _syd(ctx, cost, salvage, life, period):
+    cost, salvage, life, period = map(_num, (cost, salvage, life, period))
+    if life <= 0 or period < 1 or period > life:
+        raise FormulaError("#NUM!")
+    return (cost - salvage) * (life - period + 1) * 2 / (life * (life + 1))
+
+
+@function("DDB")
+def _ddb(ctx, cost, salvage, life, period, factor=2):
+    cost, salvage, life, period, factor = map(
+        _num, (cost, salvage, life, period, factor))
+    if life <= 0 or period < 1 or period > life:
+        raise FormulaError("#NUM!")
+    book = cost
+    depreciation = 0
+    for _ in range(int(math.ceil(period))):
+        depreciation = min(book * factor / life, max(book - salvage, 0))
+        book -= depreciation
+    return depreciation
+
+
+#
+# Recalculation
+#
+
+class DependencyGraph:
+    """
+    Which formula cells read which cells.
+
+    Single-cell references are kept in a reverse index from coord to
+    readers.  A range is kept as one edge however large it is: it is filed
+    under every (column, block of BLOCK rows) it overlaps, and a changed
+    cell only checks the ranges filed under its own column and block.
+    """
+
+    BLOCK = 256
+
+    def __init__(self):
+        self.precedents = {}    # reader -> (refs, ranges)
+        self.cell_readers = {}  # coord -> set of readers
+        self.range_readers = {} # (col, block) -> set of (row1, row2, reader)
+
+    def __len__(self):
+        return len(self.precedents)
+
+    def __contains__(self, coord):
+        return coord in self.precedents
+
+    def _buckets(self, r):
+        block = self.BLOCK
+        for col in range(r.col1, r.col2 + 1):
+            for b in range(r.row1 // block, r.row2 // block + 1):
+                yield col, b
+
+    def add(self, reader, refs, ranges):
+        self.remove(reader)
+        self.precedents[reader] = (refs, ranges)
+        for coord in refs:
+            self.cell_readers.setdefault(coord, set()).add(reader)
+        for r in ranges:
+            entry = (r.row1, r.row2, reader)
+            for key in self._buckets(r):
+                self.range_readers.setdefault(key, set()).add(entry)
+
+    def remove(self, reader):
+        refs, ranges = self.precedents.pop(reader, ((), ()))
+        for coord in refs:
+            readers = self.cell_readers.get(coord)
+            if readers is not None:
+                readers.discard(reader)
+                if not readers:
+                    del self.cell_readers[coord]
+        for r in ranges:
+            entry = (r.row1, r.row2, reader)
+            for key in self._buckets(r):
+                entries = self.range_readers.get(key)
+                if entries is not None:
+                    entries.discard(entry)
+                    if not entries:
+                        del self.range_readers[key]
+
+    def readers(self, coord):
+        """The formula cells that read coord directly"""
+        found = set(self.cell_readers.get(coord, ()))
+        col, row = _coord_to_cr(coord)
+        for row1, row2, reader in self.range_readers.get(
+                (col, row // self.BLOCK), ()):
+            if row1 <= row <= row2:
+                found.add(reader)
+        return found
+
+    def dirty(self, changed):
+        """The formula cells downstream of the changed coords, inclusive"""
+        seen = set(coord for coord in changed if coord in self.precedents)
+        stack = list(changed)
+        while stack:
+            for reader in self.readers(stack.pop()):
+                if reader not in seen:
+                    seen.add(reader)
+                    stack.append(reader)
+        return seen
+
+    def order(self, coords):
+        """
+        Topologically sorts the formula cells in coords, which must be
+        closed under readers().  Returns (ordered, circular): circular is
+        the set of cells that are part of a reference cycle; they appear
+        in ordered too, before the cells that read them.
+        """
+        # Tarjan's strongly connected components, without recursion so
+        # long dependency chains do not hit the recursion limit; the
+        # components come out readers-first
+        index = {}
+        low = {}
+        stack = []
+        onstack = set()
+        components = []
+        for root in coords:
+            if root in index:
+                continue
+            index[root] = low[root] = len(index)
+            stack.append(root)
+            onstack.add(root)
+            work = [(root, iter(self.readers(root)))]
+            while work:
+                node, successors = work[-1]
+                for succ in successors:
+                    if succ not in index:
+                        index[succ] = low[succ] = len(index)
+                        stack.append(succ)
+                        onstack.add(succ)
+                        work.append((succ, iter(self.readers(succ))))
+                        break
+                    if succ in onstack and index[succ] < low[node]:
+                        low[node] = index[succ]
+                else:
+                    work.pop()
+                    if work and low[node] < low[work[-1][0]]:
+                        low[work[-1][0]] = low[node]
+                    if low[node] == index[node]:
+                        component = []
+                        while True:
+                            member = stack.pop()
+                            onstack.discard(member)
+                            component.append(member)
+                            if member == node:
+                                break
+                        components.append(component)
+        ordered = []
+        circular = set()
+        for component in reversed(components):
+            if len(component) > 1 or \
+                    component[0] in self.readers(component[0]):
+                circular.update(component)
+            ordered.extend(component)
+        return ordered, circular
+
+
+class Recalc:
+    """
+    Evaluates the formula cells of a sheet in dependency order.
+
+    Parsed formulas are kept per cell until the formula text changes, and
+    the DependencyGraph is kept between calls, so recalc(changed) only
+    re-evaluates what depends on the changed cells.
+    """
+
+    def __init__(self, sheet):
+        self.sheet = sheet
+        self.ctx = Context(sheet)
+        self.parsed = {}            # coord -> ParsedFormula
+        self.graph = DependencyGraph()
+        for coord, cell in sheet.cells.items():
+            if cell.datatype == "f":
+                self._link(coord, cell.formula)
+
+    def _link(self, coord, text):
+        parsed = self.parsed[coord] = parse(text)
+        refs = set(parsed.refs)
+        ranges = list(parsed.ranges)
+        for name in parsed.names:
+            entry = self.sheet.names.get(name)
+            if entry is not None:
+                definition = parse(entry["definition"].lstrip("="))
+                refs.update(definition.refs)
+                ranges.extend(definition.ranges)
+        self.graph.add(coord, refs, ranges)
+
+    def _unlink(self, coord):
+        self.parsed.pop(coord, None)
+        self.graph.remove(coord)
+
+    def set_formula(self, coord, text):
+        cell = self.sheet.get_assured_cell(coord)
+        cell.datatype = "f"
+        cell.formula = text
+        cell.datavalue = 0
+        cell.valuetype = "n"
+        self._link(coord, text)
+
+    def set_value(self, coord, value):
+        cell = self.sheet.get_assured_cell(coord)
+        self._unlink(coord)
+        cell.formula = ""
+        if value is None or value == "":
+            cell.datatype, cell.valuetype, cell.datavalue = None, "b", ""
+        elif isinstance(value, (int, float)):
+            cell.datatype, cell.valuetype, cell.datavalue = "v", "n", value
+        else:
+            cell.datatype, cell.valuetype, cell.datavalue = "t", "t", value
+
+    def affected(self, changed):
+        """The formula cells downstream of the changed coords"""
+        return self.graph.dirty(changed)
+
+    def evaluate_cell(self, coord):
+        cell = self.sheet.cells[coord]
+        parsed = self.parsed[coord]
+        try:
+            if parsed.error:
+                raise parsed.error
+            value = evaluate(parsed.tree, self.ctx)
+            if isinstance(value, Range):
+                if value.nrows == 1 and value.ncols == 1:
+                    value = self.ctx.range_value(value, 0, 0)
+                else:
+                    raise FormulaError("#VALUE!", "Formula result is a range")
+            if _is_error(value):
+                raise value
+            if isinstance(value, float) and not math.isfinite(value):
+                raise FormulaError("#NUM!")
+        except FormulaError as e:
+            cell.datavalue, cell.valuetype, cell.errors = 0, "e" + e.code, \
+                e.message
+            return
+        except (ArithmeticError, ValueError) as e:
+            cell.datavalue, cell.valuetype, cell.errors = 0, "e#NUM!", str(e)
+            return
+        if cell.errors:
+            cell.errors = ""
+        if isinstance(value, bool):
+            cell.datavalue, cell.valuetype = int(value), "nl"
+        elif isinstance(value, (int, float)):
+            cell.datavalue, cell.valuetype = value, "n"
+        elif value is None:
+            cell.datavalue, cell.valuetype = 0, "n"
+        else:
+            cell.datavalue, cell.valuetype = value, "t"
+
+    def recalc(self, changed=None):
+        """
+        Recalculates everything, or only what depends on changed coords.
+        Returns the list of formula coords that were evaluated.
+        """
+        if changed is None:
+            coords = set(self.parsed)
+        else:
+            coords = self.affected(changed)
+        ordered, circular = self.graph.order(coords)
+        for coord in ordered:
+            if coord in circular:
+                cell = self.sheet.cells[coord]
+                cell.datavalue, cell.valuetype = 0, "e#REF!"
+                cell.errors = "Circular reference to " + coord
+            else:
+                self.evaluate_cell(coord)
+        if circular:
+            self.sheet.attribs["circularreferencecell"] = min(circular)
+        elif changed is None:
+            self.sheet.attribs.pop("circularreferencecell", None)
+        return ordered
+
+
+def recalc_save(text):
+    """Parses a spreadsheet save, recalculates it and writes it back out"""
+    sheet, otherparts = socialcalc.parse_spreadsheet_save(text)
+    Recalc(sheet).recalc()
+    return socialcalc.create_spreadsheet_save(sheet, otherparts)
@@ -0,0 +1,647 @@
+#!/usr/bin/env python3
+"""
+Vectorized full recalc for copied-down formulas
+
+Templates are mostly one formula copied down a column: B2*1.05, B3*1.05,
+... or SUM(C5:L5), SUM(C6:L6), ...  VectorRecalc groups the formula cells
+of each column whose parsed trees are the same once row numbers are made
+relative, and evaluates every such group as a handful of NumPy array
+operations over per-column value buffers.  Everything else, and any
+member whose inputs are not plain numbers, goes through the ordinary
+scalar evaluator, so results match formula.Recalc.
+
+The plan, the groups and their order, is built in one pass over the
+cells and kept by the sheet's layout (its cells, formulas and names), so
+recalculating the same template again, as sheetcommands.apply_to_save
+does for every compaction, skips it.
+
+Needs NumPy; without it VectorRecalc behaves exactly like formula.Recalc.
+"""
+
+import collections
+import hashlib
+import re
+
+import formula
+import socialcalc
+
+try:
+    import numpy
+    from numpy.lib.stride_tricks import sliding_window_view
+except ImportError:
+    numpy = None
+
+
+# Groups smaller than this are not worth the setup
+MIN_GROUP = 8
+
+# Plans kept for sheets recalculated again later, by layout
+PLAN_CACHE_SIZE = 8
+
+# Buffer status codes
+NUMBER, BLANK, TEXT, OTHER = 0, 1, 2, 3
+
+VECTOR_FUNCTIONS = ("SUM", "AVERAGE", "COUNT", "MIN", "MAX", "NPV", "ABS")
+_VECTOR_OPERATORS = ("+", "-", "*", "/", "^")
+
+# a coordinate as the sheet stores it
+_COORD = re.compile(r"([A-Z]+)(\d+)\Z")
+
+
+class _NotVectorizable(Exception):
+    pass
+
+
+def shape(node, row):
+    """The tree with row numbers made relative to row unless $-absolute"""
+    kind = node[0]
+    if kind == "ref":
+        col, r, rowabs = node[1:]
+        return ("ref", col, r if rowabs else r - row, rowabs)
+    if kind == "range":
+        col1, row1, col2, row2, abs1, abs2 = node[1:]
+        return ("range", col1, row1 if abs1 else row1 - row, col2,
+                row2 if abs2 else row2 - row, abs1, abs2)
+    if kind in ("neg", "pct"):
+        return (kind, shape(node[1], row))
+    if kind == "bin":
+        return ("bin", node[1], shape(node[2], row), shape(node[3], row))
+    if kind == "call":
+        return ("call", node[1], tuple(shape(arg, row) for arg in node[2]))
+    return node
+
+
+def vector_shape(node, row, inside_call=False):
+    """shape(node, row), or None if the tree cannot be vectorized"""
+    kind = node[0]
+    if kind == "ref":
+        col, r, rowabs = node[1:]
+        return ("ref", col, r if rowabs else r - row, rowabs)
+    if kind == "num":
+        return None if isinstance(node[1], bool) else node
+    if kind == "range":
+        if not inside_call:
+            return None
+        return shape(node, row)
+    if kind in ("neg", "pct"):
+        inner = vector_shape(node[1], row)
+        return None if inner is None else (kind, inner)
+    if kind == "bin":
+        if node[1] not in _VECTOR_OPERATORS:
+            return None
+        a = vector_shape(node[2], row)
+        b = vector_shape(node[3], row) if a is not None else None
+        return None if b is None else ("bin", node[1], a, b)
+    if kind == "call":
+        if node[1] not in VECTOR_FUNCTIONS:
+            return None
+        args = []
+        for arg in node[2]:
+            arg = vector_shape(arg, row, True)
+            if arg is None:
+                return None
+            args.append(arg)
+        return ("call", node[1], tuple(args))
+    return None
+
+
+def vectorizable(node):
+    return vector_shape(node, 0) is not None
+
+
+def _references(node):
+    """The ref and range nodes of a tree"""
+    kind = node[0]
+    if kind in ("ref", "range"):
+        yield node
+    elif kind in ("neg", "pct"):
+        yield from _references(node[1])
+    elif kind == "bin":
+        yield from _references(node[2])
+        yield from _references(node[3])
+    elif kind == "call":
+        for arg in node[2]:
+            yield from _references(arg)
+
+
+class Group:
+    """Formula cells in one column sharing one relative-row shape"""
+
+    def __init__(self, col, rows, coords, tree):
+        self.col = col
+        self.row0 = rows[0]
+        self.rows = numpy.array(rows)
+        self.coords = coords
+        self.tree = tree
+        self.scalar = False     # set once the tree turns out not to vectorize
+
+    def spans(self):
+        """(col1, col2, lo, hi) per reference; lo/hi are row arrays"""
+        for node in _references(self.tree):
+            if node[0] == "ref":
+                col1 = col2 = node[1]
+                row1 = row2 = node[2]
+                abs1 = abs2 = node[3]
+            else:
+                col1, row1, col2, row2, abs1, abs2 = node[1:]
+            lo = numpy.full(len(self.rows), row1) if abs1 else \
+                self.rows + (row1 - self.row0)
+            hi = numpy.full(len(self.rows), row2) if abs2 else \
+                self.rows + (row2 - self.row0)
+            yield col1, col2, lo, hi
+
+
+class Window:
+    """The cells a range argument covers, for each group member"""
+
+    def __init__(self, values, status, lo, hi, abs1, abs2):
+        n = len(lo)
+        if abs1 and abs2:
+            self.values = numpy.broadcast_to(
+                values[lo[0]:hi[0] + 1].reshape(1, -1), (n, values[
+                    lo[0]:hi[0] + 1].size))
+            self.status = numpy.broadcast_to(
+                status[lo[0]:hi[0] + 1].reshape(1, -1), self.values.shape)
+            self.cumulative = None
+        elif not abs1 and not abs2:
+            width = int(hi[0] - lo[0] + 1)
+            self.values = self._windows(values, width, lo)
+            self.status = self._windows(status, width, lo)
+            self.cumulative = None
+        else:
+            # one end fixed, e.g. SUM($B$1:B5): running totals
+            self.values = self.status = None
+            self.cumulative = (values, status, lo, hi)
+
+    @staticmethod
+    def _windows(array, width, lo):
+        """Row-major (n, width * ncols) view of the rows lo .. lo+width-1"""
+        windows = sliding_window_view(array, width, axis=0)[lo]
+        return windows.transpose(0, 2, 1).reshape(len(lo), -1)
+
+    def _running(self, array):
+        values, status, lo, hi = self.cumulative
+        sums = numpy.zeros(len(array) + 1)
+        numpy.cumsum(array.sum(axis=1), out=sums[1:])
+        return sums[hi + 1] - sums[lo]
+
+    def totals(self):
+        """(sum, count of numbers, any error-like cell) per member"""
+        if self.cumulative is not None:
+            values, status = self.cumulative[:2]
+            return (self._running(values),
+                    self._running((status == NUMBER).astype(float)),
+                    self._running((status == OTHER).astype(float)) > 0)
+        return (self.values.sum(axis=1),
+                (self.status == NUMBER).sum(axis=1),
+                (self.status == OTHER).any(axis=1))
+
+    def matrix(self):
+        if self.cumulative is not None:
+            raise _NotVectorizable()
+        return self.values, self.status
+
+
+class Plan:
+    """
+    The groups, the scalar cells left over and one evaluation order for
+    both, plus which cells feed the numeric buffers the groups read from.
+    A plan depends only on the sheet's layout, so recalcs of sheets with
+    the same layout share one.
+    """
+
+    def __init__(self, recalc):
+        self.units = []         # Group, or a coord evaluated by itself
+        self.columns = {}       # buffered col -> (rows, coords) of its cells
+        self.ordered = None     # unit indexes, None if there is a cycle
+        # one pass over the cells, each coordinate converted once
+        maxrow = 1
+        crs = {}
+        bycol = {}
+        byshape = {}
+        parsed = recalc.parsed
+        colnumbers = {}
+        match = _COORD.match
+        for coord in recalc.sheet.cells:
+            m = match(coord)
+            if m is None:
+                col, row = socialcalc.coord_to_cr(coord)
+            else:
+                name, row = m.group(1, 2)
+                col = colnumbers.get(name)
+                if col is None:
+                    col = colnumbers[name] = \
+                        socialcalc.colname_to_number(name)
+                row = int(row)
+            crs[coord] = col, row
+            if row > maxrow:
+                maxrow = row
+            bycol.setdefault(col, []).append(coord)
+            entry = parsed.get(coord)
+            if entry is None:
+                continue
+            tree = entry.tree and vector_shape(entry.tree, row)
+            if tree is None:
+                self.units.append(coord)
+                continue
+            byshape.setdefault((col, tree), []).append((row, coord))
+        self.maxrow = maxrow
+        self._group(recalc, byshape)
+        self._order(recalc, crs)
+        if self.ordered is not None:
+            self._columns(bycol, crs)
+
+    def _group(self, recalc, byshape):
+        for (col, _), members in byshape.items():
+            if len(members) < MIN_GROUP:
+                self.units.extend(coord for _, coord in members)
+                continue
+            members.sort()
+            rows = [row for row, _ in members]
+            coords = [coord for _, coord in members]
+            group = Group(col, rows, coords, recalc.parsed[coords[0]].tree)
+            if self._reads_itself(group):
+                self.units.extend(coords)
+            else:
+                self.units.append(group)
+
+    @staticmethod
+    def _reads_itself(group):
+        for col1, col2, lo, hi in group.spans():
+            if col1 <= group.col <= col2:
+                hits = numpy.searchsorted(group.rows, hi, "right") - \
+                    numpy.searchsorted(group.rows, lo, "left")
+                if hits.any():
+                    return True
+        return False
+
+    def _spans(self, recalc, unit, crs):
+        if isinstance(unit, Group):
+            for col1, col2, lo, hi in unit.spans():
+                yield col1, col2, int(lo.min()), int(hi.max())
+            return
+        refs, ranges = recalc.graph.precedents[unit]
+        for coord in refs:
+            col, row = crs.get(coord) or formula._coord_to_cr(coord)
+            yield col, col, row, row
+        for r in ranges:
+            yield r.col1, r.col2, r.row1, r.row2
+
+    def _order(self, recalc, crs):
+        # which unit holds each formula cell, by column and sorted row
+        bycol = {}
+        for i, unit in enumerate(self.units):
+            if isinstance(unit, Group):
+                for row in unit.rows.tolist():
+                    bycol.setdefault(unit.col, []).append((row, i))
+            else:
+                col, row = crs[unit]
+                bycol.setdefault(col, []).append((row, i))
+        index = {}
+        for col, entries in bycol.items():
+            entries.sort()
+            index[col] = (numpy.array([row for row, _ in entries]),
+                          numpy.array([i for _, i in entries]))
+
+        readers = [set() for _ in self.units]
+        pending = [0] * len(self.units)
+        for i, unit in enumerate(self.units):
+            precedents = set()
+            for col1, col2, lo, hi in self._spans(recalc, unit, crs):
+                self.maxrow = max(self.maxrow, hi)
+                for col in range(col1, col2 + 1):
+                    if col in index:
+                        rows, units = index[col]
+                        a = numpy.searchsorted(rows, lo, "left")
+                        b = numpy.searchsorted(rows, hi, "right")
+                        if b - a == 1:
+                            precedents.add(int(units[a]))
+                        elif b > a:
+                            precedents.update(numpy.unique(units[a:b])
+                                              .tolist())
+            if i in precedents:
+                return
+            pending[i] = len(precedents)
+            for precedent in precedents:
+                readers[precedent].add(i)
+
+        ready = [i for i, n in enumerate(pending) if n == 0]
+        ordered = []
+        while ready:
+            i = ready.pop()
+            ordered.append(i)
+            for reader in readers[i]:
+                pending[reader] -= 1
+                if pending[reader] == 0:
+                    ready.append(reader)
+        if len(ordered) == len(self.units):
+            self.ordered = ordered
+
+    def _columns(self, bycol, crs):
+        cols = set()
+        for unit in self.units:
+            if isinstance(unit, Group):
+                for col1, col2, _, _ in unit.spans():
+                    cols.update(range(col1, col2 + 1))
+        for col in cols:
+            coords = bycol.get(col, [])
+            self.columns[col] = (numpy.array([crs[coord][1]
+                                              for coord in coords], int),
+                                 coords)
+
+
+def layout(sheet):
+    """
+    A digest of what a plan depends on: the cells, their formulas and the
+    sheet's names
+    """
+    digest = hashlib.sha256()
+    for coord, cell in sheet.cells.items():
+        digest.update(("%s=%s\n" % (coord, cell.formula if cell.datatype == "f"
+                                     else "")).encode("utf-8"))
+    for name in sorted(sheet.names):
+        digest.update(("%s:%s\n" % (name, sheet.names[name]["definition"]))
+                      .encode("utf-8"))
+    return digest.digest()
+
+
+_plans = collections.OrderedDict()      # layout -> Plan
+
+
+def plan_for(recalc):
+    """The plan for recalc's sheet, built unless its layout was seen lately"""
+    key = layout(recalc.sheet)
+    plan = _plans.get(key)
+    if plan is None:
+        plan = _plans[key] = Plan(recalc)
+        if len(_plans) > PLAN_CACHE_SIZE:
+            _plans.popitem(last=False)
+    _plans.move_to_end(key)
+    return plan
+
+
+class _GroupEvaluator:
+    def __init__(self, buffers, group):
+        self.buffers = buffers
+        self.group = group
+        self.n = len(group.rows)
+        self.bad = numpy.zeros(self.n, bool)
+
+    def rows(self, row, rowabs):
+        if rowabs:
+            return numpy.full(self.n, row)
+        return self.group.rows + (row - self.group.row0)
+
+    def buffer(self, col):
+        return self.buffers[col]
+
+    def value(self, node):
+        kind = node[0]
+        if kind == "num":
+            return numpy.full(self.n, float(node[1]))
+        if kind == "ref":
+            values, status = self.buffer(node[1])
+            rows = self.rows(node[2], node[3])
+            self.bad |= status[rows] >= TEXT
+            return values[rows]
+        if kind == "neg":
+            return -self.value(node[1])
+        if kind == "pct":
+            return self.value(node[1]) * 0.01
+        if kind == "bin":
+            op = node[1]
+            a = self.value(node[2])
+            b = self.value(node[3])
+            if op == "+":
+                return a + b
+            if op == "-":
+                return a - b
+            if op == "*":
+                return a * b
+            if op == "/":
+                zero = b == 0
+                self.bad |= zero
+                return a / numpy.where(zero, 1, b)
+            return numpy.power(a, b)
+        if kind == "call":
+            return getattr(self, "call_" + node[1])(node[2])
+        raise _NotVectorizable()
+
+    def windows(self, args):
+        """Window for each range or reference argument, or a value array"""
+        for arg in args:
+            if arg[0] == "range":
+                col1, row1, col2, row2, abs1, abs2 = arg[1:]
+            elif arg[0] == "ref":
+                col1 = col2 = arg[1]
+                row1 = row2 = arg[2]
+                abs1 = abs2 = arg[3]
+            else:
+                yield self.value(arg)
+                continue
+            cols = range(col1, col2 + 1)
+            if len(cols) == 1:
+                values, status = self.buffer(col1)
+                values, status = values[:, None], status[:, None]
+            else:
+                values = numpy.stack([self.buffer(c)[0] for c in cols], 1)
+                status = numpy.stack([self.buffer(c)[1] for c in cols], 1)
+            yield Window(values, status, self.rows(row1, abs1),
+                         self.rows(row2, abs2), abs1, abs2)
+
+    def totals(self, args):
+        total = numpy.zeros(self.n)
+        count = numpy.zeros(self.n)
+        for window in self.windows(args):
+            if isinstance(window, Window):
+                sums, counts, bad = window.totals()
+                total += sums
+                count += counts
+                self.bad |= bad
+            else:
+                total += window
+                count += 1
+        return total, count
+
+    def extreme(self, args, reduce, empty):
+        result = numpy.full(self.n, empty)
+        for window in self.windows(args):
+            if isinstance(window, Window):
+                values, status = window.matrix()
+                self.bad |= (status == OTHER).any(axis=1)
+                values = numpy.where(status == NUMBER, values, empty)
+                result = reduce(result, reduce.reduce(values, axis=1))
+            else:
+                result = reduce(result, window)
+        return numpy.where(numpy.isinf(result), 0, result)
+
+    def call_SUM(self, args):
+        return self.totals(args)[0]
+
+    def call_COUNT(self, args):
+        for arg in args:
+            if arg[0] not in ("range", "ref"):
+                raise _NotVectorizable()
+        return self.totals(args)[1]
+
+    def call_AVERAGE(self, args):
+        total, count = self.totals(args)
+        self.bad |= count == 0
+        return total / numpy.where(count == 0, 1, count)
+
+    def call_MIN(self, args):
+        return self.extreme(args, numpy.minimum, numpy.inf)
+
+    def call_MAX(self, args):
+        return self.extreme(args, numpy.maximum, -numpy.inf)
+
+    def call_ABS(self, args):
+        if len(args) != 1 or args[0][0] == "range":
+            raise _NotVectorizable()
+        return numpy.abs(self.value(args[0]))
+
+    def call_NPV(self, args):
+        if len(args) < 2 or args[0][0] == "range":
+            raise _NotVectorizable()
+        rate = self.value(args[0])
+        columns = []
+        for window in self.windows(args[1:]):
+            if isinstance(window, Window):
+                values, status = window.matrix()
+                # blanks and text shift the discount periods
+                self.bad |= (status != NUMBER).any(axis=1)
+                columns.append(values)
+            else:
+                columns.append(window[:, None])
+        flows = numpy.concatenate(columns, axis=1)
+        self.bad |= rate == -1
+        periods = numpy.arange(1, flows.shape[1] + 1)
+        discount = (1 + numpy.where(rate == -1, 0, rate))[:, None] ** periods
+        return (flows / discount).sum(axis=1)
+
+    def evaluate(self):
+        with numpy.errstate(all="ignore"):
+            result = self.value(self.group.tree)
+            self.bad |= ~numpy.isfinite(result)
+        return result
+
+
+class VectorRecalc(formula.Recalc):
+    """
+    formula.Recalc with a vectorized full recalc.  The plan (groups and
+    their order) is looked up, or built, on the first full recalc and
+    kept until a formula is added, changed or removed.  The groups read
+    from per-column buffers of the current values, kept up to date as
+    cells are set and evaluated.
+    """
+
+    def __init__(self, sheet):
+        self.plan = None
+        self.buffers = {}       # col -> (values, status)
+        formula.Recalc.__init__(self, sheet)
+
+    def set_formula(self, coord, text):
+        self.plan = None
+        formula.Recalc.set_formula(self, coord, text)
+
+    def set_value(self, coord, value):
+        if coord in self.parsed:
+            self.plan = None
+        formula.Recalc.set_value(self, coord, value)
+        if self.plan is not None:
+            self.store(coord)
+
+    def evaluate_cell(self, coord):
+        formula.Recalc.evaluate_cell(self, coord)
+        if self.plan is not None:
+            self.store(coord)
+
+    def _fill(self):
+        """Fills the buffers the plan's groups read from"""
+        self.buffers = {}
+        size = self.plan.maxrow + 2
+        for col, (rows, coords) in self.plan.columns.items():
+            values = numpy.zeros(size)
+            status = numpy.full(size, BLANK, numpy.uint8)
+            self.buffers[col] = (values, status)
+            for row, coord in zip(rows.tolist(), coords):
+                self._store(values, status, row, coord)
+
+    def store(self, coord):
+        """Copies a cell's current value into the buffers"""
+        col, row = formula._coord_to_cr(coord)
+        buffer = self.buffers.get(col)
+        if buffer is None:
+            return
+        values, status = buffer
+        if row >= len(values):
+            grow = row + 1 - len(values) + 1024
+            values = numpy.concatenate([values, numpy.zeros(grow)])
+            status = numpy.concatenate(
+                [status, numpy.full(grow, BLANK, numpy.uint8)])
+            self.buffers[col] = (values, status)
+        self._store(values, status, row, coord)
+
+    def _store(self, values, status, row, coord):
+        value = self.ctx.value(coord)
+        if value is None:
+            values[row], status[row] = 0, BLANK
+        elif isinstance(value, bool) or isinstance(value, formula.FormulaError):
+            values[row], status[row] = 0, OTHER
+        elif isinstance(value, (int, float)):
+            values[row], status[row] = value, NUMBER
+        else:
+            values[row], status[row] = 0, TEXT
+
+    def recalc(self, changed=None):
+        if changed is not None or numpy is None:
+            return formula.Recalc.recalc(self, changed)
+        if self.plan is None:
+            self.plan = plan_for(self)
+            if self.plan.ordered is not None:
+                self._fill()
+        plan = self.plan
+        if plan.ordered is None:
+            # a reference cycle: leave it to the scalar path to report
+            return formula.Recalc.recalc(self)
+        evaluated = []
+        for i in plan.ordered:
+            unit = plan.units[i]
+            if isinstance(unit, Group):
+                self.evaluate_group(unit)
+                evaluated.extend(unit.coords)
+            else:
+                self.evaluate_cell(unit)
+                evaluated.append(unit)
+        self.sheet.attribs.pop("circularreferencecell", None)
+        return evaluated
+
+    def evaluate_group(self, group):
+        if not group.scalar:
+            evaluator = _GroupEvaluator(self.buffers, group)
+            try:
+                result = evaluator.evaluate()
+            except _NotVectorizable:
+                group.scalar = True
+        if group.scalar:
+            for coord in group.coords:
+                self.evaluate_cell(coord)
+            return
+        cells = self.sheet.cells
+        values, status = self.buffers.get(group.col, (None, None))
+        bad = evaluator.bad
+        for coord, value, isbad in zip(group.coords, result.tolist(),
+                                       bad.tolist()):
+            if isbad:
+                self.evaluate_cell(coord)
+                continue
+            cell = cells[coord]
+            cell.datavalue = value
+            cell.valuetype = "n"
+            if cell.errors:
+                cell.errors = ""
+        if values is not None:
+            good = ~bad
+            rows = group.rows[good]
+            values[rows] = result[good]
+            status[rows] = NUMBER
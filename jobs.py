@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+Export and import jobs on a pool of worker processes
+
+Downloads used to share one tmp.b / tmp.<suffix> pair under
+excelinterop/, so two exports at once overwrote each other's files, and
+a sheet being converted held the interpreter lock that the IOLoop
+needs.  JobRunner runs each conversion in a process of its own pool,
+with a scratch directory nothing else uses:
+
+    async with runner.submit(sheetexport.export_file, content, type) as job:
+        ...stream job.result, a file in job.directory...
+
+The function is called in a worker as fn(directory, *args) and must be
+importable at module level.  The directory and whatever the job left in
+it are removed when the block exits, however it exits.
+
+At most `workers` jobs run at once.  Up to `queue` more wait for a free
+worker, and submitting beyond that raises Busy straight away rather than
+letting the wait grow without bound.  A job running longer than
+`timeout` seconds, counted from when a worker picks it up, is
+interrupted in its worker with JobTimeout, so the worker is free for the
+next one.  A caller that goes away (a cancelled request) does not free
+the job's place or remove its directory while a worker is still writing
+there; both wait for the worker to finish, and a job that has not
+started yet is dropped from the queue.  stats() counts jobs by outcome.
+"""
+
+import asyncio
+import os
+import shutil
+import signal
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+
+class Busy(Exception):
+    """Every worker is busy and the queue is full"""
+
+
+class JobTimeout(Exception):
+    pass
+
+
+def _alarm(signum, frame):
+    raise JobTimeout("job ran out of time")
+
+
+def _run(fn, directory, timeout, args):
+    """In the worker: fn(directory, *args), interrupted after timeout"""
+    if timeout:
+        previous = signal.signal(signal.SIGALRM, _alarm)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        return fn(directory, *args)
+    finally:
+        if timeout:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous)
+
+
+class Job:
+    """A submitted job; use it with async with"""
+
+    def __init__(self, runner, fn, args):
+        self.runner = runner
+        self.fn = fn
+        self.args = args
+        self.directory = None
+        self.future = None
+        self.result = None
+
+    async def __aenter__(self):
+        self.directory = tempfile.mkdtemp(prefix="job-",
+                                          dir=self.runner.directory)
+        try:
+            work, future = self.runner._start(self.fn, self.directory,
+                                              self.args)
+        except BaseException:
+            self._cleanup()
+            raise
+        self.future = future
+        try:
+            self.result = await asyncio.shield(future)
+        except BaseException:
+            # not yet picked up by a worker: drop it from the queue
+            work.cancel()
+            self._cleanup()
+            raise
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self._cleanup()
+
+    def _cleanup(self):
+        future = self.future
+        if future is not None and not future.done():
+            # the worker is still writing there
+            future.add_done_callback(lambda _: self._cleanup())
+            return
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class JobRunner:
+    """
+    Runs jobs on `workers` processes, with scratch directories under
+    directory (a new temporary directory by default).
+    """
+
+    def __init__(self, workers=None, queue=32, timeout=120, directory=None,
+                 clock=time.monotonic):
+        self.workers = workers or os.cpu_count() or 1
+        self.queue = queue
+        self.timeout = timeout
+        self.clock = clock
+        self.directory = tempfile.mkdtemp(prefix="jobs-", dir=directory)
+        self.executor = ProcessPoolExecutor(self.workers)
+        self.pending = 0        # running or waiting for a worker
+        self.counters = dict(submitted=0, completed=0, failed=0,
+                             timed_out=0, rejected=0, cancelled=0)
+        self.seconds = 0.0
+
+    def submit(self, fn, *args):
+        """A Job running fn(directory, *args); raises Busy if full"""
+        if self.pending >= self.workers + self.queue:
+            self.counters["rejected"] += 1
+            raise Busy("%d jobs already running or queued" % self.pending)
+        return Job(self, fn, args)
+
+    def _start(self, fn, directory, args):
+        """
+        Queues fn for a worker; returns its concurrent.futures.Future and
+        an asyncio Future that settles once the worker is done with it
+        """
+        work = self.executor.submit(_run, fn, directory, self.timeout, args)
+        self.pending += 1
+        self.counters["submitted"] += 1
+        start = self.clock()
+        future = asyncio.wrap_future(work)
+        future.add_done_callback(lambda future: self._settled(future, start))
+        return work, future
+
+    def _settled(self, future, start):
+        self.pending -= 1
+        self.seconds += self.clock() - start
+        if future.cancelled():
+            self.counters["cancelled"] += 1
+        elif isinstance(future.exception(), JobTimeout):
+            self.counters["timed_out"] += 1
+        elif future.exception() is not None:
+            self.counters["failed"] += 1
+        else:
+            self.counters["completed"] += 1
+
+    def stats(self):
+        stats = dict(self.counters)
+        stats.update(workers=self.workers, queue=self.queue,
+                     running=min(self.pending, self.workers),
+                     queued=max(self.pending - self.workers, 0),
+                     seconds=round(self.seconds, 3))
+        return stats
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        shutil.rmtree(self.directory, ignore_errors=True)
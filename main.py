@@ -6,16 +6,22 @@
 #
 #
 
-import commands
+import asyncio
+import contextlib
 import logging
 import os.path
 import re
+import shutil
+import signal
 import tornado.auth
-import tornado.database
+import tornado.escape
 import tornado.httpserver
 import tornado.ioloop
+import tornado.netutil
 import tornado.options
+import tornado.process
 import tornado.web
+import tornado.websocket
 import unicodedata
 
 import random
@@ -23,17 +29,52 @@ import string
 import uuid
 
 from tornado.options import define, options
-import util.ystockquote
 from util.amazon_ses import AmazonSES,EmailMessage
 import util.tickersymbols
-
-channels = {}
+import fetchers
+import annualdata
+import dbpool
+import exportcache
+import pubsub
+import sheetcodec
+import sheetcommands
+import sheetexport
+import sheetimport
+import sheetstore
+import uploads
+import jobs
 
 define("port", default=8888, help="run on the given port", type=int)
 define("mysql_host", default="127.0.0.1:3306", help="database host")
 define("mysql_database", default="aspiringinvestments", help="database name")
 define("mysql_user", default="ai", help="database user")
 define("mysql_password", default="ai", help="database password")
+define("fetch_workers", default=8, help="threads for market data fetches", type=int)
+define("quote_ttl", default=15, help="seconds to cache stock quotes", type=float)
+define("fundamentals_ttl", default=6*3600, help="seconds to cache annual data", type=float)
+define("ticker_cache_size", default=2000, help="max cached ticker lookups", type=int)
+define("db_pool_size", default=8, help="database connections", type=int)
+define("db_ping_interval", default=60, help="seconds idle before a connection is checked", type=float)
+define("annualdata_max_age", default=7*86400, help="seconds before stored ten-year data is refreshed", type=float)
+define("sheet_compact_after", default=50, help="delta saves kept before folding them into the sheet", type=int)
+define("sheet_history_versions", default=1000, help="versions of each sheet kept as history (0 for all)", type=int)
+define("sheet_history_days", default=90, help="days of sheet history kept (0 for all)", type=float)
+define("sheet_replay_cache", default=32, help="sheets whose replayed current version is kept in memory", type=int)
+define("processes", default=1, help="worker processes to fork (0 for one per CPU)", type=int)
+define("channel_db", default="", help="SQLite file sharing collaboration sessions between processes")
+define("channel_idle_timeout", default=6*3600, help="seconds a collaboration session nobody is on is kept (0 for ever)", type=float)
+define("channel_cache_mb", default=256, help="memory for recent collaboration messages across sessions (0 for no limit)", type=float)
+define("channel_poll_interval", default=0.05, help="seconds between checks for messages from other processes", type=float)
+define("broadcast_window_ms", default=20, help="milliseconds broadcasts are held to go out together (0 to send at once)", type=float)
+define("channel_log_dir", default="", help="directory logging collaboration sessions so they survive a restart")
+define("channel_log_fsync_ms", default=50, help="milliseconds between fsyncs of the session logs (0 after every write, -1 to leave it to the OS)", type=float)
+define("job_workers", default=0, help="processes converting exports and imports (0 for one per CPU)", type=int)
+define("job_queue", default=32, help="conversions waiting for a worker before more are turned away", type=int)
+define("job_timeout", default=120, help="seconds a conversion may run (0 for no limit)", type=float)
+define("job_dir", default="", help="directory for conversion scratch files (the system temporary directory by default)")
+define("export_cache_dir", default="", help="directory keeping finished exports for repeat downloads (a temporary directory by default)")
+define("export_cache_mb", default=256, help="disk for kept exports (0 keeps only the latest)", type=float)
+define("upload_max_mb", default=100, help="largest spreadsheet upload accepted, in MB", type=float)
 
 
 class Application(tornado.web.Application):
@@ -45,6 +86,7 @@ class Application(tornado.web.Application):
             (r"/stock", StockHandler),
             (r"/broadcast", MessageNewHandler),
             (r"/updates", MessageUpdateHandler),
+            (r"/socket", MessageSocketHandler),
             (r"/sharedsession", SharedSessionHandler),
             (r"/uploadtest", UploadTestHandler),
             (r"/upload", UploadHandler),
@@ -58,7 +100,13 @@ class Application(tornado.web.Application):
             (r"/collaborate(.*)", CollaborateHandler),            
             (r"/share", ShareHandler),
             (r"/usersheet", UserSheetHandler),
-            (r"/tickerjson", TickerJsonHandler)              
+            (r"/sheethistory", SheetHistoryHandler),
+            (r"/tickerjson", TickerJsonHandler),
+            (r"/stats/tickercache", TickerCacheStatsHandler),
+            (r"/stats/db", DatabaseStatsHandler),
+            (r"/stats/channels", ChannelStatsHandler),
+            (r"/stats/jobs", JobStatsHandler),
+            (r"/stats/exports", ExportStatsHandler)
         ]
         settings = dict(
             app_title=u"Aspiring Investments",
@@ -81,9 +129,61 @@ class Application(tornado.web.Application):
             self.amazonSes = None
             self.fromemail = ""
 
-        self.db = tornado.database.Connection(
-            host=options.mysql_host, database=options.mysql_database,
-            user=options.mysql_user, password=options.mysql_password)
+        self.fetcher = fetchers.TickerFetcher(
+            fetchers.ScriptSource(self.settings["util_path"]),
+            max_workers=options.fetch_workers,
+            cache=fetchers.TickerCache(options.ticker_cache_size),
+            quote_ttl=options.quote_ttl,
+            fundamentals_ttl=options.fundamentals_ttl)
+
+        self.db = dbpool.mysql_pool(
+            options.mysql_host, options.mysql_database, options.mysql_user,
+            options.mysql_password, size=options.db_pool_size,
+            ping_interval=options.db_ping_interval)
+
+        self.annualdata = annualdata.AnnualDataStore(
+            self.db, self.fetcher.ten_year_data,
+            max_age=options.annualdata_max_age)
+
+        self.sheets = sheetstore.SheetStore(
+            self.db, compact_after=options.sheet_compact_after,
+            history_versions=options.sheet_history_versions or None,
+            history_age=options.sheet_history_days * 86400 or None,
+            replay_cache=options.sheet_replay_cache,
+            conflict_errors=dbpool.mysql_errors()[1])
+
+        lifecycle = dict(
+            batch_window=options.broadcast_window_ms / 1000.0,
+            idle_timeout=options.channel_idle_timeout or None,
+            max_cached_bytes=int(options.channel_cache_mb * 1024 * 1024)
+            or None)
+        if options.channel_db:
+            self.channels = pubsub.SqliteBackend(
+                options.channel_db,
+                poll_interval=options.channel_poll_interval, **lifecycle)
+        else:
+            fsync = options.channel_log_fsync_ms
+            self.channels = pubsub.MemoryBackend(
+                log_dir=options.channel_log_dir or None,
+                fsync_interval=fsync / 1000.0 if fsync >= 0 else None,
+                **lifecycle)
+
+        self.jobs = jobs.JobRunner(
+            workers=options.job_workers or None, queue=options.job_queue,
+            timeout=options.job_timeout or None,
+            directory=options.job_dir or None)
+
+        self.exports = exportcache.ExportCache(
+            options.export_cache_dir or None,
+            max_bytes=int(options.export_cache_mb * 1024 * 1024))
+
+    async def close(self):
+        """Stops the background work on shutdown, the database last"""
+        self.jobs.close()
+        self.fetcher.close()
+        self.channels.close()
+        await self.annualdata.close()
+        self.db.close()
 
 class BaseHandler(tornado.web.RequestHandler):
     @property
@@ -104,7 +204,7 @@ class TemplatesHandler(BaseHandler):
         index2 = sheetstr.index("--SocialCalcSpreadsheetControlSave",index1)
         return sheetstr[index1:index2]
 
-    def post(self):
+    async def post(self):
         sheetstr = self.get_argument("savespreadsheet", None)
         user = "demo"
         if sheetstr != None:
@@ -112,25 +212,21 @@ class TemplatesHandler(BaseHandler):
             #logging.info(model)
             fname = self.get_argument("newpagename")
             #differentiate the new template from existing template
-            template = self.db.query("SELECT * FROM StockTemplates WHERE user = %s AND fname = %s",user,fname)            
-            if len(template) == 0:
-                self.db.execute(
-                    "INSERT INTO StockTemplates (user,fname,data)"
-                    " VALUES (%s,%s,%s)",
-                    user, fname, model)
-            else:
-                self.db.execute(
-                    "UPDATE StockTemplates SET data = %s"
-                    "WHERE user = %s AND fname = %s", model, user, fname)
+            await self.db.execute(
+                "INSERT INTO StockTemplates (user,fname,data)"
+                " VALUES (%s,%s,%s)"
+                " ON DUPLICATE KEY UPDATE data = VALUES(data)",
+                user, fname, sheetcodec.encode(model))
                 
-        entries = self.db.query("SELECT * FROM StockTemplates WHERE user = %s",user)
+        entries = await self.db.query("SELECT * FROM StockTemplates WHERE user = %s",user)
         if not entries:
             #create a default entry
-            self.db.execute(
+            await self.db.execute(
                 "INSERT INTO StockTemplates (user,fname,data)"
-                " VALUES (%s,%s,%s)",
+                " VALUES (%s,%s,%s)"
+                " ON DUPLICATE KEY UPDATE id = id",
                 user, "Financial Statements", "\n")
-            entries = self.db.query("SELECT * FROM StockTemplates WHERE user = %s",user)
+            entries = await self.db.query("SELECT * FROM StockTemplates WHERE user = %s",user)
         for i in entries:
             pass
             #logging.info(i.fname)
@@ -145,7 +241,7 @@ class TemplatesHandler(BaseHandler):
 class StockHandler(BaseHandler):
     def get(self):
         self.write("StockHandler")
-    def post(self):
+    async def post(self):
         savebeg = """
 socialcalc:version:1.0
 MIME-Version: 1.0
@@ -174,15 +270,13 @@ version:1.5
         self.set_cookie("idinsession",str(1))
         ticker = self.get_argument('ticker')
         fname = self.get_argument('pagename')
-        cmdname = os.path.join(self.application.settings["util_path"],"msnparse.py")
-        #logging.info("cmd is %s"%cmdname)
-        sheetstr = commands.getoutput("python %s %s"%(cmdname,ticker))
-        template = self.db.query("SELECT * FROM StockTemplates WHERE user = %s AND fname = %s",user,fname)
+        sheetstr = await self.application.fetcher.stock_sheet(ticker)
+        template = await self.db.query("SELECT * FROM StockTemplates WHERE user = %s AND fname = %s",user,fname)
         #logging.info(sheetstr)
         #logging.info("---")
         #logging.info(template)
         if len(template) != 0:
-            sheetstr = sheetstr+template[0].data
+            sheetstr = sheetstr+sheetcodec.decode(template[0].data)
         entry = {}
         entry['sheetstr'] = savebeg+sheetstr+saveend
         #entry['sheetstr'] = ""
@@ -190,7 +284,7 @@ version:1.5
         entry['fname'] = fname
         entry['session'] = session
         # create the new session
-        channels[session] = MessageMixin(session, ticker, fname)
+        await self.application.channels.open(session, ticker, fname)
         self.render("editstocksheet.html", entry=entry)
     def get_random_string(self,size):
         char_set = string.ascii_uppercase + string.digits
@@ -200,10 +294,10 @@ version:1.5
 # This is where shared sessions start
 #
 class SharedSessionHandler(BaseHandler):
-    def post(self):
+    async def post(self):
         #self.write("Shared session for %s"%self.get_argument("sessionid"))
         session = self.get_argument("sessionid")
-        channel = channels.get(session,None)
+        channel = await self.application.channels.get(session)
         if channel != None:
             entry = {}
             entry['ticker'] = channel.ticker
@@ -212,7 +306,8 @@ class SharedSessionHandler(BaseHandler):
             entry['sheetstr'] = ""
             entry['sheetmscestr'] = ""            
             self.set_cookie("session",session)
-            self.set_cookie("idinsession",str(channel.get_nextid()))
+            self.set_cookie("idinsession",str(
+                await self.application.channels.next_id(channel)))
             #self.render("sharedstocksheet.html", entry=entry)
             #self.render("sharedmultistocksheet.html", entry=entry)
             self.render("importcollabload.html", entry=entry)
@@ -221,65 +316,32 @@ class SharedSessionHandler(BaseHandler):
 
 
 
-class MessageMixin:
-    def __init__(self, session, ticker, fname):
-        self.waiters = []
-        self.cache = []
-        self.cache_size = 1000
-        self.session = session
-        self.ticker = ticker
-        self.fname = fname
-        self.nextid = 2;
-
-    def wait_for_messages(self, callback, cursor=None):
-        if cursor:
-            index = 0
-            for i in xrange(len(self.cache)):
-                index = len(self.cache) - i - 1
-                if self.cache[index]["id"] == cursor: break
-            recent = self.cache[index + 1:]
-            if recent:
-                callback(recent)
-                return        
-        self.waiters.append(callback)
-
-    def new_messages(self, message):
-        logging.info("Sending new message to %r listeners", len(self.waiters))
-        for callback in self.waiters:
-            try:
-                callback(message)
-            except:
-                logging.error("Error in waiter callback", exc_info=True)
-        self.waiters = []
-        self.cache.extend(message)
-        if len(self.cache) > self.cache_size:
-            self.cache = self.cache[-self.cache_size:]
-
-    def get_nextid(self):
-        id = self.nextid;
-        self.nextid = self.nextid+1
-        return id
-
 #
 # this is where new broadcast messages come in
 #
+def new_message(handler, data, type, sender):
+    return {
+        "id": str(uuid.uuid4()),
+        "idinsession": handler.get_cookie("idinsession"),
+        "session": handler.get_cookie("session"),
+        "data": data,
+        "type": type,
+        "from": sender,
+        "html": '<div></div>'
+    }
+
+
 class MessageNewHandler(BaseHandler):
-    def post(self):
-        message = {
-            "id": str(uuid.uuid4()),
-            "idinsession": self.get_cookie("idinsession"),
-            "session":self.get_cookie("session"),
-            "data": self.get_argument("data"),
-            "type": self.get_argument("type"),
-            "from": self.get_argument("from"),
-            "html": '<div></div>'
-        }
+    async def post(self):
+        message = new_message(self, self.get_argument("data"),
+                              self.get_argument("type"),
+                              self.get_argument("from"))
         #logging.info(message)
         # write back some message
         self.write(message)
         # get the right channel and post a message to it
         session = self.get_cookie("session")
-        channel = channels.get(session,None)
+        channel = await self.application.channels.get(session)
         if channel != None:
             #broadcast
             channel.new_messages([message])
@@ -289,31 +351,85 @@ class MessageNewHandler(BaseHandler):
 # This is the long poller
 #
 class MessageUpdateHandler(BaseHandler):
-    @tornado.web.asynchronous
-    def post(self):
-        #create a new channel if id=1 and no channel exists
+    channel = None
+    waiting = None      # resolved with the batch this poll answers with
+
+    async def post(self):
         cursor = self.get_argument("cursor", None)
         session = self.get_cookie("session")        
         id = self.get_cookie("idinsession")
         #logging.info("long poll id=%s,session=%s"%(id,session))
-        channel = channels.get(session,None)
-        if channel:
-            channel.wait_for_messages(self.async_callback(self.on_new_messages),
-                                      cursor=cursor)
-
-    def on_new_messages(self, messages):
-        # Closed client connection
-        if self.request.connection.stream.closed():
+        self.channel = await self.application.channels.get(session)
+        if self.channel is None:
+            raise tornado.web.HTTPError(404, "session not found")
+        self.waiting = asyncio.get_running_loop().create_future()
+        try:
+            await self.channel.wait_for_messages(self.on_new_messages,
+                                                 cursor=cursor)
+        except pubsub.StaleCursor as e:
+            # the client missed messages the channel no longer keeps;
+            # it reloads the sheet and carries on from the newest
+            self.finish(dict(messages=[], resync=True, cursor=e.latest))
             return
+        try:
+            batch = await self.waiting
+        except asyncio.CancelledError:
+            return      # the client has gone
         #logging.info(messages)
-        #self.write(messages)
-        self.finish(dict(messages=messages))
+        # encoded once for every listener on the channel
+        self.set_header("Content-Type", "application/json; charset=UTF-8")
+        self.finish(batch.encoded)
+
+    def on_new_messages(self, batch):
+        if not self.waiting.done():
+            self.waiting.set_result(batch)
+
+    def on_connection_close(self):
+        # a client gone mid-poll no longer keeps its channel alive
+        if self.waiting is not None and not self.waiting.done():
+            self.channel.cancel_wait(self.on_new_messages)
+            self.waiting.cancel()
+
+
+#
+# The same channel over a WebSocket: broadcasts are pushed as they
+# happen, and the client's own broadcasts come in on the same connection.
+# updater.js falls back to /updates and /broadcast without one.
+#
+class MessageSocketHandler(tornado.websocket.WebSocketHandler):
+    async def open(self):
+        self.channel = await self.application.channels.get(self.get_cookie("session"))
+        if self.channel is None:
+            self.close(4004, "session not found")
+            return
+        try:
+            await self.channel.subscribe(
+                self.on_new_messages, cursor=self.get_argument("cursor", None))
+        except pubsub.StaleCursor as e:
+            self.write_message(dict(messages=[], resync=True, cursor=e.latest))
+            await self.channel.subscribe(self.on_new_messages)
+
+    def on_new_messages(self, batch):
+        # one text frame per batch, the same bytes for every connection
+        try:
+            self.write_message(batch.encoded)
+        except tornado.websocket.WebSocketClosedError:
+            pass
+
+    def on_message(self, text):
+        args = tornado.escape.json_decode(text)
+        self.channel.new_messages([new_message(self, args["data"],
+                                               args["type"], args["from"])])
+
+    def on_close(self):
+        if getattr(self, "channel", None) is not None:
+            self.channel.unsubscribe(self.on_new_messages)
 
 
 class MultiSheetHandler(BaseHandler):
     def get(self):
         self.write("StockHandler")
-    def post(self):
+    async def post(self):
         user = "demo"
         session = self.get_random_string(6)
         logging.info("session is %s"%session)
@@ -321,9 +437,7 @@ class MultiSheetHandler(BaseHandler):
         self.set_cookie("idinsession",str(1))
         ticker = self.get_argument('ticker')
         fname = self.get_argument('pagename')
-        cmdname = os.path.join(self.application.settings["util_path"],"msnparse.py")
-        logging.info("cmd is %s"%cmdname)
-        sheetstr = commands.getoutput("python %s %s"%(cmdname,ticker))
+        sheetstr = await self.application.fetcher.stock_sheet(ticker)
         #template = self.db.query("SELECT * FROM StockTemplates WHERE user = %s AND fname = %s",user,fname)
         #logging.info(sheetstr)
         #logging.info("---")
@@ -337,7 +451,7 @@ class MultiSheetHandler(BaseHandler):
         entry['fname'] = fname
         entry['session'] = session
         # create the new session
-        channels[session] = MessageMixin(session, ticker, fname)
+        await self.application.channels.open(session, ticker, fname)
         self.render("editmultistocksheet.html", entry=entry)
 
     def get_random_string(self,size):
@@ -345,31 +459,122 @@ class MultiSheetHandler(BaseHandler):
         return ''.join(random.sample(char_set,6))
 
 
-sessionfileuploads = {}
+@contextlib.contextmanager
+def conversion_errors():
+    """Turns the ways an export or import job fails into HTTP errors"""
+    try:
+        yield
+    except (sheetexport.ExportError, sheetimport.UnreadableSheet) as e:
+        raise tornado.web.HTTPError(400, str(e))
+    except jobs.Busy:
+        raise tornado.web.HTTPError(503, "too many conversions running")
+    except jobs.JobTimeout:
+        raise tornado.web.HTTPError(504, "the conversion took too long")
+
+
+def read_text(path):
+    """The UTF-8 text of the file at path; a 400 if it is not UTF-8"""
+    try:
+        with open(path, encoding="utf-8", newline="") as f:
+            return f.read()
+    except UnicodeDecodeError:
+        raise tornado.web.HTTPError(400, "the file is not UTF-8 text")
+
+
+async def import_sheet(jobrunner, upload):
+    """
+    The workbook save for an uploaded spreadsheet, written to a file by a
+    job and read back off the IOLoop
+    """
+    with conversion_errors():
+        async with jobrunner.submit(sheetimport.read_upload, upload.path,
+                                    upload.filename) as job:
+            return await asyncio.get_running_loop().run_in_executor(
+                None, read_text, job.result)
+
+
+@tornado.web.stream_request_body
+class UploadBaseHandler(BaseHandler):
+    """
+    Handlers taking a file upload.  The body is parsed as it arrives and
+    the file written to disk, never held in memory whole; post() finds it
+    with self.uploaded().
+    """
+    upload = None
+    upload_error = None
+    feeding = None
+
+    def prepare(self):
+        if self.request.method != "POST":
+            return
+        limit = int(options.upload_max_mb * 1024 * 1024)
+        self.request.connection.set_max_body_size(limit)
+        if int(self.request.headers.get("Content-Length", 0)) > limit:
+            raise tornado.web.HTTPError(413, "upload larger than %d bytes"
+                                        % limit)
+        try:
+            self.upload = uploads.MultipartParser(
+                self.request.headers.get("Content-Type", ""),
+                self.application.jobs.directory, max_bytes=limit)
+        except uploads.MultipartError as e:
+            raise tornado.web.HTTPError(400, str(e))
+
+    async def data_received(self, chunk):
+        if self.upload is None or self.upload_error is not None:
+            return
+        # written on a worker thread; Tornado reads no more of the body
+        # until this returns, so a slow disk holds back the client rather
+        # than the IOLoop
+        self.feeding = asyncio.get_running_loop().run_in_executor(
+            None, self.upload.feed, chunk)
+        try:
+            await self.feeding
+        except ValueError as e:
+            # answered once post() is reached
+            self.upload_error = e
 
+    def uploaded(self, name="upload"):
+        """The uploads.Upload of the file field name"""
+        try:
+            if self.upload_error is not None:
+                raise self.upload_error
+            self.upload.close()
+        except uploads.UploadTooLarge as e:
+            raise tornado.web.HTTPError(413, str(e))
+        except uploads.MultipartError as e:
+            raise tornado.web.HTTPError(400, str(e))
+        if not self.upload.files.get(name):
+            raise tornado.web.HTTPError(400, "no %s file uploaded" % name)
+        return self.upload.files[name][0]
+
+    def on_finish(self):
+        self.discard_upload()
+
+    def on_connection_close(self):
+        BaseHandler.on_connection_close(self)
+        self.discard_upload()
+
+    def discard_upload(self):
+        if self.upload is None:
+            return
+        upload, self.upload = self.upload, None
+        if self.feeding is not None and not self.feeding.done():
+            self.feeding.add_done_callback(lambda _: upload.cleanup())
+        else:
+            upload.cleanup()
 
 
-class UploadTestHandler(BaseHandler):
+class UploadTestHandler(UploadBaseHandler):
     def get(self):
         entry = {}
         entry['fname'] = "test"
         entry['sheetstr'] = ""
         self.render("uploadtest.html", entry=entry)
 
-    def post(self):
-        fname = self.request.files['upload'][0]['filename']
-        fcontent = self.request.files['upload'][0]['body']
-        fullfname = "./excelinterop/phpexcel/socialcalc/tmp/"+fname
-        f = open(fullfname,"w")
-        f.write(fcontent)
-        f.close()
-        #logging.info("wrote "+fullfname)
-        cmdname = "./excelinterop/phpexcel/socialcalc/import.php"
-        output = commands.getoutput("php %s %s"%(cmdname, fullfname))
-        #logging.info("output is "+output)
-        i = output.index("$---$")
-        wbook = output[i+5:]
-        sessionfileuploads[fname] = wbook
+    async def post(self):
+        upload = self.uploaded()
+        fname = upload.filename
+        wbook = await import_sheet(self.application.jobs, upload)
 
         #logging.info(fname)
         #logging.info(wbook)
@@ -398,27 +603,16 @@ class UploadTestHandler(BaseHandler):
         #self.finish(dict(data=sheetstr))
 
 
-class UploadHandler(BaseHandler):
+class UploadHandler(UploadBaseHandler):
     def get(self):
         entry = {}
         entry['fname'] = "test"
         entry['sheetstr'] = ""
         self.render("uploadtest.html",entry=entry)
-    def post(self):
-        fname = self.request.files['upload'][0]['filename']
-        fcontent = self.request.files['upload'][0]['body']
-
-        fullfname = "./excelinterop/phpexcel/socialcalc/tmp/"+fname
-        f = open(fullfname,"w")
-        f.write(fcontent)
-        f.close()
-        #logging.info("wrote "+fullfname)
-        cmdname = "./excelinterop/phpexcel/socialcalc/import.php"
-        output = commands.getoutput("php %s %s"%(cmdname, fullfname))
-        #logging.info("output is "+output)
-        i = output.index("$---$")
-        wbook = output[i+5:]
-        sessionfileuploads[fname] = wbook
+    async def post(self):
+        upload = self.uploaded()
+        fname = upload.filename
+        wbook = await import_sheet(self.application.jobs, upload)
 
         #logging.info(fname)
         #logging.info(wbook)
@@ -431,79 +625,104 @@ class UploadHandler(BaseHandler):
 
 
 contenttypes = {"Excel2007":"application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                "Excel5":"application/vnd.ms-excel",
-                "PDF":"application/pdf",
                 "HTML":"text/html",
-                "CSV":"text/plain",
+                "CSV":"text/csv; charset=UTF-8",
                 "MSC":"text/plain",
                 "MSCE":"text/plain",
                 "ODS":"application/vnd.oasis.opendocument.spreadsheet"}
 
 
 suffix = {"Excel2007":"xlsx",
-          "Excel5":"xls",
-          "PDF":"pdf",
           "HTML":"html",
           "CSV":"csv",
           "ODS":"ods",
           "MSC":"msc",
           "MSCE":"msce"}
 
-sessionfiledownloads = {}
-import codecs
+
+async def export_sheet(application, content, type, key):
+    """The export of content as type, as an open file, from the cache if
+    it is there and from a job if not"""
+    if type not in sheetexport.WRITERS:
+        raise tornado.web.HTTPError(400, "cannot export to %s" % type)
+
+    async def produce(path):
+        async with application.jobs.submit(sheetexport.export_file,
+                                           content, type) as job:
+            shutil.move(job.result, path)
+
+    with conversion_errors():
+        return await application.exports.get(key, produce)
+
+
 class DownloadFileHandler(BaseHandler):
-    def post(self):
-        logging.info(self.get_argument("type"))
-        #logging.info(self.get_argument("content"))
+    async def get(self):
+        """An export prepared by DownloadHandler, while it is cached"""
+        id = self.get_argument('id')
+        type = id.rpartition(".")[2]
+        if not exportcache.KEY.match(id) or type not in sheetexport.WRITERS:
+            raise tornado.web.HTTPError(404)
+        if self.not_modified(id):
+            return
+        f = self.application.exports.open(id)
+        if f is None:
+            raise tornado.web.HTTPError(404)
+        self.set_download_headers(type)
+        await self.stream_file(f)
+
+    async def post(self):
         type = self.get_argument('type')
-        #logging.info(self.get_argument('content'))
-        if (type != "MSC") and (type != "MSCE") and (type != "HTML") :
-            fullfname = "./excelinterop/phpexcel/socialcalc/tmp/tmp"
-            inpfile = fullfname+".b"
-        
-            f = codecs.open(inpfile,encoding='utf-8',mode="w+")
-            s = unicode(self.get_argument('content'))
-            #logging.info(s)
-            f.write(s)
-            f.close()
-            outfile = fullfname+"."+suffix[type]
-            logging.info(outfile)
-            logging.info(inpfile)
-            cmdname = "./excelinterop/phpexcel/socialcalc/export.php"
-            output = commands.getoutput("php %s %s %s %s"%(cmdname, inpfile, outfile, type))
-            logging.info(output)
-            content = open(outfile).read()
-        else:
-            content = self.get_argument('content')
+        logging.info(type)
+        if type not in contenttypes:
+            raise tornado.web.HTTPError(400, "cannot export to %s" % type)
+        content = self.get_argument('content')
+        if type in ("MSC", "MSCE", "HTML"):
+            self.set_download_headers(type)
+            self.finish(content)
+            return
+        key = exportcache.key(content, type)
+        f = await export_sheet(self.application, content, type, key)
+        self.set_download_headers(type)
+        await self.stream_file(f)
+
+    def not_modified(self, key):
+        """
+        Answers 304 if the browser already has the export for key; for GET
+        only, as browsers do not revalidate POSTs
+        """
+        self.set_header("Etag", '"%s"' % key)
+        if self.check_etag_header():
+            self.set_status(304)
+            self.finish()
+            return True
+        return False
+
+    def set_download_headers(self, type):
         self.set_header("Content-Type", contenttypes[type])
         self.set_header("Content-Disposition", 'attachment;filename='+"tmp."+suffix[type])
-        self.set_header("Cache-Control", 'max-age=0') 
-        self.write(content)
+        self.set_header("Cache-Control", 'max-age=0')
 
+    async def stream_file(self, f):
+        # a chunk at a time, so a large file is never all in memory
+        with f:
+            for chunk in iter(lambda: f.read(64 * 1024), b""):
+                self.write(chunk)
+                await self.flush()
+        self.finish()
 
 
 class DownloadHandler(BaseHandler):
-    def post(self):
-        #logging.info(self.get_argument('type'))
+    async def post(self):
+        """Exports the sheet for a later GET /downloadfile?id=..."""
         type = self.get_argument('type')
-        #logging.info(self.get_argument('content'))
-        fullfname = "./excelinterop/phpexcel/socialcalc/tmp/tmp"
-        inpfile = fullfname+".b"
-        f = open(inpfile,"wb")
-        f.write(self.get_argument('content'))
+        content = self.get_argument('content')
+        key = exportcache.key(content, type)
+        f = await export_sheet(self.application, content, type, key)
         f.close()
-        outfile = fullfname+"."+suffix[type]
-        logging.info(outfile)
-        logging.info(inpfile)
-        cmdname = "./excelinterop/phpexcel/socialcalc/export.php"
-        output = commands.getoutput("php %s %s %s %s"%(cmdname, inpfile, outfile, type))
-        logging.info(output)
-        sessionfiledownloads["file"] = outfile
-        sessionfiledownloads["type"] = type
-        self.finish(dict(data=type))
-
-class ImportHandler(BaseHandler):
-    def get(self):
+        self.finish(dict(data=type, id=key))
+
+class ImportHandler(UploadBaseHandler):
+    async def get(self):
 
         user = "demo"
         session = self.get_random_string(6)
@@ -515,7 +734,7 @@ class ImportHandler(BaseHandler):
         entry['sheetstr'] = ""
         entry['sheetmscestr'] = ""                    
         entry['session'] = session
-        channels[session] = MessageMixin(session, "", "")
+        await self.application.channels.open(session, "", "")
         self.render("importcollab.html", entry=entry)
 
     def get_random_string(self,size):
@@ -523,27 +742,16 @@ class ImportHandler(BaseHandler):
         return ''.join(random.sample(char_set,6))
 
 
-    def post(self):
+    async def post(self):
         session = self.get_cookie("session")
 
-        fname = self.request.files['upload'][0]['filename']
-        fcontent = self.request.files['upload'][0]['body']
+        upload = self.uploaded()
+        fname = upload.filename
         if (fname[-3:] != "msc") and (fname[-4:] != "msce") :
-            fullfname = "./excelinterop/phpexcel/socialcalc/tmp/"+fname
-            f = open(fullfname,"w")
-            f.write(fcontent)
-            f.close()
-            #logging.info("wrote "+fullfname)
-            cmdname = "./excelinterop/phpexcel/socialcalc/import.php"
-            output = commands.getoutput("php %s %s"%(cmdname, fullfname))
-            #logging.info("output is "+output)
-            i = output.index("$---$")
-            wbook = output[i+5:]
-            
+            wbook = await import_sheet(self.application.jobs, upload)
         else:
-            wbook = fcontent
-    
-        sessionfileuploads[fname] = wbook
+            wbook = await asyncio.get_running_loop().run_in_executor(
+                None, read_text, upload.path)
 
         self.set_cookie("idinsession",str(1))
 
@@ -564,7 +772,7 @@ class ImportHandler(BaseHandler):
 
 
 class TickerJsonHandler(BaseHandler):
-    def post(self):
+    async def post(self):
         tick1 = self.get_argument('tick1')
         tick2 = self.get_argument('tick2')
         tick3 = self.get_argument('tick3')
@@ -577,15 +785,13 @@ class TickerJsonHandler(BaseHandler):
             return
 
         
-        logging.info("ticker is ",tick1,tick2,tick3)
-        cmdname = os.path.join(self.application.settings["util_path"],"msnparse.py")
-        logging.info("cmd is %s"%cmdname)
-        sheetstr = commands.getoutput("python %s %s %s %s %s"%(cmdname,"json",tick1,tick2,tick3))
+        logging.info("ticker is %s %s %s"%(tick1,tick2,tick3))
+        sheetstr = await self.application.fetcher.compare_json(tick1,tick2,tick3)
         self.finish(dict(data=sheetstr,result="ok"))        
 
 
 class TickerHandler(BaseHandler):
-    def post(self):
+    async def post(self):
         ticker = self.get_argument('ticker')
         logging.info("ticker is "+ticker)
 
@@ -595,15 +801,12 @@ class TickerHandler(BaseHandler):
             #return
             logging.info("couldnt find ticker "+ticker);
 
-        cmdname = os.path.join(self.application.settings["util_path"],"msnparse.py")
-        logging.info("cmd is %s"%cmdname)
-        sheetstr = commands.getoutput("python %s %s %s"%(cmdname,"none",ticker))
-        tickdata = util.ystockquote.get_all(ticker)
+        sheetstr, tickdata = await self.application.fetcher.ticker(ticker)
         logging.info(tickdata)
         self.finish(dict(data=sheetstr,tick=tickdata,result="ok"))        
 
 class TenYearDataHandler(BaseHandler):
-    def post(self):
+    async def post(self):
         ticker = self.get_argument('ticker')
         logging.info("ticker is "+ticker)
 
@@ -612,15 +815,43 @@ class TenYearDataHandler(BaseHandler):
             self.finish(dict(result="fail"))
             return
 
-        cmdname = os.path.join(self.application.settings["util_path"],"tenyeardata.py")
-        logging.info("cmd is %s"%cmdname)
-        sheetstr = commands.getoutput("python %s %s"%(cmdname,ticker))
+        try:
+            sheetstr = await self.application.annualdata.get(ticker)
+        except fetchers.FetchError as e:
+            logging.warning("%s", e)
+            self.finish(dict(result="fail"))
+            return
         self.finish(dict(data=sheetstr,result="ok"))        
 
 
 
+class TickerCacheStatsHandler(BaseHandler):
+    def get(self):
+        self.finish(self.application.fetcher.cache.stats())
+
+
+class DatabaseStatsHandler(BaseHandler):
+    def get(self):
+        self.finish(self.application.db.stats())
+
+
+class ChannelStatsHandler(BaseHandler):
+    def get(self):
+        self.finish(self.application.channels.stats())
+
+
+class JobStatsHandler(BaseHandler):
+    def get(self):
+        self.finish(self.application.jobs.stats())
+
+
+class ExportStatsHandler(BaseHandler):
+    def get(self):
+        self.finish(self.application.exports.stats())
+
+
 class ShareHandler(BaseHandler):
-    def post(self):
+    async def post(self):
         pretext = """
 Brought to you by Aspiring Investments
 -----------------------------------------
@@ -636,17 +867,12 @@ shared investment model
         sheetstr = self.get_argument("data", None)
         user = "demo"
         if sheetstr != None:
-            sheets = self.db.query("SELECT * FROM SharedSheets WHERE user = %s AND fname = %s",user,fname)            
-            if len(sheets) == 0:
-                self.db.execute(
-                    "INSERT INTO SharedSheets (user,fname,data)"
-                    " VALUES (%s,%s,%s)",
-                    user, fname, sheetstr)
-            else:
-                pass
-                #self.db.execute(
-                #    "UPDATE UserSheets SET data = %s"
-                #    "WHERE user = %s AND fname = %s", sheetstr, user, fname)
+            # an existing share under this name is left as it is
+            await self.db.execute(
+                "INSERT INTO SharedSheets (user,fname,data)"
+                " VALUES (%s,%s,%s)"
+                " ON DUPLICATE KEY UPDATE id = id",
+                user, fname, sheetcodec.encode(sheetstr))
         link = "http://"+self.request.host+"/embed?arg="+fname
         # send email
         if (msg != ""):
@@ -677,10 +903,10 @@ shared investment model
 # This is where shared sessions start
 #
 class CollaborateHandler(BaseHandler):
-    def get(self, slug):
+    async def get(self, slug):
         #self.write("Shared session for %s"%self.get_argument("sessionid"))
         session = self.get_argument("shsessionid")
-        channel = channels.get(session,None)
+        channel = await self.application.channels.get(session)
         if channel != None:
             entry = {}
             entry['ticker'] = channel.ticker
@@ -689,7 +915,8 @@ class CollaborateHandler(BaseHandler):
             entry['sheetstr'] = ""
             entry['sheetmscestr'] = ""            
             self.set_cookie("session",session)
-            self.set_cookie("idinsession",str(channel.get_nextid()))
+            self.set_cookie("idinsession",str(
+                await self.application.channels.next_id(channel)))
             #self.render("sharedstocksheet.html", entry=entry)
             #self.render("sharedmultistocksheet.html", entry=entry)
             self.render("importcollabload.html", entry=entry)
@@ -733,7 +960,7 @@ real-time
 
 
 class EmbedHandler(BaseHandler):
-    def get(self,slug):
+    async def get(self,slug):
         #logging.info("in get embed"+slug)
         #logging.info(self.request.uri)
         #logging.info(self.request.host)
@@ -748,35 +975,30 @@ class EmbedHandler(BaseHandler):
         self.set_cookie("session",session)
         self.set_cookie("idinsession",str(1))
         
-        wbook = self.db.query("SELECT * FROM SharedSheets WHERE user = %s AND fname = %s",user,fname)
+        wbook = await self.db.query("SELECT * FROM SharedSheets WHERE user = %s AND fname = %s",user,fname)
         #logging.info(wbook)
         entry = {}
         entry['fname'] = fname
-        entry['sheetstr'] = wbook[0].data
+        entry['sheetstr'] = sheetcodec.decode(wbook[0].data)
         entry['sheetmscestr'] = ""
         entry['session'] = session
-        channels[session] = MessageMixin(session, "", "")
+        await self.application.channels.open(session, "", "")
         self.render("importcollabload.html", entry=entry)
 
         
 
-    def post(self,slug):
+    async def post(self,slug):
         fname = self.get_random_string(20)
         logging.info("fname is "+fname)
         sheetstr = self.get_argument("data", None)
         user = "demo"
         if sheetstr != None:
-            sheets = self.db.query("SELECT * FROM SharedSheets WHERE user = %s AND fname = %s",user,fname)            
-            if len(sheets) == 0:
-                self.db.execute(
-                    "INSERT INTO SharedSheets (user,fname,data)"
-                    " VALUES (%s,%s,%s)",
-                    user, fname, sheetstr)
-            else:
-                pass
-                #self.db.execute(
-                #    "UPDATE UserSheets SET data = %s"
-                #    "WHERE user = %s AND fname = %s", sheetstr, user, fname)
+            # an existing share under this name is left as it is
+            await self.db.execute(
+                "INSERT INTO SharedSheets (user,fname,data)"
+                " VALUES (%s,%s,%s)"
+                " ON DUPLICATE KEY UPDATE id = id",
+                user, fname, sheetcodec.encode(sheetstr))
         link = "http://"+self.request.host+self.request.uri+"?arg="+fname
         self.finish(dict(data=link))        
 
@@ -787,17 +1009,18 @@ class EmbedHandler(BaseHandler):
 
 
 class SaveHandler(BaseHandler):
-    def get(self):
+    async def get(self):
         # display all sheets
         user = "demo"
-        entries = self.db.query("SELECT * FROM UserSheets WHERE user = %s",user)
+        entries = await self.db.query("SELECT * FROM UserSheets WHERE user = %s",user)
         if not entries:
             #create a default entry
-            self.db.execute(
+            await self.db.execute(
                 "INSERT INTO UserSheets (user,fname,data)"
-                " VALUES (%s,%s,%s)",
+                " VALUES (%s,%s,%s)"
+                " ON DUPLICATE KEY UPDATE id = id",
                 user, "default", "\n")
-            entries = self.db.query("SELECT * FROM UserSheets WHERE user = %s",user)
+            entries = await self.db.query("SELECT * FROM UserSheets WHERE user = %s",user)
         for i in entries:
             pass
             #logging.info(i.fname)
@@ -808,28 +1031,43 @@ class SaveHandler(BaseHandler):
         self.render("allusersheets.html", argument=argument)
 
         
-    def post(self):
+    async def post(self):
         fname = self.get_argument('fname')
         logging.info("fname is "+fname)
         sheetstr = self.get_argument("data", None)
+        commands = self.get_argument("commands", None)
         user = "demo"
+        version = None
         if sheetstr != None:
-            fname = self.get_argument("fname")
-            sheets = self.db.query("SELECT * FROM UserSheets WHERE user = %s AND fname = %s",user,fname)            
-            if len(sheets) == 0:
-                self.db.execute(
-                    "INSERT INTO UserSheets (user,fname,data)"
-                    " VALUES (%s,%s,%s)",
-                    user, fname, sheetstr)
-            else:
-                self.db.execute(
-                    "UPDATE UserSheets SET data = %s"
-                    "WHERE user = %s AND fname = %s", sheetstr, user, fname)
-        self.finish(dict(data="Done"))        
+            version = await self.application.sheets.save(user, fname, sheetstr)
+        elif commands != None:
+            # a delta: the commands run since the save at "version"
+            try:
+                base = int(self.get_argument("version"))
+                commands = tornado.escape.json_decode(commands)
+            except ValueError:
+                raise tornado.web.HTTPError(
+                    400, "a delta needs a numeric version and a JSON list "
+                    "of commands")
+            if not isinstance(commands, list) or \
+                    not all(isinstance(c, str) for c in commands):
+                raise tornado.web.HTTPError(400, "commands must be a list "
+                                            "of strings")
+            try:
+                version = await self.application.sheets.append(
+                    user, fname, base, commands)
+            except sheetstore.StaleVersion as e:
+                self.finish(dict(data="Full", version=e.version))
+                return
+            except sheetcommands.CommandError as e:
+                logging.info("full save needed for %s: %s" % (fname, e))
+                self.finish(dict(data="Full"))
+                return
+        self.finish(dict(data="Done", version=version))        
 
         
 class UserSheetHandler(BaseHandler):
-    def post(self):
+    async def post(self):
 
         
         user = "demo"
@@ -840,7 +1078,7 @@ class UserSheetHandler(BaseHandler):
         isdel = self.get_argument("delete")
         if (isdel == "yes"):
             logging.info("deleting "+fname)
-            self.db.execute("DELETE FROM UserSheets WHERE user = %s AND fname = %s",user, fname)
+            await self.application.sheets.delete(user, fname)
             self.redirect("/save")
             return
 
@@ -851,14 +1089,33 @@ class UserSheetHandler(BaseHandler):
         self.set_cookie("session",session)
         self.set_cookie("idinsession",str(1))
         
-        wbook = self.db.query("SELECT * FROM UserSheets WHERE user = %s AND fname = %s",user,fname)
-        #logging.info(wbook)
+        version = self.get_argument("version", None)
+        if version != None:
+            # a past version; the next save stores it in full as the newest
+            sheetstr = await self.application.sheets.load_version(
+                user, fname, int(version))
+            version = None
+        else:
+            loaded = await self.application.sheets.load(user, fname)
+            sheetstr, version = loaded if loaded is not None else (None, None)
+        if sheetstr is None:
+            # no such sheet (or version): start it empty
+            sheetstr = ""
+        # autosave in updater.js sends its deltas against this version
+        self.set_cookie("sheetname", tornado.escape.url_escape(fname, False),
+                        path=self.request.path)
+        if version is None:
+            self.clear_cookie("sheetversion", path=self.request.path)
+        else:
+            self.set_cookie("sheetversion", str(version),
+                            path=self.request.path)
         entry = {}
         entry['fname'] = fname
-        entry['sheetstr'] = wbook[0].data
+        entry['sheetstr'] = sheetstr
+        entry['version'] = version
         entry['sheetmscestr'] = ""
         entry['session'] = session
-        channels[session] = MessageMixin(session, "", "")
+        await self.application.channels.open(session, "", "")
         self.render("importcollabload.html", entry=entry)
         
     def get_random_string(self,size):
@@ -866,12 +1123,39 @@ class UserSheetHandler(BaseHandler):
         return ''.join(random.sample(char_set,6))
 
 
+class SheetHistoryHandler(BaseHandler):
+    async def get(self):
+        user = "demo"
+        fname = self.get_argument("pagename")
+        history = await self.application.sheets.history(user, fname)
+        self.finish(dict(versions=[dict(version=version, saved=saved)
+                                   for version, saved in history]))
+
+
 
 def main():
     tornado.options.parse_command_line()
-    http_server = tornado.httpserver.HTTPServer(Application())
-    http_server.listen(options.port)
-    tornado.ioloop.IOLoop.instance().start()
+    if options.processes != 1 and not options.channel_db:
+        raise SystemExit("--processes needs --channel_db so the workers "
+                         "share collaboration sessions")
+    sockets = tornado.netutil.bind_sockets(options.port)
+    if options.processes != 1:
+        tornado.process.fork_processes(options.processes)
+    asyncio.run(serve(sockets))
+
+
+async def serve(sockets):
+    # each worker opens its own database and channel connections
+    application = Application()
+    http_server = tornado.httpserver.HTTPServer(application)
+    http_server.add_sockets(sockets)
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stopping.set)
+    await stopping.wait()
+    http_server.stop()
+    await application.close()
 
 
 
@@ -0,0 +1,17 @@
+--
+-- The fetch time and a unique (ticker, year) key on TickerAnnualData,
+-- for the ten-year data store's freshness check and its upserts.
+--
+--   mysql --user=ai --password=ai --database=aspiringinvestments < migrations/000_ticker_annual_data.sql
+--
+-- Duplicate rows are removed first, keeping the oldest of each ticker
+-- and year.  Existing rows get updated = 0, so each is refreshed the
+-- first time it is asked for.
+--
+
+DELETE newer FROM TickerAnnualData newer JOIN TickerAnnualData older
+    ON newer.ticker = older.ticker AND newer.year = older.year
+    AND newer.id > older.id;
+ALTER TABLE TickerAnnualData
+    ADD COLUMN updated INT NOT NULL DEFAULT 0,
+    ADD UNIQUE KEY ticker_year (ticker, year);
@@ -0,0 +1,28 @@
+--
+-- Unique (user, fname) keys on the sheet tables, for single-statement
+-- upserts.
+--
+--   mysql --user=ai --password=ai --database=aspiringinvestments < migrations/001_unique_keys.sql
+--
+-- Duplicate rows left by the old SELECT-then-INSERT saves are removed
+-- first, keeping the oldest row of each name: that is the one the
+-- handlers read.
+--
+
+DELETE newer FROM StockTemplates newer JOIN StockTemplates older
+    ON newer.user = older.user AND newer.fname = older.fname
+    AND newer.id > older.id;
+ALTER TABLE StockTemplates ROW_FORMAT=DYNAMIC,
+    ADD UNIQUE KEY user_fname (user, fname);
+
+DELETE newer FROM UserSheets newer JOIN UserSheets older
+    ON newer.user = older.user AND newer.fname = older.fname
+    AND newer.id > older.id;
+ALTER TABLE UserSheets ROW_FORMAT=DYNAMIC,
+    ADD UNIQUE KEY user_fname (user, fname);
+
+DELETE newer FROM SharedSheets newer JOIN SharedSheets older
+    ON newer.user = older.user AND newer.fname = older.fname
+    AND newer.id > older.id;
+ALTER TABLE SharedSheets ROW_FORMAT=DYNAMIC,
+    ADD UNIQUE KEY user_fname (user, fname);
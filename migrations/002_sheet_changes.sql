@@ -0,0 +1,19 @@
+--
+-- Versioned UserSheets and the UserSheetChanges log for delta saves.
+--
+--   mysql --user=ai --password=ai --database=aspiringinvestments < migrations/002_sheet_changes.sql
+--
+-- Existing sheets start at version 0 with an empty log.
+--
+
+ALTER TABLE UserSheets
+    ADD COLUMN version INT NOT NULL DEFAULT 0;
+
+CREATE TABLE UserSheetChanges (
+    id INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+    fname VARCHAR(100) NOT NULL,
+    user VARCHAR(512) NOT NULL,
+    version INT NOT NULL,
+    commands LONGBLOB,
+    UNIQUE KEY user_fname_version (user, fname, version)
+) ROW_FORMAT=DYNAMIC;
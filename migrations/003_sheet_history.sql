@@ -0,0 +1,24 @@
+--
+-- Sheet version history: save times, and UserSheetSnapshots for the
+-- snapshots that compaction and full saves replace.
+--
+--   mysql --user=ai --password=ai --database=aspiringinvestments < migrations/003_sheet_history.sql
+--
+-- History starts with the first save after the upgrade.
+--
+
+ALTER TABLE UserSheets
+    ADD COLUMN saved INT NOT NULL DEFAULT 0;
+
+ALTER TABLE UserSheetChanges
+    ADD COLUMN saved INT NOT NULL DEFAULT 0;
+
+CREATE TABLE UserSheetSnapshots (
+    id INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+    fname VARCHAR(100) NOT NULL,
+    user VARCHAR(512) NOT NULL,
+    version INT NOT NULL,
+    data LONGBLOB,
+    saved INT NOT NULL DEFAULT 0,
+    UNIQUE KEY user_fname_version (user, fname, version)
+) ROW_FORMAT=DYNAMIC;
@@ -0,0 +1,742 @@
+#!/usr/bin/env python3
+"""
+Collaboration channels behind a pluggable backend
+
+A collaboration session is a channel: the long polls and WebSocket
+connections waiting on it, the recent messages a reconnecting client
+catches up from, and the counter handing out idinsession numbers.
+Channels used to live in a module-level dict in main.py, so only one
+Tornado process could serve /collaborate and a restart dropped every
+session.
+
+The handlers now reach channels through a backend with three
+coroutines: open(session, ticker, fname) and get(session), each
+returning a MessageMixin (or None from get for an unknown session), and
+next_id(channel) for the next idinsession number.  MemoryBackend
+keeps them in this process, as before.  SqliteBackend keeps the session
+list, the idinsession counters and the recent messages in a SQLite file
+shared by every worker process on the host: a broadcast is a row
+appended to ChannelMessages, and each process polls the table every
+poll_interval seconds and hands new rows to the long polls it holds.
+The SQLite calls run on a thread of the backend's own, so waiting on
+another process's write lock never holds up the event loop.
+Messages reach every process in the same order, the publishing process
+included, and a session opened by one worker can be joined through any
+other, or after a restart.
+
+Channels do not live forever.  Every reap_interval seconds a backend
+drops the channels nobody is waiting on that have been idle for
+idle_timeout seconds.  The backend keeps a running total of what the
+message caches hold, and once a message takes it past max_cached_bytes
+it empties caches there and then, starting with the channel idle
+longest.  A client catching up from an emptied cache gets StaleCursor
+and reloads the sheet.  stats() reports the live channels and what
+their caches hold.
+
+Given a log_dir, MemoryBackend also writes each channel to a
+collablog.SessionLog.  A channel the process does not hold, after a
+restart or a reap, is rebuilt from its log by get(), and cursors older
+than the cache are caught up from the log rather than going stale.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import collablog
+
+
+class StaleCursor(Exception):
+    """A cursor older than the messages a channel still keeps"""
+
+    def __init__(self, latest):
+        Exception.__init__(self, "cursor is no longer buffered")
+        self.latest = latest
+
+
+class Batch(list):
+    """
+    Messages sent together.  encoded is the body every listener is sent,
+    {"messages": [...]} as JSON, built the first time it is asked for and
+    then shared by all of them.
+    """
+
+    _encoded = None
+
+    @property
+    def encoded(self):
+        if self._encoded is None:
+            # as tornado.escape.json_encode writes it
+            self._encoded = json.dumps({"messages": self}).replace(
+                "</", "<\\/").encode("utf-8")
+        return self._encoded
+
+
+def message_size(message):
+    """Roughly the memory a cached message takes up"""
+    return sys.getsizeof(message) + sum(sys.getsizeof(value)
+                                        for value in message.values())
+
+
+def _soon(fn):
+    """Calls fn once the event loop has finished its current pass"""
+    try:
+        asyncio.get_running_loop().call_soon(fn)
+    except RuntimeError:
+        fn()
+
+
+# types where only the newest message from each sender matters: a repeated
+# ask.snapshot gets the same answer, and a client loads one snapshot, which
+# the newest one serves best.  execute messages are edits and all are kept.
+COALESCED = ("ask.snapshot", "snapshot")
+
+
+def coalesce(messages):
+    """messages without those a later one from the same sender supersedes"""
+    newest = {}
+    for i, message in enumerate(messages):
+        if message.get("type") in COALESCED:
+            newest[message["type"], message.get("from")] = i
+    return [message for i, message in enumerate(messages)
+            if message.get("type") not in COALESCED or
+            newest[message["type"], message.get("from")] == i]
+
+
+class MessageMixin:
+    """
+    The waiters and recent messages of one session.
+
+    The last cache_size messages are kept in a ring buffer.  Each message
+    gets the next sequence number and an index maps message ids to them,
+    so catching up from a cursor is one lookup and a slice.  A cursor that
+    is not in the buffer raises StaleCursor: the client has missed
+    messages and must reload the sheet.
+
+    Long polls wait for the next batch and are dropped once it is sent;
+    subscribers (WebSocket connections) get every batch until they
+    unsubscribe.  Listeners are called with a Batch, the same one for
+    all of them, so the batch is encoded once however many there are.
+    Everything broadcast in one pass of the event loop reaches the
+    subscribers as a single batch.
+
+    With a batch_window (seconds), broadcasts are held for that long
+    after the first one arrives and go out together, less the ones
+    coalesce() drops, so a burst of edits wakes each listener once.
+
+    active is when the channel was last used, by clock().  log, if set,
+    is the collablog.SessionLog every broadcast and idinsession is
+    written to.  budget, if set, is called with each change in
+    cached_bytes.
+    """
+
+    def __init__(self, session, ticker, fname, cache_size=1000,
+                 batch_window=0, clock=time.time):
+        self.batch_window = batch_window
+        self.clock = clock
+        self.active = clock()
+        self.queued = []        # held by the batch window
+        self.waiters = []
+        self.subscribers = []
+        self.outgoing = []      # broadcast this pass, not yet sent to subscribers
+        self.ring = []          # message with sequence s at (s - 1 - base) % size
+        self.sizes = []         # message_size of each ring slot
+        self.cached_bytes = 0
+        self.base = 0           # sequence number before the oldest in the ring
+        self.seq = 0            # sequence number of the newest message
+        self.latest_id = None   # id of the newest message
+        self.index = {}         # message id -> sequence number
+        self.cache_size = cache_size
+        self.session = session
+        self.ticker = ticker
+        self.fname = fname
+        self.nextid = 2
+        self.log = None
+        self.budget = None
+
+    @property
+    def cache(self):
+        """The buffered messages, oldest first"""
+        return self._since(self.seq - len(self.ring))
+
+    def latest(self):
+        """The id of the newest message, or None"""
+        return self.latest_id
+
+    def _since(self, seq):
+        """The buffered messages after sequence number seq"""
+        start = (seq - self.base) % self.cache_size
+        end = start + self.seq - seq
+        if end <= len(self.ring):
+            return self.ring[start:end]
+        return self.ring[start:] + self.ring[:end - self.cache_size]
+
+    def _remember(self, messages):
+        before = self.cached_bytes
+        for message in messages:
+            self.seq += 1
+            size = message_size(message)
+            if len(self.ring) < self.cache_size:
+                self.ring.append(message)
+                self.sizes.append(size)
+            else:
+                slot = (self.seq - 1 - self.base) % self.cache_size
+                dropped = self.ring[slot]["id"]
+                if self.index.get(dropped) == self.seq - self.cache_size:
+                    del self.index[dropped]
+                self.cached_bytes -= self.sizes[slot]
+                self.ring[slot] = message
+                self.sizes[slot] = size
+            self.cached_bytes += size
+            self.index[message["id"]] = self.seq
+            self.latest_id = message["id"]
+        if self.budget is not None:
+            self.budget(self.cached_bytes - before)
+
+    def drop_cache(self):
+        """Empties the message cache; older cursors become stale"""
+        dropped = self.cached_bytes
+        self.ring, self.sizes, self.index = [], [], {}
+        self.cached_bytes = 0
+        self.base = self.seq
+        if self.budget is not None:
+            self.budget(-dropped)
+
+    async def _catch_up(self, cursor):
+        """The messages after cursor; raises StaleCursor"""
+        self.active = self.clock()
+        if not cursor or cursor == self.latest_id:
+            return []
+        seq = self.index.get(cursor)
+        if seq is not None:
+            return Batch(self._since(seq))
+        if self.log is None:
+            raise StaleCursor(self.latest())
+        recent = await self.log.read_since(cursor)
+        if recent is None:
+            raise StaleCursor(self.latest())
+        # what was broadcast while the log was read is in the cache
+        last = recent[-1]["id"] if recent else cursor
+        if last != self.latest_id:
+            seq = self.index.get(last)
+            if seq is None:
+                raise StaleCursor(self.latest())
+            recent += self._since(seq)
+        return Batch(recent)
+
+    async def wait_for_messages(self, callback, cursor=None):
+        recent = await self._catch_up(cursor)
+        if recent:
+            callback(recent)
+            return
+        self.waiters.append(callback)
+
+    def cancel_wait(self, callback):
+        """Forgets a long poll whose client has gone"""
+        if callback in self.waiters:
+            self.waiters.remove(callback)
+
+    async def subscribe(self, callback, cursor=None):
+        """Calls callback with every batch after cursor until unsubscribed"""
+        recent = await self._catch_up(cursor)
+        # the queue goes to those already subscribed; this one caught up
+        self._flush_subscribers()
+        if recent:
+            callback(recent)
+        self.subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        self.subscribers.remove(callback)
+        self.active = self.clock()
+
+    def new_messages(self, message):
+        self.active = self.clock()
+        if not self.batch_window:
+            self._broadcast(message)
+            return
+        if not self.queued:
+            try:
+                asyncio.get_running_loop().call_later(
+                    self.batch_window, self._flush_queued)
+            except RuntimeError:
+                self._broadcast(message)
+                return
+        self.queued.extend(message)
+
+    def _flush_queued(self):
+        messages, self.queued = coalesce(self.queued), []
+        self._broadcast(messages)
+
+    def _broadcast(self, message):
+        self._fan_out(message)
+
+    def _fan_out(self, message):
+        logging.info("Sending new message to %r listeners",
+                     len(self.waiters) + len(self.subscribers))
+        self._send(self.waiters, Batch(message))
+        self.waiters = []
+        if self.log is not None:
+            self.log.append(message)
+        self._remember(message)
+        if self.subscribers:
+            queued = bool(self.outgoing)
+            self.outgoing.extend(message)
+            if not queued:
+                _soon(self._flush_subscribers)
+
+    def _flush_subscribers(self):
+        if not self.outgoing:
+            return
+        batch, self.outgoing = Batch(self.outgoing), []
+        self._send(list(self.subscribers), batch)
+
+    @staticmethod
+    def _send(callbacks, batch):
+        for callback in callbacks:
+            try:
+                callback(batch)
+            except:
+                logging.error("Error in waiter callback", exc_info=True)
+
+    def get_nextid(self):
+        self.active = self.clock()
+        id = self.nextid
+        self.nextid = self.nextid + 1
+        if self.log is not None:
+            self.log.record_nextid(id)
+        return id
+
+
+async def _every(interval, fn, what):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            result = fn()
+            if asyncio.iscoroutine(result):
+                await result
+        except Exception as e:
+            logging.warning("%s failed: %s", what, e)
+
+
+def _keep_running(task, interval, fn, what):
+    """task if it is running, else a new one calling fn every interval"""
+    if task is not None and not task.done():
+        return task
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return None     # no loop yet; fn is called directly
+    return asyncio.ensure_future(_every(interval, fn, what))
+
+
+class Backend:
+    """
+    The channels of this process, and their reaping.  idle_timeout and
+    max_cached_bytes of None turn off reaping and the memory budget.
+    """
+
+    def __init__(self, cache_size=1000, batch_window=0, idle_timeout=None,
+                 max_cached_bytes=None, reap_interval=60, clock=time.time):
+        self.cache_size = cache_size
+        self.batch_window = batch_window
+        self.idle_timeout = idle_timeout
+        self.max_cached_bytes = max_cached_bytes
+        self.reap_interval = reap_interval
+        self.clock = clock
+        self.channels = {}      # session -> MessageMixin
+        self.cached_bytes = 0   # held by the caches of channels
+        self.reaper = None
+        self.counters = dict(opened=0, replayed=0, reaped=0, evicted=0)
+
+    def _add(self, channel):
+        self._remove(channel.session)
+        self.channels[channel.session] = channel
+        channel.budget = self._cached
+        self._cached(channel.cached_bytes)
+        if self.idle_timeout is not None:
+            self.reaper = _keep_running(self.reaper, self.reap_interval,
+                                        self.reap, "Channel reaping")
+        return channel
+
+    async def next_id(self, channel):
+        """The next idinsession number of channel"""
+        return channel.get_nextid()
+
+    def _remove(self, session):
+        channel = self.channels.pop(session, None)
+        if channel is not None:
+            channel.budget = None
+            self.cached_bytes -= channel.cached_bytes
+        return channel
+
+    def _cached(self, change):
+        """Empties caches, least recently used first, past the budget"""
+        self.cached_bytes += change
+        if change <= 0 or self.max_cached_bytes is None or \
+                self.cached_bytes <= self.max_cached_bytes:
+            return
+        for channel in sorted(self.channels.values(),
+                              key=lambda channel: channel.active):
+            if self.cached_bytes <= self.max_cached_bytes:
+                break
+            if channel.cached_bytes:
+                channel.drop_cache()
+                self.counters["evicted"] += 1
+
+    def _idle(self, channel, now):
+        return (self.idle_timeout is not None and
+                now - channel.active > self.idle_timeout and
+                not channel.waiters and not channel.subscribers and
+                not channel.queued)
+
+    def reap(self):
+        """Drops idle channels"""
+        now = self.clock()
+        for session, channel in list(self.channels.items()):
+            if self._idle(channel, now):
+                self._remove(session)
+                if channel.log is not None:
+                    channel.log.delete()
+                self.counters["reaped"] += 1
+
+    def stats(self):
+        channels = self.channels.values()
+        stats = dict(self.counters)
+        stats.update(
+            channels=len(self.channels),
+            waiters=sum(len(channel.waiters) for channel in channels),
+            subscribers=sum(len(channel.subscribers) for channel in channels),
+            cached_messages=sum(len(channel.ring) for channel in channels),
+            cached_bytes=self.cached_bytes,
+            max_cached_bytes=self.max_cached_bytes)
+        return stats
+
+    def close(self):
+        if self.reaper is not None:
+            self.reaper.cancel()
+
+
+class MemoryBackend(Backend):
+    """
+    Channels held by this process alone, logged under log_dir if it is
+    set.  fsync_interval and segment_bytes are passed to the logs, which
+    do their file work on a thread of the backend's own.
+    """
+
+    def __init__(self, log_dir=None, fsync_interval=0.05,
+                 segment_bytes=4 * 1024 * 1024, **kwargs):
+        Backend.__init__(self, **kwargs)
+        self.log_dir = log_dir
+        self.executor = None
+        self.replaying = {}     # session -> Task
+        if log_dir is not None:
+            os.makedirs(log_dir, exist_ok=True)
+            self.executor = ThreadPoolExecutor(
+                1, thread_name_prefix="collablog")
+        self.log_options = dict(keep=self.cache_size,
+                                fsync_interval=fsync_interval,
+                                segment_bytes=segment_bytes,
+                                executor=self.executor)
+
+    async def _on_log_thread(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, lambda: fn(*args, **self.log_options))
+
+    def _log_path(self, session):
+        if self.log_dir is None or not collablog.SESSION_NAME.match(session):
+            return None
+        return os.path.join(self.log_dir, session)
+
+    def _channel(self, session, ticker, fname):
+        return MessageMixin(session, ticker, fname, self.cache_size,
+                            self.batch_window, self.clock)
+
+    async def open(self, session, ticker, fname):
+        self.counters["opened"] += 1
+        channel = self._channel(session, ticker, fname)
+        path = self._log_path(session)
+        if path is not None:
+            channel.log = await self._on_log_thread(
+                collablog.SessionLog.create, path, ticker, fname)
+        return self._add(channel)
+
+    async def get(self, session):
+        channel = self.channels.get(session)
+        if channel is not None:
+            return channel
+        path = self._log_path(session)
+        if path is None:
+            return None
+        # concurrent gets share one replay, and so one channel
+        task = self.replaying.get(session)
+        if task is None:
+            task = self.replaying[session] = asyncio.ensure_future(
+                self._replay(session, path))
+            task.add_done_callback(
+                lambda _: self.replaying.pop(session, None))
+        return await asyncio.shield(task)
+
+    async def _replay(self, session, path):
+        opened = await self._on_log_thread(collablog.SessionLog.open, path)
+        if not opened:
+            return None
+        log, replayed = opened
+        channel = self._channel(session, replayed.ticker, replayed.fname)
+        channel.seq = channel.base = replayed.seq - len(replayed.messages)
+        channel._remember(replayed.messages)
+        channel.nextid = replayed.nextid
+        channel.log = log
+        self.counters["replayed"] += 1
+        return self._add(channel)
+
+    def reap(self):
+        Backend.reap(self)
+        if self.log_dir is None or self.idle_timeout is None:
+            return
+        # logs of sessions no process has asked for since the last run
+        cutoff = self.clock() - self.idle_timeout
+        for session in os.listdir(self.log_dir):
+            path = os.path.join(self.log_dir, session)
+            if session in self.channels or not os.path.isdir(path):
+                continue
+            if all(os.path.getmtime(os.path.join(path, name)) < cutoff
+                   for name in os.listdir(path)):
+                shutil.rmtree(path, ignore_errors=True)
+
+    def close(self):
+        Backend.close(self)
+        for channel in self.channels.values():
+            if channel.log is not None:
+                channel.log.close()
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+
+
+class SharedChannel(MessageMixin):
+    """
+    A MessageMixin whose broadcasts and idinsession numbers go through a
+    SqliteBackend.  Its waiters and cache stay local to the process.
+    polled is the seq of the newest row it has been handed.
+    """
+
+    def __init__(self, backend, session, ticker, fname):
+        MessageMixin.__init__(self, session, ticker, fname,
+                              backend.cache_size, backend.batch_window,
+                              backend.clock)
+        self.backend = backend
+        self.polled = 0
+
+    def _broadcast(self, message):
+        self.backend._publish(self.session, message)
+
+    def get_nextid(self):
+        raise TypeError("shared idinsession numbers come from "
+                        "SqliteBackend.next_id()")
+
+    def _deliver(self, messages):
+        self._fan_out(messages)
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS Channels (
+    session TEXT PRIMARY KEY,
+    ticker TEXT NOT NULL,
+    fname TEXT NOT NULL,
+    nextid INTEGER NOT NULL,
+    active REAL NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS ChannelMessages (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    session TEXT NOT NULL,
+    body TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ChannelMessagesSession
+    ON ChannelMessages (session, seq);
+"""
+
+
+class SqliteBackend(Backend):
+    """
+    Channels shared through the SQLite file at path by every process that
+    opens it.  The connection is used from one thread of the backend's
+    own, which the coroutines hand their queries to; WAL mode keeps a
+    publish to a short append that does not wait on the readers in other
+    processes.  Sessions no process has used for idle_timeout seconds are
+    deleted from the file.
+    """
+
+    def __init__(self, path, poll_interval=0.05, **kwargs):
+        Backend.__init__(self, **kwargs)
+        self.poll_interval = poll_interval
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix="channels")
+        # set up here, before serving; afterwards used on the executor's
+        # thread only
+        self.conn = sqlite3.connect(path, timeout=10, isolation_level=None,
+                                    check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        columns = [row[1] for row in
+                   self.conn.execute("PRAGMA table_info(Channels)")]
+        if "active" not in columns:
+            self.conn.execute("ALTER TABLE Channels ADD COLUMN "
+                              "active REAL NOT NULL DEFAULT 0")
+        self.last_seq = self._scalar(
+            "SELECT MAX(seq) FROM ChannelMessages") or 0
+        self.poller = None
+        self.sending = set()    # publishes on their way to the file
+
+    async def _call(self, fn, *args):
+        """fn(*args) on the connection's thread"""
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, fn, *args)
+
+    def _scalar(self, sql, *args):
+        row = self.conn.execute(sql, args).fetchone()
+        return row[0] if row else None
+
+    def _transaction(self, fn, *args):
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = fn(*args)
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.conn.execute("COMMIT")
+        return result
+
+    async def open(self, session, ticker, fname):
+        await self._call(self.conn.execute,
+                         "INSERT OR REPLACE INTO Channels "
+                         "(session, ticker, fname, nextid, active) "
+                         "VALUES (?, ?, ?, 2, ?)",
+                         (session, ticker, fname, self.clock()))
+        self.counters["opened"] += 1
+        channel = self._add(SharedChannel(self, session, ticker, fname))
+        self._start_polling()
+        return channel
+
+    async def get(self, session):
+        channel = self.channels.get(session)
+        if channel is not None:
+            return channel
+        found = await self._call(self._read_channel, session)
+        channel = self.channels.get(session)
+        if channel is not None or found is None:
+            # another get() got there first, or there is no such session
+            return channel
+        # opened by another process, or before a restart: catch up from
+        # what the file keeps; polls only hand it rows after those
+        ticker, fname, rows = found
+        channel = self._add(SharedChannel(self, session, ticker, fname))
+        channel._remember([json.loads(body) for _, body in rows])
+        if rows:
+            channel.polled = rows[-1][0]
+        self._start_polling()
+        return channel
+
+    def _read_channel(self, session):
+        row = self.conn.execute("SELECT ticker, fname FROM Channels "
+                                "WHERE session = ?", (session,)).fetchone()
+        if row is None:
+            return None
+        rows = self.conn.execute(
+            "SELECT seq, body FROM ChannelMessages WHERE session = ? "
+            "ORDER BY seq DESC LIMIT ?", (session, self.cache_size)).fetchall()
+        return row[0], row[1], rows[::-1]
+
+    async def next_id(self, channel):
+        channel.active = self.clock()
+        return await self._call(self._transaction, self._next_id,
+                                channel.session, channel.active)
+
+    def _next_id(self, session, now):
+        self.conn.execute("UPDATE Channels SET nextid = nextid + 1, "
+                          "active = ? WHERE session = ?", (now, session))
+        return self._scalar("SELECT nextid - 1 FROM Channels "
+                            "WHERE session = ?", session)
+
+    def _publish(self, session, messages):
+        rows = [(session, json.dumps(message)) for message in messages]
+        task = asyncio.ensure_future(self._send(session, rows, self.clock()))
+        # the loop only keeps a weak reference to a task
+        self.sending.add(task)
+        task.add_done_callback(self.sending.discard)
+
+    async def _send(self, session, rows, now):
+        try:
+            await self._call(self._transaction, self._append, session, rows,
+                             now)
+        except Exception as e:
+            logging.warning("Channel publish failed: %s", e)
+            return
+        # local listeners need not wait for the next poll
+        await self.poll()
+
+    def _append(self, session, rows, now):
+        self.conn.executemany(
+            "INSERT INTO ChannelMessages (session, body) VALUES (?, ?)", rows)
+        # keep what a reconnecting poller can catch up from
+        self.conn.execute(
+            "DELETE FROM ChannelMessages WHERE session = ? AND seq <= "
+            "(SELECT seq FROM ChannelMessages WHERE session = ? "
+            "ORDER BY seq DESC LIMIT 1 OFFSET ?)",
+            (session, session, self.cache_size))
+        self.conn.execute("UPDATE Channels SET active = ? "
+                          "WHERE session = ?", (now, session))
+
+    async def poll(self):
+        """Hands messages published since the last poll to local channels"""
+        rows = await self._call(self._read_since, self.last_seq)
+        batches = {}
+        for seq, session, body in rows:
+            if seq <= self.last_seq:
+                continue        # handed out by a poll that finished first
+            self.last_seq = seq
+            channel = self.channels.get(session)
+            if channel is not None and seq > channel.polled:
+                channel.polled = seq
+                batches.setdefault(session, []).append(json.loads(body))
+        for session, messages in batches.items():
+            self.channels[session]._deliver(messages)
+
+    def _read_since(self, seq):
+        return self.conn.execute("SELECT seq, session, body "
+                                 "FROM ChannelMessages WHERE seq > ? "
+                                 "ORDER BY seq", (seq,)).fetchall()
+
+    def _start_polling(self):
+        self.poller = _keep_running(self.poller, self.poll_interval,
+                                    self.poll, "Channel poll")
+
+    async def reap(self):
+        Backend.reap(self)
+        if self.idle_timeout is None:
+            return
+        now = self.clock()
+        live = [(now, session) for session, channel in self.channels.items()
+                if channel.waiters or channel.subscribers]
+
+        def reap():
+            # sessions with clients here are in use, whatever the file says
+            self.conn.executemany("UPDATE Channels SET active = ? "
+                                  "WHERE session = ?", live)
+            self.conn.execute("DELETE FROM Channels WHERE active < ?",
+                              (now - self.idle_timeout,))
+            self.conn.execute("DELETE FROM ChannelMessages WHERE session "
+                              "NOT IN (SELECT session FROM Channels)")
+
+        await self._call(self._transaction, reap)
+
+    def close(self):
+        Backend.close(self)
+        if self.poller is not None:
+            self.poller.cancel()
+        self.executor.shutdown(wait=True)
+        self.conn.close()
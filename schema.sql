@@ -5,6 +5,12 @@
 --
 -- To reload the tables:
 --   mysql --user=ai --password=ai --database=aspiringinvestments < schema.sql
+--
+-- To bring an existing database up to date without reloading, apply the
+-- files in migrations/ in order.
+--
+-- The data column of the sheet tables is written by sheetcodec.encode:
+-- compressed with a header, or plain text for short and legacy rows.
 
 SET SESSION storage_engine = "InnoDB";
 SET SESSION time_zone = "+0:00";
@@ -15,29 +21,60 @@ CREATE TABLE StockTemplates (
     id INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
     fname VARCHAR(100) NOT NULL,
     user VARCHAR(512) NOT NULL,
-    data LONGBLOB
-);
+    data LONGBLOB,
+    UNIQUE KEY user_fname (user, fname)
+) ROW_FORMAT=DYNAMIC;
 
 DROP TABLE IF EXISTS UserSheets;
 CREATE TABLE UserSheets (
     id INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
     fname VARCHAR(100) NOT NULL,
     user VARCHAR(512) NOT NULL,
-    data LONGBLOB
-);
+    data LONGBLOB,
+    version INT NOT NULL DEFAULT 0,
+    saved INT NOT NULL DEFAULT 0,
+    UNIQUE KEY user_fname (user, fname)
+) ROW_FORMAT=DYNAMIC;
+
+-- Delta saves, and the older UserSheets snapshots kept as history; see
+-- sheetstore.py
+DROP TABLE IF EXISTS UserSheetChanges;
+CREATE TABLE UserSheetChanges (
+    id INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+    fname VARCHAR(100) NOT NULL,
+    user VARCHAR(512) NOT NULL,
+    version INT NOT NULL,
+    commands LONGBLOB,
+    saved INT NOT NULL DEFAULT 0,
+    UNIQUE KEY user_fname_version (user, fname, version)
+) ROW_FORMAT=DYNAMIC;
+
+DROP TABLE IF EXISTS UserSheetSnapshots;
+CREATE TABLE UserSheetSnapshots (
+    id INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+    fname VARCHAR(100) NOT NULL,
+    user VARCHAR(512) NOT NULL,
+    version INT NOT NULL,
+    data LONGBLOB,
+    saved INT NOT NULL DEFAULT 0,
+    UNIQUE KEY user_fname_version (user, fname, version)
+) ROW_FORMAT=DYNAMIC;
 
 DROP TABLE IF EXISTS SharedSheets;
 CREATE TABLE SharedSheets (
     id INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
     fname VARCHAR(100) NOT NULL,
     user VARCHAR(512) NOT NULL,
-    data LONGBLOB
-);
+    data LONGBLOB,
+    UNIQUE KEY user_fname (user, fname)
+) ROW_FORMAT=DYNAMIC;
 
 DROP TABLE IF EXISTS TickerAnnualData;
 CREATE TABLE TickerAnnualData (
     id INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
     ticker VARCHAR(20) NOT NULL,
     year VARCHAR(20) NOT NULL,
-    data LONGBLOB
+    data LONGBLOB,
+    updated INT NOT NULL DEFAULT 0,
+    UNIQUE KEY ticker_year (ticker, year)
 );
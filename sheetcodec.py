@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+"""
+Storage codec for the sheet LONGBLOB columns
+
+UserSheets.data, SharedSheets.data and StockTemplates.data hold SocialCalc
+save text, which is mostly the same few keywords over and over
+(``cell:A1:v:...`` lines, style tables, multipart boundaries).  encode()
+deflates the text against a preset dictionary of that vocabulary and puts
+a five-byte header in front:
+
+    b"\\x89SC"  format  dictionary
+
+The first byte can never start UTF-8 text, so decode() tells an encoded
+row from a legacy plain-text row by looking at it; old rows keep loading
+and are compressed the next time they are saved.  Text too short to gain
+from compression is stored plain.
+
+Dictionaries are looked up by the id in the header, so a dictionary that
+has been used to write rows must never change; a retrained one goes in
+under a new id and DEFAULT_DICTIONARY moves to it.
+
+    python sheetcodec.py train SAVEFILE... > dictionary.txt
+    python sheetcodec.py recompress [--batch_size=100]
+
+build a dictionary from sample saves, and encode the legacy rows already
+in the database.
+"""
+
+import collections
+import re
+import zlib
+
+MAGIC = b"\x89SC"
+FORMAT_DEFLATE = 1
+HEADER_SIZE = len(MAGIC) + 2
+
+# below this many bytes the header and deflate overhead outweigh the gain
+MIN_SIZE = 64
+
+TABLES = ("UserSheets", "SharedSheets", "StockTemplates")
+
+
+class CodecError(Exception):
+    pass
+
+
+# The save format's fixed vocabulary: the multipart wrapper written by
+# SocialCalc.SpreadsheetControlCreateSpreadsheetSave, then the sheet save's
+# line types and the cell attributes and style values that recur in
+# typical sheets.  deflate reaches the end of a preset dictionary most
+# cheaply, so the most common pieces come last.
+DICTIONARY_1 = (
+    "socialcalc:version:1.0\n"
+    "MIME-Version: 1.0\n"
+    "Content-Type: multipart/mixed; boundary=SocialCalcSpreadsheetControlSave\n"
+    "# SocialCalc Spreadsheet Control Save\n"
+    "part:sheet\npart:edit\npart:audit\n"
+    "--SocialCalcSpreadsheetControlSave--\n"
+    "--SocialCalcSpreadsheetControlSave\n"
+    "Content-type: text/plain; charset=UTF-8\n\n"
+    "version:1.0\nversion:1.5\n"
+    "rowpane:0:1:1\ncolpane:0:1:1\necell:A1\n"
+    "sheet:c:26:r:100:w:80:h:20:tf:1:ntf:1:layout:1:font:1:tvf:1:ntvf:1\n"
+    "col:A:w:120\ncol:B:w:100\nrow:1:h:20\n"
+    "layout:1:padding:* * * *;vertical-align:*;\n"
+    "layout:2:padding:* * * *;vertical-align:top;\n"
+    "font:1:normal bold * *\nfont:2:italic normal * *\n"
+    "font:3:* * 12pt Arial,Helvetica,sans-serif\n"
+    "color:1:rgb(0,0,0)\ncolor:2:rgb(255,255,255)\n"
+    "color:3:rgb(255,0,0)\ncolor:4:rgb(0,0,255)\n"
+    "border:1:1px solid rgb(0,0,0)\n"
+    "cellformat:1:left\ncellformat:2:center\ncellformat:3:right\n"
+    "valueformat:1:#,##0.00\nvalueformat:2:0.00%\n"
+    "valueformat:3:[$$]#,##0.00\nvalueformat:4:text-wiki\n"
+    "name:TOTAL::\n"
+    "IF(ROUND(AVERAGE(COUNT(MAX(MIN(ABS(NPV(IRR(PMT(SUM("
+    ":colspan:2:rowspan:2:cssc:csss:comment:\n"
+    ":bg:2:c:1:cf:3:l:1:tvf:1:ntvf:1:b:1:1:1:1\n"
+    "cell:A1:t:Total Revenue:f:1\n"
+    "cell:B1:vtf:n:0:SUM(B2\\cB9):ntvf:1\n"
+    "cell:A2:t:Net Income\ncell:A3:t:Cash\n"
+    "cell:B2:v:1000:ntvf:1\ncell:B3:v:0.25:ntvf:2\n"
+    "cell:C1:v:\ncell:D1:v:\ncell:E1:v:\ncell:F1:v:\n"
+)
+
+DICTIONARIES = {
+    0: b"",
+    1: DICTIONARY_1.encode("utf-8"),
+}
+DEFAULT_DICTIONARY = 1
+
+
+def is_encoded(data):
+    return isinstance(data, (bytes, bytearray)) and data[:3] == MAGIC
+
+
+def encode(text, dictionary=DEFAULT_DICTIONARY, level=6):
+    """The bytes to store for save text"""
+    raw = text.encode("utf-8") if isinstance(text, str) else bytes(text)
+    if len(raw) < MIN_SIZE:
+        return raw
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15, 9,
+                                  zlib.Z_DEFAULT_STRATEGY,
+                                  DICTIONARIES[dictionary])
+    body = compressor.compress(raw) + compressor.flush()
+    if len(body) + HEADER_SIZE >= len(raw):
+        return raw
+    return MAGIC + bytes((FORMAT_DEFLATE, dictionary)) + body
+
+
+def decode(data):
+    """The save text in a stored value, encoded or legacy"""
+    if data is None or isinstance(data, str):
+        return data
+    if not is_encoded(data):
+        return bytes(data).decode("utf-8")
+    if len(data) < HEADER_SIZE:
+        raise CodecError("Truncated sheet header")
+    fmt, dictionary = data[3], data[4]
+    if fmt != FORMAT_DEFLATE:
+        raise CodecError("Unknown sheet storage format %d" % fmt)
+    if dictionary not in DICTIONARIES:
+        raise CodecError("Unknown sheet dictionary %d" % dictionary)
+    decompressor = zlib.decompressobj(-15, DICTIONARIES[dictionary])
+    try:
+        raw = decompressor.decompress(bytes(data[HEADER_SIZE:]))
+        raw += decompressor.flush()
+    except zlib.error as e:
+        raise CodecError("Corrupt sheet data: %s" % e)
+    if not decompressor.eof:
+        raise CodecError("Truncated sheet data")
+    return raw.decode("utf-8")
+
+
+# numbers, coordinates and free text vary from sheet to sheet; what is
+# left of a line once they are blanked out is the reusable part
+_VARIABLE = re.compile(r"(?<=:)[^:\n]*\d[^:\n]*(?=:|$)|(?<=:t:)[^:\n]+")
+
+
+def train_dictionary(samples, size=8192):
+    """
+    A preset dictionary for encode built from sample save texts: the line
+    shapes and whole lines that recur across the samples, the most
+    valuable last, trimmed to size bytes.
+    """
+    counts = collections.Counter()
+    for text in samples:
+        seen = set()
+        for line in text.splitlines():
+            if not line:
+                continue
+            seen.add(line)
+            shape = _VARIABLE.sub("", line)
+            if shape != line:
+                seen.add(shape)
+        counts.update(seen)
+    pieces = [piece for piece, count in counts.items() if count > 1]
+    pieces.sort(key=lambda piece: counts[piece] * len(piece))
+    chosen, total = [], 0
+    for piece in reversed(pieces):
+        if total + len(piece) + 1 > size:
+            continue
+        chosen.append(piece)
+        total += len(piece) + 1
+    chosen.reverse()
+    return "".join(piece + "\n" for piece in chosen)
+
+
+async def recompress(db, table, batch_size=100):
+    """
+    Encodes the legacy plain-text rows of table, batch_size rows per
+    query.  A row saved again since it was read is left alone.  Returns
+    (rows, encoded, skipped, stored bytes before, after).
+    """
+    rows = encoded = skipped = before = after = 0
+    last = 0
+    while True:
+        batch = await db.query(
+            "SELECT id, data FROM %s WHERE id > %%s ORDER BY id LIMIT %%s"
+            % table, last, batch_size)
+        if not batch:
+            break
+        updates = []
+        for row in batch:
+            last = row["id"]
+            data = row["data"]
+            rows += 1
+            if data is None:
+                continue
+            size = len(data)
+            before += size
+            if is_encoded(data):
+                after += size
+                continue
+            value = encode(decode(data))
+            if is_encoded(value):
+                updates.append((value, row["id"], data))
+            else:
+                after += size
+
+        def update(conn):
+            # only if the row still holds what was read
+            return [conn.execute_rowcount(
+                "UPDATE %s SET data = %%s WHERE id = %%s AND data = %%s"
+                % table, *update) for update in updates]
+
+        if updates:
+            for (value, _, data), changed in zip(updates,
+                                                  await db.run(update)):
+                if changed:
+                    encoded += 1
+                    after += len(value)
+                else:
+                    skipped += 1
+                    after += len(data)
+    return rows, encoded, skipped, before, after
+
+
+def main():
+    import asyncio
+    import logging
+    import sys
+    from tornado.options import define, options, parse_command_line
+    import dbpool
+
+    define("mysql_host", default="127.0.0.1:3306", help="database host")
+    define("mysql_database", default="aspiringinvestments",
+           help="database name")
+    define("mysql_user", default="ai", help="database user")
+    define("mysql_password", default="ai", help="database password")
+    define("batch_size", default=100, help="rows per recompress query",
+           type=int)
+    define("dictionary_size", default=8192, help="bytes of trained dictionary",
+           type=int)
+    args = parse_command_line()
+    if args and args[0] == "train" and len(args) > 1:
+        samples = []
+        for name in args[1:]:
+            with open(name, encoding="utf-8") as f:
+                samples.append(f.read())
+        sys.stdout.write(train_dictionary(samples, options.dictionary_size))
+        return
+    if args != ["recompress"]:
+        raise SystemExit("usage: sheetcodec.py train SAVEFILE... | "
+                         "sheetcodec.py recompress [options]")
+
+    db = dbpool.mysql_pool(options.mysql_host, options.mysql_database,
+                           options.mysql_user, options.mysql_password, size=1)
+
+    async def run():
+        for table in TABLES:
+            rows, encoded, skipped, before, after = await recompress(
+                db, table, options.batch_size)
+            logging.info("%s: %d rows, %d encoded, %d saved meanwhile and "
+                         "skipped, %.1f MB -> %.1f MB", table, rows, encoded,
+                         skipped, before / 1e6, after / 1e6)
+
+    asyncio.run(run())
+    db.close()
+
+
+if __name__ == "__main__":
+    main()
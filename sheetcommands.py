@@ -0,0 +1,454 @@
+#!/usr/bin/env python3
+"""
+Server-side SocialCalc sheet commands
+
+Applies the command strings the spreadsheet control executes and
+broadcasts (``set A1 value n 5``, ``erase A1:B2 formulas``, ...) to a
+socialcalc.Sheet, following SocialCalc.ExecuteSheetCommand in
+src/js/core/socialcalc-engine.js.  Several commands may be joined with
+newlines, as in ScheduleSheetCommands.
+
+Only the commands that depend on nothing but the sheet are supported.
+Commands that need client state (the clipboard for paste, undo/redo) or
+that move cells around (insertrow, deletecol, sort, movepaste, ...) raise
+UnsupportedCommand; callers fall back to a full save for those.
+"""
+
+import re
+
+import formula
+import formula_vector
+import socialcalc
+
+# attrib name -> (style table on the sheet, cell field) for set coord
+_STYLE_ATTRIBS = {
+    "bt": ("borderstyles", "bt"), "br": ("borderstyles", "br"),
+    "bb": ("borderstyles", "bb"), "bl": ("borderstyles", "bl"),
+    "color": ("colors", "color"), "bgcolor": ("colors", "bgcolor"),
+    "layout": ("layouts", "layout"), "cellformat": ("cellformats", "cellformat"),
+    "font": ("fonts", "font"),
+    "textvalueformat": ("valueformats", "textvalueformat"),
+    "nontextvalueformat": ("valueformats", "nontextvalueformat"),
+}
+
+# set sheet attrib -> style table, or None for a plain value
+_SHEET_STYLE_ATTRIBS = {
+    "defaultcolor": "colors", "defaultbgcolor": "colors",
+    "defaultlayout": "layouts", "defaultfont": "fonts",
+    "defaulttextformat": "cellformats", "defaultnontextformat": "cellformats",
+    "defaulttextvalueformat": "valueformats",
+    "defaultnontextvalueformat": "valueformats",
+}
+
+# set sheet attribs _set_sheet handles
+_SHEET_ATTRIBS = ("defaultcolwidth", "lastcol", "lastrow",
+                  "recalc") + tuple(_SHEET_STYLE_ATTRIBS)
+
+# set coord attribs _set_cells handles
+_CELL_ATTRIBS = ("value", "text", "formula", "constant", "empty", "all",
+                 "cssc", "csss", "mod", "comment") + tuple(_STYLE_ATTRIBS)
+
+# verbs whose first argument is a range
+_RANGE_VERBS = ("merge", "unmerge", "erase", "cut", "fillright", "filldown")
+
+# name subcommands _name handles
+_NAME_ACTIONS = ("define", "desc", "delete")
+
+# cell fields fillright/filldown copy as formats
+_FORMAT_FIELDS = ("bt", "br", "bb", "bl", "layout", "font", "color",
+                  "bgcolor", "cellformat", "nontextvalueformat",
+                  "textvalueformat", "colspan", "rowspan", "cssc", "csss")
+
+_column_re = re.compile(r"^[A-Z][A-Z]?(:[A-Z][A-Z]?)?$", re.I)
+_cell_re = re.compile(r"[a-z]?\d+", re.I)
+
+# verbs that change nothing a save records
+_NO_OPS = ("", "recalc", "redisplay", "changedrendervalues", "copy",
+           "loadclipboard", "clearclipboard")
+
+
+class CommandError(ValueError):
+    """A command that cannot be applied on the server"""
+
+
+class UnsupportedCommand(CommandError):
+    pass
+
+
+class _Tokens:
+    """SocialCalc.Parse over one command line"""
+
+    def __init__(self, line):
+        self.line = line
+        self.pos = 0
+
+    def next(self):
+        if self.pos > len(self.line):
+            return ""
+        end = self.line.find(" ", self.pos)
+        if end < 0:
+            end = len(self.line)
+        token = self.line[self.pos:end]
+        self.pos = end + 1
+        return token
+
+    def rest(self):
+        rest = self.line[self.pos:]
+        self.pos = len(self.line) + 1
+        return rest
+
+
+def _style_num(sheet, table, value):
+    if not value:
+        return 0
+    return getattr(sheet, table).add(value)
+
+
+def _range(what):
+    """(col1, row1, col2, row2) of a range such as A1:B2"""
+    first, _, last = (what or "A1").upper().partition(":")
+    try:
+        col1, row1 = socialcalc.coord_to_cr(first)
+        col2, row2 = socialcalc.coord_to_cr(last or first)
+    except ValueError:
+        raise CommandError("Bad range %r" % what)
+    return col1, row1, col2, row2
+
+
+def _parse_range(sheet, what):
+    """(col1, row1, col2, row2), growing the sheet's extent like ParseRange"""
+    col1, row1, col2, row2 = _range(what)
+    attribs = sheet.attribs
+    if col2 > attribs.get("lastcol", 1):
+        attribs["lastcol"] = col2
+    if row2 > attribs.get("lastrow", 1):
+        attribs["lastrow"] = row2
+    return col1, row1, col2, row2
+
+
+def _coords(col1, row1, col2, row2):
+    for row in range(row1, row2 + 1):
+        for col in range(col1, col2 + 1):
+            yield socialcalc.cr_to_coord(col, row)
+
+
+def _clear_value(cell):
+    cell.datavalue = ""
+    cell.datatype = None
+    cell.formula = ""
+    cell.valuetype = "b"
+    cell.errors = ""
+
+
+def offset_formula_coords(text, coloffset, rowoffset):
+    """SocialCalc.OffsetFormulaCoords: shifts the relative references"""
+    out = []
+    pos = 0
+    while pos < len(text):
+        m = formula._token_re.match(text, pos)
+        if not m:
+            out.append(text[pos:])
+            break
+        token = m.group()
+        if m.lastgroup in ("coord", "sheetref"):
+            prefix, bang, ref = token.rpartition("!")
+            col, row = socialcalc.coord_to_cr(ref)
+            newref = ""
+            if ref[0] == "$":
+                newref += "$"
+            else:
+                col += coloffset
+            newref += socialcalc.number_to_colname(max(col, 0))
+            if "$" in ref[1:]:
+                newref += "$"
+            else:
+                row += rowoffset
+            newref += str(row)
+            token = prefix + bang + (newref if col >= 1 and row >= 1
+                                     else "#REF!")
+        out.append(token)
+        pos = m.end()
+    return "".join(out)
+
+
+def _set_sheet(sheet, attrib, rest):
+    attribs = sheet.attribs
+    if attrib == "defaultcolwidth":
+        attribs[attrib] = rest
+    elif attrib in _SHEET_STYLE_ATTRIBS:
+        if attrib == "defaultfont" and rest == "* * *":
+            rest = ""
+        attribs[attrib] = _style_num(sheet, _SHEET_STYLE_ATTRIBS[attrib], rest)
+    elif attrib in ("lastcol", "lastrow"):
+        num = socialcalc.to_number(rest)
+        attribs[attrib] = int(num) if num == num and num > 0 else 1
+    elif attrib == "recalc":
+        if rest == "off":
+            attribs["recalc"] = rest
+        else:
+            attribs.pop("recalc", None)
+    else:
+        raise UnsupportedCommand("set sheet " + attrib)
+
+
+def _cell_from_parts(coord, rest):
+    """A new cell from the save-format parts of set coord all"""
+    cell = socialcalc.Cell(coord)
+    try:
+        socialcalc.cell_from_string_parts(cell, rest.split(":"), 1)
+    except (socialcalc.SaveParseError, IndexError, ValueError):
+        raise CommandError("Bad cell %r" % rest)
+    return cell
+
+
+def _set_columns(sheet, what, attrib, rest):
+    if attrib != "width":
+        return
+    first, _, last = what.upper().partition(":")
+    widths = sheet.colattribs["width"]
+    for col in range(socialcalc.colname_to_number(first),
+                     socialcalc.colname_to_number(last or first) + 1):
+        name = socialcalc.number_to_colname(col)
+        if rest:
+            widths[name] = rest
+        else:
+            widths.pop(name, None)
+
+
+def _set_cells(sheet, what, attrib, rest):
+    attribs = sheet.attribs
+    for coord in _coords(*_parse_range(sheet, what)):
+        cell = sheet.get_assured_cell(coord)
+        if attrib in ("value", "text"):
+            valuetype, _, value = rest.partition(" ")
+            cell.errors = ""
+            if attrib == "value":
+                cell.datavalue = socialcalc.to_number(value)
+                cell.datatype = "v"
+            else:
+                cell.datavalue = socialcalc.decode_from_save(value)
+                cell.datatype = "t"
+            cell.valuetype = valuetype
+            attribs["needsrecalc"] = "yes"
+        elif attrib == "formula":
+            cell.datavalue = 0
+            cell.errors = ""
+            cell.datatype = "f"
+            cell.valuetype = "e#N/A"
+            cell.formula = rest
+            attribs["needsrecalc"] = "yes"
+        elif attrib == "constant":
+            valuetype, _, rest2 = rest.partition(" ")
+            value, _, source = rest2.partition(" ")
+            cell.datavalue = socialcalc.to_number(value)
+            cell.valuetype = valuetype
+            cell.errors = valuetype[1:] if valuetype[:1] == "e" else ""
+            cell.datatype = "c"
+            cell.formula = source
+            attribs["needsrecalc"] = "yes"
+        elif attrib == "empty":
+            _clear_value(cell)
+            attribs["needsrecalc"] = "yes"
+        elif attrib == "all":
+            if rest:
+                sheet.cells[coord] = _cell_from_parts(coord, rest)
+            else:
+                del sheet.cells[coord]
+            attribs["needsrecalc"] = "yes"
+        elif attrib in _STYLE_ATTRIBS:
+            table, field = _STYLE_ATTRIBS[attrib]
+            if attrib == "font" and rest == "* * *":
+                rest = ""
+            setattr(cell, field, _style_num(sheet, table, rest))
+        elif attrib == "cssc":
+            cell.cssc = re.sub(r"[^a-zA-Z0-9\-]", "", rest)
+        elif attrib == "csss":
+            cell.csss = rest.replace("\n", "")
+        elif attrib == "mod":
+            pass            # not kept in the server-side model
+        elif attrib == "comment":
+            cell.comment = socialcalc.decode_from_save(rest)
+        else:
+            raise UnsupportedCommand("set coord " + attrib)
+
+
+def _erase(sheet, what, rest):
+    for coord in _coords(*_parse_range(sheet, what)):
+        cell = sheet.get_assured_cell(coord)
+        if rest == "all":
+            del sheet.cells[coord]
+        elif rest == "formulas":
+            _clear_value(cell)
+            cell.comment = ""
+        elif rest == "formats":
+            newcell = sheet.cells[coord] = socialcalc.Cell(coord)
+            newcell.datavalue = cell.datavalue
+            newcell.datatype = cell.datatype
+            newcell.formula = cell.formula
+            newcell.valuetype = cell.valuetype
+            newcell.comment = cell.comment
+    sheet.attribs["needsrecalc"] = "yes"
+
+
+def _fill(sheet, right, what, rest):
+    col1, row1, col2, row2 = _parse_range(sheet, what)
+    rowstart, colstart = (row1, col1 + 1) if right else (row1 + 1, col1)
+    for row in range(rowstart, row2 + 1):
+        for col in range(colstart, col2 + 1):
+            cell = sheet.get_assured_cell(socialcalc.cr_to_coord(col, row))
+            if right:
+                base = socialcalc.cr_to_coord(col1, row)
+                coloffset, rowoffset = col - colstart + 1, 0
+            else:
+                base = socialcalc.cr_to_coord(col, row1)
+                coloffset, rowoffset = 0, row - rowstart + 1
+            basecell = sheet.get_assured_cell(base)
+            if rest in ("all", "formats"):
+                for field in _FORMAT_FIELDS:
+                    setattr(cell, field, getattr(basecell, field))
+            if rest in ("all", "formulas"):
+                cell.datavalue = basecell.datavalue
+                cell.datatype = basecell.datatype
+                cell.valuetype = basecell.valuetype
+                if cell.datatype == "f":
+                    cell.formula = offset_formula_coords(
+                        basecell.formula, coloffset, rowoffset)
+                else:
+                    cell.formula = basecell.formula
+                cell.errors = basecell.errors
+    sheet.attribs["needsrecalc"] = "yes"
+
+
+def _name(sheet, what, name, rest):
+    name = re.sub(r"[^A-Z0-9_.]", "", name.upper())
+    if not name:
+        return
+    names = sheet.names
+    if what == "define":
+        if not rest:
+            return
+        if name in names:
+            names[name]["definition"] = rest
+        else:
+            names[name] = {"definition": rest, "desc": ""}
+    elif what == "desc":
+        if name in names:
+            names[name]["desc"] = rest
+    elif what == "delete":
+        names.pop(name, None)
+    else:
+        raise UnsupportedCommand("name " + what)
+    sheet.attribs["needsrecalc"] = "yes"
+
+
+def execute_command(sheet, line):
+    """Applies one command line to sheet"""
+    tokens = _Tokens(line)
+    verb = tokens.next()
+    if verb == "set":
+        what = tokens.next()
+        attrib = tokens.next()
+        rest = tokens.rest()
+        if what == "sheet":
+            _set_sheet(sheet, attrib, rest)
+        elif _column_re.match(what):
+            _set_columns(sheet, what, attrib, rest)
+        elif _cell_re.search(what):
+            _set_cells(sheet, what, attrib, rest)
+        else:
+            raise CommandError("Bad set target %r" % what)
+    elif verb in ("merge", "unmerge"):
+        col1, row1, col2, row2 = _parse_range(sheet, tokens.next())
+        cell = sheet.get_assured_cell(socialcalc.cr_to_coord(col1, row1))
+        if verb == "merge":
+            cell.colspan = col2 - col1 + 1 if col2 > col1 else 0
+            cell.rowspan = row2 - row1 + 1 if row2 > row1 else 0
+        else:
+            cell.colspan = cell.rowspan = 0
+    elif verb in ("erase", "cut"):
+        what = tokens.next()
+        _erase(sheet, what, tokens.rest())
+    elif verb in ("fillright", "filldown"):
+        what = tokens.next()
+        _fill(sheet, verb == "fillright", what, tokens.rest())
+    elif verb == "name":
+        what = tokens.next()
+        name = tokens.next()
+        _name(sheet, what, name, tokens.rest())
+    elif verb in _NO_OPS:
+        if verb == "recalc":
+            sheet.attribs["needsrecalc"] = "yes"
+    else:
+        raise UnsupportedCommand(verb)
+
+
+def split_commands(cmdstr):
+    return [line for line in cmdstr.replace("\r\n", "\n").split("\n") if line]
+
+
+def execute_commands(sheet, cmdstrs):
+    """Applies each command string, each of which may hold several lines"""
+    for cmdstr in cmdstrs:
+        for line in split_commands(cmdstr):
+            execute_command(sheet, line)
+
+
+def check_command(line):
+    """
+    Raises CommandError unless execute_command could apply line.  Only
+    the verb, range and argument shape are looked at, so the check costs
+    the same however many cells the range covers.
+    """
+    tokens = _Tokens(line)
+    verb = tokens.next()
+    if verb == "set":
+        what = tokens.next()
+        attrib = tokens.next()
+        rest = tokens.rest()
+        if what == "sheet":
+            if attrib not in _SHEET_ATTRIBS:
+                raise UnsupportedCommand("set sheet " + attrib)
+        elif _column_re.match(what):
+            pass
+        elif _cell_re.search(what):
+            _range(what)
+            if attrib not in _CELL_ATTRIBS:
+                raise UnsupportedCommand("set coord " + attrib)
+            if attrib == "all" and rest:
+                _cell_from_parts("A1", rest)
+        else:
+            raise CommandError("Bad set target %r" % what)
+    elif verb in _RANGE_VERBS:
+        _range(tokens.next())
+    elif verb == "name":
+        what = tokens.next()
+        if re.sub(r"[^A-Z0-9_.]", "", tokens.next().upper()) and \
+                what not in _NAME_ACTIONS:
+            raise UnsupportedCommand("name " + what)
+    elif verb not in _NO_OPS:
+        raise UnsupportedCommand(verb)
+
+
+def check_commands(cmdstrs):
+    """
+    Raises CommandError unless every command can be applied here; catches
+    unsupported verbs and malformed arguments but not anything that
+    depends on the sheet's contents
+    """
+    for cmdstr in cmdstrs:
+        for line in split_commands(cmdstr):
+            check_command(line)
+
+
+def apply_to_save(text, cmdstrs):
+    """
+    Applies commands to a spreadsheet save and returns the new save,
+    recalculated if the commands touched any values.
+    """
+    sheet, otherparts = socialcalc.parse_spreadsheet_save(text)
+    execute_commands(sheet, cmdstrs)
+    if sheet.attribs.get("needsrecalc") == "yes" and \
+            sheet.attribs.get("recalc") != "off":
+        formula_vector.VectorRecalc(sheet).recalc()
+        del sheet.attribs["needsrecalc"]
+    return socialcalc.create_spreadsheet_save(sheet, otherparts)
@@ -0,0 +1,450 @@
+#!/usr/bin/env python3
+"""
+XLSX, ODS and CSV export of SocialCalc sheets
+
+The download handlers used to write the posted save to a fixed file
+under excelinterop/, run `php export.php` on it with commands.getoutput
+and read the result back.  That forked a PHP interpreter that loaded the
+whole workbook into PHPExcel, blocked the IOLoop until it exited, and
+mixed up two downloads that landed at once.
+
+export() parses the save with the socialcalc module and writes the file
+to any object with write(), a row at a time.  Worksheets go straight
+into the zip entry as they are generated, strings are written inline
+rather than gathered into a shared-strings table, and runs of empty
+cells and rows are written as repeats.  Beyond the parsed sheet, the
+memory used is the list of rows and columns in use and one row of
+output.
+
+Values are written as the sheet last computed them, with formulas kept
+in XLSX.  Dates and the sheet's number formats carry over to XLSX, and
+column widths to XLSX and ODS.  Other formatting (fonts, colours,
+borders) is not exported.
+"""
+
+import csv
+import datetime
+import io
+import math
+import os
+import re
+import zipfile
+from xml.sax.saxutils import escape, quoteattr
+
+import socialcalc
+
+
+class ExportError(ValueError):
+    pass
+
+
+def load(content):
+    """[(name, Sheet)] from a workbook JSON save or a spreadsheet save"""
+    try:
+        if content.lstrip()[:1] == "{":
+            return [(name, sheet) for _, name, sheet in
+                    socialcalc.parse_workbook_json(content)]
+        sheet, _ = socialcalc.parse_spreadsheet_save(content)
+    except (socialcalc.SaveParseError, ValueError, KeyError) as e:
+        raise ExportError("cannot read the sheet: %s" % e)
+    return [("Sheet1", sheet)]
+
+
+def rows(sheet):
+    """
+    (row, [(col, cell), ...]) for each row with cells, in order.  Cells
+    are looked up by coordinate over the rows and columns in use, so only
+    those two lists are held rather than an index of every cell.
+    """
+    cells = sheet.cells
+    used_rows, used_cols = set(), set()
+    for coord in cells:
+        col, row = socialcalc.coord_to_cr(coord)
+        used_rows.add(row)
+        used_cols.add(col)
+    cols = [(col, socialcalc.number_to_colname(col))
+            for col in sorted(used_cols)]
+    for row in sorted(used_rows):
+        number = str(row)
+        yield row, [(col, cells[name + number]) for col, name in cols
+                    if name + number in cells]
+
+
+_invalid_xml = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]")
+
+
+def _text(value):
+    return escape(_invalid_xml.sub("", str(value)))
+
+
+def _number(value):
+    """value as XML number text, or None if it is not a finite number"""
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return None
+    if isinstance(value, float) and not math.isfinite(value):
+        return None
+    return socialcalc.format_number(value)
+
+
+def _widths(sheet):
+    """{col: width in pixels} for the columns given a width"""
+    widths = {}
+    for col, width in sheet.colattribs["width"].items():
+        try:
+            widths[socialcalc.colname_to_number(col)] = int(width)
+        except ValueError:
+            pass    # "auto" or blank
+    return widths
+
+
+class _Chunks:
+    """Gathers small writes into chunks of about size bytes"""
+
+    def __init__(self, out, size=64 * 1024):
+        self.out = out
+        self.size = size
+        self.parts = []
+        self.length = 0
+
+    def write(self, text):
+        self.parts.append(text)
+        self.length += len(text)
+        if self.length >= self.size:
+            self.flush()
+
+    def flush(self):
+        if self.parts:
+            self.out.write("".join(self.parts).encode("utf-8"))
+            self.parts, self.length = [], 0
+
+
+# XLSX
+
+XLSX_CONTENT_TYPES = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">\
+<Default Extension="rels" \
+ContentType="application/vnd.openxmlformats-package.relationships+xml"/>\
+<Default Extension="xml" ContentType="application/xml"/>\
+<Override PartName="/xl/workbook.xml" ContentType="application/\
+vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>\
+<Override PartName="/xl/styles.xml" ContentType="application/\
+vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>\
+%s</Types>"""
+
+XLSX_SHEET_TYPE = """<Override PartName="/xl/worksheets/sheet%d.xml" \
+ContentType="application/\
+vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>"""
+
+XLSX_RELS = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships \
+xmlns="http://schemas.openxmlformats.org/package/2006/relationships">\
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/\
+officeDocument/2006/relationships/officeDocument" \
+Target="xl/workbook.xml"/></Relationships>"""
+
+XLSX_WORKBOOK = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" \
+xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">\
+<sheets>%s</sheets></workbook>"""
+
+XLSX_WORKBOOK_RELS = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships \
+xmlns="http://schemas.openxmlformats.org/package/2006/relationships">\
+%s<Relationship Id="rIdStyles" Type="http://schemas.openxmlformats.org/\
+officeDocument/2006/relationships/styles" Target="styles.xml"/>\
+</Relationships>"""
+
+XLSX_SHEET_REL = """<Relationship Id="rId%d" \
+Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/\
+worksheet" Target="worksheets/sheet%d.xml"/>"""
+
+XLSX_STYLES = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">\
+<numFmts count="%d">%s</numFmts>\
+<fonts count="1"><font><sz val="11"/><name val="Calibri"/></font></fonts>\
+<fills count="2"><fill><patternFill patternType="none"/></fill>\
+<fill><patternFill patternType="gray125"/></fill></fills>\
+<borders count="1"><border><left/><right/><top/><bottom/><diagonal/>\
+</border></borders>\
+<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" \
+borderId="0"/></cellStyleXfs>\
+<cellXfs count="%d">%s</cellXfs></styleSheet>"""
+
+XLSX_XF = '<xf numFmtId="%d" fontId="0" fillId="0" borderId="0" ' \
+          'xfId="0" applyNumberFormat="1"/>'
+
+XLSX_DATE_STYLE = 1     # cellXfs entry for dates without a format
+
+
+def _sheet_names(sheets):
+    """Names Excel accepts: unique, at most 31 characters, no []:*?/\\"""
+    names, seen = [], set()
+    for i, (name, _) in enumerate(sheets):
+        name = re.sub(r"[\[\]:*?/\\]", "_", str(name)).strip("'")[:31] \
+            or "Sheet%d" % (i + 1)
+        base, n = name, 2
+        while name.lower() in seen:
+            suffix = " (%d)" % n
+            name = base[:31 - len(suffix)] + suffix
+            n += 1
+        seen.add(name.lower())
+        names.append(name)
+    return names
+
+
+def _number_formats(sheets):
+    """
+    (styles.xml, [{valueformat number: cellXfs index}] per sheet) for
+    the sheets' number formats
+    """
+    formats, styles = {}, []
+    for _, sheet in sheets:
+        style = {}
+        for num, fmt in sheet.valueformats:
+            # SocialCalc's own formats ([ntime], text-html, ...) have no
+            # Excel equivalent
+            if not fmt or fmt == "General" or fmt.startswith(("[", "text-")):
+                continue
+            if fmt not in formats:
+                formats[fmt] = len(formats)
+            style[num] = XLSX_DATE_STYLE + 1 + formats[fmt]
+        styles.append(style)
+    numfmts = "".join('<numFmt numFmtId="%d" formatCode=%s/>'
+                      % (164 + i, quoteattr(fmt))
+                      for fmt, i in formats.items())
+    xfs = [XLSX_XF % 0, XLSX_XF % 14] + [XLSX_XF % (164 + i)
+                                          for i in formats.values()]
+    return (XLSX_STYLES % (len(formats), numfmts, len(xfs), "".join(xfs)),
+            styles)
+
+
+def _xlsx_cell(ref, cell, styles):
+    style = styles.get(cell.nontextvalueformat)
+    if style is None and cell.valuetype.startswith("nd"):
+        style = XLSX_DATE_STYLE
+    attrs = ' r="%s"' % ref + (' s="%d"' % style if style else "")
+    formula = "<f>%s</f>" % _text(cell.formula) \
+        if cell.datatype == "f" and cell.formula else ""
+    value = cell.datavalue
+    if cell.valuetype.startswith("e"):
+        return '<c%s t="e">%s<v>%s</v></c>' % (
+            attrs, formula, _text(cell.valuetype[1:] or "#VALUE!"))
+    if cell.valuetype.startswith("n"):
+        number = _number(value)
+        if number is None:
+            return '<c%s t="e">%s<v>#NUM!</v></c>' % (attrs, formula)
+        if cell.valuetype == "nl":
+            return '<c%s t="b">%s<v>%d</v></c>' % (attrs, formula,
+                                                   bool(value))
+        return "<c%s>%s<v>%s</v></c>" % (attrs, formula, number)
+    if value == "" and not formula:
+        return ""
+    if formula:
+        return '<c%s t="str">%s<v>%s</v></c>' % (attrs, formula, _text(value))
+    return '<c%s t="inlineStr"><is><t xml:space="preserve">%s</t></is></c>' \
+        % (attrs, _text(value))
+
+
+def _write_xlsx_sheet(out, sheet, styles):
+    out.write('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+              '<worksheet xmlns="http://schemas.openxmlformats.org/'
+              'spreadsheetml/2006/main">')
+    widths = _widths(sheet)
+    if widths:
+        out.write("<cols>%s</cols>" % "".join(
+            '<col min="%d" max="%d" width="%.2f" customWidth="1"/>'
+            % (col, col, width / 7.0) for col, width in sorted(widths.items())))
+    out.write("<sheetData>")
+    for row, line in rows(sheet):
+        cells = "".join(_xlsx_cell(cell.coord, cell, styles)
+                        for _, cell in line)
+        if cells:
+            out.write('<row r="%d">%s</row>' % (row, cells))
+    out.write("</sheetData></worksheet>")
+
+
+def write_xlsx(sheets, out):
+    names = _sheet_names(sheets)
+    styles_xml, styles = _number_formats(sheets)
+    with zipfile.ZipFile(out, "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("[Content_Types].xml", XLSX_CONTENT_TYPES % "".join(
+            XLSX_SHEET_TYPE % (i + 1) for i in range(len(sheets))))
+        zf.writestr("_rels/.rels", XLSX_RELS)
+        zf.writestr("xl/workbook.xml", XLSX_WORKBOOK % "".join(
+            '<sheet name=%s sheetId="%d" r:id="rId%d"/>'
+            % (quoteattr(name), i + 1, i + 1) for i, name in enumerate(names)))
+        zf.writestr("xl/_rels/workbook.xml.rels", XLSX_WORKBOOK_RELS % "".join(
+            XLSX_SHEET_REL % (i + 1, i + 1) for i in range(len(sheets))))
+        zf.writestr("xl/styles.xml", styles_xml)
+        for i, (_, sheet) in enumerate(sheets):
+            with zf.open("xl/worksheets/sheet%d.xml" % (i + 1), "w") as f:
+                chunks = _Chunks(f)
+                _write_xlsx_sheet(chunks, sheet, styles[i])
+                chunks.flush()
+
+
+# ODS
+
+ODS_MIMETYPE = "application/vnd.oasis.opendocument.spreadsheet"
+
+ODS_MANIFEST = """<?xml version="1.0" encoding="UTF-8"?>
+<manifest:manifest \
+xmlns:manifest="urn:oasis:names:tc:opendocument:xmlns:manifest:1.0" \
+manifest:version="1.2">\
+<manifest:file-entry manifest:full-path="/" manifest:version="1.2" \
+manifest:media-type="%s"/>\
+<manifest:file-entry manifest:full-path="content.xml" \
+manifest:media-type="text/xml"/>\
+</manifest:manifest>""" % ODS_MIMETYPE
+
+ODS_HEADER = """<?xml version="1.0" encoding="UTF-8"?>
+<office:document-content \
+xmlns:office="urn:oasis:names:tc:opendocument:xmlns:office:1.0" \
+xmlns:style="urn:oasis:names:tc:opendocument:xmlns:style:1.0" \
+xmlns:table="urn:oasis:names:tc:opendocument:xmlns:table:1.0" \
+xmlns:text="urn:oasis:names:tc:opendocument:xmlns:text:1.0" \
+xmlns:fo="urn:oasis:names:tc:opendocument:xmlns:xsl-fo-compatible:1.0" \
+office:version="1.2">"""
+
+EPOCH = datetime.datetime(1899, 12, 30)     # day 0 of SocialCalc dates
+
+
+def _ods_cell(cell):
+    value = cell.datavalue
+    if cell.valuetype.startswith("n"):
+        number = _number(value)
+        if number is None:
+            return '<table:table-cell office:value-type="string">' \
+                   '<text:p>#NUM!</text:p></table:table-cell>'
+        if cell.valuetype == "nl":
+            return '<table:table-cell office:value-type="boolean" ' \
+                   'office:boolean-value="%s"><text:p>%s</text:p>' \
+                   '</table:table-cell>' % (
+                       ("true", "TRUE") if value else ("false", "FALSE"))
+        if cell.valuetype.startswith("nd"):
+            try:
+                date = EPOCH + datetime.timedelta(days=value)
+            except OverflowError:
+                pass
+            else:
+                return '<table:table-cell office:value-type="date" ' \
+                       'office:date-value="%s"><text:p>%s</text:p>' \
+                       '</table:table-cell>' % (date.isoformat(),
+                                                date.date().isoformat())
+        return '<table:table-cell office:value-type="float" ' \
+               'office:value="%s"><text:p>%s</text:p></table:table-cell>' \
+               % (number, number)
+    if cell.valuetype.startswith("e"):
+        value = cell.valuetype[1:] or "#VALUE!"
+    return '<table:table-cell office:value-type="string"><text:p>%s' \
+           '</text:p></table:table-cell>' % _text(value)
+
+
+def _repeat(tag, attribute, count):
+    if count == 1:
+        return "<%s/>" % tag
+    return '<%s %s="%d"/>' % (tag, attribute, count)
+
+
+def _write_ods_sheet(out, name, sheet, index):
+    out.write("<table:table table:name=%s>" % quoteattr(str(name)))
+    widths = _widths(sheet)
+    for col in range(1, max(widths, default=0) + 1):
+        out.write('<table:table-column table:style-name="co%d_%d"/>'
+                  % (index, col) if col in widths else
+                  "<table:table-column/>")
+    last = 0
+    for row, line in rows(sheet):
+        if row > last + 1:
+            out.write('<table:table-row table:number-rows-repeated="%d">'
+                      '<table:table-cell/></table:table-row>'
+                      % (row - last - 1))
+        out.write("<table:table-row>")
+        col = 0
+        for number, cell in line:
+            if number > col + 1:
+                out.write(_repeat("table:table-cell",
+                                  "table:number-columns-repeated",
+                                  number - col - 1))
+            out.write(_ods_cell(cell))
+            col = number
+        out.write("</table:table-row>")
+        last = row
+    if not last:
+        out.write("<table:table-row><table:table-cell/></table:table-row>")
+    out.write("</table:table>")
+
+
+def write_ods(sheets, out):
+    with zipfile.ZipFile(out, "w", zipfile.ZIP_DEFLATED) as zf:
+        # must come first, uncompressed, for the file to be recognised
+        zf.writestr("mimetype", ODS_MIMETYPE, compress_type=zipfile.ZIP_STORED)
+        zf.writestr("META-INF/manifest.xml", ODS_MANIFEST)
+        with zf.open("content.xml", "w") as f:
+            chunks = _Chunks(f)
+            chunks.write(ODS_HEADER)
+            chunks.write("<office:automatic-styles>")
+            for i, (_, sheet) in enumerate(sheets):
+                for col, width in sorted(_widths(sheet).items()):
+                    chunks.write(
+                        '<style:style style:name="co%d_%d" '
+                        'style:family="table-column">'
+                        '<style:table-column-properties '
+                        'style:column-width="%.3fin"/></style:style>'
+                        % (i, col, width / 96.0))
+            chunks.write("</office:automatic-styles>"
+                         "<office:body><office:spreadsheet>")
+            for i, (name, sheet) in enumerate(sheets):
+                _write_ods_sheet(chunks, name, sheet, i)
+            chunks.write("</office:spreadsheet></office:body>"
+                         "</office:document-content>")
+            chunks.flush()
+
+
+# CSV
+
+def _csv_value(cell):
+    if cell.valuetype.startswith("e"):
+        return cell.valuetype[1:] or "#VALUE!"
+    if cell.valuetype == "nl":
+        return "TRUE" if cell.datavalue else "FALSE"
+    return socialcalc.format_number(cell.datavalue)
+
+
+def write_csv(sheets, out):
+    """The first sheet only, as CSV has no room for more"""
+    _, sheet = sheets[0]
+    text = io.TextIOWrapper(out, encoding="utf-8", newline="",
+                            write_through=False)
+    writer = csv.writer(text)
+    last = 0
+    for row, line in rows(sheet):
+        writer.writerows([[]] * (row - last - 1))
+        values = [""] * line[-1][0]
+        for col, cell in line:
+            values[col - 1] = _csv_value(cell)
+        writer.writerow(values)
+        last = row
+    text.flush()
+    text.detach()
+
+
+WRITERS = {"Excel2007": write_xlsx, "ODS": write_ods, "CSV": write_csv}
+
+
+def export(content, type, out):
+    """Writes the save in content to out as type, a key of WRITERS"""
+    if type not in WRITERS:
+        raise ExportError("cannot export to %s" % type)
+    WRITERS[type](load(content), out)
+
+
+def export_file(directory, content, type):
+    """
+    Exports content to a file in directory and returns its path; for
+    jobs.JobRunner
+    """
+    path = os.path.join(directory, "export")
+    with open(path, "wb") as out:
+        export(content, type, out)
+    return path
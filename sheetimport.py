@@ -0,0 +1,457 @@
+#!/usr/bin/env python3
+"""
+XLSX, ODS, CSV and XLS import into SocialCalc workbook saves
+
+/upload and /import used to write the upload to excelinterop/ under the
+name the browser gave it, run `php import.php` on it with
+commands.getoutput and cut the workbook out of everything PHP printed
+at "$---$".  The workbook was built whole in PHPExcel and then again as
+one Python string, and the IOLoop waited for all of it.
+
+Here each format has a reader that yields ("sheet", name) at the start
+of every sheet, then (col, row, kind, value, formula) for each cell that
+holds something, in row order.  kind is "n" (number), "d" (date, as a
+day number), "b" (boolean), "t" (text) or "e" (error).  XLSX and ODS are
+read with iterparse straight out of the zip, and each row is dropped
+from the tree once it has been read, so no document is built up in
+memory.  The shared-strings table of an XLSX is the exception, as any
+cell may refer to any of its entries.  XLS needs the optional xlrd
+package.
+
+convert() turns those cells into the workbook JSON the client's
+SocialCalc.WorkBookControlLoad reads, with one sheet save per sheet.  It
+yields the JSON a line of the save at a time, and read_upload() writes
+those lines to a file as they come rather than joining them.
+"""
+
+import csv
+import datetime
+import io
+import json
+import os
+import re
+import zipfile
+import xml.etree.ElementTree as ET
+
+import socialcalc
+
+try:
+    import xlrd
+except ImportError:
+    xlrd = None
+
+
+class UnreadableSheet(ValueError):
+    pass
+
+
+MAX_ROWS = 1048576      # Excel's limits, which bound ODS repeats
+MAX_COLS = 16384
+
+DATE_FORMAT = "d-mmm-yyyy"
+
+
+def _day_number(moment):
+    """A date or datetime as a SocialCalc/Excel day number"""
+    if not isinstance(moment, datetime.datetime):
+        moment = datetime.datetime(moment.year, moment.month, moment.day)
+    delta = moment - datetime.datetime(1899, 12, 30)
+    return delta.days + delta.seconds / 86400.0
+
+
+def _number(text):
+    value = socialcalc.to_number(text.strip())
+    return int(value) if isinstance(value, float) and value.is_integer() \
+        and abs(value) < 1e15 else value
+
+
+# XLSX
+
+MAIN = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+RELS = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+DOCUMENT_RELS = \
+    "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+
+# built-in number formats that are dates or times
+XLSX_DATE_FORMATS = set(range(14, 23)) | set(range(27, 37)) | \
+    set(range(45, 48)) | set(range(50, 59))
+
+
+def _is_date_format(code):
+    code = re.sub(r'"[^"]*"|\[[^\]]*\]|\\.', "", code)
+    return bool(re.search("[dmyhs]", code, re.I)) and \
+        code.lower() != "general"
+
+
+def _xlsx_text(element):
+    """The text of a string item, from its <t> or its rich text runs"""
+    return "".join(t.text or "" for t in element.findall(MAIN + "t") +
+                   element.findall(MAIN + "r/" + MAIN + "t"))
+
+
+def _xlsx_shared_strings(archive):
+    if "xl/sharedStrings.xml" not in archive.namelist():
+        return []
+    strings = []
+    with archive.open("xl/sharedStrings.xml") as f:
+        for _, element in ET.iterparse(f):
+            if element.tag == MAIN + "si":
+                strings.append(_xlsx_text(element))
+                element.clear()
+    return strings
+
+
+def _xlsx_date_styles(archive):
+    """The set of cellXfs indexes whose number format is a date"""
+    if "xl/styles.xml" not in archive.namelist():
+        return set()
+    styles = ET.fromstring(archive.read("xl/styles.xml"))
+    custom = {int(fmt.get("numFmtId")): fmt.get("formatCode", "")
+              for fmt in styles.iter(MAIN + "numFmt")}
+    xfs = styles.find(MAIN + "cellXfs")
+    dates = set()
+    for i, xf in enumerate(xfs if xfs is not None else []):
+        id = int(xf.get("numFmtId", 0))
+        if id in XLSX_DATE_FORMATS or \
+                (id in custom and _is_date_format(custom[id])):
+            dates.add(i)
+    return dates
+
+
+def _xlsx_sheets(archive):
+    """[(name, path)] of the worksheets in workbook order"""
+    workbook = ET.fromstring(archive.read("xl/workbook.xml"))
+    rels = ET.fromstring(archive.read("xl/_rels/workbook.xml.rels"))
+    targets = {rel.get("Id"): rel.get("Target")
+               for rel in rels.iter(RELS + "Relationship")}
+    sheets = []
+    for sheet in workbook.iter(MAIN + "sheet"):
+        target = targets.get(sheet.get(DOCUMENT_RELS + "id"), "")
+        path = target.lstrip("/") if target.startswith("/") else \
+            os.path.normpath("xl/" + target).replace(os.sep, "/")
+        if path in archive.namelist():
+            sheets.append((sheet.get("name"), path))
+    return sheets
+
+
+def _xlsx_cell(element, strings, dates):
+    kind = element.get("t", "n")
+    v = element.find(MAIN + "v")
+    f = element.find(MAIN + "f")
+    value = v.text if v is not None else None
+    formula = f.text.replace("_xlfn.", "") if f is not None and f.text \
+        else ""
+    if kind == "inlineStr":
+        is_ = element.find(MAIN + "is")
+        return "t", _xlsx_text(is_) if is_ is not None else "", formula
+    if value is None:
+        return None
+    if kind == "s":
+        return "t", strings[int(value)], formula
+    if kind in ("str", "e"):
+        return ("t" if kind == "str" else "e"), value, formula
+    if kind == "b":
+        return "b", value.strip() == "1", formula
+    if int(element.get("s", 0)) in dates:
+        return "d", _number(value), formula
+    return "n", _number(value), formula
+
+
+def read_xlsx(f):
+    try:
+        archive = zipfile.ZipFile(f)
+        strings = _xlsx_shared_strings(archive)
+        dates = _xlsx_date_styles(archive)
+        sheets = _xlsx_sheets(archive)
+    except (zipfile.BadZipFile, KeyError, ET.ParseError) as e:
+        raise UnreadableSheet("not an XLSX workbook: %s" % e)
+    for name, path in sheets:
+        yield "sheet", name
+        try:
+            yield from _xlsx_rows(archive.open(path), strings, dates)
+        except ET.ParseError as e:
+            raise UnreadableSheet("bad worksheet %s: %s" % (name, e))
+
+
+def _xlsx_rows(part, strings, dates):
+    row = col = 0
+    parents = []
+    with part:
+        for event, element in ET.iterparse(part, events=("start", "end")):
+            if event == "start":
+                parents.append(element)
+                if element.tag == MAIN + "row":
+                    row = int(element.get("r", row + 1))
+                    col = 0
+                continue
+            parents.pop()
+            if element.tag == MAIN + "c":
+                ref = element.get("r")
+                col = socialcalc.coord_to_cr(ref)[0] if ref else col + 1
+                cell = _xlsx_cell(element, strings, dates)
+                if cell is not None:
+                    yield (col, row) + cell
+            elif element.tag == MAIN + "row":
+                # read; keep it from piling up under sheetData
+                parents[-1].remove(element)
+
+
+# ODS
+
+OFFICE = "{urn:oasis:names:tc:opendocument:xmlns:office:1.0}"
+TABLE = "{urn:oasis:names:tc:opendocument:xmlns:table:1.0}"
+TEXT = "{urn:oasis:names:tc:opendocument:xmlns:text:1.0}"
+
+ODS_CELLS = (TABLE + "table-cell", TABLE + "covered-table-cell")
+
+
+def _ods_formula(text):
+    """An OpenFormula such as of:=SUM([.A1:.B2]) in SocialCalc's syntax"""
+    if text.startswith("of:"):
+        text = text[3:]
+
+    def reference(match):
+        parts = []
+        for part in match.group(1).split(":"):
+            sheet, _, cell = part.rpartition(".")
+            sheet = sheet.lstrip("$").strip("'")
+            parts.append(sheet + "!" + cell if sheet else cell)
+        return ":".join(parts)
+
+    return re.sub(r"\[([^\]]+)\]", reference, text.lstrip("=")).replace(
+        ";", ",")
+
+
+def _ods_duration(text):
+    """An ISO duration such as PT12H30M00S as a fraction of a day"""
+    m = re.match(r"-?P(?:(\d+)D)?T?(?:(\d+)H)?(?:(\d+)M)?(?:([\d.]+)S)?$",
+                 text)
+    if not m:
+        return 0
+    d, h, mi, s = (float(g or 0) for g in m.groups())
+    return d + (h * 3600 + mi * 60 + s) / 86400.0
+
+
+def _ods_cell(element):
+    kind = element.get(OFFICE + "value-type")
+    formula = element.get(TABLE + "formula")
+    formula = _ods_formula(formula) if formula else ""
+    text = "\n".join("".join(p.itertext())
+                     for p in element.iter(TEXT + "p"))
+    if kind in ("float", "percentage", "currency"):
+        return "n", _number(element.get(OFFICE + "value", "0")), formula
+    if kind == "date":
+        value = element.get(OFFICE + "date-value", "")
+        try:
+            moment = datetime.datetime.fromisoformat(value[:19])
+        except ValueError:
+            return "t", text, formula
+        return "d", _day_number(moment), formula
+    if kind == "time":
+        return "d", _ods_duration(element.get(OFFICE + "time-value", "")), \
+            formula
+    if kind == "boolean":
+        return "b", element.get(OFFICE + "boolean-value") == "true", formula
+    if text or formula:
+        return "t", text, formula
+    return None
+
+
+def read_ods(f):
+    try:
+        archive = zipfile.ZipFile(f)
+        content = archive.open("content.xml")
+    except (zipfile.BadZipFile, KeyError) as e:
+        raise UnreadableSheet("not an ODS spreadsheet: %s" % e)
+    row = col = 0
+    cells = []          # the current row's (col, cell), until it ends
+    parents = []
+    with content:
+        try:
+            for event, element in ET.iterparse(content,
+                                               events=("start", "end")):
+                if event == "start":
+                    parents.append(element)
+                    if element.tag == TABLE + "table":
+                        row = 0
+                        yield "sheet", element.get(TABLE + "name")
+                    elif element.tag == TABLE + "table-row":
+                        col, cells = 0, []
+                    continue
+                parents.pop()
+                if element.tag in ODS_CELLS:
+                    repeat = int(element.get(
+                        TABLE + "number-columns-repeated", 1))
+                    cell = _ods_cell(element)
+                    if cell is not None:
+                        for n in range(min(repeat, MAX_COLS - col)):
+                            cells.append((col + n + 1, cell))
+                    col += repeat
+                    element.clear()
+                elif element.tag == TABLE + "table-row":
+                    repeat = int(element.get(TABLE + "number-rows-repeated",
+                                             1))
+                    if cells:
+                        for n in range(min(repeat, MAX_ROWS - row)):
+                            for number, cell in cells:
+                                yield (number, row + n + 1) + cell
+                    row += repeat
+                    parents[-1].remove(element)
+        except ET.ParseError as e:
+            raise UnreadableSheet("not an ODS spreadsheet: %s" % e)
+
+
+# CSV
+
+def read_csv(f):
+    text = io.TextIOWrapper(f, encoding="utf-8-sig", errors="replace",
+                            newline="")
+    yield "sheet", "Sheet1"
+    for row, values in enumerate(csv.reader(text), 1):
+        for col, value in enumerate(values, 1):
+            if not value:
+                continue
+            if re.match(r"^\s*-?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?\s*$", value):
+                yield col, row, "n", _number(value), ""
+            else:
+                yield col, row, "t", value, ""
+    text.detach()
+
+
+# XLS
+
+def read_xls(f):
+    if xlrd is None:
+        raise UnreadableSheet("reading .xls files needs the xlrd package")
+    try:
+        book = xlrd.open_workbook(file_contents=f.read(), on_demand=True)
+    except xlrd.XLRDError as e:
+        raise UnreadableSheet("not an XLS workbook: %s" % e)
+    for index in range(book.nsheets):
+        sheet = book.sheet_by_index(index)
+        yield "sheet", sheet.name
+        for row in range(sheet.nrows):
+            for col, cell in enumerate(sheet.row(row)):
+                if cell.ctype == xlrd.XL_CELL_NUMBER:
+                    yield col + 1, row + 1, "n", _number(repr(cell.value)), ""
+                elif cell.ctype == xlrd.XL_CELL_TEXT and cell.value:
+                    yield col + 1, row + 1, "t", cell.value, ""
+                elif cell.ctype == xlrd.XL_CELL_DATE:
+                    yield col + 1, row + 1, "d", cell.value, ""
+                elif cell.ctype == xlrd.XL_CELL_BOOLEAN:
+                    yield col + 1, row + 1, "b", bool(cell.value), ""
+                elif cell.ctype == xlrd.XL_CELL_ERROR:
+                    yield col + 1, row + 1, "e", \
+                        xlrd.error_text_from_code.get(cell.value, "#VALUE!"), ""
+        book.unload_sheet(index)
+
+
+READERS = {"xlsx": read_xlsx, "xlsm": read_xlsx, "ods": read_ods,
+           "csv": read_csv, "txt": read_csv, "xls": read_xls}
+
+
+def reader(fname):
+    """The reader for a file called fname"""
+    extension = fname.rpartition(".")[2].lower()
+    if extension not in READERS:
+        raise UnreadableSheet("cannot import .%s files" % extension)
+    return READERS[extension]
+
+
+# SocialCalc save
+
+def cell_line(col, row, kind, value, formula):
+    """The sheet save line for a cell"""
+    coord = socialcalc.cr_to_coord(col, row)
+    encode = socialcalc.encode_for_save
+    if kind == "t":
+        if formula:
+            return "cell:%s:vtf:t:%s:%s" % (coord, encode(value),
+                                            encode(formula))
+        return "cell:%s:t:%s" % (coord, encode(value))
+    if kind == "e":
+        if formula:
+            return "cell:%s:vtf:e%s:0:%s" % (coord, encode(value),
+                                             encode(formula))
+        return "cell:%s:t:%s" % (coord, encode(value))
+    valuetype = {"n": "n", "d": "nd", "b": "nl"}[kind]
+    number = socialcalc.format_number(int(value) if kind == "b" else value)
+    tail = ":ntvf:1" if kind == "d" else ""
+    if formula:
+        return "cell:%s:vtf:%s:%s:%s%s" % (coord, valuetype, number,
+                                           encode(formula), tail)
+    if kind == "n":
+        return "cell:%s:v:%s" % (coord, number)
+    return "cell:%s:vt:%s:%s%s" % (coord, valuetype, number, tail)
+
+
+class _SheetSave:
+    """Save lines for one sheet, with the sizes seen so far"""
+
+    def __init__(self):
+        self.lastcol = self.lastrow = 1
+        self.dates = False
+
+    def cell(self, col, row, kind, value, formula):
+        self.lastcol = max(self.lastcol, col)
+        self.lastrow = max(self.lastrow, row)
+        self.dates = self.dates or kind == "d"
+        return cell_line(col, row, kind, value, formula)
+
+    def tail(self):
+        lines = ["sheet:c:%d:r:%d" % (self.lastcol, self.lastrow)]
+        if self.dates:
+            lines.append("valueformat:1:%s" % DATE_FORMAT)
+        return lines
+
+
+def _json_text(line):
+    """line and its newline as the inside of a JSON string"""
+    return json.dumps(line + "\n")[1:-1]
+
+
+def convert(items):
+    """
+    Yields the workbook JSON for a reader's items, in pieces.  The save
+    of each sheet goes out as its cells are read.
+    """
+    names = []
+    save = None
+    yield '{"sheetArr": {'
+    for item in items:
+        if item[0] == "sheet":
+            if save is not None:
+                yield "".join(map(_json_text, save.tail())) + '"}}, '
+            names.append(item[1] or "Sheet%d" % (len(names) + 1))
+            save = _SheetSave()
+            yield '"sheet%d": {"name": %s, "hidden": "0", ' \
+                  '"sheetstr": {"savestr": "%s' % (
+                      len(names), json.dumps(names[-1]),
+                      _json_text("version:1.5"))
+        elif save is not None:
+            yield _json_text(save.cell(*item))
+    if save is None:
+        names.append("Sheet1")
+        save = _SheetSave()
+        yield '"sheet1": {"name": "Sheet1", "hidden": "0", ' \
+              '"sheetstr": {"savestr": "%s' % _json_text("version:1.5")
+    yield "".join(map(_json_text, save.tail())) + '"}}}, '
+    yield '"numsheets": %d, "currentid": "sheet1", "currentname": %s}' % (
+        len(names), json.dumps(names[0]))
+
+
+def read(f, fname):
+    """The workbook JSON for the spreadsheet file f, called fname"""
+    return "".join(convert(reader(fname)(f)))
+
+
+def read_upload(directory, path, fname):
+    """
+    Writes the workbook JSON for the upload stored at path to a file in
+    directory and returns its path; for jobs.JobRunner
+    """
+    out = os.path.join(directory, "workbook.json")
+    with open(path, "rb") as f, \
+            open(out, "w", encoding="utf-8", newline="") as json_out:
+        json_out.writelines(convert(reader(fname)(f)))
+    return out
@@ -0,0 +1,392 @@
+#!/usr/bin/env python3
+"""
+User sheets stored as a snapshot plus a change log, with history
+
+A /save used to send the whole workbook and rewrite the UserSheets row
+even when one cell had changed.  SheetStore also takes saves as deltas:
+the SocialCalc commands executed since the last save, the same command
+strings the collaboration code broadcasts.  Each delta is appended to
+UserSheetChanges as one row, and once enough have piled up a background
+compaction replays them onto the UserSheets snapshot.
+
+Every save moves the sheet to the next version, each in one transaction
+that locks the sheet's UserSheets row first, so two saves racing for the
+same version cannot both pass the version check.  UserSheets.version is
+the version its snapshot holds and the change rows carry the versions
+after it, so the current sheet is the snapshot with the newer changes
+replayed.  A delta names the version it was made against and is refused
+with StaleVersion if the sheet has moved on, or with a CommandError if
+the server cannot apply it; the client then sends a full save, which
+replaces the snapshot.  Workbooks (the multi-sheet JSON save) are always
+saved in full.
+
+Nothing is overwritten: a snapshot that is replaced, by compaction or by
+a full save, moves to UserSheetSnapshots, and change rows stay behind
+the snapshot that folded them in.  A past version is read from the
+nearest snapshot at or before it plus the changes up to it, which is at
+most compact_after changes as long as compaction keeps up.  Reading the
+current version still touches only the UserSheets row and the changes
+after it.  Replaying those changes means a recalculation, so the store
+keeps what the last replay of each of the replay_cache most recent
+sheets produced: the next read of that version costs no replay, and a
+read after further deltas replays only those.  History older than history_versions versions or history_age
+seconds is pruned after each snapshot write.
+"""
+
+import asyncio
+import collections
+import hashlib
+import logging
+import time
+
+import sheetcodec
+import sheetcommands
+
+
+DIALECTS = {
+    "mysql": {
+        "upsert": "INSERT INTO UserSheets (user, fname, data, version, saved) "
+                  "VALUES (%s, %s, %s, %s, %s) ON DUPLICATE KEY UPDATE "
+                  "data = VALUES(data), version = VALUES(version), "
+                  "saved = VALUES(saved)",
+        "retire": "INSERT IGNORE INTO UserSheetSnapshots "
+                  "(user, fname, version, data, saved) "
+                  "SELECT user, fname, version, data, saved FROM UserSheets "
+                  "WHERE user = %s AND fname = %s AND version = %s",
+        "begin": "START TRANSACTION",
+        "lock": " FOR UPDATE",
+    },
+    "sqlite": {
+        "upsert": "INSERT INTO UserSheets (user, fname, data, version, saved) "
+                  "VALUES (%s, %s, %s, %s, %s) ON CONFLICT (user, fname) "
+                  "DO UPDATE SET data = excluded.data, "
+                  "version = excluded.version, saved = excluded.saved",
+        "retire": "INSERT OR IGNORE INTO UserSheetSnapshots "
+                  "(user, fname, version, data, saved) "
+                  "SELECT user, fname, version, data, saved FROM UserSheets "
+                  "WHERE user = %s AND fname = %s AND version = %s",
+        # takes the write lock up front; there are no row locks
+        "begin": "BEGIN IMMEDIATE",
+        "lock": "",
+    },
+}
+
+
+class StaleVersion(Exception):
+    """A delta made against an older version than the stored one"""
+
+    def __init__(self, version):
+        Exception.__init__(self, "sheet is at version %s" % version)
+        self.version = version
+
+
+class SheetStore:
+    """
+    Delta and full saves for UserSheets, and reads of past versions.
+
+    db is a dbpool.ConnectionPool.  A sheet is compacted once it has
+    compact_after changes past its snapshot.  history_versions and
+    history_age (seconds) bound the history kept; None keeps everything.
+    conflict_errors are the driver's duplicate-key errors, raised when two
+    deltas race for the same version.  replay_cache is how many sheets'
+    replayed text is kept.
+    """
+
+    def __init__(self, db, compact_after=50, history_versions=None,
+                 history_age=None, dialect="mysql", conflict_errors=(),
+                 replay_cache=32, clock=time.time):
+        self.db = db
+        self.compact_after = compact_after
+        self.history_versions = history_versions
+        self.history_age = history_age
+        self.sql = DIALECTS[dialect]
+        self.conflict_errors = tuple(conflict_errors)
+        self.clock = clock
+        self.compacting = {}    # (user, fname) -> Task
+        self.replay_cache = replay_cache
+        # (user, fname) -> (snapshot version, snapshot digest, version, text)
+        self.replayed = collections.OrderedDict()
+
+    @staticmethod
+    def _snapshot(conn, user, fname, lock=""):
+        rows = conn.query("SELECT data, version, saved FROM UserSheets "
+                          "WHERE user = %s AND fname = %s" + lock,
+                          user, fname)
+        return rows[0] if rows else None
+
+    def _transaction(self, fn):
+        """fn(conn) as one transaction, for db.run"""
+        def run(conn):
+            conn.execute(self.sql["begin"])
+            try:
+                result = fn(conn)
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+            return result
+        return run
+
+    @staticmethod
+    def _changes(conn, user, fname, after, upto=None):
+        sql = ("SELECT version, commands FROM UserSheetChanges "
+               "WHERE user = %s AND fname = %s AND version > %s ")
+        if upto is None:
+            return conn.query(sql + "ORDER BY version", user, fname, after)
+        return conn.query(sql + "AND version <= %s ORDER BY version",
+                          user, fname, after, upto)
+
+    @staticmethod
+    def _scalar(conn, sql, *args):
+        rows = conn.query(sql, *args)
+        return rows[0]["value"] if rows else None
+
+    def _latest_change(self, conn, user, fname):
+        return self._scalar(conn, "SELECT MAX(version) AS value "
+                            "FROM UserSheetChanges "
+                            "WHERE user = %s AND fname = %s", user, fname)
+
+    @staticmethod
+    def _decode(row, changes):
+        return (sheetcodec.decode(row["data"]), row["version"],
+                [(change["version"], sheetcodec.decode(change["commands"]))
+                 for change in changes])
+
+    async def _replay(self, text, changes):
+        if not changes:
+            return text
+        return await asyncio.get_running_loop().run_in_executor(
+            None, sheetcommands.apply_to_save, text,
+            [commands for _, commands in changes])
+
+    async def _current(self, user, fname, text, base, changes):
+        """
+        (text, version) of the snapshot text at version base with changes
+        replayed, carrying on from the last replay of the sheet if that
+        started from the same snapshot
+        """
+        if not changes:
+            return text, base
+        version = changes[-1][0]
+        snapshot = hashlib.sha256(text.encode("utf-8")).digest()
+        cached = self.replayed.pop((user, fname), None)
+        if cached is not None and cached[:2] == (base, snapshot) and \
+                cached[2] <= version:
+            text = cached[3]
+            changes = [change for change in changes if change[0] > cached[2]]
+        text = await self._replay(text, changes)
+        self.replayed[(user, fname)] = (base, snapshot, version, text)
+        while len(self.replayed) > self.replay_cache:
+            self.replayed.popitem(last=False)
+        return text, version
+
+    async def _read(self, user, fname):
+        """(snapshot text, snapshot version, [command text]) or None"""
+        def read(conn):
+            row = self._snapshot(conn, user, fname)
+            if row is None:
+                return None
+            return row, self._changes(conn, user, fname, row["version"])
+
+        found = await self.db.run(read)
+        return None if found is None else self._decode(*found)
+
+    async def load(self, user, fname):
+        """(text, version) of the current sheet, or None if there is none"""
+        found = await self._read(user, fname)
+        if found is None:
+            return None
+        return await self._current(user, fname, *found)
+
+    async def load_version(self, user, fname, version):
+        """The text of a past version, or None if it is not kept"""
+        def read(conn):
+            candidates = conn.query(
+                "SELECT data, version FROM UserSheetSnapshots "
+                "WHERE user = %s AND fname = %s AND version <= %s "
+                "ORDER BY version DESC LIMIT 1", user, fname, version)
+            current = self._snapshot(conn, user, fname)
+            if current is not None and current["version"] <= version:
+                candidates.append(current)
+            if not candidates:
+                return None
+            row = max(candidates, key=lambda row: row["version"])
+            return row, self._changes(conn, user, fname, row["version"],
+                                      version)
+
+        found = await self.db.run(read)
+        if found is None:
+            return None
+        text, base, changes = self._decode(*found)
+        if (changes[-1][0] if changes else base) != version:
+            return None
+        return await self._replay(text, changes)
+
+    async def history(self, user, fname):
+        """[(version, saved)] of the versions that can be read, oldest first"""
+        def read(conn):
+            rows = conn.query("SELECT version, saved FROM UserSheetSnapshots "
+                              "WHERE user = %s AND fname = %s", user, fname)
+            rows += conn.query("SELECT version, saved FROM UserSheets "
+                               "WHERE user = %s AND fname = %s", user, fname)
+            if not rows:
+                return []
+            first = min(row["version"] for row in rows)
+            return rows + conn.query(
+                "SELECT version, saved FROM UserSheetChanges "
+                "WHERE user = %s AND fname = %s AND version > %s",
+                user, fname, first)
+
+        rows = await self.db.run(read)
+        return sorted(set((row["version"], row["saved"]) for row in rows))
+
+    @property
+    def _pruning(self):
+        return self.history_versions is not None or \
+            self.history_age is not None
+
+    def _oldest_kept(self, conn, user, fname, current):
+        """The oldest version the retention limits keep"""
+        oldest = None
+        if self.history_versions is not None:
+            oldest = current - self.history_versions + 1
+        if self.history_age is not None:
+            cutoff = self.clock() - self.history_age
+            recent = [self._scalar(conn, "SELECT MIN(version) AS value "
+                                   "FROM %s WHERE user = %%s AND fname = %%s "
+                                   "AND saved >= %%s" % table,
+                                   user, fname, cutoff)
+                      for table in ("UserSheetSnapshots", "UserSheetChanges")]
+            recent = min([v for v in recent if v is not None] + [current])
+            oldest = recent if oldest is None else max(oldest, recent)
+        return min(oldest, current)
+
+    def _prune(self, conn, user, fname, current):
+        """Drops history past the limits, keeping the snapshot it needs"""
+        oldest = self._oldest_kept(conn, user, fname, current)
+        base = self._scalar(conn, "SELECT MAX(version) AS value "
+                            "FROM UserSheetSnapshots WHERE user = %s "
+                            "AND fname = %s AND version <= %s",
+                            user, fname, oldest)
+        snapshot = self._snapshot(conn, user, fname)
+        if snapshot is not None and snapshot["version"] <= oldest:
+            base = snapshot["version"]
+        if base is None:
+            return
+        conn.execute("DELETE FROM UserSheetSnapshots WHERE user = %s "
+                     "AND fname = %s AND version < %s", user, fname, base)
+        conn.execute("DELETE FROM UserSheetChanges WHERE user = %s "
+                     "AND fname = %s AND version <= %s", user, fname, base)
+
+    def _retire(self, conn, user, fname, version):
+        """Copies the snapshot at version into the history"""
+        conn.execute(self.sql["retire"], user, fname, version)
+
+    async def save(self, user, fname, text):
+        """Stores a full save; returns its version"""
+        data = sheetcodec.encode(text)
+
+        def save(conn):
+            row = self._snapshot(conn, user, fname, self.sql["lock"])
+            version = max(row["version"] if row else 0,
+                          self._latest_change(conn, user, fname) or 0) + 1
+            if row is not None:
+                self._retire(conn, user, fname, row["version"])
+            conn.execute(self.sql["upsert"], user, fname, data, version,
+                         int(self.clock()))
+            if self._pruning:
+                self._prune(conn, user, fname, version)
+            return version
+
+        return await self.db.run(self._transaction(save))
+
+    async def append(self, user, fname, base, cmdstrs):
+        """
+        Stores the commands made against version base; returns the new
+        version.  Raises StaleVersion or sheetcommands.CommandError when
+        the caller has to send a full save instead.
+        """
+        sheetcommands.check_commands(cmdstrs)
+        lines = [line for cmdstr in cmdstrs
+                 for line in sheetcommands.split_commands(cmdstr)]
+        data = sheetcodec.encode("\n".join(lines) + "\n")
+
+        def append(conn):
+            row = self._snapshot(conn, user, fname, self.sql["lock"])
+            if row is None:
+                raise StaleVersion(None)
+            current = max(row["version"],
+                          self._latest_change(conn, user, fname) or 0)
+            if current != base:
+                raise StaleVersion(current)
+            try:
+                conn.execute("INSERT INTO UserSheetChanges "
+                             "(user, fname, version, commands, saved) "
+                             "VALUES (%s, %s, %s, %s, %s)",
+                             user, fname, current + 1, data,
+                             int(self.clock()))
+            except self.conflict_errors:
+                raise StaleVersion(current + 1)
+            return current + 1, row["version"]
+
+        version, snapshot = await self.db.run(self._transaction(append))
+        if version - snapshot >= self.compact_after:
+            self._compact_later(user, fname)
+        return version
+
+    async def delete(self, user, fname):
+        def delete(conn):
+            for table in ("UserSheets", "UserSheetChanges",
+                          "UserSheetSnapshots"):
+                conn.execute("DELETE FROM %s WHERE user = %%s "
+                             "AND fname = %%s" % table, user, fname)
+
+        await self.db.run(delete)
+        self.replayed.pop((user, fname), None)
+
+    async def compact(self, user, fname):
+        """Folds the sheet's changes into its snapshot"""
+        return await asyncio.shield(self._start((user, fname)))
+
+    def _start(self, key):
+        task = self.compacting.get(key)
+        if task is None:
+            task = self.compacting[key] = asyncio.ensure_future(
+                self._compact(key))
+        return task
+
+    async def _compact(self, key):
+        user, fname = key
+        try:
+            found = await self._read(user, fname)
+            if found is None or not found[2]:
+                return
+            snapshot = found[1]
+            text, version = await self._current(user, fname, *found)
+            data = sheetcodec.encode(text)
+
+            def write(conn):
+                self._snapshot(conn, user, fname, self.sql["lock"])
+                self._retire(conn, user, fname, snapshot)
+                # a full save since the read has moved the snapshot on
+                # already; leave it be
+                if conn.execute_rowcount(
+                        "UPDATE UserSheets SET data = %s, version = %s, "
+                        "saved = %s WHERE user = %s AND fname = %s "
+                        "AND version = %s", data, version,
+                        int(self.clock()), user, fname, snapshot) and \
+                        self._pruning:
+                    self._prune(conn, user, fname, version)
+
+            await self.db.run(self._transaction(write))
+        finally:
+            del self.compacting[key]
+
+    def _compact_later(self, user, fname):
+        if (user, fname) not in self.compacting:
+            self._start((user, fname)).add_done_callback(self._log_failure)
+
+    @staticmethod
+    def _log_failure(task):
+        if not task.cancelled() and task.exception() is not None:
+            logging.warning("Sheet compaction failed: %s", task.exception())
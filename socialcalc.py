@@ -0,0 +1,636 @@
+#!/usr/bin/env python3
+"""
+SocialCalc save-format parser
+
+Reads the ``socialcalc:version:1.0`` multipart save written by the
+spreadsheet control (SocialCalc.SpreadsheetControlCreateSpreadsheetSave in
+src/js/ui/spreadsheet-control.js) and the ``version:1.5`` sheet save inside
+it (SocialCalc.ParseSheetSave in src/js/core/socialcalc-engine.js) into an
+in-memory Sheet, and writes a Sheet back out in the same format.
+
+Input may be a whole string or any iterable of lines (an open file, a
+generator over a LONGBLOB, ...); lines are consumed one at a time.
+"""
+
+import json
+import re
+import weakref
+
+TEXT_DATA_DEFAULT_TYPE = "t"
+
+CELL_ATTRIBUTES = ("bt", "br", "bb", "bl", "layout", "font", "color",
+                   "bgcolor", "cellformat", "textvalueformat",
+                   "nontextvalueformat", "colspan", "rowspan", "cssc", "csss")
+
+STYLE_FIELDS = CELL_ATTRIBUTES + ("errors", "comment")
+STYLE_DEFAULTS = (0,) * 13 + ("",) * 4
+STYLE_INDEX = dict((name, i) for i, name in enumerate(STYLE_FIELDS))
+
+# sheet:... keys that map straight onto Sheet.attribs, with their converters
+SHEET_ATTRIBUTES = {
+    "c": ("lastcol", int),
+    "r": ("lastrow", int),
+    "w": ("defaultcolwidth", str),
+    "h": ("defaultrowheight", int),
+    "tf": ("defaulttextformat", int),
+    "ntf": ("defaultnontextformat", int),
+    "layout": ("defaultlayout", int),
+    "font": ("defaultfont", int),
+    "tvf": ("defaulttextvalueformat", int),
+    "ntvf": ("defaultnontextvalueformat", int),
+    "color": ("defaultcolor", int),
+    "bgcolor": ("defaultbgcolor", int),
+    "circularreferencecell": ("circularreferencecell", str),
+    "recalc": ("recalc", str),
+    "needsrecalc": ("needsrecalc", str),
+}
+
+MULTIPART_BOUNDARY = "SocialCalcSpreadsheetControlSave"
+
+_coord_re = re.compile(r"^\$?([A-Za-z]{1,3})\$?(\d+)$")
+_mime_re = re.compile(r"^MIME-Version:\s1\.0", re.I)
+_boundary_re = re.compile(r"^Content-Type:\s*multipart/mixed;\s*boundary=(\S+)",
+                          re.I)
+
+
+class SaveParseError(ValueError):
+    """Raised for save lines the browser-side parser would also reject"""
+
+
+def decode_from_save(s):
+    if "\\" not in s:
+        return s
+    return s.replace("\\c", ":").replace("\\n", "\n").replace("\\b", "\\")
+
+
+def encode_for_save(s):
+    if not isinstance(s, str):
+        return s
+    if "\\" in s:
+        s = s.replace("\\", "\\b")
+    if ":" in s:
+        s = s.replace(":", "\\c")
+    if "\n" in s:
+        s = s.replace("\n", "\\n")
+    return s
+
+
+def to_number(text):
+    """Converts a save-file number the way JavaScript's ``text - 0`` does"""
+    if text.isdigit():
+        return int(text)
+    try:
+        return float(text)
+    except ValueError:
+        return 0 if not text.strip() else float("nan")
+
+
+def format_number(value):
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e21:
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def colname_to_number(name):
+    number = 0
+    for ch in name.upper():
+        number = number * 26 + ord(ch) - 64
+    return number
+
+
+def number_to_colname(number):
+    name = ""
+    while number > 0:
+        number, rem = divmod(number - 1, 26)
+        name = chr(65 + rem) + name
+    return name
+
+
+def coord_to_cr(coord):
+    """Returns (col, row) for a coordinate such as ``B7`` or ``$B$7``"""
+    m = _coord_re.match(coord)
+    if not m:
+        raise ValueError("bad coordinate %r" % coord)
+    return colname_to_number(m.group(1)), int(m.group(2))
+
+
+def cr_to_coord(col, row):
+    return number_to_colname(col) + str(row)
+
+
+class StyleTable:
+    """Numbered style strings with a reverse index, like sheet.fonts/fonthash"""
+
+    __slots__ = ("items", "index")
+
+    def __init__(self):
+        self.items = [None]
+        self.index = {}
+
+    def set(self, num, value):
+        items = self.items
+        while len(items) <= num:
+            items.append(None)
+        items[num] = value
+        self.index[value] = num
+
+    def add(self, value):
+        """Returns the number for value, appending it if it is new"""
+        num = self.index.get(value)
+        if num is None:
+            num = len(self.items)
+            self.set(num, value)
+        return num
+
+    def get(self, num):
+        if 0 < num < len(self.items):
+            return self.items[num]
+        return None
+
+    def __len__(self):
+        return len(self.index)
+
+    def __iter__(self):
+        for num, value in enumerate(self.items):
+            if value is not None:
+                yield num, value
+
+
+class CellStyle:
+    """
+    A cell's formatting attributes, errors and comment as one shared value.
+
+    Most cells in a sheet share a handful of attribute combinations, so each
+    distinct combination exists once and cells only hold a reference to it.
+    Styles are immutable; use with_value() to derive a changed one.
+    """
+
+    __slots__ = ("key", "__weakref__")
+
+    _interned = weakref.WeakValueDictionary()
+
+    def __new__(cls, key=STYLE_DEFAULTS):
+        style = cls._interned.get(key)
+        if style is None:
+            style = object.__new__(cls)
+            style.key = key
+            cls._interned[key] = style
+        return style
+
+    def with_value(self, name, value):
+        i = STYLE_INDEX[name]
+        return CellStyle(self.key[:i] + (value,) + self.key[i + 1:])
+
+    @classmethod
+    def interned_count(cls):
+        return len(cls._interned)
+
+    def __repr__(self):
+        return "<CellStyle %s>" % ", ".join(
+            "%s=%r" % item for item in zip(STYLE_FIELDS, self.key)
+            if item[1] != STYLE_DEFAULTS[STYLE_INDEX[item[0]]])
+
+
+DEFAULT_STYLE = CellStyle()
+
+
+def _style_property(name):
+    i = STYLE_INDEX[name]
+
+    def get(self):
+        return self.style.key[i]
+
+    def set(self, value):
+        self.style = self.style.with_value(name, value)
+
+    return property(get, set)
+
+
+class Cell:
+    """
+    One non-empty cell.
+
+    Only the value fields live on the cell itself; formatting attributes,
+    errors and comment are read and written through the shared CellStyle
+    in cell.style.
+    """
+
+    __slots__ = ("coord", "datavalue", "datatype", "formula", "valuetype",
+                 "style")
+
+    def __init__(self, coord):
+        self.coord = coord
+        self.datavalue = ""
+        self.datatype = None
+        self.formula = ""
+        self.valuetype = "b"
+        self.style = DEFAULT_STYLE
+
+    for _name in STYLE_FIELDS:
+        locals()[_name] = _style_property(_name)
+    del _name
+
+    def __repr__(self):
+        return "<Cell %s %s:%r>" % (self.coord, self.datatype, self.datavalue)
+
+
+class Sheet:
+    def __init__(self):
+        self.cells = {}
+        self.attribs = {"lastcol": 1, "lastrow": 1, "defaultlayout": 0}
+        self.rowattribs = {"hide": {}, "height": {}}
+        self.colattribs = {"hide": {}, "width": {}}
+        self.names = {}
+        self.layouts = StyleTable()
+        self.fonts = StyleTable()
+        self.colors = StyleTable()
+        self.borderstyles = StyleTable()
+        self.cellformats = StyleTable()
+        self.valueformats = StyleTable()
+        self.copiedfrom = ""
+
+    def get_cell(self, coord):
+        return self.cells.get(coord)
+
+    def get_assured_cell(self, coord):
+        cell = self.cells.get(coord)
+        if cell is None:
+            cell = self.cells[coord] = Cell(coord)
+        return cell
+
+    def diff(self, other):
+        """Returns the sorted coords whose saved form differs from other's"""
+        changed = []
+        for coord in set(self.cells) | set(other.cells):
+            mine = self.cells.get(coord)
+            theirs = other.cells.get(coord)
+            if (cell_to_string(self, mine) if mine else "") != \
+               (cell_to_string(other, theirs) if theirs else ""):
+                changed.append(coord)
+        changed.sort(key=lambda coord: coord_to_cr(coord)[::-1])
+        return changed
+
+    def __len__(self):
+        return len(self.cells)
+
+
+def _split_lines(source):
+    if isinstance(source, str):
+        if "\r" in source:
+            source = source.replace("\r\n", "\n")
+        return source.split("\n")
+    return (line.rstrip("\r\n") for line in source)
+
+
+_INT_ITEMS = {"f": STYLE_INDEX["font"], "c": STYLE_INDEX["color"],
+              "bg": STYLE_INDEX["bgcolor"], "l": STYLE_INDEX["layout"],
+              "cf": STYLE_INDEX["cellformat"],
+              "tvf": STYLE_INDEX["textvalueformat"],
+              "ntvf": STYLE_INDEX["nontextvalueformat"],
+              "colspan": STYLE_INDEX["colspan"],
+              "rowspan": STYLE_INDEX["rowspan"]}
+_TEXT_ITEMS = {"e": STYLE_INDEX["errors"], "comment": STYLE_INDEX["comment"],
+               "cssc": STYLE_INDEX["cssc"], "csss": STYLE_INDEX["csss"]}
+
+
+def cell_from_string_parts(cell, parts, j):
+    """Fills cell from save-format parts starting at parts[j]"""
+    n = len(parts)
+    style = None
+    while j < n:
+        t = parts[j]
+        if not t:
+            break
+        if t == "v":
+            cell.datavalue = to_number(decode_from_save(parts[j + 1]))
+            cell.datatype = "v"
+            cell.valuetype = "n"
+            j += 2
+        elif t == "t":
+            cell.datavalue = decode_from_save(parts[j + 1])
+            cell.datatype = "t"
+            cell.valuetype = TEXT_DATA_DEFAULT_TYPE
+            j += 2
+        elif t == "vtf" or t == "vtc":
+            v = parts[j + 1]
+            cell.valuetype = v
+            if v[:1] == "n":
+                cell.datavalue = to_number(decode_from_save(parts[j + 2]))
+            else:
+                cell.datavalue = decode_from_save(parts[j + 2])
+            cell.formula = decode_from_save(parts[j + 3])
+            cell.datatype = "f" if t == "vtf" else "c"
+            j += 4
+        elif t == "vt":
+            v = parts[j + 1]
+            cell.valuetype = v
+            if v[:1] == "n":
+                cell.datatype = "v"
+                cell.datavalue = to_number(decode_from_save(parts[j + 2]))
+            else:
+                cell.datatype = "t"
+                cell.datavalue = decode_from_save(parts[j + 2])
+            j += 3
+        elif t in _INT_ITEMS:
+            if style is None:
+                style = list(cell.style.key)
+            style[_INT_ITEMS[t]] = int(parts[j + 1])
+            j += 2
+        elif t == "b":
+            if style is None:
+                style = list(cell.style.key)
+            style[0:4] = [int(p or 0) for p in parts[j + 1:j + 5]]
+            j += 5
+        elif t in _TEXT_ITEMS:
+            if style is None:
+                style = list(cell.style.key)
+            value = parts[j + 1]
+            style[_TEXT_ITEMS[t]] = value if t == "cssc" else \
+                decode_from_save(value)
+            j += 2
+        elif t == "mod":
+            j += 2
+        else:
+            raise SaveParseError("Unknown cell type item '%s'" % t)
+    if style is not None:
+        cell.style = CellStyle(tuple(style))
+
+
+def _parse_pairs(parts, start):
+    pairs = []
+    for j in range(start, len(parts) - 1, 2):
+        if not parts[j]:
+            break
+        pairs.append((parts[j], parts[j + 1]))
+    return pairs
+
+
+def parse_sheet_save(source, sheet=None):
+    """Parses a sheet save (the ``version:1.5`` part) into a Sheet"""
+    if sheet is None:
+        sheet = Sheet()
+    cells = sheet.cells
+    tables = {"layout": sheet.layouts, "font": sheet.fonts,
+              "color": sheet.colors, "border": sheet.borderstyles,
+              "cellformat": sheet.cellformats,
+              "valueformat": sheet.valueformats}
+    for lineno, line in enumerate(_split_lines(source), 1):
+        if not line:
+            continue
+        parts = line.split(":")
+        kind = parts[0]
+        try:
+            if kind == "cell":
+                coord = parts[1]
+                cell = cells.get(coord)
+                if cell is None:
+                    cell = cells[coord] = Cell(coord)
+                cell_from_string_parts(cell, parts, 2)
+            elif kind in tables:
+                num, value = line.split(":", 2)[1:]
+                if kind == "cellformat" or kind == "valueformat":
+                    value = decode_from_save(value)
+                tables[kind].set(int(num), value)
+            elif kind == "col":
+                for t, v in _parse_pairs(parts, 2):
+                    if t == "w":
+                        sheet.colattribs["width"][parts[1]] = v
+                    elif t == "hide":
+                        sheet.colattribs["hide"][parts[1]] = v
+                    else:
+                        raise SaveParseError("Unknown col type item '%s'" % t)
+            elif kind == "row":
+                row = int(parts[1])
+                for t, v in _parse_pairs(parts, 2):
+                    if t == "h":
+                        sheet.rowattribs["height"][row] = int(v)
+                    elif t == "hide":
+                        sheet.rowattribs["hide"][row] = v
+                    else:
+                        raise SaveParseError("Unknown row type item '%s'" % t)
+            elif kind == "sheet":
+                for t, v in _parse_pairs(parts, 1):
+                    attr = SHEET_ATTRIBUTES.get(t)
+                    if attr is not None:
+                        sheet.attribs[attr[0]] = attr[1](v)
+            elif kind == "name":
+                name = decode_from_save(parts[1]).upper()
+                sheet.names[name] = {"desc": decode_from_save(parts[2]),
+                                     "definition": decode_from_save(parts[3])}
+            elif kind == "copiedfrom":
+                sheet.copiedfrom = parts[1] + ":" + parts[2]
+            elif kind in ("version", "clipboardrange", "clipboard"):
+                pass
+            else:
+                raise SaveParseError("Unknown line type '%s'" % kind)
+        except SaveParseError as e:
+            raise SaveParseError("line %d: %s" % (lineno, e))
+        except (IndexError, ValueError):
+            raise SaveParseError("line %d: malformed %s line %r"
+                                 % (lineno, kind, line))
+    return sheet
+
+
+def iter_save_parts(source):
+    """
+    Yields (partname, line) for every body line of a multipart save.
+
+    Input without a MIME header is treated as a bare sheet save, so the
+    stock templates and sheet parts stored on their own parse as well.
+    """
+    lines = iter(_split_lines(source))
+    for line in lines:
+        if not line.strip():
+            continue
+        if line.startswith("socialcalc:") or _mime_re.match(line):
+            break
+        yield "sheet", line
+        for line in lines:
+            yield "sheet", line
+        return
+    else:
+        return
+
+    boundary = None
+    for line in lines:
+        m = _boundary_re.match(line)
+        if m:
+            boundary = "--" + m.group(1)
+            break
+    if boundary is None:
+        raise SaveParseError("multipart save without a boundary")
+    closing = boundary + "--"
+
+    partlist = []
+    state = "seek"                  # seek -> mimeheader -> body
+    current = None                  # None while in the control header part
+    for line in lines:
+        if line == boundary or line == closing:
+            if current is None and state == "body":
+                current = 0
+            elif current is not None:
+                current += 1
+            if line == closing:
+                break
+            state = "mimeheader"
+        elif state == "mimeheader":
+            if not line:
+                state = "body"
+        elif state == "body":
+            if current is None:
+                p = line.split(":")
+                if p[0] == "part":
+                    partlist.append(p[1])
+            elif current < len(partlist):
+                yield partlist[current], line
+
+
+def parse_spreadsheet_save(source):
+    """
+    Parses a full spreadsheet control save.
+
+    Returns (sheet, otherparts) where otherparts maps the remaining part
+    names (edit, audit, ...) to their text.
+    """
+    otherparts = {}
+
+    def sheet_lines():
+        for part, line in iter_save_parts(source):
+            if part == "sheet":
+                yield line
+            else:
+                otherparts.setdefault(part, []).append(line)
+
+    sheet = parse_sheet_save(sheet_lines())
+    return sheet, {k: "\n".join(v) + "\n" for k, v in otherparts.items()}
+
+
+def parse_workbook_json(text):
+    """Parses a workbook JSON save into a list of (id, name, Sheet)"""
+    workbook = json.loads(text)
+    sheets = []
+    for sheetid, entry in workbook["sheetArr"].items():
+        sheet, _ = parse_spreadsheet_save(entry["sheetstr"]["savestr"])
+        sheets.append((sheetid, entry.get("name", sheetid), sheet))
+    return sheets
+
+
+def cell_to_string(sheet, cell):
+    """Returns the ``:v:...`` tail of a cell save line"""
+    value = encode_for_save(format_number(cell.datavalue)
+                            if isinstance(cell.datavalue, (int, float))
+                            else cell.datavalue)
+    out = []
+    if cell.datatype == "v":
+        if cell.valuetype == "n":
+            out.append(":v:%s" % value)
+        else:
+            out.append(":vt:%s:%s" % (cell.valuetype, value))
+    elif cell.datatype == "t":
+        if cell.valuetype == TEXT_DATA_DEFAULT_TYPE:
+            out.append(":t:%s" % value)
+        else:
+            out.append(":vt:%s:%s" % (cell.valuetype, value))
+    elif cell.datatype in ("f", "c"):
+        out.append(":vt%s:%s:%s:%s" % (cell.datatype, cell.valuetype, value,
+                                        encode_for_save(cell.formula)))
+    if cell.errors:
+        out.append(":e:%s" % encode_for_save(cell.errors))
+    if cell.bt or cell.br or cell.bb or cell.bl:
+        out.append(":b:%s:%s:%s:%s" % (cell.bt or "", cell.br or "",
+                                       cell.bb or "", cell.bl or ""))
+    for attr, code in (("layout", "l"), ("font", "f"), ("color", "c"),
+                       ("bgcolor", "bg"), ("cellformat", "cf"),
+                       ("textvalueformat", "tvf"),
+                       ("nontextvalueformat", "ntvf"),
+                       ("colspan", "colspan"), ("rowspan", "rowspan"),
+                       ("cssc", "cssc")):
+        value = getattr(cell, attr)
+        if value:
+            out.append(":%s:%s" % (code, value))
+    if cell.csss:
+        out.append(":csss:%s" % encode_for_save(cell.csss))
+    if cell.comment:
+        out.append(":comment:%s" % encode_for_save(cell.comment))
+    return "".join(out)
+
+
+def iter_sheet_save(sheet):
+    """Yields the lines of a sheet save, without line terminators"""
+    yield "version:1.5"
+    for _, coord in sorted((coord_to_cr(coord)[::-1], coord)
+                           for coord in sheet.cells):
+        line = cell_to_string(sheet, sheet.cells[coord])
+        if line:
+            yield "cell:" + coord + line
+    colattribs = sheet.colattribs
+    for coord in sorted(set(colattribs["width"]) | set(colattribs["hide"]),
+                        key=colname_to_number):
+        if coord in colattribs["width"]:
+            yield "col:%s:w:%s" % (coord, colattribs["width"][coord])
+        if coord in colattribs["hide"]:
+            yield "col:%s:hide:%s" % (coord, colattribs["hide"][coord])
+    rowattribs = sheet.rowattribs
+    for row in sorted(set(rowattribs["height"]) | set(rowattribs["hide"])):
+        if row in rowattribs["height"]:
+            yield "row:%s:h:%s" % (row, rowattribs["height"][row])
+        if row in rowattribs["hide"]:
+            yield "row:%s:hide:%s" % (row, rowattribs["hide"][row])
+    line = "sheet"
+    for code, (attr, _) in SHEET_ATTRIBUTES.items():
+        value = sheet.attribs.get(attr)
+        if value or attr in ("lastcol", "lastrow"):
+            line += ":%s:%s" % (code, encode_for_save(str(value)))
+    yield line
+    for kind, table in (("border", sheet.borderstyles),
+                        ("cellformat", sheet.cellformats),
+                        ("color", sheet.colors), ("font", sheet.fonts),
+                        ("layout", sheet.layouts),
+                        ("valueformat", sheet.valueformats)):
+        for num, value in table:
+            if kind in ("cellformat", "valueformat"):
+                value = encode_for_save(value)
+            yield "%s:%d:%s" % (kind, num, value)
+    for name in sorted(sheet.names):
+        entry = sheet.names[name]
+        yield "name:%s:%s:%s" % (encode_for_save(name),
+                                 encode_for_save(entry["desc"]),
+                                 encode_for_save(entry["definition"]))
+    if sheet.copiedfrom:
+        yield "copiedfrom:" + sheet.copiedfrom
+
+
+def create_sheet_save(sheet):
+    return "\n".join(iter_sheet_save(sheet)) + "\n"
+
+
+def create_spreadsheet_save(sheet, otherparts=None):
+    """Wraps a sheet save in the spreadsheet control multipart envelope"""
+    otherparts = otherparts or {}
+    b = "--" + MULTIPART_BOUNDARY
+    header = "Content-type: text/plain; charset=UTF-8\n\n"
+    out = ["socialcalc:version:1.0\nMIME-Version: 1.0\n"
+           "Content-Type: multipart/mixed; boundary=%s\n" % MULTIPART_BOUNDARY,
+           b + "\n" + header,
+           "# SocialCalc Spreadsheet Control Save\nversion:1.0\npart:sheet\n"]
+    out.extend("part:%s\n" % name for name in otherparts)
+    out.append(b + "\n" + header + create_sheet_save(sheet))
+    for text in otherparts.values():
+        if not text.endswith("\n"):
+            text += "\n"
+        out.append(b + "\n" + header + text)
+    out.append(b + "--\n")
+    return "".join(out)
+
+
+if __name__ == "__main__":
+    import sys
+    data = open(sys.argv[1]).read()
+    if data.lstrip().startswith("{"):
+        sheets = parse_workbook_json(data)
+    else:
+        sheets = [("sheet1", "sheet1", parse_spreadsheet_save(data)[0])]
+    for sheetid, name, sheet in sheets:
+        print("%s %s: %d cells, %d cols x %d rows"
+              % (sheetid, name, len(sheet), sheet.attribs["lastcol"],
+                 sheet.attribs["lastrow"]))
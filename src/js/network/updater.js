@@ -11,7 +11,8 @@ if (!window.console.log) window.console.log = () => {};
 // Initialize collaboration system when DOM is ready
 $(() => {
     player.initialize();
-    updater.poll();
+    updater.connect();
+    autosave.start();
 });
 
 
@@ -29,7 +30,7 @@ const isMultipleSheet = () => {
  * @returns {string|undefined} Cookie value or undefined if not found
  */
 const getCookie = (name) => {
-    const match = document.cookie.match(`\\b${name}=([^;]*)\\b`);
+    const match = document.cookie.match(`(?:^|;\\s*)${name}=([^;]*)`);
     return match ? match[1] : undefined;
 };
 
@@ -38,8 +39,9 @@ const getCookie = (name) => {
  * @param {string} url - Request URL
  * @param {Object} args - Request parameters
  * @param {Function} [callback] - Success callback function
+ * @param {Function} [onError] - Called if the request fails
  */
-jQuery.postJSON = (url, args, callback) => {
+jQuery.postJSON = (url, args, callback, onError) => {
     const paramString = $.param(args);
     
     $.ajax({
@@ -58,6 +60,7 @@ jQuery.postJSON = (url, args, callback) => {
         },
         error(response) {
             console.error('AJAX Error:', response);
+            if (onError) onError(response);
         }
     });
 };
@@ -68,6 +71,8 @@ jQuery.postJSON = (url, args, callback) => {
  * @param {Object} data - Event data
  */
 SocialCalc.Callbacks.broadcast = (type, data) => {
+    autosave.record(type, data);
+
     // Skip certain event types
     if (type === 'ask.ecell' || type === 'ecell') {
         return;
@@ -79,18 +84,73 @@ SocialCalc.Callbacks.broadcast = (type, data) => {
         data: encodeURIComponent(JSON.stringify(data))
     };
     
-    $.postJSON('/broadcast', message, (response) => {
-        updater.showMessage(response);
-    });
+    updater.send(message);
 };
 
 
 /**
- * Real-time update polling system
+ * Real-time updates: pushed over a WebSocket where the browser and server
+ * allow it, otherwise fetched by long polling /updates
  */
 const updater = {
     errorSleepTime: 500,
     cursor: null,
+    socket: null,
+    socketFailed: false,
+
+    /**
+     * Open the WebSocket, falling back to long polling if it cannot connect
+     */
+    connect() {
+        if (!window.WebSocket || this.socketFailed) {
+            this.poll();
+            return;
+        }
+        const scheme = location.protocol === 'https:' ? 'wss:' : 'ws:';
+        let url = `${scheme}//${location.host}/socket`;
+        if (this.cursor) url += `?cursor=${encodeURIComponent(this.cursor)}`;
+
+        const socket = new WebSocket(url);
+        let opened = false;
+        socket.onopen = () => {
+            opened = true;
+            this.socket = socket;
+            this.errorSleepTime = 500;
+        };
+        socket.onmessage = (event) => {
+            try {
+                this.newMessages(JSON.parse(event.data));
+            } catch (e) {
+                console.error('Failed to parse socket message:', e);
+            }
+        };
+        socket.onclose = () => {
+            this.socket = null;
+            if (!opened) {
+                // never connected, e.g. a proxy without WebSocket support
+                this.socketFailed = true;
+                this.poll();
+                return;
+            }
+            this.errorSleepTime *= 2;
+            console.warn(`Socket closed; reconnecting in ${this.errorSleepTime}ms`);
+            setTimeout(() => this.connect(), this.errorSleepTime);
+        };
+    },
+
+    /**
+     * Broadcast a message to the session
+     * @param {Object} message - Message with from, type and data
+     */
+    send(message) {
+        if (this.socket && this.socket.readyState === WebSocket.OPEN) {
+            this.socket.send(JSON.stringify(message));
+            return;
+        }
+        $.postJSON('/broadcast', message, (response) => {
+            this.showMessage(response);
+        });
+    },
 
     /**
      * Poll server for new updates
@@ -139,7 +199,12 @@ const updater = {
      * @param {Object} response - Server response containing messages
      */
     newMessages(response) {
-        if (!response.messages) return;
+        if (response.resync) {
+            this.cursor = response.cursor;
+            player.resync();
+            return;
+        }
+        if (!response.messages || !response.messages.length) return;
         
         const messages = response.messages;
         this.cursor = messages[messages.length - 1].id;
@@ -177,6 +242,17 @@ const player = {
         }
     },
     
+    /**
+     * Reload the sheet from a collaborator after missing messages
+     */
+    resync() {
+        this._hadSnapshot = false;
+        autosave.fullNeeded = true;
+        if (this.idInSession !== '1') {
+            SocialCalc.Callbacks.broadcast('ask.snapshot', { arbit: 'arbit' });
+        }
+    },
+    
     /**
      * Handle new collaboration events
      * @param {Object} data - Event data from server
@@ -259,6 +335,7 @@ const player = {
             break;
         }
         case 'execute': {
+            autosave.record(data.type, msgData);
             if (isMultipleSheet()) {
                 const control = SocialCalc.GetCurrentWorkBookControl();
                 control.ExecuteWorkBookControlCommand(msgData, true); // remote command
@@ -273,4 +350,106 @@ const player = {
         }
         }
     }
-};
\ No newline at end of file
+};
+
+
+/**
+ * Saves to /save as deltas: the sheet commands run since the last save,
+ * falling back to the whole workbook when the server asks for it
+ */
+const autosave = {
+    fname: null,        // the sheet /usersheet loaded, from its cookie
+    version: null,      // version of the last save
+    commands: [],
+    fullNeeded: false,
+    saving: false,
+
+    /**
+     * Save the sheet loaded by /usersheet every interval ms.  Other pages
+     * do not get its cookies and are left alone.
+     * @param {number} [interval] - Milliseconds between saves
+     */
+    start(interval = 30000) {
+        const fname = getCookie('sheetname');
+        if (!fname) return;
+        this.fname = decodeURIComponent(fname);
+        const version = getCookie('sheetversion');
+        this.version = version ? Number(version) : null;
+        setInterval(() => {
+            if (this.saving) return;
+            this.saving = true;
+            this.save(this.fname, () => { this.saving = false; });
+        }, interval);
+    },
+
+    /**
+     * Record a command executed locally or by a collaborator
+     * @param {string} type - Event type
+     * @param {Object} data - Event data
+     */
+    record(type, data) {
+        if (type !== 'execute') return;
+        if (data.cmdtype === 'scmd' && !isMultipleSheet()) {
+            this.commands.push(data.cmdstr);
+        } else {
+            this.fullNeeded = true;
+        }
+    },
+
+    /**
+     * Save the sheet
+     * @param {string} fname - Sheet name
+     * @param {Function} [callback] - Called once the save is stored
+     */
+    save(fname, callback) {
+        if (this.version === null || this.fullNeeded || isMultipleSheet()) {
+            this.saveFull(fname, callback);
+            return;
+        }
+        if (!this.commands.length) {
+            if (callback) callback();
+            return;
+        }
+        const commands = this.commands.splice(0);
+        const args = {
+            fname,
+            version: this.version,
+            commands: JSON.stringify(commands)
+        };
+        $.postJSON('/save', args, (response) => {
+            if (response.data === 'Done') {
+                this.version = response.version;
+                if (callback) callback();
+            } else {
+                this.saveFull(fname, callback);
+            }
+        }, () => this.failed(callback));
+    },
+
+    /**
+     * Save the whole workbook
+     * @param {string} fname - Sheet name
+     * @param {Function} [callback] - Called once the save is stored
+     */
+    saveFull(fname, callback) {
+        const data = isMultipleSheet()
+            ? SocialCalc.WorkBookControlSaveSheet()
+            : SocialCalc.CurrentSpreadsheetControlObject.CreateSpreadsheetSave();
+        this.commands = [];
+        this.fullNeeded = false;
+        $.postJSON('/save', { fname, data }, (response) => {
+            this.version = response.version;
+            if (callback) callback();
+        }, () => this.failed(callback));
+    },
+
+    /**
+     * A save that did not arrive: its commands are gone, so the next
+     * save sends the whole workbook
+     * @param {Function} [callback] - Called as if the save had finished
+     */
+    failed(callback) {
+        this.fullNeeded = true;
+        if (callback) callback();
+    }
+};
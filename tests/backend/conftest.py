@@ -0,0 +1,9 @@
+"""
+Make the server modules next to main.py importable from the backend tests
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                "..", "..")))
@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+"""
+Ten-Year Data Store Tests
+Tests for the read-through, write-behind TickerAnnualData store
+"""
+
+import asyncio
+import sqlite3
+
+import pytest
+
+import annualdata
+import dbpool
+import fetchers
+
+
+class SqliteDB:
+    """The tornado.database calls the store makes, on sqlite"""
+
+    def __init__(self):
+        self.conn = sqlite3.connect(":memory:", check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("""
+            CREATE TABLE TickerAnnualData (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                ticker TEXT NOT NULL,
+                year TEXT NOT NULL,
+                data BLOB,
+                updated INTEGER NOT NULL DEFAULT 0,
+                UNIQUE (ticker, year)
+            )""")
+        self.writes = 0
+
+    def query(self, sql, *args):
+        return [dict(row) for row in
+                self.conn.execute(sql.replace("%s", "?"), args)]
+
+    def executemany(self, sql, rows):
+        self.conn.executemany(sql.replace("%s", "?"), rows)
+        self.conn.commit()
+        self.writes += 1
+
+    def rows(self):
+        return self.query("SELECT ticker, year, data, updated "
+                          "FROM TickerAnnualData ORDER BY ticker")
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1767225600.0     # 2026-01-01
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def db():
+    return SqliteDB()
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+def make_store(db, clock, fetch=None, **kwargs):
+    calls = []
+
+    async def default_fetch(ticker):
+        calls.append(ticker)
+        await asyncio.sleep(0.01)
+        return "%s v%d" % (ticker, len(calls))
+
+    pool = dbpool.ConnectionPool(lambda: db, size=1)
+    store = annualdata.AnnualDataStore(pool, fetch or default_fetch,
+                                       dialect="sqlite", clock=clock,
+                                       **kwargs)
+    return store, calls
+
+
+class TestReadThrough:
+    """Test serving from the table and fetching on a miss"""
+
+    def test_miss_fetches_then_serves_from_table(self, db, clock):
+        store, calls = make_store(db, clock)
+
+        async def main():
+            assert await store.get("aapl") == "AAPL v1"
+            assert await store.get("AAPL") == "AAPL v1"
+            await store.close()
+
+        asyncio.run(main())
+        assert calls == ["AAPL"]
+        assert db.rows() == [{"ticker": "AAPL", "year": "2026",
+                              "data": "AAPL v1", "updated": 1767225600}]
+
+        cold, cold_calls = make_store(db, clock)
+        assert asyncio.run(cold.get("AAPL")) == "AAPL v1"
+        assert cold_calls == []
+
+    def test_concurrent_misses_fetch_once(self, db, clock):
+        store, calls = make_store(db, clock)
+
+        async def main():
+            results = await asyncio.gather(*[store.get("MSFT")
+                                             for _ in range(20)])
+            await store.close()
+            return results
+
+        assert asyncio.run(main()) == ["MSFT v1"] * 20
+        assert calls == ["MSFT"]
+
+    def test_stale_row_served_while_refreshing(self, db, clock):
+        store, calls = make_store(db, clock, max_age=3600)
+
+        async def main():
+            await store.get("IBM")
+            await store.flush()
+            clock.now += 7200
+            assert await store.get("IBM") == "IBM v1"
+            await asyncio.sleep(0.05)
+            assert await store.get("IBM") == "IBM v2"
+            await store.close()
+
+        asyncio.run(main())
+        assert calls == ["IBM", "IBM"]
+        assert [r["data"] for r in db.rows()] == ["IBM v2"]
+
+    def test_new_year_keeps_fresh_rows(self, db, clock):
+        clock.now = 1798758000.0    # 2026-12-31 23:00
+        store, calls = make_store(db, clock)
+
+        async def main():
+            await store.get("IBM")
+            clock.now += 7200
+            assert await store.get("IBM") == "IBM v1"
+            await store.close()
+
+        asyncio.run(main())
+        assert calls == ["IBM"]
+
+    def test_new_fiscal_year_gets_new_row(self, db, clock):
+        clock.now = 1798758000.0    # 2026-12-31 23:00
+        store, calls = make_store(db, clock)
+
+        async def main():
+            await store.get("IBM")
+            await store.flush()
+            clock.now += 8 * 86400
+            assert await store.get("IBM") == "IBM v1"
+            await asyncio.sleep(0.05)
+            await store.close()
+
+        asyncio.run(main())
+        assert [(r["year"], r["data"]) for r in db.rows()] == \
+            [("2026", "IBM v1"), ("2027", "IBM v2")]
+        cold, cold_calls = make_store(db, clock)
+        assert asyncio.run(cold.get("IBM")) == "IBM v2"
+        assert cold_calls == []
+
+    def test_lookup_uses_unique_index(self, db):
+        plan = db.query("EXPLAIN QUERY PLAN SELECT ticker, data, updated "
+                        "FROM TickerAnnualData WHERE ticker IN "
+                        "(?)".replace("?", "%s"), "AAPL")
+        assert "USING INDEX" in plan[0]["detail"]
+
+
+class TestWriteBehind:
+    """Test batched, queued writes"""
+
+    def test_writes_are_batched(self, db, clock):
+        store, _ = make_store(db, clock, batch_size=10, flush_interval=60)
+
+        async def main():
+            await asyncio.gather(*[store.get("T%02d" % i) for i in range(25)])
+            await store.close()
+
+        asyncio.run(main())
+        assert len(db.rows()) == 25
+        assert db.writes <= 4
+
+    def test_upsert_keeps_one_row(self, db, clock):
+        store, _ = make_store(db, clock)
+
+        async def main():
+            for _ in range(3):
+                await store.refresh("AAPL")
+                await store.flush()
+
+        asyncio.run(main())
+        assert [r["data"] for r in db.rows()] == ["AAPL v3"]
+
+
+    def test_failed_flush_retried(self, db, clock):
+        store, _ = make_store(db, clock, flush_interval=0.01)
+        executemany, failures = db.executemany, []
+
+        def flaky(sql, rows):
+            if not failures:
+                failures.append(rows)
+                raise sqlite3.OperationalError("database is locked")
+            executemany(sql, rows)
+
+        db.executemany = flaky
+
+        async def main():
+            await store.get("AAPL")
+            await asyncio.sleep(0.1)
+            assert store.pending == {}
+            await store.close()
+
+        asyncio.run(main())
+        assert len(failures) == 1
+        assert [r["data"] for r in db.rows()] == ["AAPL v1"]
+
+
+class TestFetchFailures:
+    """Test keeping empty and error fetch output out of the table"""
+
+    @pytest.mark.parametrize("output", ["", "  \n", None,
+                                        "Traceback (most recent call last):",
+                                        "Error: no data for ZZZZ"])
+    def test_miss_rejects_bad_output(self, db, clock, output):
+        async def fetch(ticker):
+            return output
+
+        store, _ = make_store(db, clock, fetch=fetch)
+
+        async def main():
+            with pytest.raises(fetchers.FetchError):
+                await store.get("ZZZZ")
+            assert store.pending == {}
+            await store.close()
+
+        asyncio.run(main())
+        assert db.rows() == []
+
+    def test_stale_row_kept_on_bad_output(self, db, clock):
+        outputs = ["IBM v1", ""]
+
+        async def fetch(ticker):
+            return outputs.pop(0)
+
+        store, _ = make_store(db, clock, fetch=fetch, max_age=3600)
+
+        async def main():
+            await store.get("IBM")
+            await store.flush()
+            clock.now += 7200
+            assert await store.get("IBM") == "IBM v1"
+            await asyncio.sleep(0.01)
+            assert await store.get("IBM") == "IBM v1"
+            await store.close()
+
+        asyncio.run(main())
+        assert [r["data"] for r in db.rows()] == ["IBM v1"]
+
+
+class TestWarm:
+    """Test the bulk warm-up"""
+
+    def test_warm_batches(self, db, clock):
+        async def fetch(ticker):
+            if ticker == "BAD":
+                raise ValueError("no such ticker")
+            return ticker + " data"
+
+        store, _ = make_store(db, clock, fetch=fetch)
+        db.executemany(annualdata.UPSERT["sqlite"],
+                       [("T000", "2026", "old", int(clock.now))])
+        tickers = ["T%03d" % i for i in range(120)] + ["BAD"]
+
+        fresh, fetched, failed = asyncio.run(store.warm(tickers, 50))
+        assert (fresh, fetched, failed) == (1, 119, 1)
+        rows = db.rows()
+        assert len(rows) == 120
+        assert rows[0]["data"] == "old"
+        assert db.writes == 1 + 3
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+"""
+Collaboration Log Tests
+Tests for the on-disk session logs and rebuilding channels from them
+"""
+
+import asyncio
+import mmap
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import collablog
+import pubsub
+
+
+def message(n):
+    return {"id": "m%d" % n, "type": "execute", "from": "a",
+            "data": "set A%d value n %d" % (n, n)}
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+@pytest.fixture
+def log_dir(tmp_path):
+    return str(tmp_path / "logs")
+
+
+class TestSessionLog:
+    """Test segments, replay and catch-up reads"""
+
+    def test_replay(self, log_dir):
+        log = collablog.SessionLog.create(log_dir, "IBM", "model", keep=3)
+        log.append([message(1), message(2)])
+        log.record_nextid(2)
+        log.append([message(3), message(4)])
+        log.close()
+
+        log, replayed = collablog.SessionLog.open(log_dir, keep=3)
+        assert (replayed.ticker, replayed.fname) == ("IBM", "model")
+        assert (replayed.nextid, replayed.seq) == (3, 4)
+        assert replayed.messages == [message(n) for n in (2, 3, 4)]
+        log.close()
+
+    def test_segments_roll_and_prune(self, log_dir):
+        log = collablog.SessionLog.create(log_dir, "", "", keep=4,
+                                          segment_bytes=1)
+        for n in range(1, 11):
+            log.append([message(n)])
+        log.record_nextid(7)
+        # each segment holds one message; 6 goes once 7-10 hold four
+        assert sorted(os.listdir(log_dir)) == \
+            ["%020d.log" % n for n in range(6, 11)]
+        log.append([message(11)])
+        assert sorted(os.listdir(log_dir)) == \
+            ["%020d.log" % n for n in range(7, 12)]
+        log.close()
+
+        log, replayed = collablog.SessionLog.open(log_dir, keep=4)
+        assert (replayed.nextid, replayed.seq) == (8, 11)
+        assert replayed.messages == [message(n) for n in range(8, 12)]
+        assert log.since("m7") == [message(n) for n in range(8, 12)]
+        log.close()
+
+    def test_since(self, log_dir):
+        log = collablog.SessionLog.create(log_dir, "", "", segment_bytes=300)
+        # a message quoting another's id is not mistaken for it
+        decoy = dict(message(1), data='"id":"m5"')
+        log.append([decoy] + [message(n) for n in range(2, 9)])
+        log.append([message(n) for n in range(9, 12)])
+        assert len(log.segments) == 2
+        assert log.since("m5") == [message(n) for n in range(6, 12)]
+        assert log.since("m11") == []
+        assert log.since("m99") is None
+        log.close()
+
+    def test_torn_record_cut_off(self, log_dir):
+        log = collablog.SessionLog.create(log_dir, "", "")
+        log.append([message(1), message(2)])
+        log.close()
+        path = log.segments[-1][1]
+        with open(path, "ab") as f:
+            f.write(b'{"t":"m","m":{"id":"m3"')
+
+        log, replayed = collablog.SessionLog.open(log_dir)
+        assert replayed.messages == [message(1), message(2)]
+        log.append([message(3)])
+        log.close()
+        assert collablog.SessionLog.open(log_dir)[1].messages == \
+            [message(n) for n in (1, 2, 3)]
+
+    def test_fsync_every_write(self, log_dir, monkeypatch):
+        synced = []
+        monkeypatch.setattr(os, "fsync", synced.append)
+        log = collablog.SessionLog.create(log_dir, "", "", fsync_interval=0)
+        log.append([message(1)])
+        assert len(synced) == 2 and not log.dirty
+        log.close()
+
+    def test_file_work_on_executor(self, log_dir, monkeypatch):
+        threads = []
+        fsync = os.fsync
+
+        def recording_fsync(fd):
+            threads.append(threading.current_thread().name)
+            fsync(fd)
+        monkeypatch.setattr(os, "fsync", recording_fsync)
+        executor = ThreadPoolExecutor(1, thread_name_prefix="collablog")
+        log = executor.submit(collablog.SessionLog.create, log_dir, "", "",
+                              fsync_interval=0, executor=executor).result()
+
+        async def main():
+            log.append([message(1), message(2)])
+            log.record_nextid(2)
+            return await log.read_since("m1")
+
+        assert run(main()) == [message(2)]
+        log.close()
+        executor.shutdown(wait=True)
+        assert len(threads) == 3
+        assert all(name.startswith("collablog") for name in threads)
+
+    def test_maps_closed(self, log_dir, monkeypatch):
+        maps = []
+        original = mmap.mmap
+
+        def recording_mmap(*args, **kwargs):
+            maps.append(original(*args, **kwargs))
+            return maps[-1]
+        monkeypatch.setattr(mmap, "mmap", recording_mmap)
+        log = collablog.SessionLog.create(log_dir, "", "", segment_bytes=300)
+        log.append([message(n) for n in range(1, 9)])
+        log.append([message(n) for n in range(9, 12)])
+        assert log.since("m5") == [message(n) for n in range(6, 12)]
+        log.close()
+        collablog.SessionLog.open(log_dir)[0].close()
+        assert len(maps) == 4
+        assert all(data.closed for data in maps)
+
+
+class TestLoggedBackend:
+    """Test channels rebuilt from their logs"""
+
+    def test_restart_resumes_session(self, log_dir):
+        backend = pubsub.MemoryBackend(log_dir=log_dir, cache_size=5)
+        channel = run(backend.open("S1", "IBM", "model"))
+        assert run(backend.next_id(channel)) == 2
+        channel.new_messages([message(n) for n in range(1, 8)])
+        backend.close()
+
+        backend = pubsub.MemoryBackend(log_dir=log_dir, cache_size=5)
+        channel = run(backend.get("S1"))
+        assert (channel.ticker, channel.fname) == ("IBM", "model")
+        assert run(backend.next_id(channel)) == 3
+        assert channel.cache == [message(n) for n in range(3, 8)]
+        received = []
+        run(channel.wait_for_messages(received.append, cursor="m5"))
+        assert received == [[message(6), message(7)]]
+        channel.new_messages([message(8)])
+        assert channel.latest() == "m8"
+        assert backend.stats()["replayed"] == 1
+        backend.close()
+
+    def test_concurrent_gets_share_one_replay(self, log_dir):
+        backend = pubsub.MemoryBackend(log_dir=log_dir)
+        channel = run(backend.open("S1", "", ""))
+        channel.new_messages([message(1)])
+        backend.close()
+
+        backend = pubsub.MemoryBackend(log_dir=log_dir)
+
+        async def main():
+            return await asyncio.gather(*[backend.get("S1")
+                                          for _ in range(5)])
+
+        channels = run(main())
+        assert all(channel is channels[0] for channel in channels)
+        assert backend.stats()["replayed"] == 1
+        backend.close()
+
+    def test_evicted_cache_caught_up_from_log(self, log_dir):
+        backend = pubsub.MemoryBackend(log_dir=log_dir)
+        channel = run(backend.open("S1", "", ""))
+        channel.new_messages([message(n) for n in range(1, 5)])
+        channel.drop_cache()
+        received = []
+        run(channel.wait_for_messages(received.append, cursor="m2"))
+        assert received == [[message(3), message(4)]]
+        with pytest.raises(pubsub.StaleCursor):
+            run(channel.wait_for_messages(received.append, cursor="m0"))
+        backend.close()
+
+    def test_reaped_session_log_deleted(self, log_dir):
+        now = [time.time()]
+        backend = pubsub.MemoryBackend(log_dir=log_dir, idle_timeout=600,
+                                       clock=lambda: now[0])
+        run(backend.open("S1", "", "")).new_messages([message(1)])
+        run(backend.open("../S2", "", ""))
+        assert os.listdir(log_dir) == ["S1"]
+        now[0] += 601
+        backend.reap()
+        assert os.listdir(log_dir) == []
+        assert run(backend.get("S1")) is None
+        backend.close()
+
+    def test_orphaned_logs_swept(self, log_dir):
+        old = pubsub.MemoryBackend(log_dir=log_dir)
+        run(old.open("S1", "", ""))
+        old.close()
+        now = [time.time()]
+        backend = pubsub.MemoryBackend(log_dir=log_dir, idle_timeout=600,
+                                       clock=lambda: now[0])
+        backend.reap()
+        assert os.listdir(log_dir) == ["S1"]
+        now[0] += 601
+        backend.reap()
+        assert os.listdir(log_dir) == []
@@ -668,6 +668,122 @@ class TestTransactionHandling:
         assert count == 3
 
 
+class TestUpsertsAndKeyedLookups:
+    """Test unique (user, fname) keys, upserts, and lookup cost at scale"""
+
+    UPSERT = ("INSERT INTO UserSheets (user, fname, data) VALUES (?, ?, ?) "
+              "ON CONFLICT (user, fname) DO UPDATE SET data = excluded.data")
+    LOOKUP = "SELECT data FROM UserSheets WHERE user = ? AND fname = ?"
+
+    def setup_method(self):
+        """Setup test database for each test"""
+        self.db_fd, self.db_path = tempfile.mkstemp(suffix='.db')
+        self.conn = sqlite3.connect(self.db_path)
+        self.cursor = self.conn.cursor()
+
+        # schema.sql's UserSheets, key included
+        self.cursor.execute('''
+            CREATE TABLE UserSheets (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                fname TEXT NOT NULL,
+                user TEXT NOT NULL,
+                data BLOB,
+                UNIQUE (user, fname)
+            )
+        ''')
+        self.conn.commit()
+
+    def teardown_method(self):
+        """Cleanup after each test"""
+        self.conn.close()
+        os.close(self.db_fd)
+        os.unlink(self.db_path)
+
+    def test_upsert_inserts_then_updates(self):
+        """Test that saving a name twice leaves one row with the new data"""
+        self.cursor.execute(self.UPSERT, ("demo", "model", "v1"))
+        self.cursor.execute(self.UPSERT, ("demo", "model", "v2"))
+        self.cursor.execute(self.UPSERT, ("other", "model", "v1"))
+        self.conn.commit()
+
+        self.cursor.execute("SELECT user, data FROM UserSheets ORDER BY id")
+        assert self.cursor.fetchall() == [("demo", "v2"), ("other", "v1")]
+
+    def test_upsert_keeps_row_id(self):
+        """Test that an update in place keeps the row's id"""
+        self.cursor.execute(self.UPSERT, ("demo", "model", "v1"))
+        first = self.cursor.lastrowid
+        self.cursor.execute(self.UPSERT, ("demo", "model", "v2"))
+        self.cursor.execute("SELECT id FROM UserSheets")
+        assert self.cursor.fetchall() == [(first,)]
+
+    def test_insert_if_absent(self):
+        """Test the SharedSheets form: an existing row is left alone"""
+        insert = ("INSERT INTO UserSheets (user, fname, data) VALUES (?, ?, ?) "
+                  "ON CONFLICT (user, fname) DO NOTHING")
+        self.cursor.execute(insert, ("demo", "shared", "first"))
+        self.cursor.execute(insert, ("demo", "shared", "second"))
+        self.cursor.execute(self.LOOKUP, ("demo", "shared"))
+        assert self.cursor.fetchall() == [("first",)]
+
+    def test_lookup_uses_key(self):
+        """Test that the handlers' lookups and listings are index searches"""
+        for sql, args in ((self.LOOKUP, ("demo", "model")),
+                          ("SELECT * FROM UserSheets WHERE user = ?",
+                           ("demo",))):
+            self.cursor.execute("EXPLAIN QUERY PLAN " + sql, args)
+            detail = " ".join(row[-1] for row in self.cursor.fetchall())
+            assert "USING INDEX" in detail
+            assert "SCAN" not in detail
+
+    def _grow(self, total):
+        """Add rows until the table holds total, 100 sheets per user"""
+        self.cursor.execute("SELECT COUNT(*) FROM UserSheets")
+        start = self.cursor.fetchone()[0]
+        self.cursor.executemany(
+            "INSERT INTO UserSheets (user, fname, data) VALUES (?, ?, ?)",
+            ((f"user_{i // 100}", f"sheet_{i % 100}", "x")
+             for i in range(start, total)))
+        self.conn.commit()
+
+    def _time_lookups(self, total, samples=2000):
+        """Mean seconds per keyed lookup and per upsert over the table"""
+        import random
+        import time
+
+        rng = random.Random(total)
+        keys = [(f"user_{i // 100}", f"sheet_{i % 100}")
+                for i in (rng.randrange(total) for _ in range(samples))]
+        start = time.perf_counter()
+        for key in keys:
+            self.cursor.execute(self.LOOKUP, key)
+            assert self.cursor.fetchone() == ("x",)
+        lookup = (time.perf_counter() - start) / samples
+
+        start = time.perf_counter()
+        for user, fname in keys:
+            self.cursor.execute(self.UPSERT, (user, fname, "x"))
+        self.conn.commit()
+        upsert = (time.perf_counter() - start) / samples
+        return lookup, upsert
+
+    def test_lookup_cost_flat_to_a_million_rows(self):
+        """Test that lookups and upserts cost about the same at 10k and 1M rows"""
+        timings = {}
+        for total in (10_000, 100_000, 1_000_000):
+            self._grow(total)
+            self._time_lookups(total, 200)      # warm the page cache
+            timings[total] = self._time_lookups(total)
+
+        self.cursor.execute("SELECT COUNT(*) FROM UserSheets")
+        assert self.cursor.fetchone()[0] == 1_000_000
+        small_lookup, small_upsert = timings[10_000]
+        big_lookup, big_upsert = timings[1_000_000]
+        # a B-tree probe grows with log(rows); a scan would be 100x slower
+        assert big_lookup < 4 * small_lookup + 20e-6
+        assert big_upsert < 4 * small_upsert + 20e-6
+
+
 if __name__ == '__main__':
     # Run tests with pytest
     pytest.main([__file__, '-v', '--tb=short'])
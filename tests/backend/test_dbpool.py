@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+"""
+Database Pool Tests
+Tests for the pooled, off-loop database access layer
+"""
+
+import asyncio
+import threading
+import time
+
+import pytest
+
+import dbpool
+
+
+class Disconnected(Exception):
+    pass
+
+
+class FakeConnection:
+    """Records which thread ran each statement; SLEEP n sleeps n seconds"""
+
+    opened = 0
+
+    def __init__(self):
+        FakeConnection.opened += 1
+        self.number = FakeConnection.opened
+        self.alive = True
+        self.closed = False
+        self.statements = []
+
+    def query(self, sql, *args):
+        if not self.alive:
+            raise Disconnected("server has gone away")
+        self.statements.append(sql)
+        if sql.startswith("SLEEP"):
+            time.sleep(float(sql.split()[1]))
+        if sql == "FAIL":
+            raise ValueError("syntax error")
+        return [dict(connection=self.number, thread=threading.get_ident(),
+                     args=args)]
+
+    execute = query
+
+    def close(self):
+        self.closed = True
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def connections():
+    made = []
+
+    def connect():
+        made.append(FakeConnection())
+        return made[-1]
+
+    connect.made = made
+    return connect
+
+
+class TestConnectionPool:
+    """Test running statements on pooled connections"""
+
+    def test_query_runs_off_loop(self, connections):
+        pool = dbpool.ConnectionPool(connections, size=2)
+
+        async def main():
+            rows = await pool.query("SELECT %s", "x")
+            return rows, threading.get_ident()
+
+        rows, loop_thread = asyncio.run(main())
+        pool.close()
+        assert rows[0]["args"] == ("x",)
+        assert rows[0]["thread"] != loop_thread
+
+    def test_connections_are_reused(self, connections):
+        pool = dbpool.ConnectionPool(connections, size=4)
+
+        async def main():
+            for _ in range(10):
+                await pool.query("SELECT 1")
+
+        asyncio.run(main())
+        pool.close()
+        assert len(connections.made) == 1
+
+    def test_bounded_size(self, connections):
+        """Test that at most size statements run at once, the rest queue"""
+        pool = dbpool.ConnectionPool(connections, size=2)
+
+        async def main():
+            start = time.perf_counter()
+            await asyncio.gather(*[pool.query("SLEEP 0.1") for _ in range(4)])
+            return time.perf_counter() - start
+
+        elapsed = asyncio.run(main())
+        assert 0.2 <= elapsed < 0.35
+        assert len(connections.made) == 2
+        stats = pool.stats()
+        pool.close()
+        assert (stats["open"], stats["idle"], stats["calls"]) == (2, 2, 4)
+
+    def test_slow_query_does_not_block_loop(self, connections):
+        pool = dbpool.ConnectionPool(connections, size=2)
+        ticks = []
+
+        async def ticker():
+            while True:
+                ticks.append(1)
+                await asyncio.sleep(0.01)
+
+        async def main():
+            task = asyncio.ensure_future(ticker())
+            fast = asyncio.ensure_future(pool.query("SELECT 1"))
+            await pool.query("SLEEP 0.2")
+            assert fast.done()
+            task.cancel()
+
+        asyncio.run(main())
+        pool.close()
+        assert len(ticks) >= 10
+
+    def test_run_uses_one_connection(self, connections):
+        pool = dbpool.ConnectionPool(connections, size=4)
+
+        def transfer(conn):
+            conn.execute("UPDATE a")
+            return conn.query("SELECT a")
+
+        rows = asyncio.run(pool.run(transfer))
+        pool.close()
+        assert connections.made[0].statements == ["UPDATE a", "SELECT a"]
+        assert rows[0]["connection"] == connections.made[0].number
+
+
+class TestHealthChecks:
+    """Test pinging idle connections and dropping broken ones"""
+
+    def test_idle_connection_is_pinged(self, connections):
+        clock = FakeClock()
+        pool = dbpool.ConnectionPool(connections, size=1, ping_interval=30,
+                                     clock=clock)
+
+        async def main():
+            await pool.query("SELECT a")
+            clock.now += 10
+            await pool.query("SELECT b")
+            clock.now += 60
+            await pool.query("SELECT c")
+
+        asyncio.run(main())
+        pool.close()
+        assert connections.made[0].statements == \
+            ["SELECT a", "SELECT b", "SELECT 1", "SELECT c"]
+        assert pool.stats()["pings"] == 1
+
+    def test_failed_ping_reconnects(self, connections):
+        clock = FakeClock()
+        pool = dbpool.ConnectionPool(connections, size=1, ping_interval=30,
+                                     clock=clock)
+
+        async def main():
+            await pool.query("SELECT a")
+            connections.made[0].alive = False
+            clock.now += 60
+            return await pool.query("SELECT b")
+
+        rows = asyncio.run(main())
+        pool.close()
+        assert rows[0]["connection"] == connections.made[1].number
+        assert connections.made[0].closed
+        stats = pool.stats()
+        assert (stats["failed_pings"], stats["connects"]) == (1, 2)
+
+    def test_disconnect_drops_connection(self, connections):
+        pool = dbpool.ConnectionPool(connections, size=1,
+                                     disconnect_errors=(Disconnected,))
+
+        async def main():
+            await pool.query("SELECT a")
+            connections.made[0].alive = False
+            with pytest.raises(Disconnected):
+                await pool.query("SELECT b")
+            return await pool.query("SELECT c")
+
+        rows = asyncio.run(main())
+        pool.close()
+        assert rows[0]["connection"] == connections.made[1].number
+        assert pool.stats()["disconnects"] == 1
+
+    def test_other_errors_keep_connection(self, connections):
+        pool = dbpool.ConnectionPool(connections, size=1,
+                                     disconnect_errors=(Disconnected,))
+
+        async def main():
+            with pytest.raises(ValueError):
+                await pool.query("FAIL")
+            await pool.query("SELECT a")
+
+        asyncio.run(main())
+        pool.close()
+        assert len(connections.made) == 1
+        assert pool.stats()["errors"] == 1
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.description = None
+        self.rows = []
+        self.lastrowid = None
+        self.rowcount = 0
+
+    def execute(self, sql, args):
+        self.conn.statements.append((sql, args))
+        if sql.startswith("SELECT"):
+            self.description = [("fname",), ("version",)]
+            self.rows = [("a", 1), ("b", 2)][:int(sql.split()[-1])]
+        else:
+            self.lastrowid, self.rowcount = 7, 1
+
+    def executemany(self, sql, args):
+        for one in args:
+            self.execute(sql, one)
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def close(self):
+        pass
+
+
+class FakePyMySQL:
+    """What MySQLConnection calls on a PyMySQL connection"""
+
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self.statements = []
+        self.closed = False
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def close(self):
+        self.closed = True
+
+
+class TestMySQL:
+    """Test the pool main.py builds, on a stand-in for the MySQL server"""
+
+    @pytest.fixture
+    def server(self, monkeypatch):
+        pymysql = pytest.importorskip("pymysql")
+        made = []
+
+        def connect(**kwargs):
+            made.append(FakePyMySQL(**kwargs))
+            return made[-1]
+
+        monkeypatch.setattr(pymysql, "connect", connect)
+        return made
+
+    def test_application_pool(self, server):
+        pool = dbpool.mysql_pool("db.local:3307", "aspiringinvestments",
+                                 "ai", "secret", size=2, ping_interval=60)
+
+        async def main():
+            rows = await pool.query("SELECT * FROM UserSheets LIMIT 2")
+            row = await pool.get("SELECT * FROM UserSheets LIMIT 1")
+            new = await pool.execute("INSERT INTO UserSheets VALUES (%s)", "x")
+            return rows, row, new
+
+        rows, row, new = asyncio.run(main())
+        pool.close()
+        assert [(r.fname, r["version"]) for r in rows] == [("a", 1), ("b", 2)]
+        assert (row.fname, new) == ("a", 7)
+        [conn] = server
+        assert conn.kwargs["host"] == "db.local" and conn.kwargs["port"] == 3307
+        assert conn.kwargs["database"] == "aspiringinvestments"
+        assert conn.kwargs["autocommit"]
+        assert conn.statements[0] == ("SELECT * FROM UserSheets LIMIT 2", None)
+        assert conn.statements[2] == ("INSERT INTO UserSheets VALUES (%s)",
+                                      ("x",))
+        assert conn.closed
+        import pymysql
+        assert pymysql.OperationalError in pool.disconnect_errors
+
+    def test_socket_and_rowcount(self, server):
+        conn = dbpool.MySQLConnection("/run/mysqld/mysqld.sock", "ai")
+        assert server[0].kwargs["unix_socket"] == "/run/mysqld/mysqld.sock"
+        assert conn.execute_rowcount("UPDATE UserSheets SET version = 1") == 1
+        with pytest.raises(ValueError):
+            conn.get("SELECT * FROM UserSheets LIMIT 2")
+        assert conn.get("SELECT * FROM UserSheets LIMIT 0") is None
+        with pytest.raises(AttributeError):
+            dbpool.Row(fname="a").data
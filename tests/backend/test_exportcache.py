@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""
+Export Cache Tests
+Tests for keeping exported workbooks on disk by content
+"""
+
+import asyncio
+import os
+
+import pytest
+
+import exportcache
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+class Producer:
+    """produce(path) writing size bytes, counting the calls"""
+
+    def __init__(self, size=10, delay=0):
+        self.size = size
+        self.delay = delay
+        self.calls = 0
+
+    async def __call__(self, path):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        with open(path, "wb") as f:
+            f.write(b"x" * self.size)
+
+
+def get(cache, key, produce):
+    async def go():
+        with await cache.get(key, produce) as f:
+            return f.read()
+    return run(go())
+
+
+class TestKeys:
+    """Test the content keys"""
+
+    def test_key(self):
+        a = exportcache.key("version:1.5\n", "Excel2007")
+        assert a == exportcache.key(b"version:1.5\n", "Excel2007")
+        assert a != exportcache.key("version:1.5\n", "ODS")
+        assert a != exportcache.key("version:1.5\n\n", "Excel2007")
+        assert exportcache.KEY.match(a)
+
+    def test_bad_key(self, tmp_path):
+        cache = exportcache.ExportCache(str(tmp_path))
+        with pytest.raises(ValueError):
+            cache.open("../../etc/passwd")
+
+
+class TestCache:
+    """Test hits, coalescing and eviction"""
+
+    def test_hit(self, tmp_path):
+        cache = exportcache.ExportCache(str(tmp_path))
+        produce = Producer()
+        key = exportcache.key("a", "CSV")
+        assert get(cache, key, produce) == b"x" * 10
+        assert get(cache, key, produce) == b"x" * 10
+        assert produce.calls == 1
+        stats = cache.stats()
+        assert (stats["hits"], stats["misses"], stats["bytes"]) == (1, 1, 10)
+
+    def test_coalesced(self, tmp_path):
+        cache = exportcache.ExportCache(str(tmp_path))
+        produce = Producer(delay=0.01)
+        key = exportcache.key("a", "CSV")
+
+        async def go():
+            files = await asyncio.gather(
+                *[cache.get(key, produce) for _ in range(3)])
+            data = [f.read() for f in files]
+            for f in files:
+                f.close()
+            return data
+        assert run(go()) == [b"x" * 10] * 3
+        assert produce.calls == 1
+        assert cache.stats()["coalesced"] == 2
+
+    def test_failure_not_cached(self, tmp_path):
+        cache = exportcache.ExportCache(str(tmp_path))
+
+        async def fail(path):
+            open(path, "wb").close()
+            raise ValueError("bad sheet")
+        key = exportcache.key("a", "CSV")
+        with pytest.raises(ValueError):
+            get(cache, key, fail)
+        assert os.listdir(str(tmp_path)) == []
+        assert cache.stats()["errors"] == 1
+        assert get(cache, key, Producer()) == b"x" * 10
+
+    def test_lru_eviction(self, tmp_path):
+        cache = exportcache.ExportCache(str(tmp_path), max_bytes=25)
+        a, b, c = [exportcache.key(s, "CSV") for s in "abc"]
+        get(cache, a, Producer())
+        get(cache, b, Producer())
+        cache.open(a).close()
+        get(cache, c, Producer())
+        assert sorted(os.listdir(str(tmp_path))) == sorted([a, c])
+        assert cache.stats()["evictions"] == 1
+
+    def test_newest_kept_even_if_too_big(self, tmp_path):
+        cache = exportcache.ExportCache(str(tmp_path), max_bytes=5)
+        key = exportcache.key("a", "CSV")
+        assert get(cache, key, Producer()) == b"x" * 10
+        assert cache.open(key) is not None
+
+    def test_waiters_open_before_eviction(self, tmp_path):
+        cache = exportcache.ExportCache(str(tmp_path), max_bytes=15)
+        a, b = [exportcache.key(s, "CSV") for s in "ab"]
+        produce_a, produce_b = Producer(delay=0.01), Producer(delay=0.01)
+
+        async def go():
+            # b finishes in the same turn as a, before a's callers resume
+            files = await asyncio.gather(cache.get(a, produce_a),
+                                         cache.get(b, produce_b))
+            for f in files:
+                f.close()
+        run(go())
+        assert (produce_a.calls, produce_b.calls) == (1, 1)
+        assert os.listdir(str(tmp_path)) == [b]
+        assert cache.stats()["pinned"] == 0
+
+    def test_removed_by_other_process(self, tmp_path):
+        cache = exportcache.ExportCache(str(tmp_path))
+        key = exportcache.key("a", "CSV")
+
+        async def produce(path):
+            with open(path, "wb") as f:
+                f.write(b"x")
+            # as if another process evicted it once written
+            asyncio.get_running_loop().call_soon(
+                os.remove, str(tmp_path / key))
+        with pytest.raises(FileNotFoundError):
+            get(cache, key, produce)
+        assert cache.stats()["misses"] == exportcache.PRODUCE_TRIES
+
+    def test_open_file_survives_eviction(self, tmp_path):
+        cache = exportcache.ExportCache(str(tmp_path), max_bytes=15)
+        a, b = [exportcache.key(s, "CSV") for s in "ab"]
+        get(cache, a, Producer())
+        f = cache.open(a)
+        get(cache, b, Producer())
+        assert cache.open(a) is None
+        with f:
+            assert f.read() == b"x" * 10
+
+
+class TestSharedDirectory:
+    """Test restarts and processes sharing a directory"""
+
+    def test_restart(self, tmp_path):
+        first = exportcache.ExportCache(str(tmp_path))
+        key = exportcache.key("a", "CSV")
+        get(first, key, Producer())
+        (tmp_path / (key + ".part-1")).write_bytes(b"")
+        os.utime(str(tmp_path / (key + ".part-1")), (0, 0))
+        second = exportcache.ExportCache(str(tmp_path))
+        assert second.stats()["bytes"] == 10
+        assert os.listdir(str(tmp_path)) == [key]
+
+    def test_other_process(self, tmp_path):
+        first = exportcache.ExportCache(str(tmp_path))
+        second = exportcache.ExportCache(str(tmp_path))
+        key = exportcache.key("a", "CSV")
+        get(first, key, Producer())
+        produce = Producer()
+        assert get(second, key, produce) == b"x" * 10
+        assert produce.calls == 0
+        os.remove(str(tmp_path / key))
+        assert first.open(key) is None
+        assert first.stats()["bytes"] == 0
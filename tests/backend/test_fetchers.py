@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+"""
+Market Data Fetcher Tests
+Tests for running the util fetch scripts in-process
+"""
+
+import asyncio
+import sys
+import threading
+import time
+
+import pytest
+
+import fetchers
+
+
+MSNPARSE = '''
+import time
+
+LOADS = []
+LOADS.append(1)
+
+
+def main(argv):
+    if argv[0] == "slow":
+        time.sleep(0.2)
+    print("args:" + ",".join(argv))
+'''
+
+TENYEARDATA = '''
+def main(argv):
+    return "ten years of " + argv[0]
+'''
+
+SCRIPT = '''
+import sys
+
+print("argv:" + ",".join(sys.argv[1:]))
+if sys.argv[1] == "exit":
+    sys.exit(1)
+'''
+
+YSTOCKQUOTE = '''
+def get_all(symbol):
+    return {"symbol": symbol}
+'''
+
+
+@pytest.fixture
+def source(tmp_path):
+    for name, text in (("msnparse", MSNPARSE), ("tenyeardata", TENYEARDATA),
+                       ("ystockquote", YSTOCKQUOTE)):
+        (tmp_path / (name + ".py")).write_text(text)
+    return fetchers.ScriptSource(str(tmp_path))
+
+
+class TestScriptSource:
+    """Test loading and calling the fetch scripts"""
+
+    def test_printed_output(self, source):
+        assert source.ticker_sheet("AAPL") == "args:none,AAPL"
+        assert source.compare_json("A", "B", "C") == "args:json,A,B,C"
+
+    def test_returned_output(self, source):
+        assert source.ten_year_data("MSFT") == "ten years of MSFT"
+
+    def test_loaded_once(self, source):
+        source.stock_sheet("A")
+        source.stock_sheet("B")
+        assert source.module("msnparse").LOADS == [1]
+
+    def test_missing_script(self, tmp_path):
+        with pytest.raises(fetchers.FetchError):
+            fetchers.ScriptSource(str(tmp_path)).stock_sheet("A")
+
+    def test_threads_capture_separately(self, source):
+        results = {}
+
+        def fetch(ticker):
+            results[ticker] = source.stock_sheet(ticker)
+
+        threads = [threading.Thread(target=fetch, args=("T%d" % i,))
+                   for i in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert results == dict(("T%d" % i, "args:T%d" % i)
+                               for i in range(20))
+
+    def test_script_without_main(self, source, tmp_path):
+        (tmp_path / "script.py").write_text(SCRIPT)
+        argv = sys.argv
+        assert source.run("script", "A", "B") == "argv:A,B"
+        assert source.run("script", "C") == "argv:C"
+        assert source.run("script", "exit") == "argv:exit"
+        assert sys.argv is argv
+
+    def test_stdout_restored(self, source):
+        stdout = sys.stdout
+        source.stock_sheet("A")
+        assert sys.stdout is stdout
+
+
+class TestTickerFetcher:
+    """Test the coroutine front end"""
+
+    def test_ticker(self, source):
+        fetcher = fetchers.TickerFetcher(source)
+        sheet, quote = asyncio.run(fetcher.ticker("IBM"))
+        fetcher.close()
+        assert sheet == "args:none,IBM"
+        assert quote == {"symbol": "IBM"}
+
+    def test_does_not_block_loop(self, source):
+        """Test that the event loop keeps running during a slow fetch"""
+        fetcher = fetchers.TickerFetcher(source)
+        ticks = []
+
+        async def ticker():
+            while True:
+                ticks.append(time.perf_counter())
+                await asyncio.sleep(0.01)
+
+        async def main():
+            task = asyncio.ensure_future(ticker())
+            await fetcher.stock_sheet("slow")
+            task.cancel()
+
+        asyncio.run(main())
+        fetcher.close()
+        assert len(ticks) >= 10
+
+    def test_bounded_workers(self, source):
+        """Test that at most max_workers fetches run at once"""
+        fetcher = fetchers.TickerFetcher(source, max_workers=2)
+
+        async def main():
+            start = time.perf_counter()
+            await asyncio.gather(*[fetcher.stock_sheet("slow")
+                                   for _ in range(4)])
+            return time.perf_counter() - start
+
+        elapsed = asyncio.run(main())
+        fetcher.close()
+        assert 0.4 <= elapsed < 0.7
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTickerCache:
+    """Test TTL expiry, LRU eviction and coalescing"""
+
+    def test_hit_and_expiry(self):
+        clock = FakeClock()
+        cache = fetchers.TickerCache(clock=clock)
+        calls = []
+
+        async def fetch():
+            calls.append(1)
+            return "v%d" % len(calls)
+
+        async def main():
+            assert await cache.get("AAPL", 10, fetch) == "v1"
+            clock.now += 9
+            assert await cache.get("AAPL", 10, fetch) == "v1"
+            clock.now += 2
+            assert await cache.get("AAPL", 10, fetch) == "v2"
+
+        asyncio.run(main())
+        stats = cache.stats()
+        assert (stats["hits"], stats["misses"], stats["expired"]) == (1, 2, 1)
+
+    def test_lru_eviction(self):
+        cache = fetchers.TickerCache(maxsize=2)
+        cache.put("A", 1, 60)
+        cache.put("B", 2, 60)
+        assert cache.lookup("A") == 1
+        cache.put("C", 3, 60)
+        assert cache.lookup("B") is None
+        assert (cache.lookup("A"), cache.lookup("C")) == (1, 3)
+        assert cache.stats()["evictions"] == 1
+
+    def test_single_flight(self):
+        """Test that 200 concurrent misses make one upstream fetch"""
+        cache = fetchers.TickerCache()
+        calls = []
+
+        async def fetch():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return "quote"
+
+        async def main():
+            return await asyncio.gather(*[cache.get("AAPL", 5, fetch)
+                                          for _ in range(200)])
+
+        assert asyncio.run(main()) == ["quote"] * 200
+        assert len(calls) == 1
+        stats = cache.stats()
+        assert (stats["misses"], stats["coalesced"]) == (1, 199)
+        assert stats["fetches"] == 1
+        assert stats["fetch_mean_ms"] >= 40
+
+    def test_errors_reach_waiters_and_are_not_cached(self):
+        cache = fetchers.TickerCache()
+        calls = []
+
+        async def fetch():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            if len(calls) == 1:
+                raise fetchers.FetchError("upstream down")
+            return "ok"
+
+        async def main():
+            results = await asyncio.gather(
+                *[cache.get("MSFT", 5, fetch) for _ in range(3)],
+                return_exceptions=True)
+            assert all(isinstance(r, fetchers.FetchError) for r in results)
+            assert await cache.get("MSFT", 5, fetch) == "ok"
+
+        asyncio.run(main())
+        assert cache.stats()["errors"] == 1
+
+    def test_cancelled_caller_does_not_cancel_fetch(self):
+        cache = fetchers.TickerCache()
+
+        async def fetch():
+            await asyncio.sleep(0.05)
+            return "ok"
+
+        async def main():
+            first = asyncio.ensure_future(cache.get("IBM", 5, fetch))
+            second = asyncio.ensure_future(cache.get("IBM", 5, fetch))
+            await asyncio.sleep(0.01)
+            first.cancel()
+            return await second
+
+        assert asyncio.run(main()) == "ok"
+        assert cache.lookup("IBM") == "ok"
+
+    def test_fetcher_uses_cache(self, source):
+        fetcher = fetchers.TickerFetcher(source, cache=fetchers.TickerCache())
+        module = source.module("msnparse")
+        calls = []
+        main = module.main
+        module.main = lambda argv: calls.append(argv) or main(argv)
+
+        async def run():
+            return await asyncio.gather(*[fetcher.ticker("aapl")
+                                          for _ in range(50)])
+
+        results = asyncio.run(run())
+        fetcher.close()
+        assert results[0] == ("args:none,aapl", {"symbol": "aapl"})
+        assert calls == [["none", "aapl"]]
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+Vectorized Recalc Tests
+Tests that grouped NumPy evaluation matches the scalar evaluator
+"""
+
+import time
+
+import pytest
+
+import formula
+import sheetcommands
+import socialcalc
+
+numpy = pytest.importorskip("numpy")
+
+import formula_vector  # noqa: E402
+
+
+def template(nrows, extra=(), running=True):
+    lines = ["version:1.5"]
+    for row in range(1, nrows + 1):
+        for i, col in enumerate("BCDEFGHIJK"):
+            lines.append("cell:%s%d:v:%d.5" % (col, row, 100 + row + i * 7))
+        lines.append("cell:L%d:vtf:n:0:SUM(B%d\\cK%d)" % (row, row, row))
+        lines.append("cell:M%d:vtf:n:0:AVERAGE(B%d\\cK%d)" % (row, row, row))
+        lines.append("cell:N%d:vtf:n:0:NPV(0.08,B%d\\cK%d)" % (row, row, row))
+        lines.append("cell:O%d:vtf:n:0:(K%d/B%d)^(1/9)-1" % (row, row, row))
+        lines.append("cell:P%d:vtf:n:0:MAX(B%d\\cK%d)-MIN(B%d\\cK%d)"
+                     % (row, row, row, row, row))
+        if running:
+            lines.append("cell:Q%d:vtf:n:0:SUM($L$1\\cL%d)/$B$1"
+                         % (row, row))
+    lines.extend(extra)
+    return "\n".join(lines) + "\n"
+
+
+def both(text):
+    scalar = formula.Recalc(socialcalc.parse_sheet_save(text))
+    vector = formula_vector.VectorRecalc(socialcalc.parse_sheet_save(text))
+    scalar.recalc()
+    vector.recalc()
+    return scalar, vector
+
+
+def assert_same(scalar, vector):
+    for coord, cell in scalar.sheet.cells.items():
+        other = vector.sheet.cells[coord]
+        assert other.valuetype == cell.valuetype, coord
+        if isinstance(cell.datavalue, float):
+            assert other.datavalue == pytest.approx(cell.datavalue), coord
+        else:
+            assert other.datavalue == cell.datavalue, coord
+
+
+class TestGrouping:
+    """Test detection of copied-down formulas"""
+
+    def test_shape_ignores_relative_rows(self):
+        a = formula.parse("SUM(B5:K5)*$B$1").tree
+        b = formula.parse("SUM(B6:K6)*$B$1").tree
+        assert formula_vector.shape(a, 5) == formula_vector.shape(b, 6)
+        c = formula.parse("SUM(B6:K6)*$B$2").tree
+        assert formula_vector.shape(a, 5) != formula_vector.shape(c, 6)
+
+    def test_groups(self):
+        _, vector = both(template(20))
+        groups = [u for u in vector.plan.units
+                  if isinstance(u, formula_vector.Group)]
+        assert sorted(g.col for g in groups) == [12, 13, 14, 15, 16, 17]
+        assert all(len(g.coords) == 20 for g in groups)
+
+    def test_running_total_reads_itself(self):
+        """Test that a column reading its own cells is left scalar"""
+        lines = ["cell:A1:v:1"]
+        for row in range(2, 30):
+            lines.append("cell:A%d:vtf:n:0:A%d+1" % (row, row - 1))
+        _, vector = both("\n".join(lines))
+        assert not any(isinstance(u, formula_vector.Group)
+                       for u in vector.plan.units)
+        assert vector.sheet.cells["A29"].datavalue == 29
+
+
+class TestVectorRecalc:
+    """Test that vectorized results match the scalar evaluator"""
+
+    def test_matches_scalar(self):
+        assert_same(*both(template(50)))
+
+    def test_non_numeric_inputs_fall_back(self):
+        extra = ["cell:C7:t:n/a", "cell:D9:vtf:n:0:1/0", "cell:B11:v:0",
+                 "cell:E12:t:", "cell:F13:vt:nl:1"]
+        scalar, vector = both(template(30, extra))
+        assert_same(scalar, vector)
+        assert vector.sheet.cells["O11"].valuetype == "e#DIV/0!"
+        assert vector.sheet.cells["L9"].valuetype == "e#DIV/0!"
+        assert vector.sheet.cells["L7"].valuetype == "n"
+        assert vector.sheet.cells["N7"].valuetype == "n"
+
+    def test_edits_after_vector_recalc(self):
+        scalar, vector = both(template(30))
+        for recalc in (scalar, vector):
+            recalc.set_value("C5", 1000)
+            recalc.recalc(["C5"])
+            recalc.set_formula("R1", "SUM(L1:L30)")
+            recalc.recalc()
+        assert_same(scalar, vector)
+
+    def test_cycle_uses_scalar_recalc(self):
+        scalar, vector = both(template(10, ["cell:B1:vtf:n:0:Q10"]))
+        assert vector.plan.ordered is None
+        assert_same(scalar, vector)
+        assert vector.sheet.attribs["circularreferencecell"] == \
+            scalar.sheet.attribs["circularreferencecell"]
+
+    def test_speedup(self):
+        """Test that a full recalc of a copied-down template is 10x faster"""
+        scalar, vector = both(template(3000, running=False))
+
+        start = time.perf_counter()
+        scalar.recalc()
+        scalar_time = time.perf_counter() - start
+        start = time.perf_counter()
+        vector.recalc()
+        vector_time = time.perf_counter() - start
+
+        assert scalar_time / vector_time > 10
+
+
+class TestPlanCache:
+    """Test sharing plans between recalcs of sheets with one layout"""
+
+    def test_shared_by_layout(self):
+        _, first = both(template(20))
+        _, second = both(template(20, ["cell:B3:v:7"]))
+        assert second.plan is first.plan
+        _, third = both(template(20, ["cell:R1:vtf:n:0:L1*2"]))
+        assert third.plan is not first.plan
+
+    def test_values_not_shared(self):
+        both(template(20))
+        scalar, vector = both(template(20).replace("cell:C4:v:", "cell:C4:v:9"))
+        assert_same(scalar, vector)
+
+    def test_compaction(self):
+        sheet = socialcalc.parse_sheet_save(template(20))
+        text = socialcalc.create_spreadsheet_save(sheet, {})
+        formula_vector._plans.clear()
+        text = sheetcommands.apply_to_save(text, ["set B2 value n 1000"])
+        assert len(formula_vector._plans) == 1
+        sheet, _ = socialcalc.parse_spreadsheet_save(text)
+        scalar = formula.Recalc(socialcalc.parse_sheet_save(template(20)))
+        scalar.set_value("B2", 1000)
+        scalar.recalc()
+        assert sheet.cells["L2"].datavalue == \
+            pytest.approx(scalar.sheet.cells["L2"].datavalue)
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+Job Runner Tests
+Tests for running conversions on a pool of worker processes
+"""
+
+import asyncio
+import os
+import time
+
+import pytest
+
+import jobs
+import sheetexport
+from test_socialcalc import SHEET_SAVE
+
+
+def write(directory, text):
+    path = os.path.join(directory, "out")
+    with open(path, "w") as f:
+        f.write(text)
+    return path
+
+
+def sleep(directory, seconds):
+    time.sleep(seconds)
+
+
+def sleep_and_write(directory, seconds):
+    time.sleep(seconds)
+    return write(directory, "late")
+
+
+def fail(directory):
+    raise ValueError("bad sheet")
+
+
+@pytest.fixture
+def runner(tmp_path):
+    runner = jobs.JobRunner(workers=1, queue=1, timeout=0.5,
+                            directory=str(tmp_path))
+    yield runner
+    runner.close()
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+class TestJobs:
+    """Test running jobs and cleaning up after them"""
+
+    def test_scratch_directories(self, runner):
+        async def go():
+            async with runner.submit(write, "one") as first:
+                async with runner.submit(write, "two") as second:
+                    assert first.directory != second.directory
+                    assert os.path.dirname(first.directory) == \
+                        runner.directory
+                    assert open(first.result).read() == "one"
+                    assert open(second.result).read() == "two"
+            return first.directory
+        directory = run(go())
+        assert not os.path.exists(directory)
+        assert os.listdir(runner.directory) == []
+        stats = runner.stats()
+        assert (stats["submitted"], stats["completed"], stats["running"]) == \
+            (2, 2, 0)
+
+    def test_export(self, runner):
+        async def go():
+            async with runner.submit(sheetexport.export_file, SHEET_SAVE,
+                                     "CSV") as job:
+                return open(job.result, "rb").read()
+        assert run(go()).startswith(b"Revenue,1000000")
+
+    def test_failure_cleans_up(self, runner):
+        async def go():
+            with pytest.raises(ValueError):
+                async with runner.submit(fail):
+                    pass
+        run(go())
+        assert os.listdir(runner.directory) == []
+        assert runner.stats()["failed"] == 1
+
+
+class TestLimits:
+    """Test the queue limit and the timeout"""
+
+    def test_busy(self, runner):
+        async def go():
+            waiting = [asyncio.ensure_future(
+                runner.submit(sleep, 0.1).__aenter__()) for _ in range(2)]
+            await asyncio.sleep(0)
+            assert runner.stats()["queued"] == 1
+            with pytest.raises(jobs.Busy):
+                runner.submit(sleep, 0)
+            for job in await asyncio.gather(*waiting):
+                await job.__aexit__(None, None, None)
+        run(go())
+        assert runner.stats()["rejected"] == 1
+        assert runner.stats()["completed"] == 2
+
+    def test_timeout(self, runner):
+        async def go():
+            start = time.monotonic()
+            with pytest.raises(jobs.JobTimeout):
+                async with runner.submit(sleep, 30):
+                    pass
+            return time.monotonic() - start
+        assert run(go()) < 5
+        assert runner.stats()["timed_out"] == 1
+        # the worker is free again
+        async def again():
+            async with runner.submit(write, "after") as job:
+                return open(job.result).read()
+        assert run(again()) == "after"
+
+    def test_timeout_starts_with_the_worker(self, runner):
+        """Test that time spent queued does not count against a job"""
+        async def go():
+            async def job():
+                async with runner.submit(sleep_and_write, 0.3) as job:
+                    return open(job.result).read()
+            return await asyncio.gather(job(), job())
+        assert run(go()) == ["late", "late"]
+        assert runner.stats()["timed_out"] == 0
+
+    def test_cancelled_caller(self, runner):
+        """Test that a job keeps its place and directory until it finishes"""
+        async def go():
+            job = runner.submit(sleep_and_write, 0.2)
+            entering = asyncio.ensure_future(job.__aenter__())
+            await asyncio.sleep(0.05)
+            entering.cancel()
+            await asyncio.sleep(0.05)
+            assert runner.stats()["running"] == 1
+            assert os.path.isdir(job.directory)
+            await job.future
+            await asyncio.sleep(0)
+            return job.directory
+        assert not os.path.exists(run(go()))
+        assert runner.stats()["completed"] == 1
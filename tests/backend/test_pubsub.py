@@ -0,0 +1,474 @@
+#!/usr/bin/env python3
+"""
+Collaboration Channel Tests
+Tests for the in-process and cross-process channel backends
+"""
+
+import asyncio
+import os
+import sqlite3
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+import pubsub
+
+
+def message(n, sender="a"):
+    return {"id": "m%d" % n, "type": "execute", "from": sender,
+            "data": "set A%d value n %d" % (n, n)}
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1767225600.0     # 2026-01-01
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "channels.db")
+
+
+@pytest.fixture
+def backends(path):
+    opened = []
+
+    def backend(**kwargs):
+        opened.append(pubsub.SqliteBackend(path, **kwargs))
+        return opened[-1]
+
+    yield backend
+    for backend in opened:
+        backend.close()
+
+
+class TestMemoryBackend:
+    """Test channels kept in this process"""
+
+    def test_open_get_and_broadcast(self):
+        async def main():
+            backend = pubsub.MemoryBackend()
+            assert await backend.get("S1") is None
+            channel = await backend.open("S1", "IBM", "model")
+            assert await backend.get("S1") is channel
+            assert (channel.ticker, channel.fname) == ("IBM", "model")
+            assert [await backend.next_id(channel),
+                    await backend.next_id(channel)] == [2, 3]
+            return channel
+
+        channel = run(main())
+        received = []
+        run(channel.wait_for_messages(received.append))
+        channel.new_messages([message(1)])
+        assert received == [[message(1)]]
+
+    def test_catch_up_from_cursor(self):
+        channel = run(pubsub.MemoryBackend().open("S1", "", ""))
+        channel.new_messages([message(1), message(2), message(3)])
+        received = []
+        run(channel.wait_for_messages(received.append, cursor="m1"))
+        assert received == [[message(2), message(3)]]
+
+
+class TestCursor:
+    """Test catching up from a cursor through the ring buffer"""
+
+    def channel(self, count, cache_size=4):
+        channel = pubsub.MessageMixin("S1", "", "", cache_size)
+        channel.new_messages([message(n) for n in range(1, count + 1)])
+        return channel
+
+    def test_catch_up_after_wrapping(self):
+        channel = self.channel(10)
+        assert channel.cache == [message(n) for n in (7, 8, 9, 10)]
+        for cursor, expected in (("m7", [8, 9, 10]), ("m9", [10])):
+            received = []
+            run(channel.wait_for_messages(received.append, cursor=cursor))
+            assert received == [[message(n) for n in expected]]
+
+    def test_newest_cursor_waits(self):
+        channel = self.channel(6)
+        received = []
+        run(channel.wait_for_messages(received.append, cursor="m6"))
+        assert received == [] and len(channel.waiters) == 1
+        channel.new_messages([message(7)])
+        assert received == [[message(7)]]
+
+    @pytest.mark.parametrize("cursor", ["m6", "m1", "unknown"])
+    def test_stale_cursor_reported(self, cursor):
+        channel = self.channel(10)
+        received = []
+        with pytest.raises(pubsub.StaleCursor) as raised:
+            run(channel.wait_for_messages(received.append, cursor=cursor))
+        assert raised.value.latest == "m10"
+        assert received == [] and channel.waiters == []
+
+    def test_index_bounded_by_buffer(self):
+        channel = self.channel(1000, cache_size=16)
+        assert sorted(channel.index.values()) == list(range(985, 1001))
+        assert channel.latest() == "m1000"
+        assert pubsub.MessageMixin("S2", "", "").latest() is None
+
+
+class TestSubscribers:
+    """Test the persistent listeners WebSocket connections register"""
+
+    def test_every_batch_until_unsubscribed(self):
+        channel = pubsub.MessageMixin("S1", "", "")
+        batches, polled = [], []
+        run(channel.subscribe(batches.append))
+        run(channel.wait_for_messages(polled.append))
+        channel.new_messages([message(1)])
+        channel.new_messages([message(2), message(3)])
+        assert batches == [[message(1)], [message(2), message(3)]]
+        assert polled == [[message(1)]]
+
+        channel.unsubscribe(batches.append)
+        channel.new_messages([message(4)])
+        assert len(batches) == 2
+
+    def test_catch_up_then_live(self):
+        channel = pubsub.MessageMixin("S1", "", "", cache_size=2)
+        channel.new_messages([message(1), message(2), message(3)])
+        batches = []
+        run(channel.subscribe(batches.append, cursor="m2"))
+        channel.new_messages([message(4)])
+        assert batches == [[message(3)], [message(4)]]
+        with pytest.raises(pubsub.StaleCursor):
+            run(channel.subscribe(batches.append, cursor="m1"))
+        assert channel.subscribers == [batches.append]
+
+
+class TestFanOut:
+    """Test that a broadcast is encoded once for all its listeners"""
+
+    def test_listeners_share_one_encoding(self, monkeypatch):
+        channel = pubsub.MessageMixin("S1", "", "")
+        batches = []
+        for _ in range(50):
+            run(channel.wait_for_messages(batches.append))
+        calls = []
+        dumps = pubsub.json.dumps
+        monkeypatch.setattr(pubsub.json, "dumps",
+                            lambda obj: calls.append(obj) or dumps(obj))
+        channel.new_messages([dict(message(1), html="<div></div>")])
+        bodies = set(batch.encoded for batch in batches)
+        assert len(calls) == 1
+        assert bodies == {b'{"messages": [{"id": "m1", "type": "execute", '
+                          b'"from": "a", "data": "set A1 value n 1", '
+                          b'"html": "<div><\\/div>"}]}'}
+
+    def test_subscribers_get_one_batch_per_pass(self):
+        async def main():
+            channel = pubsub.MessageMixin("S1", "", "")
+            first, second = [], []
+            await channel.subscribe(first.append)
+            channel.new_messages([message(1)])
+            channel.new_messages([message(2)])
+            # joining sends the queue on to the others before catching up
+            await channel.subscribe(second.append, cursor="m1")
+            await asyncio.sleep(0)
+            channel.new_messages([message(3)])
+            channel.new_messages([message(4)])
+            await asyncio.sleep(0)
+            return first, second
+
+        first, second = asyncio.run(main())
+        assert first == [[message(1), message(2)], [message(3), message(4)]]
+        assert second == [[message(2)], [message(3), message(4)]]
+        assert first[1] is second[1]
+
+
+class TestBatchWindow:
+    """Test holding broadcasts to send them as one coalesced batch"""
+
+    def snapshot(self, n, sender):
+        return {"id": "s%d" % n, "type": "snapshot", "from": sender,
+                "data": "version %d" % n}
+
+    def test_coalesce(self):
+        messages = [self.snapshot(1, "a"), message(1), self.snapshot(2, "b"),
+                    self.snapshot(3, "a"), message(2)]
+        assert pubsub.coalesce(messages) == \
+            [message(1), self.snapshot(2, "b"), self.snapshot(3, "a"),
+             message(2)]
+
+    def test_coalesce_asks(self):
+        ask = {"id": "q1", "type": "ask.snapshot", "from": "b", "data": ""}
+        messages = [ask, message(1), dict(ask, id="q2"), message(2, "b")]
+        assert pubsub.coalesce(messages) == \
+            [message(1), dict(ask, id="q2"), message(2, "b")]
+
+    def test_edits_kept(self):
+        messages = [message(n) for n in range(1, 6)]
+        assert pubsub.coalesce(messages) == messages
+
+    def test_burst_wakes_listeners_once(self):
+        async def main():
+            channel = pubsub.MessageMixin("S1", "", "", batch_window=0.02)
+            polled, batches = [], []
+            await channel.wait_for_messages(polled.append)
+            await channel.subscribe(batches.append)
+            for n in range(1, 101):
+                channel.new_messages([message(n)])
+                channel.new_messages([self.snapshot(n, "a")])
+                await asyncio.sleep(0)
+            assert polled == batches == []
+            await asyncio.sleep(0.1)
+            return polled, batches, channel
+
+        polled, batches, channel = asyncio.run(main())
+        expected = [message(n) for n in range(1, 101)] + \
+            [self.snapshot(100, "a")]
+        assert polled == batches == [expected]
+        assert channel.cache[-2:] == expected[-2:] and channel.seq == 101
+
+    def test_shared_channel_publishes_merged_batch(self, backends):
+        async def main():
+            one = backends(batch_window=0.01)
+            channel = await one.open("S1", "", "")
+            for n in range(1, 4):
+                channel.new_messages([self.snapshot(n, "a")])
+            await asyncio.sleep(0.05)
+            return one.conn.execute(
+                "SELECT COUNT(*) FROM ChannelMessages").fetchone()[0]
+
+        assert asyncio.run(main()) == 1
+
+
+class TestLifecycle:
+    """Test reaping idle channels and the message cache budget"""
+
+    def test_idle_channels_reaped(self):
+        clock = FakeClock()
+        backend = pubsub.MemoryBackend(idle_timeout=600, clock=clock)
+        idle, waited, busy = [run(backend.open(s, "", "")) for s in "ABC"]
+        run(waited.wait_for_messages(print))
+        clock.now += 500
+        busy.new_messages([message(1)])
+        clock.now += 200
+        backend.reap()
+        assert sorted(backend.channels) == ["B", "C"]
+
+        # a long poll whose client went away no longer holds it
+        waited.cancel_wait(print)
+        clock.now += 601
+        backend.reap()
+        assert backend.channels == {}
+        assert backend.stats()["reaped"] == 3
+        assert backend.stats()["cached_bytes"] == 0
+
+    def test_cache_budget_evicts_least_recent(self):
+        clock = FakeClock()
+        per_channel = sum(pubsub.message_size(message(n))
+                          for n in range(1, 11))
+        backend = pubsub.MemoryBackend(max_cached_bytes=2 * per_channel,
+                                       clock=clock)
+        channels = [run(backend.open(s, "", "")) for s in "ABC"]
+        for channel in channels[:2]:
+            clock.now += 1
+            channel.new_messages([message(n) for n in range(1, 11)])
+        clock.now += 1
+        run(channels[0].wait_for_messages(print, cursor="m10"))
+        assert backend.stats()["evicted"] == 0
+
+        # enforced as the message arrives, not at the next reap
+        clock.now += 1
+        channels[2].new_messages([message(1)])
+        assert [len(channel.cache) for channel in channels] == [10, 0, 1]
+        stats = backend.stats()
+        assert (stats["channels"], stats["cached_messages"],
+                stats["cached_bytes"], stats["evicted"], stats["waiters"]) \
+            == (3, 11, per_channel + pubsub.message_size(message(1)), 1, 1)
+        assert backend.reaper is None
+
+    def test_evicted_cache_keeps_sequence(self):
+        channel = pubsub.MessageMixin("S1", "", "", cache_size=4)
+        channel.new_messages([message(n) for n in range(1, 7)])
+        channel.drop_cache()
+        received = []
+        with pytest.raises(pubsub.StaleCursor) as raised:
+            run(channel.wait_for_messages(received.append, cursor="m5"))
+        assert raised.value.latest == "m6"
+        run(channel.wait_for_messages(received.append, cursor="m6"))
+        channel.new_messages([message(n) for n in range(7, 13)])
+        assert received == [[message(n) for n in range(7, 13)]]
+        assert channel.cache == [message(n) for n in range(9, 13)]
+        run(channel.wait_for_messages(received.append, cursor="m10"))
+        assert received[-1] == [message(11), message(12)]
+
+    def test_sqlite_sessions_expire(self, backends):
+        async def main():
+            clock = FakeClock()
+            one = backends(idle_timeout=600, clock=clock)
+            two = backends(idle_timeout=600, clock=clock)
+            (await one.open("A", "", "")).new_messages([message(1)])
+            (await one.open("B", "", "")).new_messages([message(2)])
+            await settle(one)
+            # B has a client on the other worker
+            await (await two.get("B")).wait_for_messages(print, cursor="m2")
+            clock.now += 700
+            await two.reap()
+            await one.reap()
+            assert one.channels == {} and await one.get("A") is None
+            assert (await one.get("B")).cache == [message(2)]
+            return one
+
+        one = run(main())
+        assert one.conn.execute(
+            "SELECT session FROM ChannelMessages").fetchall() == [("B",)]
+
+
+async def settle(*backends):
+    """Waits for publishes to reach the file and the local channels"""
+    for backend in backends:
+        while backend.sending:
+            await asyncio.gather(*backend.sending)
+        await backend.poll()
+
+
+class TestSqliteBackend:
+    """Test channels shared between processes through one SQLite file"""
+
+    def test_session_visible_to_other_workers(self, backends):
+        async def main():
+            one, two = backends(), backends()
+            await one.open("S1", "IBM", "model")
+            channel = await two.get("S1")
+            assert (channel.ticker, channel.fname) == ("IBM", "model")
+            assert await two.get("nope") is None
+            assert await two.get("S1") is channel
+
+        run(main())
+
+    def test_nextid_shared(self, backends):
+        async def main():
+            one, two = backends(), backends()
+            first = await one.open("S1", "", "")
+            second = await two.get("S1")
+            return [await one.next_id(first), await two.next_id(second),
+                    await one.next_id(first)]
+
+        assert run(main()) == [2, 3, 4]
+
+    def test_nextid_not_blocked_by_other_writer(self, backends, path):
+        """Test that a write lock held elsewhere does not stall the loop"""
+        async def main():
+            one = backends()
+            channel = await one.open("S1", "", "")
+            other = sqlite3.connect(path, isolation_level=None)
+            other.execute("BEGIN IMMEDIATE")
+            ticks = 0
+            waiting = asyncio.ensure_future(one.next_id(channel))
+            while ticks < 10:
+                await asyncio.sleep(0.01)
+                ticks += 1
+            assert not waiting.done()
+            other.execute("COMMIT")
+            other.close()
+            return await waiting
+
+        assert run(main()) == 2
+
+    def test_broadcast_reaches_every_worker_in_order(self, backends):
+        async def main():
+            one, two = backends(), backends()
+            channels = [await one.open("S1", "", ""), await two.get("S1")]
+            received = [[], []]
+            for channel, got in zip(channels, received):
+                await channel.wait_for_messages(got.extend)
+
+            channels[1].new_messages([message(1, "b")])
+            await settle(two, one)
+            for channel, got in zip(channels, received):
+                await channel.wait_for_messages(got.extend)
+            channels[0].new_messages([message(2), message(3)])
+            await settle(one, two)
+            return received
+
+        received = run(main())
+        assert received[0] == received[1] == \
+            [message(1, "b"), message(2), message(3)]
+
+    def test_other_sessions_not_delivered(self, backends):
+        async def main():
+            one = backends()
+            a, b = await one.open("A", "", ""), await one.open("B", "", "")
+            received = []
+            await b.wait_for_messages(received.append)
+            a.new_messages([message(1)])
+            await settle(one)
+            return received, b
+
+        received, b = run(main())
+        assert received == [] and b.cache == []
+
+    def test_late_joiner_catches_up(self, backends):
+        async def main():
+            one = backends(cache_size=3)
+            channel = await one.open("S1", "", "")
+            channel.new_messages([message(n) for n in range(1, 6)])
+            await settle(one)
+
+            # a worker started after the messages, or after a restart
+            two = backends(cache_size=3)
+            joined = await two.get("S1")
+            assert joined.cache == [message(3), message(4), message(5)]
+            received = []
+            await joined.wait_for_messages(received.append, cursor="m3")
+            assert received == [[message(4), message(5)]]
+            # polling does not hand it the messages it caught up from
+            await two.poll()
+            channel.new_messages([message(6)])
+            await settle(one, two)
+            return joined
+
+        assert run(main()).cache == [message(4), message(5), message(6)]
+
+    def test_poller_delivers_without_direct_poll(self, backends):
+        async def main():
+            one, two = backends(poll_interval=0.01), backends()
+            received = asyncio.get_running_loop().create_future()
+            await (await one.open("S1", "", "")).wait_for_messages(
+                received.set_result)
+            (await two.get("S1")).new_messages([message(1)])
+            return await asyncio.wait_for(received, 5)
+
+        assert run(main()) == [message(1)]
+
+    def test_publish_from_another_process(self, backends, path):
+        one = backends()
+        channel = run(one.open("S1", "", ""))
+        script = textwrap.dedent("""
+            import asyncio
+            import sys
+            import pubsub
+
+            async def main():
+                backend = pubsub.SqliteBackend(sys.argv[1])
+                channel = await backend.get("S1")
+                id = await backend.next_id(channel)
+                channel.new_messages([{"id": "m%d" % id}])
+                while backend.sending:
+                    await asyncio.gather(*backend.sending)
+                backend.close()
+
+            asyncio.run(main())
+        """)
+        root = os.path.join(os.path.dirname(__file__), "..", "..")
+        subprocess.run([sys.executable, "-c", script, path], check=True,
+                       cwd=root)
+        received = []
+        run(channel.wait_for_messages(received.append))
+        run(one.poll())
+        assert received == [[{"id": "m2"}]]
+        assert run(one.next_id(channel)) == 3
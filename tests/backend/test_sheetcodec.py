@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""
+Sheet Storage Codec Tests
+Tests for the compressed encoding of the sheet LONGBLOB columns
+"""
+
+import asyncio
+import hashlib
+import os
+import sqlite3
+import sys
+
+import pytest
+
+import dbpool
+import sheetcodec
+import socialcalc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "..",
+                                "benchmarks"))
+from bench_parse import generate_sheet_save
+
+
+def sample_save(ncells):
+    sheet = socialcalc.parse_sheet_save(generate_sheet_save(ncells))
+    return socialcalc.create_spreadsheet_save(sheet, {"edit": "version:1.0\n"})
+
+
+# rows written with dictionary 1 only decode against these exact bytes
+DICTIONARY_1_SHA256 = (
+    "2705f77bca093944aa81b4d2303d7d441704eee6547653b8ea6d44c69d5588ad")
+
+
+class SqliteDB:
+    """The tornado.database calls recompress makes, on sqlite"""
+
+    def __init__(self):
+        self.conn = sqlite3.connect(":memory:", check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("""
+            CREATE TABLE UserSheets (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                fname TEXT NOT NULL,
+                user TEXT NOT NULL,
+                data BLOB,
+                UNIQUE (user, fname)
+            )""")
+
+    def query(self, sql, *args):
+        return [dict(row) for row in
+                self.conn.execute(sql.replace("%s", "?"), args)]
+
+    def execute_rowcount(self, sql, *args):
+        cursor = self.conn.execute(sql.replace("%s", "?"), args)
+        self.conn.commit()
+        return cursor.rowcount
+
+
+class TestEncoding:
+    """Test round trips and the stored layout"""
+
+    def test_round_trip(self):
+        text = sample_save(500)
+        data = sheetcodec.encode(text)
+        assert sheetcodec.is_encoded(data)
+        assert data[3:5] == bytes((sheetcodec.FORMAT_DEFLATE,
+                                   sheetcodec.DEFAULT_DICTIONARY))
+        assert sheetcodec.decode(data) == text
+
+    def test_non_ascii_round_trip(self):
+        text = "version:1.5\n" + "cell:A1:t:Café € 漢字\n" * 20
+        assert sheetcodec.decode(sheetcodec.encode(text)) == text
+
+    def test_typical_sheet_compresses_fivefold(self):
+        text = sample_save(2000)
+        assert len(text.encode("utf-8")) / len(sheetcodec.encode(text)) > 4.5
+
+    def test_dictionary_helps_small_sheets(self):
+        text = sample_save(60)
+        with_dict = sheetcodec.encode(text)
+        without = sheetcodec.encode(text, dictionary=0)
+        assert sheetcodec.decode(without) == text
+        assert len(with_dict) < 0.8 * len(without)
+
+    def test_short_text_stored_plain(self):
+        assert sheetcodec.encode("\n") == b"\n"
+        assert sheetcodec.decode(b"\n") == "\n"
+
+    def test_shipped_dictionary_is_frozen(self):
+        digest = hashlib.sha256(sheetcodec.DICTIONARIES[1]).hexdigest()
+        assert digest == DICTIONARY_1_SHA256
+
+
+class TestLegacyRows:
+    """Test that rows written before the codec still load"""
+
+    def test_plain_bytes(self):
+        text = sample_save(50)
+        assert sheetcodec.decode(text.encode("utf-8")) == text
+
+    def test_str_and_none_pass_through(self):
+        assert sheetcodec.decode("cell:A1:v:1\n") == "cell:A1:v:1\n"
+        assert sheetcodec.decode(None) is None
+
+    def test_bytearray(self):
+        data = sheetcodec.encode(sample_save(50))
+        assert sheetcodec.decode(bytearray(data)) == sample_save(50)
+
+
+class TestErrors:
+    """Test that damaged rows fail loudly"""
+
+    def test_unknown_dictionary(self):
+        data = bytearray(sheetcodec.encode(sample_save(50)))
+        data[4] = 250
+        with pytest.raises(sheetcodec.CodecError, match="dictionary 250"):
+            sheetcodec.decode(bytes(data))
+
+    def test_unknown_format(self):
+        data = bytearray(sheetcodec.encode(sample_save(50)))
+        data[3] = 9
+        with pytest.raises(sheetcodec.CodecError, match="format 9"):
+            sheetcodec.decode(bytes(data))
+
+    def test_truncated(self):
+        data = sheetcodec.encode(sample_save(500))
+        with pytest.raises(sheetcodec.CodecError):
+            sheetcodec.decode(data[:len(data) // 2])
+        with pytest.raises(sheetcodec.CodecError):
+            sheetcodec.decode(data[:4])
+
+
+class TestTraining:
+    """Test building a dictionary from sample saves"""
+
+    def test_trained_dictionary_round_trips(self, monkeypatch):
+        samples = [sample_save(n) for n in (40, 70, 100)]
+        trained = sheetcodec.train_dictionary(samples, size=4096)
+        assert 0 < len(trained) <= 4096
+        assert "cell::v::ntvf:\n" in trained
+
+        monkeypatch.setitem(sheetcodec.DICTIONARIES, 200,
+                            trained.encode("utf-8"))
+        text = sample_save(80)
+        data = sheetcodec.encode(text, dictionary=200)
+        assert data[4] == 200
+        assert sheetcodec.decode(data) == text
+        assert len(data) < len(sheetcodec.encode(text, dictionary=0))
+
+
+class TestRecompress:
+    """Test encoding legacy rows in place"""
+
+    def test_recompress_legacy_rows(self):
+        db = SqliteDB()
+        texts = [sample_save(100 + i) for i in range(5)]
+        db.conn.executemany(
+            "INSERT INTO UserSheets (user, fname, data) VALUES (?, ?, ?)",
+            [("demo", "s%d" % i, text.encode("utf-8"))
+             for i, text in enumerate(texts)] +
+            [("demo", "default", b"\n"),
+             ("demo", "new", sheetcodec.encode(texts[0]))])
+        pool = dbpool.ConnectionPool(lambda: db, size=1)
+        try:
+            rows, encoded, skipped, before, after = asyncio.run(
+                sheetcodec.recompress(pool, "UserSheets", batch_size=2))
+        finally:
+            pool.close()
+
+        assert (rows, encoded, skipped) == (7, 5, 0)
+        assert after * 4 < before
+        stored = db.query("SELECT fname, data FROM UserSheets ORDER BY id")
+        assert [sheetcodec.decode(r["data"]) for r in stored] == \
+            texts + ["\n", texts[0]]
+        assert stored[5]["data"] == b"\n"
+
+    def test_save_during_recompress_kept(self):
+        db = SqliteDB()
+        texts = [sample_save(100 + i) for i in range(2)]
+        db.conn.executemany(
+            "INSERT INTO UserSheets (user, fname, data) VALUES (?, ?, ?)",
+            [("demo", "s%d" % i, text.encode("utf-8"))
+             for i, text in enumerate(texts)])
+        newer = sample_save(200)
+        execute_rowcount = db.execute_rowcount
+
+        def save_first(sql, *args):
+            # a save lands between the SELECT and the UPDATE of row 1
+            if args[1] == 1:
+                db.conn.execute("UPDATE UserSheets SET data = ? WHERE id = 1",
+                                (newer.encode("utf-8"),))
+            return execute_rowcount(sql, *args)
+        db.execute_rowcount = save_first
+        pool = dbpool.ConnectionPool(lambda: db, size=1)
+        try:
+            rows, encoded, skipped, _, _ = asyncio.run(
+                sheetcodec.recompress(pool, "UserSheets"))
+        finally:
+            pool.close()
+
+        assert (rows, encoded, skipped) == (2, 1, 1)
+        stored = db.query("SELECT data FROM UserSheets ORDER BY id")
+        assert [sheetcodec.decode(r["data"]) for r in stored] == \
+            [newer, texts[1]]
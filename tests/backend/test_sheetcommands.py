@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""
+Sheet Command Tests
+Tests for applying SocialCalc sheet commands on the server
+"""
+
+import pytest
+
+import sheetcommands
+import socialcalc
+from sheetcommands import execute_commands
+
+
+def make_sheet(*lines):
+    return socialcalc.parse_sheet_save("version:1.5\n" + "\n".join(lines))
+
+
+def saved(sheet, coord):
+    cell = sheet.get_cell(coord)
+    return socialcalc.cell_to_string(sheet, cell) if cell else None
+
+
+class TestSetCell:
+    """Test set coord commands"""
+
+    def test_values(self):
+        sheet = make_sheet()
+        execute_commands(sheet, ["set A1 value n 42",
+                                 "set A2 text t a\\cb c",
+                                 "set A3 formula SUM(A1:A1)*2",
+                                 "set A4 constant n$ 1.5 $1.50"])
+        assert saved(sheet, "A1") == ":v:42"
+        assert saved(sheet, "A2") == ":t:a\\cb c"
+        assert sheet.get_cell("A3").formula == "SUM(A1:A1)*2"
+        assert sheet.get_cell("A3").valuetype == "e#N/A"
+        assert saved(sheet, "A4") == ":vtc:n$:1.5:$1.50"
+        assert sheet.attribs["needsrecalc"] == "yes"
+
+    def test_range_grows_sheet(self):
+        sheet = make_sheet()
+        execute_commands(sheet, ["set B2:C4 value n 1"])
+        assert len(sheet) == 6
+        assert (sheet.attribs["lastcol"], sheet.attribs["lastrow"]) == (3, 4)
+
+    def test_styles_share_table_entries(self):
+        sheet = make_sheet("cell:A1:v:1")
+        execute_commands(sheet, ["set A1:B1 font italic bold 12pt Arial",
+                                 "set A1 bt 1px solid rgb(0,0,0)",
+                                 "set B1 color rgb(255,0,0)"])
+        a1, b1 = sheet.get_cell("A1"), sheet.get_cell("B1")
+        assert a1.font == b1.font == 1
+        assert sheet.fonts.get(1) == "italic bold 12pt Arial"
+        assert sheet.borderstyles.get(a1.bt) == "1px solid rgb(0,0,0)"
+        execute_commands(sheet, ["set A1 font * * *"])
+        assert a1.font == 0
+
+    def test_all_and_empty(self):
+        sheet = make_sheet("cell:A1:v:1:f:1")
+        execute_commands(sheet, ["set A2 all :t:hi:cf:2", "set A1 empty"])
+        assert saved(sheet, "A2") == ":t:hi:cf:2"
+        assert saved(sheet, "A1") == ":f:1"
+        execute_commands(sheet, ["set A2 all"])
+        assert sheet.get_cell("A2") is None
+
+    def test_comment_and_multiline(self):
+        sheet = make_sheet()
+        execute_commands(sheet, ["set A1 comment note\\nmore\nset B1 value n 2"])
+        assert sheet.get_cell("A1").comment == "note\nmore"
+        assert saved(sheet, "B1") == ":v:2"
+
+
+class TestOtherCommands:
+    """Test sheet, column, merge, erase, fill and name commands"""
+
+    def test_sheet_and_column(self):
+        sheet = make_sheet()
+        execute_commands(sheet, ["set sheet defaultcolwidth 120",
+                                 "set sheet recalc off",
+                                 "set B:C width 90",
+                                 "set sheet lastrow 40"])
+        assert sheet.attribs["defaultcolwidth"] == "120"
+        assert sheet.attribs["recalc"] == "off"
+        assert sheet.colattribs["width"] == {"B": "90", "C": "90"}
+        assert sheet.attribs["lastrow"] == 40
+        execute_commands(sheet, ["set C width", "set sheet recalc on"])
+        assert sheet.colattribs["width"] == {"B": "90"}
+        assert "recalc" not in sheet.attribs
+
+    def test_merge_unmerge(self):
+        sheet = make_sheet()
+        execute_commands(sheet, ["merge A1:C2"])
+        cell = sheet.get_cell("A1")
+        assert (cell.colspan, cell.rowspan) == (3, 2)
+        execute_commands(sheet, ["unmerge A1"])
+        assert (cell.colspan, cell.rowspan) == (0, 0)
+
+    def test_erase(self):
+        sheet = make_sheet("cell:A1:v:1:f:1:comment:x", "cell:A2:v:2:f:1",
+                           "cell:A3:v:3")
+        execute_commands(sheet, ["erase A1 formulas", "erase A2 formats",
+                                 "cut A3 all"])
+        assert saved(sheet, "A1") == ":f:1"
+        assert saved(sheet, "A2") == ":v:2"
+        assert sheet.get_cell("A3") is None
+
+    def test_filldown_offsets_relative_refs(self):
+        sheet = make_sheet("cell:B1:vtf:n:0:A1*$A$1+Sheet2!A1:f:2")
+        execute_commands(sheet, ["filldown B1:B3 all"])
+        assert sheet.get_cell("B3").formula == "A3*$A$1+Sheet2!A3"
+        assert sheet.get_cell("B3").font == 2
+
+    def test_fillright_off_sheet_is_ref_error(self):
+        assert sheetcommands.offset_formula_coords("A1+$A1", -1, 0) == \
+            "#REF!+$A1"
+        assert sheetcommands.offset_formula_coords('"A1"&B2', 1, 1) == \
+            '"A1"&C3'
+
+    def test_names(self):
+        sheet = make_sheet()
+        execute_commands(sheet, ["name define total A1:A9",
+                                 "name desc TOTAL the total"])
+        assert sheet.names["TOTAL"] == {"definition": "A1:A9",
+                                        "desc": "the total"}
+        execute_commands(sheet, ["name delete total"])
+        assert sheet.names == {}
+
+
+class TestUnsupported:
+    """Test that commands the server cannot replay are refused up front"""
+
+    @pytest.mark.parametrize("command", ["insertrow A3", "paste A1 all",
+                                         "sort A1:B9 A up", "undo",
+                                         "set sheet usermaxcol 5",
+                                         "set A1 fancy 1"])
+    def test_refused(self, command):
+        with pytest.raises(sheetcommands.UnsupportedCommand):
+            sheetcommands.check_commands(["set A1 value n 1\n" + command])
+
+    def test_malformed(self):
+        with pytest.raises(sheetcommands.CommandError):
+            sheetcommands.check_commands(["set A1 all :zz:1"])
+
+    @pytest.mark.parametrize("command", ["erase A1:ZZ100000 formulas",
+                                         "set A1:ZZ100000 color rgb(0,0,0)",
+                                         "filldown A1:ZZ100000 all"])
+    def test_large_range_not_executed(self, command):
+        # would take minutes if the cells were created
+        sheetcommands.check_commands([command])
+
+    def test_malformed_range(self):
+        for command in ("erase A1:B formulas", "merge 1A", "set A1:? color x"):
+            with pytest.raises(sheetcommands.CommandError):
+                sheetcommands.check_commands([command])
+
+    def test_no_ops_accepted(self):
+        sheetcommands.check_commands(["recalc", "redisplay", "copy A1 all"])
+
+
+class TestApplyToSave:
+    """Test replaying commands onto a stored spreadsheet save"""
+
+    def test_recalculates_and_keeps_other_parts(self):
+        sheet = make_sheet("cell:A1:v:1", "cell:A2:vtf:n:1:A1*2")
+        text = socialcalc.create_spreadsheet_save(sheet, {"edit": "ecell:A2\n"})
+        text = sheetcommands.apply_to_save(text, ["set A1 value n 5"])
+        sheet, parts = socialcalc.parse_spreadsheet_save(text)
+        assert sheet.get_cell("A2").datavalue == 10
+        assert "needsrecalc" not in sheet.attribs
+        assert parts == {"edit": "ecell:A2\n"}
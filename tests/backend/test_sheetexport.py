@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Sheet Export Tests
+Tests for writing SocialCalc sheets as XLSX, ODS and CSV
+"""
+
+import io
+import json
+import xml.etree.ElementTree as ET
+import zipfile
+
+import pytest
+
+import sheetexport
+from test_socialcalc import SHEET_SAVE, SPREADSHEET_SAVE
+
+XLSX = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+TABLE = "{urn:oasis:names:tc:opendocument:xmlns:table:1.0}"
+OFFICE = "{urn:oasis:names:tc:opendocument:xmlns:office:1.0}"
+
+
+def export(content, type):
+    out = io.BytesIO()
+    sheetexport.export(content, type, out)
+    return out.getvalue()
+
+
+def unzip(data):
+    archive = zipfile.ZipFile(io.BytesIO(data))
+    return {name: archive.read(name) for name in archive.namelist()}
+
+
+class TestLoad:
+    """Test reading the saves the client posts"""
+
+    def test_spreadsheet_save(self):
+        [(name, sheet)] = sheetexport.load(SPREADSHEET_SAVE)
+        assert name == "Sheet1" and sheet.cells["B1"].datavalue == 42
+
+    def test_workbook_json(self):
+        workbook = json.dumps({"sheetArr": {
+            "s1": {"name": "Income", "sheetstr": {"savestr": SHEET_SAVE}},
+            "s2": {"name": "Notes", "sheetstr": {"savestr": SPREADSHEET_SAVE}},
+        }})
+        assert [name for name, _ in sheetexport.load(workbook)] == \
+            ["Income", "Notes"]
+
+    def test_unreadable(self):
+        with pytest.raises(sheetexport.ExportError):
+            sheetexport.load("{not json")
+        with pytest.raises(sheetexport.ExportError):
+            export(SHEET_SAVE, "PDF")
+
+    def test_rows_in_order(self):
+        [(_, sheet)] = sheetexport.load(SHEET_SAVE)
+        assert [(row, [col for col, _ in line])
+                for row, line in sheetexport.rows(sheet)] == \
+            [(1, [1, 2]), (2, [1, 2]), (3, [1, 2, 3]), (4, [4])]
+
+
+class TestXlsx:
+    """Test the Excel 2007 workbook"""
+
+    def test_parts_and_cells(self):
+        parts = unzip(export(SHEET_SAVE, "Excel2007"))
+        assert sorted(parts) == [
+            "[Content_Types].xml", "_rels/.rels", "xl/_rels/workbook.xml.rels",
+            "xl/styles.xml", "xl/workbook.xml", "xl/worksheets/sheet1.xml"]
+        for part in parts.values():
+            ET.fromstring(part)
+        sheet = ET.fromstring(parts["xl/worksheets/sheet1.xml"])
+        cells = {c.get("r"): c for c in sheet.iter(XLSX + "c")}
+        assert cells["A3"].get("t") == "inlineStr"
+        assert cells["A3"].find(XLSX + "is/" + XLSX + "t").text == "Profit:net"
+        assert cells["B3"].find(XLSX + "f").text == "B1-B2"
+        assert cells["B3"].find(XLSX + "v").text == "249999.5"
+        # the #,##0.00 value format and a date
+        assert cells["B1"].get("s") == "2" and cells["D4"].get("s") == "1"
+        assert b'formatCode="#,##0.00"' in parts["xl/styles.xml"]
+        assert sheet.find(XLSX + "cols/" + XLSX + "col").get("width") == \
+            "17.14"
+
+    def test_errors_and_escaping(self):
+        save = ("version:1.5\ncell:A1:vtf:e#DIV/0!:0:1/0\n"
+                "cell:A2:t:<b> & \x01\ncell:A3:vtf:nl:1:TRUE()\n")
+        sheet = ET.fromstring(unzip(export(save, "Excel2007"))
+                              ["xl/worksheets/sheet1.xml"])
+        cells = {c.get("r"): c for c in sheet.iter(XLSX + "c")}
+        assert (cells["A1"].get("t"), cells["A1"].find(XLSX + "v").text) == \
+            ("e", "#DIV/0!")
+        assert cells["A2"].find(XLSX + "is/" + XLSX + "t").text == "<b> & "
+        assert (cells["A3"].get("t"), cells["A3"].find(XLSX + "v").text) == \
+            ("b", "1")
+
+    def test_sheet_names(self):
+        assert sheetexport._sheet_names(
+            [("a/b", None), ("A_B", None), ("", None), ("x" * 40, None)]) == \
+            ["a_b", "A_B (2)", "Sheet3", "x" * 31]
+
+
+class TestOds:
+    """Test the OpenDocument spreadsheet"""
+
+    def test_mimetype_first_and_stored(self):
+        archive = zipfile.ZipFile(io.BytesIO(export(SHEET_SAVE, "ODS")))
+        first = archive.infolist()[0]
+        assert first.filename == "mimetype"
+        assert first.compress_type == zipfile.ZIP_STORED
+
+    def test_cells_and_gaps(self):
+        content = ET.fromstring(unzip(export(SHEET_SAVE, "ODS"))["content.xml"])
+        rows = list(content.iter(TABLE + "table-row"))
+        assert len(rows) == 4
+        row3 = rows[2].findall(TABLE + "table-cell")
+        assert row3[1].get(OFFICE + "value") == "249999.5"
+        row4 = rows[3].findall(TABLE + "table-cell")
+        assert row4[0].get(TABLE + "number-columns-repeated") == "3"
+        assert row4[1].get(OFFICE + "date-value") == "2010-01-01T00:00:00"
+
+
+class TestCsv:
+    """Test the CSV of the first sheet"""
+
+    def test_values(self):
+        save = SHEET_SAVE + "cell:A6:t:quoted, \"text\"\n"
+        assert export(save, "CSV").decode("utf-8").splitlines() == [
+            "Revenue,1000000", "Expenses,750000.5", "Profit:net,249999.5,AAPL",
+            ",,,40179", "", '"quoted, ""text"""']
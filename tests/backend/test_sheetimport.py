@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+"""
+Sheet Import Tests
+Tests for reading XLSX, ODS and CSV uploads into workbook saves
+"""
+
+import io
+import json
+import zipfile
+
+import pytest
+
+import sheetexport
+import sheetimport
+import socialcalc
+from test_socialcalc import SHEET_SAVE
+
+
+def cells(f, fname):
+    return [item for item in sheetimport.reader(fname)(f)]
+
+
+def zipped(parts):
+    out = io.BytesIO()
+    with zipfile.ZipFile(out, "w") as archive:
+        for name, data in parts.items():
+            archive.writestr(name, data)
+    out.seek(0)
+    return out
+
+
+XLSX_NS = 'xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"'
+
+XLSX_PARTS = {
+    "xl/workbook.xml": '<workbook %s xmlns:r="http://schemas.openxmlformats.'
+                       'org/officeDocument/2006/relationships"><sheets>'
+                       '<sheet name="Data" sheetId="1" r:id="rId1"/>'
+                       '</sheets></workbook>' % XLSX_NS,
+    "xl/_rels/workbook.xml.rels":
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/'
+        '2006/relationships"><Relationship Id="rId1" Type="worksheet" '
+        'Target="worksheets/sheet1.xml"/></Relationships>',
+    "xl/sharedStrings.xml": '<sst %s><si><t>plain</t></si><si><r><t>rich '
+                            '</t></r><r><t>text</t></r></si></sst>' % XLSX_NS,
+    "xl/styles.xml": '<styleSheet %s><numFmts><numFmt numFmtId="164" '
+                     'formatCode="yyyy\\-mm\\-dd"/></numFmts><cellXfs>'
+                     '<xf numFmtId="0"/><xf numFmtId="164"/><xf numFmtId="4"/>'
+                     '</cellXfs></styleSheet>' % XLSX_NS,
+    "xl/worksheets/sheet1.xml":
+        '<worksheet %s><sheetData>'
+        '<row r="1"><c r="A1" t="s"><v>0</v></c><c r="C1" t="s"><v>1</v></c>'
+        '</row><row r="3"><c r="A3" s="1"><v>40179</v></c>'
+        '<c r="B3" s="2"><f>SUM(A3:A3)</f><v>40179</v></c>'
+        '<c r="C3" t="b"><v>1</v></c><c r="D3" t="e"><f>1/0</f>'
+        '<v>#DIV/0!</v></c><c r="E3" t="inlineStr"><is><t>a:b</t></is></c>'
+        '<c r="F3"/></row></sheetData></worksheet>' % XLSX_NS,
+}
+
+
+class TestXlsx:
+    """Test reading Excel 2007 workbooks"""
+
+    def test_cells(self):
+        assert cells(zipped(XLSX_PARTS), "upload.xlsx") == [
+            ("sheet", "Data"),
+            (1, 1, "t", "plain", ""),
+            (3, 1, "t", "rich text", ""),
+            (1, 3, "d", 40179, ""),
+            (2, 3, "n", 40179, "SUM(A3:A3)"),
+            (3, 3, "b", True, ""),
+            (4, 3, "e", "#DIV/0!", "1/0"),
+            (5, 3, "t", "a:b", "")]
+
+    def test_round_trip(self):
+        out = io.BytesIO()
+        sheetexport.export(SHEET_SAVE, "Excel2007", out)
+        out.seek(0)
+        [(_, name, sheet)] = socialcalc.parse_workbook_json(
+            sheetimport.read(out, "model.XLSX"))
+        [(_, original)] = sheetexport.load(SHEET_SAVE)
+        assert name == "Sheet1"
+        assert sorted(sheet.cells) == sorted(original.cells)
+        assert sheet.cells["B3"].formula == "B1-B2"
+        assert sheet.cells["B3"].datavalue == 249999.5
+        assert sheet.cells["D4"].valuetype == "nd"
+
+    def test_not_a_workbook(self):
+        with pytest.raises(sheetimport.UnreadableSheet):
+            sheetimport.read(io.BytesIO(b"not a zip"), "upload.xlsx")
+
+
+ODS_CONTENT = """<office:document-content \
+xmlns:office="urn:oasis:names:tc:opendocument:xmlns:office:1.0" \
+xmlns:table="urn:oasis:names:tc:opendocument:xmlns:table:1.0" \
+xmlns:text="urn:oasis:names:tc:opendocument:xmlns:text:1.0">\
+<office:body><office:spreadsheet>\
+<table:table table:name="First">\
+<table:table-row><table:table-cell office:value-type="string">\
+<text:p>two</text:p><text:p>lines</text:p></table:table-cell>\
+<table:table-cell table:number-columns-repeated="2"/>\
+<table:table-cell office:value-type="float" office:value="2.5" \
+table:formula="of:=SUM([.A2:.B2];[Second.A1])"><text:p>2.5</text:p>\
+</table:table-cell></table:table-row>\
+<table:table-row table:number-rows-repeated="2">\
+<table:table-cell office:value-type="boolean" office:boolean-value="true" \
+table:number-columns-repeated="2"/></table:table-row>\
+<table:table-row table:number-rows-repeated="1048000"><table:table-cell/>\
+</table:table-row></table:table>\
+<table:table table:name="Second"><table:table-row>\
+<table:table-cell office:value-type="date" \
+office:date-value="2010-01-01T12:00:00"/></table:table-row></table:table>\
+</office:spreadsheet></office:body></office:document-content>"""
+
+
+class TestOds:
+    """Test reading OpenDocument spreadsheets"""
+
+    def test_cells_repeats_and_formulas(self):
+        f = zipped({"mimetype": sheetexport.ODS_MIMETYPE,
+                    "content.xml": ODS_CONTENT})
+        assert cells(f, "upload.ods") == [
+            ("sheet", "First"),
+            (1, 1, "t", "two\nlines", ""),
+            (4, 1, "n", 2.5, "SUM(A2:B2,Second!A1)"),
+            (1, 2, "b", True, ""), (2, 2, "b", True, ""),
+            (1, 3, "b", True, ""), (2, 3, "b", True, ""),
+            ("sheet", "Second"),
+            (1, 1, "d", 40179.5, "")]
+
+
+class TestCsv:
+    """Test reading CSV"""
+
+    def test_cells(self):
+        f = io.BytesIO('\ufeffname,1.5\n\n"a, b",-2e3,x\n'.encode("utf-8"))
+        assert cells(f, "upload.csv") == [
+            ("sheet", "Sheet1"),
+            (1, 1, "t", "name", ""), (2, 1, "n", 1.5, ""),
+            (1, 3, "t", "a, b", ""), (2, 3, "n", -2000, ""),
+            (3, 3, "t", "x", "")]
+
+    def test_read_upload(self, tmp_path):
+        upload = tmp_path / "upload"
+        upload.write_bytes("caf\u00e9,1\n".encode("utf-8"))
+        path = sheetimport.read_upload(str(tmp_path), str(upload),
+                                       "upload.csv")
+        assert path.startswith(str(tmp_path))
+        with open(path, encoding="utf-8") as f:
+            assert f.read() == sheetimport.read(
+                io.BytesIO(upload.read_bytes()), "upload.csv")
+
+
+class TestWorkbookSave:
+    """Test the workbook JSON written for the client"""
+
+    def test_lines(self):
+        assert [sheetimport.cell_line(*cell) for cell in [
+            (1, 1, "t", "a:b", ""), (2, 1, "n", 1.5, ""),
+            (3, 1, "n", 3, "A1*2"), (1, 2, "d", 40179, ""),
+            (2, 2, "b", False, ""), (3, 2, "e", "#N/A", "NA()"),
+            (4, 2, "t", "x", 'IF(1,"x")')]] == [
+            "cell:A1:t:a\\cb", "cell:B1:v:1.5", "cell:C1:vtf:n:3:A1*2",
+            "cell:A2:vt:nd:40179:ntvf:1", "cell:B2:vt:nl:0",
+            "cell:C2:vtf:e#N/A:0:NA()", 'cell:D2:vtf:t:x:IF(1,"x")']
+
+    def test_sheets(self):
+        items = [("sheet", "One"), (2, 3, "n", 1, ""), ("sheet", ""),
+                 (1, 1, "d", 2, "")]
+        workbook = json.loads("".join(sheetimport.convert(items)))
+        assert (workbook["numsheets"], workbook["currentid"],
+                workbook["currentname"]) == (2, "sheet1", "One")
+        assert workbook["sheetArr"]["sheet1"]["sheetstr"]["savestr"] == \
+            "version:1.5\ncell:B3:v:1\nsheet:c:2:r:3\n"
+        assert workbook["sheetArr"]["sheet2"]["name"] == "Sheet2"
+        sheets = socialcalc.parse_workbook_json(json.dumps(workbook))
+        assert sheets[1][2].valueformats.get(1) == sheetimport.DATE_FORMAT
+
+    def test_empty_and_unknown(self):
+        workbook = json.loads("".join(sheetimport.convert([])))
+        assert workbook["numsheets"] == 1
+        with pytest.raises(sheetimport.UnreadableSheet):
+            sheetimport.reader("upload.pdf")
+        if sheetimport.xlrd is None:
+            with pytest.raises(sheetimport.UnreadableSheet):
+                sheetimport.read(io.BytesIO(b""), "upload.xls")
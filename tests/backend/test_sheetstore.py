@@ -0,0 +1,489 @@
+#!/usr/bin/env python3
+"""
+Sheet Store Tests
+Tests for delta saves into the UserSheetChanges log, their compaction,
+and reads of past versions
+"""
+
+import asyncio
+import sqlite3
+import time
+
+import pytest
+
+import dbpool
+import sheetcodec
+import sheetcommands
+import sheetstore
+import socialcalc
+
+
+class SqliteDB:
+    """The tornado.database calls the store makes, on sqlite"""
+
+    def __init__(self, path=":memory:"):
+        # autocommit, as the MySQL connections are; the store begins its
+        # own transactions
+        self.conn = sqlite3.connect(path, check_same_thread=False,
+                                    isolation_level=None)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS UserSheets (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                fname TEXT NOT NULL,
+                user TEXT NOT NULL,
+                data BLOB,
+                version INTEGER NOT NULL DEFAULT 0,
+                saved INTEGER NOT NULL DEFAULT 0,
+                UNIQUE (user, fname)
+            );
+            CREATE TABLE IF NOT EXISTS UserSheetChanges (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                fname TEXT NOT NULL,
+                user TEXT NOT NULL,
+                version INTEGER NOT NULL,
+                commands BLOB,
+                saved INTEGER NOT NULL DEFAULT 0,
+                UNIQUE (user, fname, version)
+            );
+            CREATE TABLE IF NOT EXISTS UserSheetSnapshots (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                fname TEXT NOT NULL,
+                user TEXT NOT NULL,
+                version INTEGER NOT NULL,
+                data BLOB,
+                saved INTEGER NOT NULL DEFAULT 0,
+                UNIQUE (user, fname, version)
+            );""")
+
+    def query(self, sql, *args):
+        return [dict(row) for row in
+                self.conn.execute(sql.replace("%s", "?"), args)]
+
+    def execute(self, sql, *args):
+        cursor = self.conn.execute(sql.replace("%s", "?"), args)
+        return cursor.lastrowid
+
+    def execute_rowcount(self, sql, *args):
+        cursor = self.conn.execute(sql.replace("%s", "?"), args)
+        return cursor.rowcount
+
+    def changes(self):
+        return [row["version"] for row in
+                self.query("SELECT version FROM UserSheetChanges "
+                           "ORDER BY version")]
+
+    def snapshots(self):
+        return [row["version"] for row in
+                self.query("SELECT version FROM UserSheetSnapshots "
+                           "ORDER BY version")]
+
+    def snapshot(self):
+        row = self.query("SELECT data, version FROM UserSheets")[0]
+        return sheetcodec.decode(row["data"]), row["version"]
+
+
+class SlowDB(SqliteDB):
+    """SqliteDB taking its time over finding the latest version"""
+
+    def query(self, sql, *args):
+        rows = SqliteDB.query(self, sql, *args)
+        if sql.startswith("SELECT MAX(version)"):
+            time.sleep(0.05)
+        return rows
+
+
+def sheet_save(*lines):
+    sheet = socialcalc.parse_sheet_save("version:1.5\n" + "\n".join(lines))
+    return socialcalc.create_spreadsheet_save(sheet, {"edit": "version:1.0\n"})
+
+
+def value(text, coord):
+    sheet, _ = socialcalc.parse_spreadsheet_save(text)
+    return sheet.get_cell(coord).datavalue
+
+
+@pytest.fixture
+def db():
+    return SqliteDB()
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1767225600.0     # 2026-01-01
+
+    def __call__(self):
+        return self.now
+
+
+def make_store(db, **kwargs):
+    pool = dbpool.ConnectionPool(lambda: db, size=1)
+    return sheetstore.SheetStore(pool, dialect="sqlite",
+                                 conflict_errors=(sqlite3.IntegrityError,),
+                                 **kwargs)
+
+
+class TestSaves:
+    """Test full saves, delta saves and reading the current sheet"""
+
+    def test_full_save_then_deltas(self, db):
+        store = make_store(db)
+        text = sheet_save("cell:A1:v:1", "cell:A2:vtf:n:2:A1*2")
+
+        async def main():
+            assert await store.save("demo", "model", text) == 1
+            assert await store.load("demo", "model") == (text, 1)
+            assert await store.append("demo", "model", 1,
+                                      ["set A1 value n 5"]) == 2
+            assert await store.append("demo", "model", 2,
+                                      ["set B1 text t x\nset A1 value n 7"]) == 3
+            return await store.load("demo", "model")
+
+        current, version = asyncio.run(main())
+        assert version == 3
+        assert value(current, "A1") == 7
+        assert value(current, "A2") == 14
+        assert value(current, "B1") == "x"
+        # the snapshot itself is untouched until compaction
+        assert db.snapshot() == (text, 1)
+        assert db.changes() == [2, 3]
+
+    def test_stale_base_refused(self, db):
+        store = make_store(db)
+
+        async def main():
+            await store.save("demo", "model", sheet_save("cell:A1:v:1"))
+            await store.append("demo", "model", 1, ["set A1 value n 2"])
+            with pytest.raises(sheetstore.StaleVersion) as e:
+                await store.append("demo", "model", 1, ["set A1 value n 3"])
+            assert e.value.version == 2
+            with pytest.raises(sheetstore.StaleVersion) as e:
+                await store.append("demo", "missing", 0, ["set A1 value n 3"])
+            assert e.value.version is None
+
+        asyncio.run(main())
+        assert db.changes() == [2]
+
+    def test_unsupported_delta_refused(self, db):
+        store = make_store(db)
+
+        async def main():
+            await store.save("demo", "model", sheet_save("cell:A1:v:1"))
+            with pytest.raises(sheetcommands.UnsupportedCommand):
+                await store.append("demo", "model", 1, ["insertrow A1"])
+
+        asyncio.run(main())
+        assert db.changes() == []
+
+    def test_racing_saves_get_their_own_versions(self, tmp_path):
+        path = str(tmp_path / "sheets.db")
+        one, two = make_store(SlowDB(path)), make_store(SlowDB(path))
+
+        async def main():
+            await one.save("demo", "model", sheet_save("cell:A1:v:1"))
+            return await asyncio.gather(
+                one.append("demo", "model", 1, ["set A1 value n 2"]),
+                two.save("demo", "model", sheet_save("cell:A1:v:3")),
+                return_exceptions=True)
+
+        appended, saved = asyncio.run(main())
+        db = SqliteDB(path)
+        if isinstance(appended, sheetstore.StaleVersion):
+            assert (saved, db.changes()) == (2, [])
+        else:
+            assert sorted([appended, saved]) == [2, 3]
+            assert db.changes() == [appended]
+        assert db.snapshot()[1] == saved
+
+    def test_failed_save_rolls_back(self, db, monkeypatch):
+        store = make_store(db, history_versions=10)
+
+        async def main():
+            await store.save("demo", "model", sheet_save("cell:A1:v:1"))
+
+            def fail(*args):
+                raise ValueError("disk full")
+            monkeypatch.setattr(store, "_prune", fail)
+            with pytest.raises(ValueError):
+                await store.save("demo", "model", sheet_save("cell:A1:v:2"))
+
+        asyncio.run(main())
+        assert db.snapshots() == []
+        assert db.snapshot()[1] == 1
+
+    def test_full_save_keeps_replaced_snapshot(self, db):
+        store = make_store(db)
+        text = sheet_save("cell:A1:v:9")
+
+        async def main():
+            await store.save("demo", "model", sheet_save("cell:A1:v:1"))
+            await store.append("demo", "model", 1, ["set A1 value n 2"])
+            assert await store.save("demo", "model", text) == 3
+            return await store.load("demo", "model")
+
+        assert asyncio.run(main()) == (text, 3)
+        assert db.changes() == [2]
+        assert db.snapshots() == [1]
+
+    def test_current_reads_replay_once(self, db, monkeypatch):
+        store = make_store(db)
+        replayed = []
+        original = sheetcommands.apply_to_save
+
+        def counting(text, cmdstrs):
+            replayed.append(len(cmdstrs))
+            return original(text, cmdstrs)
+
+        monkeypatch.setattr(sheetcommands, "apply_to_save", counting)
+
+        async def main():
+            await store.save("demo", "model", sheet_save("cell:A1:v:1"))
+            for version in range(1, 4):
+                await store.append("demo", "model", version,
+                                   ["set A1 value n %d" % (version + 1)])
+            first = await store.load("demo", "model")
+            assert await store.load("demo", "model") == first
+            await store.append("demo", "model", 4, ["set A1 value n 5"])
+            return await store.load("demo", "model")
+
+        text, version = asyncio.run(main())
+        assert (value(text, "A1"), version) == (5, 5)
+        assert replayed == [3, 1]
+
+    def test_delete(self, db):
+        store = make_store(db)
+
+        async def main():
+            await store.save("demo", "model", sheet_save("cell:A1:v:1"))
+            await store.append("demo", "model", 1, ["set A1 value n 2"])
+            await store.delete("demo", "model")
+            return await store.load("demo", "model")
+
+        assert asyncio.run(main()) is None
+        assert db.changes() == []
+        assert db.snapshots() == []
+
+
+class TestCompaction:
+    """Test folding the log into the snapshot"""
+
+    def test_compacts_after_threshold(self, db):
+        store = make_store(db, compact_after=3)
+
+        async def main():
+            await store.save("demo", "model", sheet_save("cell:A1:v:0"))
+            for version in range(1, 4):
+                await store.append("demo", "model", version,
+                                   ["set A%d value n %d" % (version + 1,
+                                                            version)])
+            while store.compacting:
+                await asyncio.sleep(0.01)
+            return await store.load("demo", "model")
+
+        current, version = asyncio.run(main())
+        assert version == 4
+        assert db.snapshot() == (current, 4)
+        assert db.snapshots() == [1]
+        assert value(current, "A4") == 3
+
+    def test_full_save_during_compaction_wins(self, db):
+        store = make_store(db)
+        text = sheet_save("cell:A1:v:9")
+
+        async def main():
+            await store.save("demo", "model", sheet_save("cell:A1:v:1"))
+            await store.append("demo", "model", 1, ["set A1 value n 2"])
+            found = await store._read("demo", "model")
+            await store.save("demo", "model", text)
+            original = store._read
+
+            async def stale_read(user, fname):
+                return found
+
+            store._read = stale_read
+            await store.compact("demo", "model")
+            store._read = original
+            return await store.load("demo", "model")
+
+        assert asyncio.run(main()) == (text, 3)
+
+    def test_concurrent_compactions_share_one_run(self, db):
+        store = make_store(db)
+
+        async def main():
+            await store.save("demo", "model", sheet_save("cell:A1:v:1"))
+            await store.append("demo", "model", 1, ["set A1 value n 2"])
+            await asyncio.gather(*[store.compact("demo", "model")
+                                   for _ in range(5)])
+
+        asyncio.run(main())
+        assert db.snapshots() == [1]
+        assert db.snapshot()[1] == 2
+
+
+class TestWriteVolume:
+    """Test the bytes an autosave writes for a one-cell edit"""
+
+    def test_delta_is_small_next_to_full_save(self, db):
+        store = make_store(db)
+        lines = ["cell:%s:v:%d" % (socialcalc.cr_to_coord(col, row), row * col)
+                 for row in range(1, 501) for col in range(1, 11)]
+        text = sheet_save(*lines)
+
+        async def main():
+            await store.save("demo", "model", text)
+            await store.append("demo", "model", 1, ["set C7 value n 99"])
+
+        asyncio.run(main())
+        full = len(db.query("SELECT data FROM UserSheets")[0]["data"])
+        delta = len(db.query("SELECT commands FROM UserSheetChanges")[0]
+                    ["commands"])
+        assert delta * 100 < full
+
+
+class TestHistory:
+    """Test reading past versions and pruning old ones"""
+
+    def edit(self, version):
+        return ["set A1 value n %d" % (version * 10)]
+
+    def test_every_version_readable(self, db):
+        store = make_store(db, compact_after=4)
+        texts = {1: sheet_save("cell:A1:v:10")}
+
+        async def main():
+            await store.save("demo", "model", texts[1])
+            for version in range(1, 11):
+                await store.append("demo", "model", version,
+                                   self.edit(version + 1))
+                while store.compacting:
+                    await asyncio.sleep(0.01)
+            texts[12] = sheet_save("cell:A1:v:120")
+            await store.save("demo", "model", texts[12])
+            return [await store.load_version("demo", "model", version)
+                    for version in range(1, 13)]
+
+        results = asyncio.run(main())
+        assert [value(text, "A1") for text in results] == \
+            [version * 10 for version in range(1, 13)]
+        assert results[0] == texts[1] and results[11] == texts[12]
+        # a snapshot every compact_after changes, and the replaced one
+        # at each full save
+        assert db.snapshots() == [1, 5, 9]
+
+    def test_replay_bounded_by_compaction(self, db, monkeypatch):
+        store = make_store(db, compact_after=5)
+        replayed = []
+        original = sheetcommands.apply_to_save
+
+        def counting(text, cmdstrs):
+            replayed.append(len(cmdstrs))
+            return original(text, cmdstrs)
+
+        async def main():
+            await store.save("demo", "model", sheet_save("cell:A1:v:10"))
+            for version in range(1, 41):
+                await store.append("demo", "model", version,
+                                   self.edit(version + 1))
+                while store.compacting:
+                    await asyncio.sleep(0.01)
+            monkeypatch.setattr(sheetcommands, "apply_to_save", counting)
+            for version in range(1, 42):
+                text = await store.load_version("demo", "model", version)
+                assert value(text, "A1") == version * 10
+
+        asyncio.run(main())
+        assert 0 < max(replayed) <= 5
+
+    def test_unknown_versions(self, db):
+        store = make_store(db)
+
+        async def main():
+            await store.save("demo", "model", sheet_save("cell:A1:v:1"))
+            await store.append("demo", "model", 1, self.edit(2))
+            return (await store.load_version("demo", "model", 0),
+                    await store.load_version("demo", "model", 3),
+                    await store.load_version("demo", "other", 1))
+
+        assert asyncio.run(main()) == (None, None, None)
+
+    def test_history_lists_versions(self, db):
+        clock = FakeClock()
+        store = make_store(db, compact_after=2, clock=clock)
+
+        async def main():
+            await store.save("demo", "model", sheet_save("cell:A1:v:1"))
+            for version in range(1, 4):
+                clock.now += 60
+                await store.append("demo", "model", version,
+                                   self.edit(version + 1))
+                while store.compacting:
+                    await asyncio.sleep(0.01)
+            return await store.history("demo", "model")
+
+        history = asyncio.run(main())
+        start = int(FakeClock()())
+        assert [version for version, _ in history] == [1, 2, 3, 4]
+        assert history[0] == (1, start) and history[1] == (2, start + 60)
+
+    def test_prune_by_version_count(self, db):
+        store = make_store(db, compact_after=3, history_versions=5)
+
+        async def main():
+            await store.save("demo", "model", sheet_save("cell:A1:v:10"))
+            for version in range(1, 20):
+                await store.append("demo", "model", version,
+                                   self.edit(version + 1))
+                while store.compacting:
+                    await asyncio.sleep(0.01)
+            return [await store.load_version("demo", "model", version)
+                    for version in range(1, 21)]
+
+        results = asyncio.run(main())
+        kept = [version for version, text in enumerate(results, 1) if text]
+        # the last five, plus the rest of the stretch they replay from
+        assert kept[-5:] == [16, 17, 18, 19, 20]
+        assert 13 <= kept[0] <= 16
+        assert kept == list(range(kept[0], 21))
+
+    def test_prune_by_age(self, db):
+        clock = FakeClock()
+        store = make_store(db, compact_after=2, history_age=3600,
+                           clock=clock)
+
+        async def main():
+            await store.save("demo", "model", sheet_save("cell:A1:v:10"))
+            for version in range(1, 9):
+                clock.now += 1000
+                await store.append("demo", "model", version,
+                                   self.edit(version + 1))
+                while store.compacting:
+                    await asyncio.sleep(0.01)
+            return [await store.load_version("demo", "model", version)
+                    for version in range(1, 10)]
+
+        results = asyncio.run(main())
+        kept = [version for version, text in enumerate(results, 1) if text]
+        # saved within the hour: versions 7, 8 and 9
+        assert kept[-3:] == [7, 8, 9]
+        assert 5 <= kept[0] <= 7
+
+    def test_current_read_ignores_history(self, db):
+        store = make_store(db, compact_after=10)
+
+        async def main():
+            await store.save("demo", "model", sheet_save("cell:A1:v:10"))
+            for version in range(1, 200):
+                await store.append("demo", "model", version,
+                                   self.edit(version + 1))
+                while store.compacting:
+                    await asyncio.sleep(0.01)
+            return await store.load("demo", "model")
+
+        text, version = asyncio.run(main())
+        assert version == 200 and value(text, "A1") == 2000
+        plan = " ".join(row["detail"] for row in db.query(
+            "EXPLAIN QUERY PLAN SELECT version, commands "
+            "FROM UserSheetChanges WHERE user = %s AND fname = %s "
+            "AND version > %s ORDER BY version", "demo", "model", 191))
+        assert "SCAN" not in plan
@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+"""
+SocialCalc Save Format Tests
+Tests for parsing and writing the spreadsheet control save format
+"""
+
+import time
+
+import pytest
+
+import socialcalc
+
+
+SHEET_SAVE = """version:1.5
+cell:A1:t:Revenue:f:1
+cell:B1:v:1000000:ntvf:1
+cell:A2:t:Expenses
+cell:B2:v:750000.5
+cell:A3:t:Profit\\cnet:c:1:bg:2
+cell:B3:vtf:n:249999.5:B1-B2:b:1:0:1:0
+cell:C3:vtc:t:AAPL:"AAPL":e:none
+cell:D4:vt:nd:40179:comment:line1\\nline2
+col:A:w:120
+col:C:hide:yes
+row:3:h:30
+sheet:c:4:r:4:recalc:off
+border:1:1px solid rgb(0,0,0)
+cellformat:1:right
+color:1:rgb(255,0,0)
+color:2:rgb(0,0,255)
+font:1:normal bold * *
+layout:1:padding:2px 2px 1px 2px;vertical-align:top;
+valueformat:1:#,##0.00
+name:TOTAL:Net profit:B3
+"""
+
+SPREADSHEET_SAVE = """
+socialcalc:version:1.0
+MIME-Version: 1.0
+Content-Type: multipart/mixed; boundary=SocialCalcSpreadsheetControlSave
+--SocialCalcSpreadsheetControlSave
+Content-type: text/plain; charset=UTF-8
+
+# SocialCalc Spreadsheet Control Save
+version:1.0
+part:sheet
+part:edit
+--SocialCalcSpreadsheetControlSave
+Content-type: text/plain; charset=UTF-8
+
+version:1.5
+
+cell:A1:t:Hello
+cell:B1:v:42
+--SocialCalcSpreadsheetControlSave
+Content-type: text/plain; charset=UTF-8
+
+version:1.0
+rowpane:0:1:14
+--SocialCalcSpreadsheetControlSave--
+
+"""
+
+
+class TestSheetSave:
+    """Test parsing of the version:1.5 sheet save"""
+
+    def setup_method(self):
+        self.sheet = socialcalc.parse_sheet_save(SHEET_SAVE)
+
+    def test_cell_values(self):
+        """Test values, types and formulas of parsed cells"""
+        cells = self.sheet.cells
+        assert cells["A1"].datavalue == "Revenue"
+        assert cells["A1"].datatype == "t"
+        assert cells["B1"].datavalue == 1000000
+        assert cells["B1"].valuetype == "n"
+        assert cells["B2"].datavalue == 750000.5
+        assert cells["B3"].datatype == "f"
+        assert cells["B3"].formula == "B1-B2"
+        assert cells["C3"].datatype == "c"
+        assert cells["C3"].errors == "none"
+        assert cells["D4"].datatype == "v"
+        assert cells["D4"].valuetype == "nd"
+
+    def test_escaped_text(self):
+        """Test that \\c, \\n and \\b escapes are decoded"""
+        assert self.sheet.cells["A3"].datavalue == "Profit:net"
+        assert self.sheet.cells["D4"].comment == "line1\nline2"
+
+    def test_cell_attributes(self):
+        """Test style references on cells"""
+        a3 = self.sheet.cells["A3"]
+        assert (a3.color, a3.bgcolor) == (1, 2)
+        b3 = self.sheet.cells["B3"]
+        assert (b3.bt, b3.br, b3.bb, b3.bl) == (1, 0, 1, 0)
+        assert self.sheet.cells["B1"].nontextvalueformat == 1
+
+    def test_style_tables(self):
+        """Test border, font, color, layout and format tables"""
+        sheet = self.sheet
+        assert sheet.borderstyles.get(1) == "1px solid rgb(0,0,0)"
+        assert sheet.colors.get(2) == "rgb(0,0,255)"
+        assert sheet.colors.index["rgb(255,0,0)"] == 1
+        assert sheet.fonts.get(1) == "normal bold * *"
+        assert sheet.layouts.get(1) == \
+            "padding:2px 2px 1px 2px;vertical-align:top;"
+        assert sheet.cellformats.get(1) == "right"
+        assert sheet.valueformats.get(1) == "#,##0.00"
+
+    def test_sheet_row_col_attributes(self):
+        """Test sheet, col, row and name lines"""
+        sheet = self.sheet
+        assert sheet.attribs["lastcol"] == 4
+        assert sheet.attribs["lastrow"] == 4
+        assert sheet.attribs["recalc"] == "off"
+        assert sheet.colattribs["width"]["A"] == "120"
+        assert sheet.colattribs["hide"]["C"] == "yes"
+        assert sheet.rowattribs["height"][3] == 30
+        assert sheet.names["TOTAL"] == {"desc": "Net profit",
+                                        "definition": "B3"}
+
+    def test_round_trip(self):
+        """Test that writing and re-reading a sheet loses nothing"""
+        text = socialcalc.create_sheet_save(self.sheet)
+        again = socialcalc.parse_sheet_save(text)
+        assert self.sheet.diff(again) == []
+        assert socialcalc.create_sheet_save(again) == text
+
+    def test_diff(self):
+        """Test diffing two sheets by cell"""
+        other = socialcalc.parse_sheet_save(SHEET_SAVE)
+        other.cells["B2"].datavalue = 1
+        other.get_assured_cell("E9").datavalue = "new"
+        other.cells["E9"].datatype = "t"
+        other.cells["E9"].valuetype = "t"
+        assert self.sheet.diff(other) == ["B2", "E9"]
+
+    def test_unknown_line_type(self):
+        """Test that unknown line types are rejected with a line number"""
+        with pytest.raises(socialcalc.SaveParseError, match="line 2"):
+            socialcalc.parse_sheet_save("version:1.5\nbogus:1\n")
+
+    def test_unknown_cell_item(self):
+        """Test that unknown cell items are rejected"""
+        with pytest.raises(socialcalc.SaveParseError):
+            socialcalc.parse_sheet_save("cell:A1:zz:1\n")
+
+    def test_streamed_lines(self):
+        """Test parsing from an iterable of lines instead of a string"""
+        lines = iter(SHEET_SAVE.splitlines(True))
+        sheet = socialcalc.parse_sheet_save(lines)
+        assert len(sheet) == len(self.sheet)
+
+
+class TestSpreadsheetSave:
+    """Test the multipart spreadsheet control save"""
+
+    def test_parts(self):
+        """Test splitting the save into sheet and other parts"""
+        sheet, parts = socialcalc.parse_spreadsheet_save(SPREADSHEET_SAVE)
+        assert sheet.cells["A1"].datavalue == "Hello"
+        assert sheet.cells["B1"].datavalue == 42
+        assert list(parts) == ["edit"]
+        assert "rowpane:0:1:14" in parts["edit"]
+
+    def test_bare_sheet_save(self):
+        """Test that input without a MIME header is read as a sheet save"""
+        sheet, parts = socialcalc.parse_spreadsheet_save(SHEET_SAVE)
+        assert len(sheet) == 8
+        assert parts == {}
+
+    def test_round_trip(self):
+        """Test writing and re-reading the multipart envelope"""
+        sheet, parts = socialcalc.parse_spreadsheet_save(SPREADSHEET_SAVE)
+        text = socialcalc.create_spreadsheet_save(sheet, parts)
+        again, again_parts = socialcalc.parse_spreadsheet_save(text)
+        assert sheet.diff(again) == []
+        assert again_parts == parts
+
+    def test_workbook_json(self):
+        """Test the multi-sheet workbook JSON wrapper"""
+        import json
+        workbook = json.dumps({
+            "numsheets": 2, "currentid": "sheet1", "currentname": "one",
+            "sheetArr": {
+                "sheet1": {"sheetstr": {"savestr": SHEET_SAVE}, "name": "one"},
+                "sheet2": {"sheetstr": {"savestr": SPREADSHEET_SAVE},
+                           "name": "two"}}})
+        sheets = socialcalc.parse_workbook_json(workbook)
+        assert [(i, n, len(s)) for i, n, s in sheets] == \
+            [("sheet1", "one", 8), ("sheet2", "two", 2)]
+
+
+class TestCellStyles:
+    """Test the shared per-cell style records"""
+
+    def test_cells_share_styles(self):
+        """Test that cells with the same attributes share one style"""
+        sheet = socialcalc.parse_sheet_save(
+            "cell:A1:v:1:f:1:c:2\ncell:A2:v:2:c:2:f:1\ncell:A3:v:3\n")
+        a1, a2, a3 = (sheet.cells[c] for c in ("A1", "A2", "A3"))
+        assert a1.style is a2.style
+        assert a3.style is socialcalc.DEFAULT_STYLE
+
+    def test_set_attribute(self):
+        """Test that changing one cell's attribute leaves the others alone"""
+        sheet = socialcalc.parse_sheet_save("cell:A1:v:1:f:1\ncell:A2:v:2:f:1\n")
+        a1, a2 = sheet.cells["A1"], sheet.cells["A2"]
+        a1.color = 3
+        assert (a1.font, a1.color) == (1, 3)
+        assert (a2.font, a2.color) == (1, 0)
+        a1.color = 0
+        assert a1.style is a2.style
+
+    def test_cell_memory(self):
+        """Test that a parsed cell costs a few hundred bytes at most"""
+        import gc
+        import tracemalloc
+        text = "\n".join("cell:%s%d:v:%d.5:f:1" % (col, row, row)
+                         for row in range(1, 5001) for col in "ABCDEFGHIJ")
+        gc.collect()
+        tracemalloc.start()
+        sheet = socialcalc.parse_sheet_save(text)
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        assert len(sheet) == 50000
+        assert size / len(sheet) < 300
+
+
+class TestCoordinates:
+    """Test coordinate helpers"""
+
+    def test_coord_to_cr(self):
+        assert socialcalc.coord_to_cr("A1") == (1, 1)
+        assert socialcalc.coord_to_cr("$AB$12") == (28, 12)
+
+    def test_cr_to_coord(self):
+        assert socialcalc.cr_to_coord(28, 12) == "AB12"
+        assert socialcalc.cr_to_coord(702, 1) == "ZZ1"
+
+
+class TestParsePerformance:
+    """Test parse speed on a large sheet"""
+
+    def test_parse_100k_cells(self):
+        """Test that a 100k-cell save parses in well under a second"""
+        lines = ["version:1.5"]
+        for row in range(1, 10001):
+            lines.append("cell:A%d:t:Item %d" % (row, row))
+            for col in "BCDEFGHI":
+                lines.append("cell:%s%d:v:%d.5" % (col, row, row))
+            lines.append("cell:J%d:vtf:n:0:SUM(B%d\\cI%d)" % (row, row, row))
+        text = "\n".join(lines)
+
+        start = time.time()
+        sheet = socialcalc.parse_sheet_save(text)
+        elapsed = time.time() - start
+
+        assert len(sheet) == 100000
+        assert elapsed < 1.0
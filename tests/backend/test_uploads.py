@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Upload Tests
+Tests for parsing multipart uploads onto disk a chunk at a time
+"""
+
+import os
+
+import pytest
+
+import uploads
+
+CONTENT_TYPE = "multipart/form-data; boundary=----b0undary"
+
+BODY = (b"preamble\r\n"
+        b"------b0undary\r\n"
+        b'Content-Disposition: form-data; name="note"\r\n\r\n'
+        b"caf\xc3\xa9\r\n"
+        b"------b0undary\r\n"
+        b'Content-Disposition: form-data; name="upload"; '
+        b'filename="C:\\\\models\\\\model.xlsx"\r\n'
+        b"Content-Type: application/vnd.ms-excel\r\n\r\n"
+        b"PK\x03\x04\r\n------b0undar\r\n--\x00"
+        b"\r\n------b0undary--\r\n"
+        b"epilogue")
+
+
+def parse(body, chunk_size, directory, **kwargs):
+    parser = uploads.MultipartParser(CONTENT_TYPE, directory, **kwargs)
+    for at in range(0, len(body), chunk_size):
+        parser.feed(body[at:at + chunk_size])
+    parser.close()
+    return parser
+
+
+class TestParser:
+    """Test splitting the body into fields and files"""
+
+    @pytest.mark.parametrize("chunk_size", [1, 2, 7, 16, 64 * 1024])
+    def test_fields_and_files(self, tmp_path, chunk_size):
+        parser = parse(BODY, chunk_size, str(tmp_path))
+        assert parser.fields == {"note": ["caf\u00e9"]}
+        [upload] = parser.files["upload"]
+        assert upload.filename == "model.xlsx"
+        assert upload.content_type == "application/vnd.ms-excel"
+        with open(upload.path, "rb") as f:
+            assert f.read() == b"PK\x03\x04\r\n------b0undar\r\n--\x00"
+        assert upload.size == 24
+        assert os.path.dirname(upload.path) == parser.directory
+        parser.cleanup()
+        parser.cleanup()
+        assert os.listdir(str(tmp_path)) == []
+
+    def test_quoted_boundary(self, tmp_path):
+        parser = uploads.MultipartParser(
+            'multipart/form-data; boundary="----b0undary"', str(tmp_path))
+        parser.feed(BODY)
+        parser.close()
+        assert "upload" in parser.files
+
+    def test_too_large(self, tmp_path):
+        with pytest.raises(uploads.UploadTooLarge) as raised:
+            parse(BODY, 16, str(tmp_path), max_bytes=100)
+        assert raised.value.max_bytes == 100
+
+    def test_field_too_long(self, tmp_path):
+        with pytest.raises(uploads.MultipartError):
+            parse(BODY, 16, str(tmp_path), max_field_bytes=3)
+
+
+class TestMalformed:
+    """Test bodies that are not multipart/form-data"""
+
+    def test_content_type(self):
+        for content_type in ("text/plain", "multipart/form-data",
+                             "application/x-www-form-urlencoded"):
+            with pytest.raises(uploads.MultipartError):
+                uploads.MultipartParser(content_type)
+
+    def test_truncated(self, tmp_path):
+        with pytest.raises(uploads.MultipartError):
+            parse(BODY[:-30], 16, str(tmp_path))
+
+    def test_bad_parts(self, tmp_path):
+        for body in (b"------b0undary\r\nno colon\r\n\r\n",
+                     b"------b0undary\r\nContent-Disposition: inline\r\n\r\n",
+                     b"------b0undary!!"):
+            parser = uploads.MultipartParser(CONTENT_TYPE, str(tmp_path))
+            with pytest.raises(uploads.MultipartError):
+                parser.feed(body)
+            parser.cleanup()
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+Multipart uploads spooled to disk as they arrive
+
+Tornado used to buffer a whole upload in memory, then split it into
+request.files with every file's body a bytes copy of its part, so a
+100 MB workbook cost several times that before the import even began.
+MultipartParser takes the multipart/form-data body a chunk at a time,
+as a stream_request_body handler receives it.  File parts are written
+straight to files in a scratch directory and small fields are kept as
+text; memory stays at about one chunk whatever the upload's size:
+
+    parser = MultipartParser(content_type, directory, max_bytes=...)
+    parser.feed(chunk)      # for each chunk of the body
+    parser.close()
+    parser.files["upload"][0].path
+
+A body over max_bytes raises UploadTooLarge as soon as it gets there,
+so an oversized upload is turned away without being stored.
+"""
+
+import email.message
+import os
+import shutil
+import tempfile
+
+
+class MultipartError(ValueError):
+    """The body is not well-formed multipart/form-data"""
+
+
+class UploadTooLarge(ValueError):
+    def __init__(self, max_bytes):
+        ValueError.__init__(self, "upload larger than %d bytes" % max_bytes)
+        self.max_bytes = max_bytes
+
+
+class Upload:
+    """A file part, stored at path"""
+
+    def __init__(self, name, filename, content_type, path):
+        self.name = name
+        self.filename = filename
+        self.content_type = content_type
+        self.path = path
+        self.size = 0
+
+
+def _header_params(name, value):
+    message = email.message.Message()
+    message[name] = value
+    return message
+
+
+def boundary(content_type):
+    """The boundary of a multipart/form-data Content-Type"""
+    message = _header_params("Content-Type", content_type)
+    value = message.get_param("boundary")
+    if message.get_content_type() != "multipart/form-data" or not value:
+        raise MultipartError("not multipart/form-data: %r" % content_type)
+    return value.encode("latin-1")
+
+
+class MultipartParser:
+    """
+    Parses a multipart/form-data body fed to it in chunks, writing file
+    parts under directory (a new temporary directory by default) and
+    keeping fields of up to max_field_bytes in fields
+    """
+
+    MAX_HEADER_BYTES = 16 * 1024
+
+    def __init__(self, content_type, directory=None, max_bytes=None,
+                 max_field_bytes=64 * 1024):
+        self.delimiter = b"\r\n--" + boundary(content_type)
+        self.directory = tempfile.mkdtemp(prefix="upload-", dir=directory)
+        self.max_bytes = max_bytes
+        self.max_field_bytes = max_field_bytes
+        self.fields = {}        # name -> [text]
+        self.files = {}         # name -> [Upload]
+        self.received = 0
+        # the body starts with the delimiter less its leading CRLF
+        self.buffer = bytearray(b"\r\n")
+        self.state = "preamble"
+        self.part = None        # the Upload or field being read
+        self.sink = None        # its open file or bytearray
+
+    def feed(self, chunk):
+        self.received += len(chunk)
+        if self.max_bytes is not None and self.received > self.max_bytes:
+            raise UploadTooLarge(self.max_bytes)
+        self.buffer += chunk
+        while self._step():
+            pass
+
+    def _step(self):
+        """Parses what it can of the buffer; False when it needs more"""
+        buffer = self.buffer
+        if self.state == "preamble":
+            at = buffer.find(self.delimiter)
+            if at < 0:
+                # keep what could be the start of the delimiter
+                del buffer[:max(len(buffer) - len(self.delimiter), 0)]
+                return False
+            del buffer[:at + len(self.delimiter)]
+            self.state = "delimited"
+        elif self.state == "delimited":
+            if len(buffer) < 2:
+                return False
+            if buffer[:2] == b"--":
+                self.state = "done"
+            elif buffer[:2] == b"\r\n":
+                self.state = "headers"
+            else:
+                raise MultipartError("bad delimiter line")
+            del buffer[:2]
+        elif self.state == "headers":
+            at = buffer.find(b"\r\n\r\n")
+            if at < 0:
+                if len(buffer) > self.MAX_HEADER_BYTES:
+                    raise MultipartError("part headers too long")
+                return False
+            self._start_part(bytes(buffer[:at]))
+            del buffer[:at + 4]
+            self.state = "body"
+        elif self.state == "body":
+            at = buffer.find(self.delimiter)
+            end = at if at >= 0 else len(buffer) - len(self.delimiter) + 1
+            if end > 0:
+                self._write(buffer[:end])
+                del buffer[:end]
+            if at < 0:
+                return False
+            del buffer[:len(self.delimiter)]
+            self._end_part()
+            self.state = "delimited"
+        else:
+            # the epilogue after the last part is ignored
+            del buffer[:]
+            return False
+        return True
+
+    def _start_part(self, data):
+        headers = {}
+        for line in data.decode("utf-8", "replace").split("\r\n"):
+            name, colon, value = line.partition(":")
+            if not colon:
+                raise MultipartError("bad part header %r" % line)
+            headers[name.strip().lower()] = value.strip()
+        disposition = _header_params(
+            "Content-Disposition", headers.get("content-disposition", ""))
+        name = disposition.get_param("name", header="content-disposition")
+        if name is None or \
+                disposition.get_content_disposition() != "form-data":
+            raise MultipartError("part is not form-data")
+        filename = disposition.get_filename()
+        if filename is None:
+            self.part, self.sink = name, bytearray()
+            return
+        fd, path = tempfile.mkstemp(dir=self.directory)
+        # old browsers send the whole path, Windows ones with backslashes
+        filename = filename.replace("\\", "/").rpartition("/")[2]
+        self.part = Upload(name, filename,
+                           headers.get("content-type",
+                                       "application/octet-stream"), path)
+        self.sink = os.fdopen(fd, "wb")
+
+    def _write(self, data):
+        if isinstance(self.part, Upload):
+            self.sink.write(data)
+            self.part.size += len(data)
+            return
+        self.sink += data
+        if len(self.sink) > self.max_field_bytes:
+            raise MultipartError("field %s too long" % self.part)
+
+    def _end_part(self):
+        if isinstance(self.part, Upload):
+            self.sink.close()
+            self.files.setdefault(self.part.name, []).append(self.part)
+        else:
+            self.fields.setdefault(self.part, []).append(
+                self.sink.decode("utf-8", "replace"))
+        self.part = self.sink = None
+
+    def close(self):
+        """Checks the body ended with the closing delimiter"""
+        if self.state != "done":
+            raise MultipartError("body ended early")
+
+    def cleanup(self):
+        """Removes the stored files; safe to call more than once"""
+        if isinstance(self.part, Upload):
+            self.sink.close()
+        self.part = self.sink = None
+        shutil.rmtree(self.directory, ignore_errors=True)